@@ -9,10 +9,18 @@ from .core.simulation_modules.volume_creation_module.volume_creation_module_mode
     ModelBasedVolumeCreationAdapter
 from .core.simulation_modules.volume_creation_module.volume_creation_module_segmentation_based_adapter import \
     SegmentationBasedVolumeCreationAdapter
+from .core.simulation_modules.volume_creation_module.phantom_sampler import PhantomSampler, \
+    StructureDistribution, UniformDistribution, UniformIntegerDistribution, NormalDistribution, ChoiceDistribution
 from .core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_adapter import \
     MCXAdapter
 from .core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_reflectance_adapter import \
     MCXAdapterReflectance
+from .core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter import \
+    MonteCarloAdapter
+from .core.simulation_modules.optical_simulation_module.optical_forward_model_diffusion_adapter import \
+    DiffusionFluenceAdapter
+from .core.simulation_modules.optical_simulation_module.optical_forward_model_layered_adapter import \
+    LayeredDiffusionAdapter
 from .core.simulation_modules.acoustic_forward_module.acoustic_forward_module_k_wave_adapter import \
     KWaveAdapter
 from .core.simulation_modules.reconstruction_module.reconstruction_module_delay_and_sum_adapter import \
@@ -40,6 +48,7 @@ from simpa.core.processing_components.monospectral.noise import SaltAndPepperNoi
 from simpa.core.processing_components.monospectral.noise import UniformNoise
 from simpa.core.processing_components.monospectral.field_of_view_cropping import FieldOfViewCropping
 from simpa.core.processing_components.monospectral.iterative_qPAI_algorithm import IterativeqPAI
+from simpa.core.processing_components.monospectral.gradient_based_qPAI_algorithm import GradientBasedqPAI
 from simpa.core.processing_components.multispectral.linear_unmixing import LinearUnmixing
 
 from .core.device_digital_twins import *
@@ -4,7 +4,9 @@
 
 from simpa.utils import Tags, Settings
 from simpa.utils.tissue_properties import TissueProperties
-from simpa.io_handling import load_data_field, save_data_field
+from simpa.io_handling import load_data_field, save_data_field, delete_data_field
+from simpa.io_handling.io_hdf5 import contains_hdf5_path
+from simpa.utils.dict_path_manager import generate_dict_path
 from simpa.core.processing_components import ProcessingComponent
 from simpa.core.device_digital_twins import DigitalDeviceTwinBase, PhotoacousticDevice
 import numpy as np
@@ -59,7 +61,29 @@ class FieldOfViewCropping(ProcessingComponent):
 
         wavelength = self.global_settings[Tags.WAVELENGTH]
 
+        # the optical output may only have been stored within a region of the volume that contains the field of view
+        optical_output_offset = None
+        if contains_hdf5_path(self.global_settings[Tags.SIMPA_OUTPUT_PATH],
+                              generate_dict_path(Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, wavelength)):
+            optical_output_offset = load_data_field(self.global_settings[Tags.SIMPA_OUTPUT_PATH],
+                                                    Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, wavelength)
+            optical_output_fields = [Tags.DATA_FIELD_FLUENCE, Tags.DATA_FIELD_INITIAL_PRESSURE]
+            if any(data_field in data_fields for data_field in optical_output_fields):
+                # the offset is shared by the optical outputs, such that they have to be cropped together
+                data_fields = data_fields + [data_field for data_field in optical_output_fields
+                                             if data_field not in data_fields]
+        cropped_optical_output = False
+        full_field_of_view_voxels = field_of_view_voxels
+
         for data_field in data_fields:
+            field_of_view_voxels = full_field_of_view_voxels
+            is_stored_at_offset = optical_output_offset is not None and data_field in [Tags.DATA_FIELD_FLUENCE,
+                                                                                       Tags.DATA_FIELD_INITIAL_PRESSURE]
+            if is_stored_at_offset:
+                field_of_view_voxels = np.maximum(field_of_view_voxels - np.repeat(optical_output_offset, 2), 0)
+                # also if it was already stored with the shape of the field of view and is thus skipped below
+                cropped_optical_output = True
+
             # Crop wavelength-independent properties only in the last wavelength run
             if (data_field in TissueProperties.wavelength_independent_properties
                     and wavelength != self.global_settings[Tags.WAVELENGTHS][-1]):
@@ -101,4 +125,9 @@ class FieldOfViewCropping(ProcessingComponent):
             # save
             save_data_field(data_array, self.global_settings[Tags.SIMPA_OUTPUT_PATH], data_field, wavelength)
 
+        if cropped_optical_output:
+            # the cropped optical output now shares the field of view with the other cropped data fields
+            delete_data_field(self.global_settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET,
+                              wavelength)
+
         self.logger.info("Cropping field of view...[Done]")
@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import time
+from typing import Tuple
+
+import numpy as np
+from scipy.optimize import minimize, Bounds
+
+from simpa.utils import Tags
+from simpa.utils.libraries.literature_values import StandardProperties
+from simpa.utils.calculate import calculate_gruneisen_parameter_from_temperature
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter import \
+    MonteCarloAdapter
+from simpa.core.processing_components.monospectral.iterative_qPAI_algorithm import IterativeqPAI
+
+
+class GradientBasedqPAI(IterativeqPAI):
+    """
+    Reconstructs the absorption from the initial pressure like `IterativeqPAI`, but instead of the fixed-point update
+    the squared error between the measured and the simulated initial pressure is minimised with the quasi-Newton
+    method L-BFGS-B [1] under the constraint of a non-negative absorption. The gradient of the error is computed by
+    the `MonteCarloAdapter` from the same photon paths as the fluence by perturbation Monte Carlo, such that every
+    iteration takes about one evaluation of the error and its gradient. The photons are simulated with a fixed seed,
+    so that the simulated initial pressure is a smooth function of the absorption.
+    The optimisation starts from the result of one fixed-point update of `IterativeqPAI`. The result is saved in the
+    same way as by `IterativeqPAI`.
+    Parameters:
+    Tags.DOWNSCALE_FACTOR (default: 0.73)
+    Tags.ITERATIVE_RECONSTRUCTION_CONSTANT_REGULARIZATION (default: False)
+    Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER (default: 10)
+    Tags.ITERATIVE_RECONSTRUCTION_REGULARIZATION_SIGMA (default: 0.01)
+    Tags.ITERATIVE_RECONSTRUCTION_SAVE_INTERMEDIATE_RESULTS (default: False)
+    Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL (default: 0.001), the decrease of the error within one iteration
+    relative to the error of the initial guess below which the optimisation stops
+    global_settings (required)
+    component_settings_key (required)
+
+    [1] R. H. Byrd et al. 1995, "A Limited Memory Algorithm for Bound Constrained Optimization",
+    https://doi.org/10.1137/0916069
+    """
+
+    def iterative_absorption_reconstruction(self, pa_device) -> Tuple[np.ndarray, list]:
+        """
+        Performs quantitative photoacoustic image reconstruction of absorption distribution by minimising the squared
+        error of the initial pressure with L-BFGS-B. The distribution of scattering coefficients must be known a
+        priori.
+
+        :return: Reconstructed absorption coefficients in 1/cm.
+        :raises: TypeError: if input data are not passed as a certain type
+                 ValueError: if input data cannot be used for reconstruction due to shape or value
+                 AssertionError: is Tags.MAX_NUMBER_ITERATIVE_RECONSTRUCTION tag is zero
+        """
+
+        target_intial_pressure, scattering, anisotropy, stacked_to_volume = self.get_reconstruction_inputs()
+        shape = np.shape(target_intial_pressure)
+        y_pos = int(shape[1] / 2)  # to extract middle slice
+        nmax = self.get_maximum_number_of_iterations()
+        pressure_factor = self.get_pressure_factor(shape)
+
+        optical_model = MonteCarloAdapter(self.global_settings)
+        illumination_geometries = pa_device.get_illumination_geometry()
+        if not isinstance(illumination_geometries, list):
+            illumination_geometries = [illumination_geometries]
+        # the photons have to be the same for all evaluations
+        random_seed = optical_model.get_random_seed()
+
+        def simulate_fluence(absorption: np.ndarray, adjoint: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+            fluence, _, fluence_gradient = optical_model.forward_model_absorption_derivatives(
+                absorption, scattering, anisotropy, illumination_geometries, adjoint=adjoint, random_seed=random_seed)
+            return fluence, fluence_gradient
+
+        # initial guess
+        sigma = self.regularization_sigma(target_intial_pressure, stacked_to_volume)
+        fluence, _ = simulate_fluence(1e-16 * np.ones(shape))
+        absorption = self.update_absorption_estimate(target_intial_pressure, fluence, sigma)
+        # the optimisation variable is the absorption times the regularised fluence of the initial guess, whose
+        # initial pressure depends on it with a slope of about one everywhere, which is a diagonal preconditioner
+        fluence, _ = simulate_fluence(absorption)
+        variable_scale = np.asarray(pressure_factor * (fluence + sigma), dtype=np.float64) * np.ones(shape)
+        error_normalisation = max(np.sum(np.square(pressure_factor * absorption * fluence - target_intial_pressure)),
+                                  1e-30)
+
+        def squared_error_and_gradient(variable: np.ndarray) -> Tuple[float, np.ndarray]:
+            absorption = variable.reshape(shape) / variable_scale
+            fluence, _ = simulate_fluence(absorption)
+            residual = pressure_factor * absorption * fluence - target_intial_pressure
+            # the derivative of the error with respect to the fluence is the adjoint of the gradient of the fluence
+            _, fluence_gradient = simulate_fluence(absorption, adjoint=residual * pressure_factor * absorption)
+            gradient = (residual * pressure_factor * fluence + fluence_gradient) / variable_scale
+            return 0.5 * np.sum(np.square(residual)) / error_normalisation, np.ravel(gradient) / error_normalisation
+
+        list_of_intermediate_absorptions = [absorption[:, y_pos, :]]
+
+        def store_intermediate_absorption(variable: np.ndarray):
+            # only store middle slice (2-d image instead of 3-d volume) in iteration list for better performance
+            list_of_intermediate_absorptions.append((variable.reshape(shape) / variable_scale)[:, y_pos, :])
+
+        # run algorithm
+        start_time = time.time()
+        result = minimize(squared_error_and_gradient, np.ravel(absorption * variable_scale), jac=True,
+                          method="L-BFGS-B", bounds=Bounds(0, np.inf), callback=store_intermediate_absorption,
+                          options={"maxiter": nmax, "ftol": self.get_stopping_level(), "gtol": 0})
+        self.logger.debug(f"L-BFGS-B stopped after {result.nit} iterations and {result.nfev} evaluations: "
+                          f"{result.message}")
+        print("--- %s seconds/iteration ---" % round((time.time() - start_time) / max(result.nit, 1), 2))
+        absorption = result.x.reshape(shape) / variable_scale
+
+        # extracting field of view if input initial pressure was passed as a 2-d array
+        if stacked_to_volume:
+            absorption = absorption[:, y_pos, :]
+
+        # function returns the last iteration result as a numpy array and all iteration results in a list
+        return absorption, list_of_intermediate_absorptions
+
+    def get_pressure_factor(self, shape: Tuple[int, ...]) -> [np.ndarray, float]:
+        """
+        :param shape: shape of the image data
+        :return: the factor between the product of absorption and fluence and the initial pressure, which is one
+                 unless Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE is given, as in `update_absorption_estimate`
+        """
+        if Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE not in self.optical_settings:
+            return 1.0
+        if Tags.DATA_FIELD_GRUNEISEN_PARAMETER in self.global_settings:
+            gamma = self.global_settings[Tags.DATA_FIELD_GRUNEISEN_PARAMETER] * np.ones(shape)
+        else:
+            gamma = calculate_gruneisen_parameter_from_temperature(StandardProperties.BODY_TEMPERATURE_CELCIUS)
+            gamma = gamma * np.ones(shape)
+        return gamma * (self.optical_settings[Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE] / 1000) * 1e6
+
+    def get_stopping_level(self) -> float:
+        """
+        :return: Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL or 0.001 by default.
+        :raises: AssertionError: if Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL tag is zero
+        """
+        if Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL in self.iterative_method_settings:
+            if self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL] == 0:
+                raise AssertionError("Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL should be greater than zero.")
+            return float(self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL])
+        return 1e-3
@@ -13,8 +13,10 @@ from simpa.utils.libraries.molecule_library import MolecularComposition
 from simpa.utils.calculate import calculate_gruneisen_parameter_from_temperature
 from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_adapter import \
     MCXAdapter
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter import \
+    MonteCarloAdapter
 from simpa.utils import Settings
-from simpa.io_handling import save_data_field, load_data_field
+from simpa.io_handling import save_data_field, load_data_field, load_optical_output_in_volume
 from simpa.utils import TISSUE_LIBRARY
 from simpa.core.processing_components import ProcessingComponent
 import os
@@ -63,13 +65,15 @@ class IterativeqPAI(ProcessingComponent):
 
         # check if simulation_path and optical_model_binary_path exist
         self.logger.debug(f"Simulation path: {self.global_settings[Tags.SIMULATION_PATH]}")
-        self.logger.debug(f"Optical model binary path: {self.optical_settings[Tags.OPTICAL_MODEL_BINARY_PATH]}")
 
         if not os.path.exists(self.global_settings[Tags.SIMULATION_PATH]):
             print("Tags.SIMULATION_PATH tag in settings cannot be found.")
 
-        if not os.path.exists(self.optical_settings[Tags.OPTICAL_MODEL_BINARY_PATH]):
-            print("Tags.OPTICAL_MODEL_BINARY_PATH tag in settings cannot be found.")
+        # the binary path is only needed by optical models that run an external program
+        if Tags.OPTICAL_MODEL_BINARY_PATH in self.optical_settings:
+            self.logger.debug(f"Optical model binary path: {self.optical_settings[Tags.OPTICAL_MODEL_BINARY_PATH]}")
+            if not os.path.exists(self.optical_settings[Tags.OPTICAL_MODEL_BINARY_PATH]):
+                print("Tags.OPTICAL_MODEL_BINARY_PATH tag in settings cannot be found.")
 
         # debug reconstruction settings
         self.logger.debug(f"Resampling factor: {self.downscale_factor}")
@@ -131,34 +135,7 @@ class IterativeqPAI(ProcessingComponent):
                  AssertionError: is Tags.MAX_NUMBER_ITERATIVE_RECONSTRUCTION tag is zero
         """
 
-        # extract "measured" initial pressure and a priori scattering data
-        target_intial_pressure, scattering, anisotropy = self.extract_initial_data_from_hdf5()
-
-        # checking input data
-        if not isinstance(target_intial_pressure, np.ndarray):
-            raise TypeError("Image data is not a numpy ndarray.")
-        elif target_intial_pressure.size == 0:
-            raise ValueError("Image data is empty.")
-        elif (len(target_intial_pressure.shape) < 2) or (len(target_intial_pressure.shape) > 3):
-            raise ValueError("Image data is invalid. Data must be two or three dimensional.")
-
-        if not isinstance(scattering, np.ndarray):
-            raise TypeError("Scattering input is not a numpy ndarray.")
-        elif scattering.shape != target_intial_pressure.shape:
-            raise ValueError("Shape of scattering data is invalid. Scattering must have the same shape as image_data.")
-
-        # get optical properties necessary for simulation
-        optical_properties_dict = self.standard_optical_properties(target_intial_pressure)
-        if scattering is None:
-            scattering = optical_properties_dict["scattering"]
-        if anisotropy is None:
-            anisotropy = optical_properties_dict["anisotropy"]
-
-        # preprocessing for iterative qPAI method and mcx_adapter
-        target_intial_pressure, scattering, anisotropy, stacked_to_volume = self.preprocessing_for_iterative_qpai(
-            intial_pressure=target_intial_pressure,
-            scattering=scattering,
-            anisotropy=anisotropy)
+        target_intial_pressure, scattering, anisotropy, stacked_to_volume = self.get_reconstruction_inputs()
 
         # regularization parameter sigma
         sigma = self.regularization_sigma(target_intial_pressure, stacked_to_volume)
@@ -169,11 +146,7 @@ class IterativeqPAI(ProcessingComponent):
         list_of_intermediate_absorptions = []  # if intentional all intermediate iteration updates can be returned
         error_list = []
 
-        nmax = 10
-        if Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER in self.iterative_method_settings:
-            if self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER] == 0:
-                raise AssertionError("Tags.MAX_NUMBER_ITERATIVE_RECONSTRUCTION tag is invalid (equals zero).")
-            nmax = int(self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER])
+        nmax = self.get_maximum_number_of_iterations()
 
         # run algorithm
         start_time = time.time()
@@ -208,6 +181,56 @@ class IterativeqPAI(ProcessingComponent):
         # function returns the last iteration result as a numpy array and all iteration results in a list
         return absorption, list_of_intermediate_absorptions
 
+    def get_reconstruction_inputs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, bool]:
+        """
+        Loads and checks the "measured" initial pressure and the a priori known scattering and anisotropy and
+        preprocesses them for the reconstruction.
+
+        :return: Preprocessed initial pressure, scattering, anisotropy and bool indicating if image had to be stacked
+                 to 3-d.
+        :raises: TypeError: if input data are not passed as a certain type
+                 ValueError: if input data cannot be used for reconstruction due to shape or value
+        """
+
+        # extract "measured" initial pressure and a priori scattering data
+        target_intial_pressure, scattering, anisotropy = self.extract_initial_data_from_hdf5()
+
+        # checking input data
+        if not isinstance(target_intial_pressure, np.ndarray):
+            raise TypeError("Image data is not a numpy ndarray.")
+        elif target_intial_pressure.size == 0:
+            raise ValueError("Image data is empty.")
+        elif (len(target_intial_pressure.shape) < 2) or (len(target_intial_pressure.shape) > 3):
+            raise ValueError("Image data is invalid. Data must be two or three dimensional.")
+
+        if not isinstance(scattering, np.ndarray):
+            raise TypeError("Scattering input is not a numpy ndarray.")
+        elif scattering.shape != target_intial_pressure.shape:
+            raise ValueError("Shape of scattering data is invalid. Scattering must have the same shape as image_data.")
+
+        # get optical properties necessary for simulation
+        optical_properties_dict = self.standard_optical_properties(target_intial_pressure)
+        if scattering is None:
+            scattering = optical_properties_dict["scattering"]
+        if anisotropy is None:
+            anisotropy = optical_properties_dict["anisotropy"]
+
+        # preprocessing for iterative qPAI method and mcx_adapter
+        return self.preprocessing_for_iterative_qpai(intial_pressure=target_intial_pressure,
+                                                     scattering=scattering,
+                                                     anisotropy=anisotropy)
+
+    def get_maximum_number_of_iterations(self) -> int:
+        """
+        :return: Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER or 10 by default.
+        :raises: AssertionError: if the tag is zero
+        """
+        if Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER in self.iterative_method_settings:
+            if self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER] == 0:
+                raise AssertionError("Tags.MAX_NUMBER_ITERATIVE_RECONSTRUCTION tag is invalid (equals zero).")
+            return int(self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER])
+        return 10
+
     def extract_initial_data_from_hdf5(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
         Extract necessary information - initial pressure and scattering coefficients -
@@ -224,11 +247,13 @@ class IterativeqPAI(ProcessingComponent):
             wavelength = self.global_settings[Tags.WAVELENGTHS][0]
         self.logger.debug(f"Wavelength: {wavelength}")
         # get initial pressure and scattering
-        initial_pressure = load_data_field(self.global_settings[Tags.SIMPA_OUTPUT_PATH],
-                                           Tags.DATA_FIELD_INITIAL_PRESSURE,
-                                           wavelength)
         scattering = load_data_field(self.global_settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_SCATTERING_PER_CM,
                                      wavelength)
+        # the initial pressure may only have been stored within the field of view
+        initial_pressure = load_optical_output_in_volume(self.global_settings[Tags.SIMPA_OUTPUT_PATH],
+                                                         Tags.DATA_FIELD_INITIAL_PRESSURE,
+                                                         np.shape(scattering),
+                                                         wavelength)
 
         anisotropy = load_data_field(self.global_settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ANISOTROPY,
                                      wavelength)
@@ -318,13 +343,6 @@ class IterativeqPAI(ProcessingComponent):
         :raises: ValueError: if estimated noise is zero, so SNR cannot be computed.
         """
 
-        noise = float(estimate_sigma(input_image))
-
-        if noise == 0.0:
-            raise ValueError("An estimated noise level of zero cannot be used to compute a signal to noise ratio.")
-
-        signal_noise_ratio = input_image / noise
-
         if Tags.ITERATIVE_RECONSTRUCTION_CONSTANT_REGULARIZATION in self.iterative_method_settings:
             if self.iterative_method_settings[Tags.ITERATIVE_RECONSTRUCTION_CONSTANT_REGULARIZATION]:
                 sigma = 1e-2
@@ -338,7 +356,7 @@ class IterativeqPAI(ProcessingComponent):
                 self.logger.debug(f"Regularization parameter: {sigma}")
             else:
                 self.logger.debug("Regularization: SNR/spatially dependent")
-                sigma = 1 / signal_noise_ratio
+                sigma = 1 / self.signal_noise_ratio(input_image)
                 sigma[sigma > 1e8] = 1e8
                 sigma[sigma < 1e-8] = 1e-8
         elif stacked_to_volume:
@@ -348,12 +366,29 @@ class IterativeqPAI(ProcessingComponent):
             self.logger.debug(f"Regularization parameter: {sigma}")
         else:
             self.logger.debug("Regularization: SNR/spatially dependent")
-            sigma = 1 / signal_noise_ratio
+            sigma = 1 / self.signal_noise_ratio(input_image)
             sigma[sigma > 1e8] = 1e8
             sigma[sigma < 1e-8] = 1e-8
 
         return sigma
 
+    @staticmethod
+    def signal_noise_ratio(input_image: np.ndarray) -> np.ndarray:
+        """
+        Computes the signal to noise ratio of every pixel with the noise level estimated from the whole image.
+
+        :param input_image: Noisy input image.
+        :return: Signal to noise ratio.
+        :raises: ValueError: if estimated noise is zero, so SNR cannot be computed.
+        """
+
+        noise = float(estimate_sigma(input_image))
+
+        if noise == 0.0:
+            raise ValueError("An estimated noise level of zero cannot be used to compute a signal to noise ratio.")
+
+        return input_image / noise
+
     def standard_optical_properties(self, image_data: np.ndarray) -> dict:
         """
         Returns a optical properties dictionary containing scattering coefficients and anisotropy.
@@ -407,34 +442,21 @@ class IterativeqPAI(ProcessingComponent):
 
         if model == Tags.OPTICAL_MODEL_MCX:
             forward_model_implementation = MCXAdapter(self.global_settings)
+        elif model == Tags.OPTICAL_MODEL_MONTE_CARLO:
+            forward_model_implementation = MonteCarloAdapter(self.global_settings)
         else:
-            raise AssertionError("Tags.OPTICAL_MODEL tag must be Tags.OPTICAL_MODEL_MCX.")
+            raise AssertionError("Tags.OPTICAL_MODEL tag must be Tags.OPTICAL_MODEL_MCX or "
+                                 "Tags.OPTICAL_MODEL_MONTE_CARLO.")
 
         _device = pa_device.get_illumination_geometry()
 
-        if isinstance(_device, list):
-            # per convention this list has at least two elements
-            results = forward_model_implementation.forward_model(absorption_cm=absorption,
-                                                                 scattering_cm=scattering,
-                                                                 anisotropy=anisotropy,
-                                                                 illumination_geometry=_device[0])
-            fluence = results[Tags.DATA_FIELD_FLUENCE]
-            for idx in range(1, len(_device)):
-                # we already looked at the 0th element, so go from 1 to n-1
-                results = forward_model_implementation.forward_model(absorption_cm=absorption,
-                                                                     scattering_cm=scattering,
-                                                                     anisotropy=anisotropy,
-                                                                     illumination_geometry=_device[idx + 1])
-                fluence += results[Tags.DATA_FIELD_FLUENCE]
-
-            fluence = fluence / len(_device)
-
-        else:
-            results = forward_model_implementation.forward_model(absorption_cm=absorption,
-                                                                 scattering_cm=scattering,
-                                                                 anisotropy=anisotropy,
-                                                                 illumination_geometry=_device)
-            fluence = results[Tags.DATA_FIELD_FLUENCE]
+        # the results of all illumination geometries are averaged, and cached if the optical settings request it
+        results = forward_model_implementation.run_forward_model(_device=_device,
+                                                                 device=pa_device,
+                                                                 absorption=absorption,
+                                                                 scattering=scattering,
+                                                                 anisotropy=anisotropy)
+        fluence = results[Tags.DATA_FIELD_FLUENCE]
 
         print("Simulating the optical forward process...[Done]")
 
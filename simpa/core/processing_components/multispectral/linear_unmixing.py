@@ -138,8 +138,8 @@ class LinearUnmixing(MultispectralProcessingAlgorithm):
         The name must match the ones used in the spectral library of SIMPA.
         """
 
-        self.chromophore_spectra_dict[spectrum.spectrum_name] = [spectrum.get_value_for_wavelength(wavelength)
-                                                                 for wavelength in self.wavelengths]
+        self.chromophore_spectra_dict[spectrum.spectrum_name] = spectrum.get_value_for_wavelength(
+            np.asarray(self.wavelengths))
 
     def create_absorption_matrix(self) -> np.ndarray:
         """
@@ -148,16 +148,10 @@ class LinearUnmixing(MultispectralProcessingAlgorithm):
         :return: absorption matrix
         """
 
-        numberWavelengths = len(self.wavelengths)
-        numberChromophores = len(self.chromophore_spectra_dict.keys())
-
-        # prepare matrix
-        endmemberMatrix = np.zeros((numberWavelengths, numberChromophores))
-
         # write absorption data for each chromophore and the corresponding wavelength into an array (matrix)
+        endmemberMatrix = np.zeros((len(self.wavelengths), len(self.chromophore_spectra_dict.keys())))
         for index, key in enumerate(self.chromophore_spectra_dict.keys()):
-            for wave in range(numberWavelengths):
-                endmemberMatrix[wave][index] = self.chromophore_spectra_dict[key][wave]
+            endmemberMatrix[:, index] = self.chromophore_spectra_dict[key]
 
         return endmemberMatrix
 
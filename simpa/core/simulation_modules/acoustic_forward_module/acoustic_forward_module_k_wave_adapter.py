@@ -14,7 +14,7 @@ from simpa.core.device_digital_twins import (CurvedArrayDetectionGeometry,
                                              DetectionGeometryBase)
 from simpa.core.simulation_modules.acoustic_forward_module import \
     AcousticForwardModelBaseAdapter
-from simpa.io_handling.io_hdf5 import load_data_field, save_hdf5
+from simpa.io_handling.io_hdf5 import load_data_field, save_hdf5, load_optical_output_in_volume
 from simpa.utils import Tags
 from simpa.utils.matlab import generate_matlab_cmd
 from simpa.utils.calculate import rotation_matrix_between_vectors
@@ -84,9 +84,11 @@ class KWaveAdapter(AcousticForwardModelBaseAdapter):
 
         data_dict = {}
         file_path = self.global_settings[Tags.SIMPA_OUTPUT_PATH]
-        data_dict[Tags.DATA_FIELD_INITIAL_PRESSURE] = load_data_field(file_path, Tags.DATA_FIELD_INITIAL_PRESSURE,
-                                                                      wavelength=wavelength)
         data_dict[Tags.DATA_FIELD_SPEED_OF_SOUND] = load_data_field(file_path, Tags.DATA_FIELD_SPEED_OF_SOUND)
+        # the initial pressure may only have been stored within the field of view
+        data_dict[Tags.DATA_FIELD_INITIAL_PRESSURE] = load_optical_output_in_volume(
+            file_path, Tags.DATA_FIELD_INITIAL_PRESSURE, np.shape(data_dict[Tags.DATA_FIELD_SPEED_OF_SOUND]),
+            wavelength=wavelength)
         data_dict[Tags.DATA_FIELD_DENSITY] = load_data_field(file_path, Tags.DATA_FIELD_DENSITY)
         data_dict[Tags.DATA_FIELD_ALPHA_COEFF] = load_data_field(file_path, Tags.DATA_FIELD_ALPHA_COEFF)
 
@@ -2,18 +2,20 @@
 # SPDX-FileCopyrightText: 2021 Janek Groehl
 # SPDX-License-Identifier: MIT
 from abc import abstractmethod
-from typing import Dict, Union
+from typing import Dict, Iterator, List, Tuple, Union
 
 import numpy as np
 
 from simpa.core import SimulationModule
 from simpa.core.device_digital_twins import (IlluminationGeometryBase,
                                              PhotoacousticDevice)
-from simpa.io_handling.io_hdf5 import load_data_field, save_hdf5
+from simpa.io_handling.io_hdf5 import load_data_field, save_hdf5, contains_hdf5_path
 from simpa.utils import Settings, Tags
 from simpa.utils.dict_path_manager import generate_dict_path
+from simpa.utils.calculate import downsample_volume, upsample_volume
 from simpa.utils.quality_assurance.data_sanity_testing import \
     assert_array_well_defined
+from simpa.core.simulation_modules.optical_simulation_module.fluence_cache import FluenceCache
 
 
 class OpticalForwardModuleBase(SimulationModule):
@@ -21,6 +23,16 @@ class OpticalForwardModuleBase(SimulationModule):
     Use this class as a base for implementations of optical forward models.
     This class has the attributes `self.temporary_output_files` which stores file paths that are temporarily created as
     input to the optical simulator, e.g. MCX. The class attributes `nx, ny & nz` represent the volume dimensions
+
+    If Tags.SPACING_MM is given in the optical settings, the forward model is run on the volumes of the optical grid
+    (Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES) with `self.global_settings[Tags.SPACING_MM]` set to the optical spacing,
+    and the fluence is upsampled to the volume before the initial pressure is computed.
+
+    If Tags.OPTICAL_MODEL_CACHE_DIRECTORY is given in the optical settings, the results of `self.forward_model` are
+    cached on disk for every illumination geometry, see `self.cached_forward_model`.
+
+    If Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW is True in the optical settings, the initial pressure is only computed
+    and the fluence is only stored within the field of view of the detection geometry, see `self.get_output_region`.
     """
 
     def __init__(self, global_settings: Settings):
@@ -30,6 +42,14 @@ class OpticalForwardModuleBase(SimulationModule):
         self.ny = None
         self.nz = None
         self.temporary_output_files = []
+        self.fluence_cache = None
+        if Tags.OPTICAL_MODEL_CACHE_DIRECTORY in self.component_settings:
+            if Tags.OPTICAL_MODEL_CACHE_MAXIMUM_SIZE_MB in self.component_settings:
+                maximum_size_mb = self.component_settings[Tags.OPTICAL_MODEL_CACHE_MAXIMUM_SIZE_MB]
+            else:
+                maximum_size_mb = 1024
+            self.fluence_cache = FluenceCache(self.component_settings[Tags.OPTICAL_MODEL_CACHE_DIRECTORY],
+                                              int(maximum_size_mb * 1024 * 1024))
 
     @abstractmethod
     def forward_model(self,
@@ -67,6 +87,16 @@ class OpticalForwardModuleBase(SimulationModule):
         anisotropy = load_data_field(file_path, Tags.DATA_FIELD_ANISOTROPY, wl)
         gruneisen_parameter = load_data_field(file_path, Tags.DATA_FIELD_GRUNEISEN_PARAMETER)
 
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        optical_spacing_mm = self.global_settings.get_optical_spacing_mm()
+        if optical_spacing_mm != spacing_mm:
+            optical_grid_volumes = self.load_optical_grid_volumes(absorption, scattering, anisotropy)
+            optical_absorption = optical_grid_volumes[Tags.DATA_FIELD_ABSORPTION_PER_CM]
+            optical_scattering = optical_grid_volumes[Tags.DATA_FIELD_SCATTERING_PER_CM]
+            optical_anisotropy = optical_grid_volumes[Tags.DATA_FIELD_ANISOTROPY]
+        else:
+            optical_absorption, optical_scattering, optical_anisotropy = absorption, scattering, anisotropy
+
         _device = None
         if isinstance(device, IlluminationGeometryBase):
             _device = device
@@ -75,22 +105,42 @@ class OpticalForwardModuleBase(SimulationModule):
         else:
             raise TypeError(f"The optical forward modelling does not support devices of type {type(device)}")
 
-        results = self.run_forward_model(_device=_device,
-                                         device=device,
-                                         absorption=absorption,
-                                         scattering=scattering,
-                                         anisotropy=anisotropy)
+        global_settings = self.global_settings
+        if optical_spacing_mm != spacing_mm:
+            # the illumination geometries and the forward models place the volume using the global spacing
+            self.global_settings = Settings(global_settings, verbose=False)
+            self.global_settings[Tags.SPACING_MM] = optical_spacing_mm
+        try:
+            results = self.run_forward_model(_device=_device,
+                                             device=device,
+                                             absorption=optical_absorption,
+                                             scattering=optical_scattering,
+                                             anisotropy=optical_anisotropy)
+        finally:
+            self.global_settings = global_settings
         fluence = results[Tags.DATA_FIELD_FLUENCE]
+        if optical_spacing_mm != spacing_mm:
+            fluence = upsample_volume(fluence, np.shape(absorption), optical_spacing_mm, spacing_mm)
         if not (Tags.IGNORE_QA_ASSERTIONS in self.global_settings and Tags.IGNORE_QA_ASSERTIONS):
             assert_array_well_defined(fluence, assume_non_negativity=True, array_name="fluence")
 
+        output_region = self.get_output_region(device, np.shape(absorption))
+        if output_region is not None:
+            # copies, such that the volumes of the whole simulation can be freed
+            fluence = np.array(fluence[output_region])
+            absorption = absorption[output_region]
+            gruneisen_parameter = gruneisen_parameter[output_region]
+            results[Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET] = np.asarray([region.start for region in output_region])
+
         if Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE in self.component_settings:
             units = Tags.UNITS_PRESSURE
             # Initial pressure should be given in units of Pascale
             conversion_factor = 1e6  # 1 J/cm^3 = 10^6 N/m^2 = 10^6 Pa
-            initial_pressure = (absorption * fluence * gruneisen_parameter *
-                                (self.component_settings[Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE] / 1000)
-                                * conversion_factor)
+            # the scalar factors are combined first and applied in place, so that no further volumes are allocated
+            initial_pressure = absorption * fluence
+            initial_pressure *= gruneisen_parameter
+            initial_pressure *= (self.component_settings[Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE] / 1000) * \
+                conversion_factor
         else:
             units = Tags.UNITS_ARBITRARY
             initial_pressure = absorption * fluence
@@ -109,6 +159,72 @@ class OpticalForwardModuleBase(SimulationModule):
         save_hdf5(optical_output, self.global_settings[Tags.SIMPA_OUTPUT_PATH], optical_output_path)
         self.logger.info("Simulating the optical forward process...[Done]")
 
+    def get_output_region(self, device: Union[IlluminationGeometryBase, PhotoacousticDevice],
+                          shape: Tuple[int, int, int]) -> Union[Tuple[slice, slice, slice], None]:
+        """
+        Determines the region of the volume within which the optical output is stored if
+        Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW is True. It contains the voxels that `FieldOfViewCropping` keeps,
+        enlarged by Tags.OPTICAL_MODEL_FIELD_OF_VIEW_PADDING_MM on every side and limited to the volume.
+
+        :param device: Illumination or Photoacoustic device that defines the field of view
+        :param shape: the shape of the volume
+        :return: slices of the region or None, if the whole volume is stored
+        """
+        if not (Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW in self.component_settings and
+                self.component_settings[Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW]):
+            return None
+        if not isinstance(device, PhotoacousticDevice) or device.detection_geometry is None:
+            self.logger.warning("The optical output can only be cropped to the field of view of a detection "
+                                "geometry. The whole volume is stored instead.")
+            return None
+        padding_mm = 0
+        if Tags.OPTICAL_MODEL_FIELD_OF_VIEW_PADDING_MM in self.component_settings:
+            padding_mm = self.component_settings[Tags.OPTICAL_MODEL_FIELD_OF_VIEW_PADDING_MM]
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        field_of_view_voxels = np.round(np.asarray(device.detection_geometry.get_field_of_view_mm(),
+                                                   dtype=np.float64) / spacing_mm).astype(int)
+        padding_voxels = int(np.round(padding_mm / spacing_mm))
+        region = []
+        for axis in range(3):
+            start, end = field_of_view_voxels[2 * axis], field_of_view_voxels[2 * axis + 1]
+            # like `FieldOfViewCropping`, a field of view from A to A keeps the voxel A
+            end = max(end, start + 1)
+            start, end = start - padding_voxels, end + padding_voxels
+            start = min(max(start, 0), shape[axis] - 1)
+            end = min(max(end, start + 1), shape[axis])
+            region.append(slice(start, end))
+        self.logger.debug(f"Storing the optical output within the region {region} of the volume of shape {shape}")
+        return tuple(region)
+
+    def load_optical_grid_volumes(self, absorption: np.ndarray, scattering: np.ndarray,
+                                  anisotropy: np.ndarray) -> Dict:
+        """
+        Loads the optical properties at the optical spacing that were created during volume creation. If they are not
+        stored, they are obtained by averaging blocks of the given volumes, which requires the optical spacing to be
+        an integer multiple of the global spacing.
+
+        :param absorption: Absorption volume at the global spacing
+        :param scattering: Scattering volume at the global spacing
+        :param anisotropy: Dimensionless scattering anisotropy at the global spacing
+        :return: dictionary with the absorption, scattering, and anisotropy at the optical spacing
+        """
+        file_path = self.global_settings[Tags.SIMPA_OUTPUT_PATH]
+        wavelength = self.global_settings[Tags.WAVELENGTH]
+        if contains_hdf5_path(file_path, generate_dict_path(Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES, wavelength)):
+            return load_data_field(file_path, Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES, wavelength)
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        optical_spacing_mm = self.global_settings.get_optical_spacing_mm()
+        factor = int(round(optical_spacing_mm / spacing_mm))
+        if factor < 1 or not np.isclose(factor * spacing_mm, optical_spacing_mm):
+            raise ValueError(f"No volumes were created at the optical spacing ({optical_spacing_mm} mm) and it is not "
+                             f"an integer multiple of the spacing of the volume ({spacing_mm} mm).")
+        self.logger.warning("No volumes were created at the optical spacing. Averaging the volumes instead.")
+        shape = tuple(int(round(self.global_settings[dimension] / optical_spacing_mm))
+                      for dimension in [Tags.DIM_VOLUME_X_MM, Tags.DIM_VOLUME_Y_MM, Tags.DIM_VOLUME_Z_MM])
+        return {Tags.DATA_FIELD_ABSORPTION_PER_CM: downsample_volume(absorption, factor, shape),
+                Tags.DATA_FIELD_SCATTERING_PER_CM: downsample_volume(scattering, factor, shape),
+                Tags.DATA_FIELD_ANISOTROPY: downsample_volume(anisotropy, factor, shape)}
+
     def run_forward_model(self,
                           _device,
                           device: Union[IlluminationGeometryBase, PhotoacousticDevice],
@@ -127,25 +243,116 @@ class OpticalForwardModuleBase(SimulationModule):
         """
         if isinstance(_device, list):
             # per convention this list has at least two elements
-            results = self.forward_model(absorption_cm=absorption,
-                                         scattering_cm=scattering,
-                                         anisotropy=anisotropy,
-                                         illumination_geometry=_device[0])
-            fluence = results[Tags.DATA_FIELD_FLUENCE]
-            for idx in range(1, len(_device)):
-                # we already looked at the 0th element, so go from 1 to n-1
-                results = self.forward_model(absorption_cm=absorption,
-                                             scattering_cm=scattering,
-                                             anisotropy=anisotropy,
-                                             illumination_geometry=_device[idx])
-                fluence += results[Tags.DATA_FIELD_FLUENCE]
+            fluence = None
+            for _, results in self.iterate_forward_model(absorption_cm=absorption,
+                                                         scattering_cm=scattering,
+                                                         anisotropy=anisotropy,
+                                                         illumination_geometries=_device):
+                if fluence is None:
+                    # the sum does not depend on the order in which the results arrive
+                    fluence = results[Tags.DATA_FIELD_FLUENCE]
+                    fluence_dtype = fluence.dtype
+                    fluence = fluence.astype(np.float64)
+                else:
+                    fluence += results[Tags.DATA_FIELD_FLUENCE]
 
-            fluence = fluence / len(_device)
+            fluence = (fluence / len(_device)).astype(fluence_dtype)
 
         else:
-            results = self.forward_model(absorption_cm=absorption,
-                                         scattering_cm=scattering,
-                                         anisotropy=anisotropy,
-                                         illumination_geometry=_device)
+            results = self.cached_forward_model(absorption_cm=absorption,
+                                                scattering_cm=scattering,
+                                                anisotropy=anisotropy,
+                                                illumination_geometry=_device)
             fluence = results[Tags.DATA_FIELD_FLUENCE]
         return {Tags.DATA_FIELD_FLUENCE: fluence}
+
+    def cached_forward_model(self,
+                             absorption_cm: np.ndarray,
+                             scattering_cm: np.ndarray,
+                             anisotropy: np.ndarray,
+                             illumination_geometry: IlluminationGeometryBase) -> Dict:
+        """
+        runs `self.forward_model` unless its results for the same inputs are found in the cache. Without a cache, this
+        is the same as calling `self.forward_model`.
+
+        :param absorption_cm: Absorption in units of per centimeter
+        :param scattering_cm: Scattering in units of per centimeter
+        :param anisotropy: Dimensionless scattering anisotropy
+        :param illumination_geometry: A device that represents a detection geometry
+        :return: the results of the forward model
+        """
+        if self.fluence_cache is None:
+            return self.forward_model(absorption_cm=absorption_cm,
+                                      scattering_cm=scattering_cm,
+                                      anisotropy=anisotropy,
+                                      illumination_geometry=illumination_geometry)
+        key = self.get_cache_key(absorption_cm, scattering_cm, anisotropy, illumination_geometry)
+        results = self.fluence_cache.load(key)
+        if results is None:
+            results = self.forward_model(absorption_cm=absorption_cm,
+                                         scattering_cm=scattering_cm,
+                                         anisotropy=anisotropy,
+                                         illumination_geometry=illumination_geometry)
+            self.fluence_cache.store(key, results)
+        return results
+
+    def get_cache_key(self,
+                      absorption_cm: np.ndarray,
+                      scattering_cm: np.ndarray,
+                      anisotropy: np.ndarray,
+                      illumination_geometry: IlluminationGeometryBase) -> str:
+        """
+        The key depends on the optical properties, the source definition of the illumination geometry, the adapter,
+        the spacing, the random seed, and all optical settings apart from those of the cache.
+
+        :param absorption_cm: Absorption in units of per centimeter
+        :param scattering_cm: Scattering in units of per centimeter
+        :param anisotropy: Dimensionless scattering anisotropy
+        :param illumination_geometry: A device that represents a detection geometry
+        :return: key of the results of the forward model in the cache
+        """
+        return self.fluence_cache.get_key({"absorption_cm": absorption_cm,
+                                           "scattering_cm": scattering_cm,
+                                           "anisotropy": anisotropy}, self.get_cache_parameters(illumination_geometry))
+
+    def get_cache_parameters(self, illumination_geometry: IlluminationGeometryBase) -> Dict:
+        """
+        Adapters whose results depend on further parameters should add them to the parameters of the base class.
+
+        :param illumination_geometry: A device that represents a detection geometry
+        :return: the parameters apart from the optical properties that determine the results of the forward model
+        """
+        cache_tags = [Tags.OPTICAL_MODEL_CACHE_DIRECTORY[0], Tags.OPTICAL_MODEL_CACHE_MAXIMUM_SIZE_MB[0]]
+        return {
+            "adapter": type(self).__module__ + "." + type(self).__qualname__,
+            "illumination_geometry": type(illumination_geometry).__name__,
+            "source": illumination_geometry.get_mcx_illuminator_definition(self.global_settings),
+            "spacing_mm": self.global_settings[Tags.SPACING_MM],
+            "random_seed": self.global_settings[Tags.RANDOM_SEED] if Tags.RANDOM_SEED in self.global_settings
+            else None,
+            "optical_settings": {key: value for key, value in self.component_settings.items()
+                                 if key not in cache_tags}
+        }
+
+    def iterate_forward_model(self,
+                              absorption_cm: np.ndarray,
+                              scattering_cm: np.ndarray,
+                              anisotropy: np.ndarray,
+                              illumination_geometries: List[IlluminationGeometryBase]) -> Iterator[Tuple[int, Dict]]:
+        """
+        runs `self.forward_model` for each of the given illumination geometries and yields the results as soon as they
+        are available, so that they can be aggregated without keeping all of them in memory. By default, the
+        illumination geometries are simulated one after the other. Adapters can override this method to simulate them
+        concurrently, in which case the results may be yielded in any order.
+
+        :param absorption_cm: Absorption in units of per centimeter
+        :param scattering_cm: Scattering in units of per centimeter
+        :param anisotropy: Dimensionless scattering anisotropy
+        :param illumination_geometries: list of illumination geometries
+        :return: iterator over tuples of the index of the illumination geometry and the results of the forward model
+        """
+        for index, illumination_geometry in enumerate(illumination_geometries):
+            yield index, self.cached_forward_model(absorption_cm=absorption_cm,
+                                                   scattering_cm=scattering_cm,
+                                                   anisotropy=anisotropy,
+                                                   illumination_geometry=illumination_geometry)
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, Optional
+
+import numpy as np
+
+from simpa.log import Logger
+
+DIGEST_CHUNK_SIZE_BYTES = 16 * 1024 * 1024
+CACHE_FILE_SUFFIX = ".npz"
+
+
+class FluenceCache:
+    """
+    Stores the results of optical forward models in a directory on the local disk. Every entry is a single `.npz` file
+    that is named after the digest of the inputs of the forward model. The modification time of a file is updated
+    whenever it is read, and the least recently used entries are deleted as soon as the total size of the cache
+    exceeds the given maximum. As entries are written to a temporary file and then renamed, several processes can
+    share the same cache directory.
+    """
+
+    def __init__(self, directory: str, maximum_size_bytes: int):
+        """
+        :param directory: directory in which the cache entries are stored, it is created if it does not exist
+        :param maximum_size_bytes: maximum total size of all entries in the cache
+        """
+        self.logger = Logger()
+        self.directory = directory
+        self.maximum_size_bytes = maximum_size_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(volumes: Dict[str, np.ndarray], parameters: Dict) -> str:
+        """
+        Computes the key of a cache entry. The volumes are hashed in chunks of their memory, such that no copy of them
+        is made unless they are not contiguous.
+
+        :param volumes: dictionary of the named input volumes of the forward model
+        :param parameters: dictionary of all further inputs of the forward model, it has to be JSON serializable
+            except for numpy arrays and scalars
+        :return: hexadecimal digest of the volumes and parameters
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for name in sorted(volumes):
+            volume = np.ascontiguousarray(volumes[name])
+            digest.update(json.dumps([name, volume.dtype.str, volume.shape]).encode("utf-8"))
+            memory = memoryview(volume.reshape(-1)).cast("B")
+            for start in range(0, len(memory), DIGEST_CHUNK_SIZE_BYTES):
+                digest.update(memory[start:start + DIGEST_CHUNK_SIZE_BYTES])
+        digest.update(json.dumps(parameters, sort_keys=True, default=_to_json_serializable).encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        :param key: key of the cache entry as computed by `get_key`
+        :return: the cached results or None if there is no entry for the key
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as entry:
+                results = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        self.logger.debug(f"Loaded the results of the optical forward model from the cache: {path}")
+        return results
+
+    def store(self, key: str, results: Dict) -> None:
+        """
+        Stores the results under the given key and evicts the least recently used entries if the cache grows too
+        large. Results that contain anything but numpy arrays are not cached.
+
+        :param key: key of the cache entry as computed by `get_key`
+        :param results: results of the forward model
+        """
+        if not all(isinstance(value, np.ndarray) for value in results.values()):
+            self.logger.debug("Results that do not only consist of numpy arrays are not cached.")
+            return
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as temporary_file:
+                np.savez(temporary_file, **results)
+            os.replace(temporary_path, self.get_path(key))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the total size of the cache is at most its maximum size.
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            try:
+                status = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                continue
+            entries.append((status.st_mtime_ns, status.st_size, file_name))
+        total_size_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size_bytes <= self.maximum_size_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+            total_size_bytes -= size
+
+    def get_path(self, key: str) -> str:
+        """
+        :param key: key of the cache entry
+        :return: path of the file of the cache entry
+        """
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+
+def _to_json_serializable(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return str(value)
@@ -0,0 +1,329 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import json
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import torch
+
+from simpa.utils import Tags, Settings
+from simpa.utils.processing_device import get_processing_device
+from simpa.core.simulation_modules.optical_simulation_module import OpticalForwardModuleBase
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter import \
+    sample_photon_sources, propagate_photons
+from simpa.core.device_digital_twins.illumination_geometries.illumination_geometry_base import IlluminationGeometryBase
+
+# the boundary is assumed to be index matched, i.e. there is no internal reflection at the surface of the volume
+BOUNDARY_REFLECTION_PARAMETER = 1.0
+
+# the diffusion coefficient is bounded in non-scattering regions, in which the diffusion approximation does not hold
+MINIMUM_TRANSPORT_COEFFICIENT_PER_MM = 1e-2
+
+
+class DiffusionFluenceAdapter(OpticalForwardModuleBase):
+    """
+    This class computes the fluence in the diffusion approximation of the radiative transfer equation, which is
+    considerably faster than a Monte Carlo simulation but only accurate in the diffuse regime, i.e. further than a few
+    transport mean free paths away from the sources and in regions where scattering dominates absorption.
+
+    The illumination is modelled as a collimated beam that is attenuated by the reduced interaction coefficient
+    and acts as an isotropic source of diffuse light where it is scattered. The steady-state diffusion equation
+
+        - div(D grad(phi)) + mu_a phi = mu_s' phi_collimated,  D = 1 / (3 (mu_a + mu_s'))
+
+    is discretised with finite volumes on the voxel grid with Robin boundary conditions and solved with a conjugate
+    gradient method on the device given by Tags.GPU, which is preconditioned with a geometric multigrid cycle.
+    The solutions of previous runs of the same adapter, e.g. for previous wavelengths, are used as initial guesses.
+
+    The photon sources are created from the same definition as for MCX,
+    i.e. `IlluminationGeometryBase.get_mcx_illuminator_definition`, and the fluence is normalised in the same way as
+    by the `MCXAdapter`.
+    """
+
+    def __init__(self, global_settings: Settings):
+        """
+        :param global_settings: global settings used during simulations
+        """
+        super(DiffusionFluenceAdapter, self).__init__(global_settings=global_settings)
+        self.torch_device = get_processing_device(global_settings)
+        self.previous_diffuse_fluences = {}
+
+    def forward_model(self,
+                      absorption_cm: np.ndarray,
+                      scattering_cm: np.ndarray,
+                      anisotropy: np.ndarray,
+                      illumination_geometry: IlluminationGeometryBase) -> Dict:
+        """
+        solves the diffusion equation for the given illumination geometry.
+
+        :param absorption_cm: array containing the absorption of the tissue in `cm` units
+        :param scattering_cm: array containing the scattering of the tissue in `cm` units
+        :param anisotropy: array containing the anisotropy of the volume defined by `absorption_cm` and `scattering_cm`
+        :param illumination_geometry: and instance of `IlluminationGeometryBase` defining the illumination geometry
+        :return: `Dict` containing the fluence in units of J/cm^2
+        """
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        absorption_per_mm = np.asarray(absorption_cm, dtype=np.float64) / 10
+        reduced_scattering_per_mm = np.asarray(scattering_cm, dtype=np.float64) * (1 - anisotropy) / 10
+        source = illumination_geometry.get_mcx_illuminator_definition(self.global_settings)
+        if Tags.OPTICAL_MODEL_NUMBER_PHOTONS in self.component_settings:
+            number_of_rays = int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS])
+        else:
+            number_of_rays = 10000
+
+        collimated_fluence = get_collimated_fluence(source, absorption_per_mm, reduced_scattering_per_mm, spacing_mm,
+                                                    number_of_rays)
+
+        if Tags.DIFFUSION_SOLVER_TOLERANCE in self.component_settings:
+            tolerance = self.component_settings[Tags.DIFFUSION_SOLVER_TOLERANCE]
+        else:
+            tolerance = 1e-5
+        if Tags.DIFFUSION_SOLVER_MAXIMUM_ITERATIONS in self.component_settings:
+            maximum_iterations = int(self.component_settings[Tags.DIFFUSION_SOLVER_MAXIMUM_ITERATIONS])
+        else:
+            maximum_iterations = 10000
+
+        warm_start_key = (json.dumps(source, sort_keys=True, default=float), np.shape(absorption_cm), spacing_mm)
+        diffuse_fluence, iterations = solve_diffusion_equation(
+            absorption_per_mm, reduced_scattering_per_mm, collimated_fluence * reduced_scattering_per_mm,
+            spacing_mm, initial_fluence=self.previous_diffuse_fluences.get(warm_start_key),
+            tolerance=tolerance, maximum_iterations=maximum_iterations, device=self.torch_device)
+        self.logger.debug(f"The diffusion equation was solved in {iterations} iterations")
+        if iterations >= maximum_iterations:
+            self.logger.warning(f"The diffusion solver did not converge within {maximum_iterations} iterations")
+        diffuse_fluence = diffuse_fluence.cpu().numpy()
+        # the solutions are kept on the CPU, such that the memory of the processing device is only occupied by the
+        # current solution, and only those of the current grid are kept
+        self.previous_diffuse_fluences = {key: value for key, value in self.previous_diffuse_fluences.items()
+                                          if key[1:] == warm_start_key[1:]}
+        self.previous_diffuse_fluences[warm_start_key] = diffuse_fluence
+
+        fluence = (diffuse_fluence + collimated_fluence) * 100  # Convert from J/mm^2 to J/cm^2
+        return {Tags.DATA_FIELD_FLUENCE: fluence.astype(np.float32)}
+
+
+def get_collimated_fluence(source: dict, absorption_per_mm: np.ndarray, reduced_scattering_per_mm: np.ndarray,
+                           spacing_mm: float, number_of_rays: int, random_seed: int = 0) -> np.ndarray:
+    """
+    Traces rays from the given source through the volume, which are attenuated by the reduced interaction
+    coefficient mu_a + mu_s'.
+
+    :param source: mcx illuminator definition as given by `IlluminationGeometryBase.get_mcx_illuminator_definition`
+    :param absorption_per_mm: absorption volume in units of per millimeter
+    :param reduced_scattering_per_mm: reduced scattering volume in units of per millimeter
+    :param spacing_mm: the voxel spacing of the volumes
+    :param number_of_rays: the number of rays that sample the source
+    :param random_seed: the seed of the positions of the rays within the source
+    :return: the fluence of the collimated light normalised to the energy of the source in units of 1/mm^2
+    """
+    random_generator = np.random.default_rng(random_seed)
+    positions, directions = sample_photon_sources(source, number_of_rays, random_generator)
+    interaction = absorption_per_mm + reduced_scattering_per_mm
+    path_lengths = propagate_photons(interaction, np.zeros_like(interaction), np.zeros_like(interaction),
+                                     positions=positions, directions=directions, random_generator=random_generator,
+                                     spacing_mm=spacing_mm, roulette_threshold=0)
+    return path_lengths.reshape(np.shape(interaction)) / (number_of_rays * spacing_mm ** 2)
+
+
+def get_diffusion_operator(absorption_per_mm: torch.Tensor, reduced_scattering_per_mm: torch.Tensor,
+                           spacing_mm: float) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+    """
+    Discretises the operator - div(D grad(phi)) + mu_a phi with finite volumes on the voxel grid. The diffusion
+    coefficients at the faces between voxels are the harmonic means of the adjacent voxels. At the surface of the
+    volume, the Robin boundary condition phi + 2 A D d(phi)/dn = 0 is applied.
+
+    :param absorption_per_mm: absorption volume in units of per millimeter
+    :param reduced_scattering_per_mm: reduced scattering volume in units of per millimeter
+    :param spacing_mm: the voxel spacing of the volumes
+    :return: tuple of the coefficients of the voxels themselves, i.e. the absorption and the boundary losses, and of
+        the coupling coefficients across the faces along the three axes, which have one entry less along their axis
+    """
+    diffusion_coefficient = 1 / (3 * torch.clamp(absorption_per_mm + reduced_scattering_per_mm,
+                                                 min=MINIMUM_TRANSPORT_COEFFICIENT_PER_MM))
+    self_coefficients = absorption_per_mm.clone()
+    # the boundary flux is limited by the diffusion across the half voxel and the extrapolation length in series
+    boundary_coefficients = 1 / (spacing_mm * (spacing_mm / (2 * diffusion_coefficient) +
+                                               2 * BOUNDARY_REFLECTION_PARAMETER))
+    face_coefficients = []
+    for axis in range(3):
+        length = diffusion_coefficient.shape[axis]
+        lower = diffusion_coefficient.narrow(axis, 0, length - 1)
+        upper = diffusion_coefficient.narrow(axis, 1, length - 1)
+        face_coefficients.append(2 * lower * upper / ((lower + upper) * spacing_mm ** 2))
+        self_coefficients.narrow(axis, 0, 1).add_(boundary_coefficients.narrow(axis, 0, 1))
+        self_coefficients.narrow(axis, length - 1, 1).add_(boundary_coefficients.narrow(axis, length - 1, 1))
+    return self_coefficients, face_coefficients
+
+
+def apply_diffusion_operator(fluence: torch.Tensor, self_coefficients: torch.Tensor,
+                             face_coefficients: List[torch.Tensor]) -> torch.Tensor:
+    """
+    :param fluence: the fluence the operator is applied to
+    :param self_coefficients: the coefficients of the voxels as returned by `get_diffusion_operator`
+    :param face_coefficients: the coefficients of the faces as returned by `get_diffusion_operator`
+    :return: the result of the discretised diffusion operator applied to the fluence
+    """
+    result = self_coefficients * fluence
+    for axis, coefficients in enumerate(face_coefficients):
+        length = fluence.shape[axis]
+        flux = coefficients * (fluence.narrow(axis, 1, length - 1) - fluence.narrow(axis, 0, length - 1))
+        result.narrow(axis, 0, length - 1).sub_(flux)
+        result.narrow(axis, 1, length - 1).add_(flux)
+    return result
+
+
+def get_diagonal(self_coefficients: torch.Tensor, face_coefficients: List[torch.Tensor]) -> torch.Tensor:
+    """
+    :param self_coefficients: the coefficients of the voxels as returned by `get_diffusion_operator`
+    :param face_coefficients: the coefficients of the faces as returned by `get_diffusion_operator`
+    :return: the diagonal of the discretised diffusion operator
+    """
+    diagonal = self_coefficients.clone()
+    for axis, coefficients in enumerate(face_coefficients):
+        length = diagonal.shape[axis]
+        diagonal.narrow(axis, 0, length - 1).add_(coefficients)
+        diagonal.narrow(axis, 1, length - 1).add_(coefficients)
+    return diagonal
+
+
+def restrict(volume: torch.Tensor) -> torch.Tensor:
+    """
+    :param volume: volume on the fine grid
+    :return: the sums over blocks of 2x2x2 voxels, where the last block along an axis of odd length is incomplete
+    """
+    padding = [0, volume.shape[2] % 2, 0, volume.shape[1] % 2, 0, volume.shape[0] % 2]
+    volume = torch.nn.functional.pad(volume, padding)
+    nx, ny, nz = volume.shape
+    return volume.reshape(nx // 2, 2, ny // 2, 2, nz // 2, 2).sum(dim=(1, 3, 5))
+
+
+def prolongate(volume: torch.Tensor, shape: torch.Size) -> torch.Tensor:
+    """
+    :param volume: volume on the coarse grid
+    :param shape: the shape of the fine grid
+    :return: the volume on the fine grid, constant within each block of 2x2x2 voxels
+    """
+    for axis in range(3):
+        volume = volume.repeat_interleave(2, dim=axis).narrow(axis, 0, shape[axis])
+    return volume
+
+
+class DiffusionMultigridLevel:
+    """
+    The discretised diffusion operator on one level of the multigrid hierarchy.
+    """
+
+    def __init__(self, absorption_per_mm: torch.Tensor, reduced_scattering_per_mm: torch.Tensor, spacing_mm: float):
+        self.shape = absorption_per_mm.shape
+        self.self_coefficients, self.face_coefficients = get_diffusion_operator(absorption_per_mm,
+                                                                                reduced_scattering_per_mm, spacing_mm)
+        self.inverse_diagonal = 1 / get_diagonal(self.self_coefficients, self.face_coefficients)
+
+    def apply(self, fluence: torch.Tensor) -> torch.Tensor:
+        return apply_diffusion_operator(fluence, self.self_coefficients, self.face_coefficients)
+
+    def smooth(self, fluence: torch.Tensor, source: torch.Tensor, iterations: int) -> torch.Tensor:
+        # damped Jacobi iterations, which keep the multigrid cycle symmetric
+        for _ in range(iterations):
+            fluence = fluence + (2 / 3) * self.inverse_diagonal * (source - self.apply(fluence))
+        return fluence
+
+
+def get_multigrid_levels(absorption_per_mm: torch.Tensor, reduced_scattering_per_mm: torch.Tensor,
+                         spacing_mm: float, minimum_size: int = 4) -> List[DiffusionMultigridLevel]:
+    """
+    Creates the hierarchy of operators by discretising the diffusion equation with the optical properties averaged
+    over blocks of 2x2x2 voxels on grids of doubled spacing.
+
+    :param absorption_per_mm: absorption volume in units of per millimeter
+    :param reduced_scattering_per_mm: reduced scattering volume in units of per millimeter
+    :param spacing_mm: the voxel spacing of the volumes
+    :param minimum_size: the grids are coarsened until the shortest axis has less than twice this many voxels
+    :return: list of the levels from the finest to the coarsest grid
+    """
+    levels = [DiffusionMultigridLevel(absorption_per_mm, reduced_scattering_per_mm, spacing_mm)]
+    while min(absorption_per_mm.shape) >= 2 * minimum_size:
+        number_of_voxels = restrict(torch.ones_like(absorption_per_mm))
+        absorption_per_mm = restrict(absorption_per_mm) / number_of_voxels
+        reduced_scattering_per_mm = restrict(reduced_scattering_per_mm) / number_of_voxels
+        spacing_mm = 2 * spacing_mm
+        levels.append(DiffusionMultigridLevel(absorption_per_mm, reduced_scattering_per_mm, spacing_mm))
+    return levels
+
+
+def apply_multigrid_preconditioner(residual: torch.Tensor, levels: List[DiffusionMultigridLevel],
+                                   smoothing_iterations: int = 2, coarse_iterations: int = 20) -> torch.Tensor:
+    """
+    Approximates the solution of the diffusion equation for the given residual with a symmetric V-cycle, such that it
+    can serve as the preconditioner of the conjugate gradient method.
+
+    :param residual: the right hand side on the finest level
+    :param levels: the hierarchy of operators as returned by `get_multigrid_levels`
+    :param smoothing_iterations: the number of Jacobi iterations before and after the coarse grid correction
+    :param coarse_iterations: the number of Jacobi iterations on the coarsest level
+    :return: the approximate solution
+    """
+    level, coarser_levels = levels[0], levels[1:]
+    if not coarser_levels:
+        return level.smooth(torch.zeros_like(residual), residual, coarse_iterations)
+    fluence = level.smooth(torch.zeros_like(residual), residual, smoothing_iterations)
+    # the residual density is averaged and the correction is interpolated as the transposed operation
+    coarse_residual = restrict(residual - level.apply(fluence)) / 8
+    correction = apply_multigrid_preconditioner(coarse_residual, coarser_levels, smoothing_iterations,
+                                                coarse_iterations)
+    fluence = fluence + prolongate(correction, residual.shape)
+    return level.smooth(fluence, residual, smoothing_iterations)
+
+
+def solve_diffusion_equation(absorption_per_mm: np.ndarray, reduced_scattering_per_mm: np.ndarray,
+                             source: np.ndarray, spacing_mm: float,
+                             initial_fluence: Union[np.ndarray, torch.Tensor] = None,
+                             tolerance: float = 1e-5, maximum_iterations: int = 10000,
+                             device: torch.device = torch.device("cpu")) -> Tuple[torch.Tensor, int]:
+    """
+    Solves the steady-state diffusion equation with the conjugate gradient method, which is preconditioned with a
+    geometric multigrid cycle.
+
+    :param absorption_per_mm: absorption volume in units of per millimeter
+    :param reduced_scattering_per_mm: reduced scattering volume in units of per millimeter
+    :param source: the isotropic source of diffuse light in units of per cubic millimeter
+    :param spacing_mm: the voxel spacing of the volumes
+    :param initial_fluence: initial guess of the fluence, e.g. the solution for a similar set of properties, which is
+        copied to `device`
+    :param tolerance: the iteration stops when the norm of the residual is below this fraction of the norm of the
+        source
+    :param maximum_iterations: the maximum number of iterations
+    :param device: the torch device on which the equation is solved
+    :return: tuple of the fluence in units of 1/mm^2 and the number of iterations
+    """
+    absorption_per_mm = torch.as_tensor(absorption_per_mm, dtype=torch.float32, device=device)
+    reduced_scattering_per_mm = torch.as_tensor(reduced_scattering_per_mm, dtype=torch.float32, device=device)
+    source = torch.as_tensor(source, dtype=torch.float32, device=device)
+    levels = get_multigrid_levels(absorption_per_mm, reduced_scattering_per_mm, spacing_mm)
+
+    if initial_fluence is None:
+        fluence = torch.zeros_like(source)
+        residual = source.clone()
+    else:
+        fluence = torch.as_tensor(initial_fluence, dtype=torch.float32, device=device).clone()
+        residual = source - levels[0].apply(fluence)
+    preconditioned_residual = apply_multigrid_preconditioner(residual, levels)
+    search_direction = preconditioned_residual.clone()
+    residual_product = torch.sum(residual * preconditioned_residual, dtype=torch.float64)
+    threshold = tolerance * torch.linalg.norm(source)
+
+    iteration = 0
+    while iteration < maximum_iterations and torch.linalg.norm(residual) > threshold:
+        operator_direction = levels[0].apply(search_direction)
+        step = residual_product / torch.sum(search_direction * operator_direction, dtype=torch.float64)
+        fluence.add_(search_direction, alpha=float(step))
+        residual.sub_(operator_direction, alpha=float(step))
+        preconditioned_residual = apply_multigrid_preconditioner(residual, levels)
+        new_residual_product = torch.sum(residual * preconditioned_residual, dtype=torch.float64)
+        search_direction.mul_(float(new_residual_product / residual_product)).add_(preconditioned_residual)
+        residual_product = new_residual_product
+        iteration += 1
+
+    return fluence, iteration
@@ -0,0 +1,170 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import json
+from typing import Dict, Tuple
+
+import numpy as np
+from scipy.linalg import solve_banded
+
+from simpa.utils import Tags, Settings
+from simpa.core.simulation_modules.optical_simulation_module import OpticalForwardModuleBase
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_diffusion_adapter import \
+    BOUNDARY_REFLECTION_PARAMETER, MINIMUM_TRANSPORT_COEFFICIENT_PER_MM
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter import \
+    sample_photon_sources, move_photons_into_volume
+from simpa.core.device_digital_twins.illumination_geometries.illumination_geometry_base import IlluminationGeometryBase
+
+# relative deviation from the lateral mean up to which a volume is considered to consist of horizontal layers
+LAYERED_VOLUME_TOLERANCE = 1e-5
+
+
+class LayeredDiffusionAdapter(OpticalForwardModuleBase):
+    """
+    This class computes the fluence in volumes that consist of horizontal layers, e.g. phantoms that are built only
+    from a background and `HorizontalLayerStructure` s, under a broad illumination from the top of the volume.
+    In such a volume, the fluence only depends on the depth, such that the diffusion approximation of the radiative
+    transfer equation reduces to a one-dimensional problem along the z-axis:
+
+        - d/dz(D dphi/dz) + mu_a phi = mu_s' phi_collimated,  D = 1 / (3 (mu_a + mu_s'))
+
+    It is discretised with finite volumes in the same way as by the `DiffusionFluenceAdapter`, but without lateral
+    boundaries, and the resulting tridiagonal system is solved directly, which takes milliseconds per wavelength.
+    The depth profile of the fluence per unit of incident radiant exposure is multiplied with the radiant exposure
+    of the illumination geometry on the x-y grid, such that the result is normalised in the same way as by the
+    `MCXAdapter`. This is only accurate for beams that are wide compared to the transport mean free path.
+
+    If the optical properties vary laterally, their means over each x-y plane are used and a warning is logged.
+    """
+
+    def __init__(self, global_settings: Settings):
+        """
+        :param global_settings: global settings used during simulations
+        """
+        super(LayeredDiffusionAdapter, self).__init__(global_settings=global_settings)
+        self.incident_exposures = {}
+
+    def forward_model(self,
+                      absorption_cm: np.ndarray,
+                      scattering_cm: np.ndarray,
+                      anisotropy: np.ndarray,
+                      illumination_geometry: IlluminationGeometryBase) -> Dict:
+        """
+        solves the one-dimensional diffusion equation for the layers of the volume and the given illumination
+        geometry.
+
+        :param absorption_cm: array containing the absorption of the tissue in `cm` units
+        :param scattering_cm: array containing the scattering of the tissue in `cm` units
+        :param anisotropy: array containing the anisotropy of the volume defined by `absorption_cm` and `scattering_cm`
+        :param illumination_geometry: and instance of `IlluminationGeometryBase` defining the illumination geometry
+        :return: `Dict` containing the fluence in units of J/cm^2
+        """
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        absorption_per_mm = np.asarray(absorption_cm, dtype=np.float64) / 10
+        reduced_scattering_per_mm = np.asarray(scattering_cm, dtype=np.float64) * (1 - anisotropy) / 10
+        shape = np.shape(absorption_per_mm)
+
+        absorption_profile, absorption_is_layered = get_depth_profile(absorption_per_mm)
+        reduced_scattering_profile, reduced_scattering_is_layered = get_depth_profile(reduced_scattering_per_mm)
+        if not (absorption_is_layered and reduced_scattering_is_layered):
+            self.logger.warning("The optical properties vary within horizontal layers, the layered diffusion model "
+                                "uses their means over each layer.")
+
+        source = illumination_geometry.get_mcx_illuminator_definition(self.global_settings)
+        exposure_key = (json.dumps(source, sort_keys=True, default=float), shape, spacing_mm)
+        if exposure_key not in self.incident_exposures:
+            if Tags.OPTICAL_MODEL_NUMBER_PHOTONS in self.component_settings:
+                number_of_rays = int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS])
+            else:
+                number_of_rays = 100000
+            self.incident_exposures[exposure_key] = get_incident_exposure(source, shape, spacing_mm, number_of_rays)
+        exposure, direction_cosine, enters_through_top = self.incident_exposures[exposure_key]
+        if not enters_through_top:
+            self.logger.warning("Parts of the illumination do not enter the volume through its top surface, which is "
+                                "not accounted for by the layered diffusion model.")
+
+        collimated_fluence, diffuse_fluence = solve_layered_diffusion_equation(
+            absorption_profile, reduced_scattering_profile, spacing_mm, direction_cosine)
+        depth_profile = (collimated_fluence + diffuse_fluence) * 100  # Convert from J/mm^2 to J/cm^2
+        fluence = exposure.astype(np.float32)[:, :, None] * depth_profile.astype(np.float32)[None, None, :]
+        return {Tags.DATA_FIELD_FLUENCE: fluence}
+
+
+def get_depth_profile(volume: np.ndarray) -> Tuple[np.ndarray, bool]:
+    """
+    :param volume: volume of an optical property
+    :return: tuple of the means of the volume over each x-y plane and whether the volume deviates from them by at
+        most `LAYERED_VOLUME_TOLERANCE`
+    """
+    profile = np.mean(volume, axis=(0, 1))
+    is_layered = np.allclose(volume, profile[None, None, :], rtol=LAYERED_VOLUME_TOLERANCE, atol=0)
+    return profile, is_layered
+
+
+def get_incident_exposure(source: dict, shape: Tuple[int, int, int], spacing_mm: float,
+                          number_of_rays: int, random_seed: int = 0) -> Tuple[np.ndarray, float, bool]:
+    """
+    Traces rays from the given source onto the volume and bins the positions at which they enter it on the x-y grid.
+
+    :param source: mcx illuminator definition as given by `IlluminationGeometryBase.get_mcx_illuminator_definition`
+    :param shape: the shape of the volume
+    :param spacing_mm: the voxel spacing of the volume
+    :param number_of_rays: the number of rays that sample the source
+    :param random_seed: the seed of the positions of the rays within the source
+    :return: tuple of the radiant exposure on the x-y grid normalised to the energy of the source in units of
+        1/mm^2, the mean cosine between the rays and the z-axis, and whether all rays that hit the volume enter it
+        through its top surface
+    """
+    random_generator = np.random.default_rng(random_seed)
+    positions, directions = sample_photon_sources(source, number_of_rays, random_generator)
+    hits_volume = move_photons_into_volume(positions, directions, shape)
+    positions, directions = positions[hits_volume], directions[hits_volume]
+    enters_through_top = bool(np.all(np.isclose(positions[:, 2], 0, atol=1e-6) & (directions[:, 2] > 0)))
+    direction_cosine = float(np.mean(np.abs(directions[:, 2]))) if len(directions) else 1.0
+    x = np.clip(positions[:, 0].astype(np.int64), 0, shape[0] - 1)
+    y = np.clip(positions[:, 1].astype(np.int64), 0, shape[1] - 1)
+    exposure = np.bincount(x * shape[1] + y, minlength=shape[0] * shape[1]).reshape(shape[:2])
+    return exposure / (number_of_rays * spacing_mm ** 2), direction_cosine, enters_through_top
+
+
+def solve_layered_diffusion_equation(absorption_per_mm: np.ndarray, reduced_scattering_per_mm: np.ndarray,
+                                     spacing_mm: float, direction_cosine: float = 1.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solves the one-dimensional diffusion equation of a stack of layers that is illuminated by a collimated beam from
+    the top. The collimated fluence is averaged over each layer, the diffusion coefficients at the interfaces are the
+    harmonic means of the adjacent layers and the Robin boundary condition phi + 2 A D d(phi)/dn = 0 is applied at the
+    top and bottom surface.
+
+    :param absorption_per_mm: absorption of the layers from the top to the bottom in units of per millimeter
+    :param reduced_scattering_per_mm: reduced scattering of the layers in units of per millimeter
+    :param spacing_mm: the thickness of each layer
+    :param direction_cosine: the cosine between the collimated beam and the z-axis
+    :return: tuple of the collimated and the diffuse fluence per unit of incident radiant exposure in each layer
+    """
+    absorption_per_mm = np.asarray(absorption_per_mm, dtype=np.float64)
+    reduced_scattering_per_mm = np.asarray(reduced_scattering_per_mm, dtype=np.float64)
+    interaction_per_mm = absorption_per_mm + reduced_scattering_per_mm
+
+    # the attenuation along the oblique path through each layer
+    optical_thickness = interaction_per_mm * spacing_mm / direction_cosine
+    transmission = np.exp(-np.concatenate([[0], np.cumsum(optical_thickness)[:-1]]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        layer_average = np.where(optical_thickness > 0, -np.expm1(-optical_thickness) / optical_thickness, 1)
+    collimated_fluence = transmission * layer_average / direction_cosine
+
+    diffusion_coefficient = 1 / (3 * np.maximum(interaction_per_mm, MINIMUM_TRANSPORT_COEFFICIENT_PER_MM))
+    face_coefficients = 2 * diffusion_coefficient[:-1] * diffusion_coefficient[1:] / (
+        (diffusion_coefficient[:-1] + diffusion_coefficient[1:]) * spacing_mm ** 2)
+    boundary_coefficients = 1 / (spacing_mm * (spacing_mm / (2 * diffusion_coefficient[[0, -1]]) +
+                                               2 * BOUNDARY_REFLECTION_PARAMETER))
+    # the tridiagonal matrix in the banded form of `scipy.linalg.solve_banded`
+    banded_matrix = np.zeros((3, len(absorption_per_mm)))
+    banded_matrix[0, 1:] = -face_coefficients
+    banded_matrix[1] = absorption_per_mm
+    banded_matrix[1, :-1] += face_coefficients
+    banded_matrix[1, 1:] += face_coefficients
+    np.add.at(banded_matrix[1], [0, -1], boundary_coefficients)
+    banded_matrix[2, :-1] = -face_coefficients
+    diffuse_fluence = solve_banded((1, 1), banded_matrix, reduced_scattering_per_mm * collimated_fluence)
+    return collimated_fluence, diffuse_fluence
@@ -10,7 +10,11 @@ from simpa.core.device_digital_twins.illumination_geometries.illumination_geomet
 import json
 import os
 import gc
-from typing import List, Dict, Tuple
+import shutil
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Tuple, Iterator
 
 
 class MCXAdapter(OpticalForwardModuleBase):
@@ -35,6 +39,8 @@ class MCXAdapter(OpticalForwardModuleBase):
         super(MCXAdapter, self).__init__(global_settings=global_settings)
         self.mcx_json_config_file = None
         self.mcx_volumetric_data_file = None
+        self.mcx_medium_file = None
+        self.temporary_directory = None
         self.frames = None
         self.mcx_output_suffixes = {'mcx_volumetric_data_file': '.mc2'}
 
@@ -56,32 +62,172 @@ class MCXAdapter(OpticalForwardModuleBase):
         :return: `Dict` containing the results of optical simulations, the keys in this dictionary-like object
             depend on the Tags defined in `self.component_settings`
         """
-        if Tags.MCX_ASSUMED_ANISOTROPY in self.component_settings:
-            _assumed_anisotropy = self.component_settings[Tags.MCX_ASSUMED_ANISOTROPY]
-        else:
-            _assumed_anisotropy = 0.9
+        _assumed_anisotropy = self.get_assumed_anisotropy()
 
-        self.generate_mcx_bin_input(absorption_cm=absorption_cm,
-                                    scattering_cm=scattering_cm,
-                                    anisotropy=anisotropy,
-                                    assumed_anisotropy=_assumed_anisotropy)
+        with self.scratch_directory(self.get_scratch_size_bytes(np.shape(absorption_cm))):
+            self.generate_mcx_bin_input(absorption_cm=absorption_cm,
+                                        scattering_cm=scattering_cm,
+                                        anisotropy=anisotropy,
+                                        assumed_anisotropy=_assumed_anisotropy)
 
-        settings_dict = self.get_mcx_settings(illumination_geometry=illumination_geometry,
-                                              assumed_anisotropy=_assumed_anisotropy)
+            settings_dict = self.get_mcx_settings(illumination_geometry=illumination_geometry,
+                                                  assumed_anisotropy=_assumed_anisotropy)
 
-        print(settings_dict)
-        self.generate_mcx_json_input(settings_dict=settings_dict)
-        # run the simulation
-        cmd = self.get_command()
-        self.run_mcx(cmd)
+            print(settings_dict)
+            self.generate_mcx_json_input(settings_dict=settings_dict)
+            # run the simulation
+            cmd = self.get_command()
+            self.run_mcx(cmd)
 
-        # Read output
-        results = self.read_mcx_output()
+            # Read output
+            results = self.read_mcx_output()
 
-        # clean temporary files
-        self.remove_mcx_output()
+            # clean temporary files
+            self.remove_mcx_output()
         return results
 
+    def iterate_forward_model(self,
+                              absorption_cm: np.ndarray,
+                              scattering_cm: np.ndarray,
+                              anisotropy: np.ndarray,
+                              illumination_geometries: List[IlluminationGeometryBase]) -> Iterator[Tuple[int, Dict]]:
+        """
+        runs MCX for each of the given illumination geometries. The binary file containing the volumes is written once
+        to the scratch directory and shared by all runs, while the configuration and the output of every run are kept
+        in a temporary directory of their own. Up to `Tags.MCX_NUMBER_OF_PARALLEL_RUNS` MCX processes run concurrently
+        and the results of each run are read and yielded as soon as it has finished. Illumination geometries whose
+        results are found in the cache are not simulated again.
+
+        :param absorption_cm: array containing the absorption of the tissue in `cm` units
+        :param scattering_cm: array containing the scattering of the tissue in `cm` units
+        :param anisotropy: array containing the anisotropy of the volume defined by `absorption_cm` and `scattering_cm`
+        :param illumination_geometries: list of instances of `IlluminationGeometryBase`
+        :return: iterator over tuples of the index of the illumination geometry and the results of its simulation, in
+            the order in which the simulations finish
+        """
+        _assumed_anisotropy = self.get_assumed_anisotropy()
+        if Tags.MCX_NUMBER_OF_PARALLEL_RUNS in self.component_settings:
+            number_of_parallel_runs = self.component_settings[Tags.MCX_NUMBER_OF_PARALLEL_RUNS]
+        else:
+            number_of_parallel_runs = 1
+
+        cache_keys = dict()
+        if self.fluence_cache is not None:
+            for index, illumination_geometry in enumerate(illumination_geometries):
+                cache_keys[index] = self.get_cache_key(absorption_cm, scattering_cm, anisotropy, illumination_geometry)
+                results = self.fluence_cache.load(cache_keys[index])
+                if results is not None:
+                    del cache_keys[index]
+                    yield index, results
+            if not cache_keys:
+                return
+
+        number_of_runs = len(illumination_geometries) if self.fluence_cache is None else len(cache_keys)
+        with self.scratch_directory(self.get_scratch_size_bytes(np.shape(absorption_cm),
+                                                                min(number_of_parallel_runs, number_of_runs))) \
+                as simulation_directory:
+            self.generate_mcx_bin_input(absorption_cm=absorption_cm,
+                                        scattering_cm=scattering_cm,
+                                        anisotropy=anisotropy,
+                                        assumed_anisotropy=_assumed_anisotropy)
+            with ThreadPoolExecutor(max_workers=number_of_parallel_runs) as executor:
+                runs = dict()
+                for index, illumination_geometry in enumerate(illumination_geometries):
+                    if self.fluence_cache is not None and index not in cache_keys:
+                        continue
+                    self.temporary_directory = os.path.join(simulation_directory, str(index))
+                    os.mkdir(self.temporary_directory)
+                    settings_dict = self.get_mcx_settings(illumination_geometry=illumination_geometry,
+                                                          assumed_anisotropy=_assumed_anisotropy)
+                    self.generate_mcx_json_input(settings_dict=settings_dict)
+                    output_files = {name: getattr(self, name) for name in self.mcx_output_suffixes}
+                    runs[executor.submit(self.run_mcx, self.get_command())] = (index, self.temporary_directory,
+                                                                               output_files)
+
+                for future in as_completed(runs):
+                    future.result()
+                    index, run_directory, output_files = runs[future]
+                    for name, path in output_files.items():
+                        setattr(self, name, path)
+                    results = self.read_mcx_output()
+                    shutil.rmtree(run_directory)
+                    if index in cache_keys:
+                        self.fluence_cache.store(cache_keys[index], results)
+                    yield index, results
+
+    @contextmanager
+    def scratch_directory(self, required_bytes: int = 0):
+        """
+        Creates a temporary directory for the input and output files of MCX in the scratch directory, see
+        `self.get_scratch_directory`, and removes it with all its contents afterwards. Within the context,
+        `self.temporary_directory` is set to the created directory.
+
+        :param required_bytes: the expected size of the files in the temporary directory
+        :return: context manager that yields the path of the temporary directory
+        """
+        directory = tempfile.mkdtemp(prefix=self.global_settings[Tags.VOLUME_NAME] + "_",
+                                     dir=self.get_scratch_directory(required_bytes))
+        self.temporary_directory = directory
+        try:
+            yield directory
+        finally:
+            self.temporary_directory = None
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def get_scratch_directory(self, required_bytes: int = 0) -> str:
+        """
+        :param required_bytes: the expected size of the files exchanged with MCX
+        :return: Tags.MCX_SCRATCH_DIRECTORY if it is given, otherwise /dev/shm if it is available and has enough free
+            space, such that the files exchanged with MCX are kept in memory, and the simulation path as a last resort
+        """
+        if Tags.MCX_SCRATCH_DIRECTORY in self.component_settings:
+            return self.component_settings[Tags.MCX_SCRATCH_DIRECTORY]
+        if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            free_bytes = shutil.disk_usage("/dev/shm").free
+            if free_bytes >= required_bytes:
+                return "/dev/shm"
+            self.logger.debug(f"/dev/shm has only {free_bytes} of the {required_bytes} bytes required by MCX, the "
+                              f"files are kept in the simulation path instead.")
+        return self.global_settings[Tags.SIMULATION_PATH]
+
+    def get_scratch_size_bytes(self, shape: Tuple[int, int, int], number_of_runs: int = 1) -> int:
+        """
+        :param shape: the shape of the simulated volume
+        :param number_of_runs: the number of MCX runs whose output is kept at the same time
+        :return: an upper bound of the size of the medium file, which holds two float32 values per voxel, and of the
+            float32 fluence of every time frame written by each run. One padded layer of the volume is included.
+        """
+        number_of_voxels = int(shape[0]) * int(shape[1]) * (int(shape[2]) + 1)
+        return number_of_voxels * 4 * (2 + number_of_runs * self.get_number_of_time_frames())
+
+    def get_number_of_time_frames(self) -> int:
+        """
+        :return: the number of time frames of the fluence computed by MCX, Tags.TOTAL_TIME over Tags.TIME_STEP
+        """
+        if Tags.TIME_STEP and Tags.TOTAL_TIME in self.component_settings:
+            return int(self.component_settings[Tags.TOTAL_TIME] / self.component_settings[Tags.TIME_STEP])
+        return 1
+
+    def get_assumed_anisotropy(self) -> float:
+        """
+        :return: the anisotropy that is assumed for the whole volume in the MCX simulations, 0.9 by default
+        """
+        if Tags.MCX_ASSUMED_ANISOTROPY in self.component_settings:
+            return self.component_settings[Tags.MCX_ASSUMED_ANISOTROPY]
+        return 0.9
+
+    def get_temporary_file_path(self, suffix: str) -> str:
+        """
+        :param suffix: suffix of the file name, including the file extension
+        :return: path of a temporary file named after the volume in `self.temporary_directory`, or in the simulation
+            path if no temporary directory is in use
+        """
+        if self.temporary_directory is None:
+            directory = self.global_settings[Tags.SIMULATION_PATH]
+        else:
+            directory = self.temporary_directory
+        return directory + "/" + self.global_settings[Tags.VOLUME_NAME] + suffix
+
     def generate_mcx_json_input(self, settings_dict: Dict) -> None:
         """
         generates JSON serializable file with settings needed by MCX to run simulations.
@@ -89,8 +235,7 @@ class MCXAdapter(OpticalForwardModuleBase):
         :param settings_dict: dictionary to be saved as .json
         :return: None
         """
-        tmp_json_filename = self.global_settings[Tags.SIMULATION_PATH] + "/" + \
-            self.global_settings[Tags.VOLUME_NAME] + ".json"
+        tmp_json_filename = self.get_temporary_file_path(".json")
         self.mcx_json_config_file = tmp_json_filename
         self.temporary_output_files.append(tmp_json_filename)
         with open(tmp_json_filename, "w") as json_file:
@@ -109,8 +254,7 @@ class MCXAdapter(OpticalForwardModuleBase):
         :param kwargs: dummy, used for class inheritance
         :return: dictionary with settings to be used by MCX
         """
-        mcx_volumetric_data_file = self.global_settings[Tags.SIMULATION_PATH] + "/" + \
-            self.global_settings[Tags.VOLUME_NAME] + "_output"
+        mcx_volumetric_data_file = self.get_temporary_file_path("_output")
         for name, suffix in self.mcx_output_suffixes.items():
             self.__setattr__(name, mcx_volumetric_data_file + suffix)
             self.temporary_output_files.append(mcx_volumetric_data_file + suffix)
@@ -120,7 +264,7 @@ class MCXAdapter(OpticalForwardModuleBase):
         else:
             time = 5e-09
             dt = 5e-09
-        self.frames = int(time / dt)
+        self.frames = self.get_number_of_time_frames()
 
         source = illumination_geometry.get_mcx_illuminator_definition(self.global_settings)
         settings_dict = {
@@ -157,8 +301,7 @@ class MCXAdapter(OpticalForwardModuleBase):
                 ],
                 "MediaFormat": "muamus_float",
                 "Dim": [self.nx, self.ny, self.nz],
-                "VolumeFile": self.global_settings[Tags.SIMULATION_PATH] + "/" +
-                self.global_settings[Tags.VOLUME_NAME] + ".bin"
+                "VolumeFile": self.mcx_medium_file
             }}
         if Tags.MCX_SEED not in self.component_settings:
             if Tags.RANDOM_SEED in self.global_settings:
@@ -221,8 +364,8 @@ class MCXAdapter(OpticalForwardModuleBase):
         op_array = np.stack([absorption_mm, scattering_mm], axis=-1, dtype=np.float32)
         [self.nx, self.ny, self.nz, _] = np.shape(op_array)
         # # create a binary of the volume
-        tmp_input_path = self.global_settings[Tags.SIMULATION_PATH] + "/" + \
-            self.global_settings[Tags.VOLUME_NAME] + ".bin"
+        tmp_input_path = self.get_temporary_file_path(".bin")
+        self.mcx_medium_file = tmp_input_path
         self.temporary_output_files.append(tmp_input_path)
         # write array in 'C' order to binary file
         op_array.tofile(tmp_input_path)
@@ -234,15 +377,25 @@ class MCXAdapter(OpticalForwardModuleBase):
         :param kwargs: dummy, used for class inheritance compatibility
         :return: `Dict` instance containing the MCX output
         """
-        shape = [self.nx, self.ny, self.nz, self.frames]
-        fluence = np.fromfile(self.mcx_volumetric_data_file, dtype=np.float32).reshape(shape, order='F')
-        fluence *= 100  # Convert from J/mm^2 to J/cm^2
+        # the output is mapped into memory and converted from J/mm^2 to J/cm^2 while it is copied out of the mapping
+        mcx_output = self.map_mcx_output()
+        fluence = np.multiply(np.asarray(mcx_output), np.float32(100))
+        del mcx_output
         if np.shape(fluence)[3] == 1:
             fluence = np.squeeze(fluence, 3)
         results = dict()
         results[Tags.DATA_FIELD_FLUENCE] = fluence
         return results
 
+    def map_mcx_output(self) -> np.memmap:
+        """
+        maps the volumetric `.mc2` output of MCX into memory without reading it
+
+        :return: read-only array of shape `(nx, ny, nz, frames)` in `F` order
+        """
+        shape = (self.nx, self.ny, self.nz, self.frames)
+        return np.memmap(self.mcx_volumetric_data_file, dtype=np.float32, mode="r", shape=shape, order='F')
+
     def remove_mcx_output(self) -> None:
         """
         deletes temporary MCX output files from the file system
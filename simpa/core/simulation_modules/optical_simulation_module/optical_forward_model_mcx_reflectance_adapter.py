@@ -3,14 +3,166 @@
 # SPDX-License-Identifier: MIT
 import numpy as np
 import struct
-import jdata
 import os
-from typing import List, Tuple, Dict, Union
+from typing import List, Tuple, Dict, Union, Iterator
 
 from simpa.utils import Tags, Settings
 from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_adapter import MCXAdapter
 from simpa.core.device_digital_twins import IlluminationGeometryBase, PhotoacousticDevice
 
+# header of every block of photons in an `.mch` file as written by MCX
+MCH_HEADER = np.dtype([("magic", "S4"),
+                       ("version", "<u4"),
+                       ("maxmedia", "<u4"),
+                       ("detnum", "<u4"),
+                       ("colcount", "<u4"),
+                       ("totalphoton", "<u4"),
+                       ("detected", "<u4"),
+                       ("savedphoton", "<u4"),
+                       ("unitinmm", "<f4"),
+                       ("seedbyte", "<u4"),
+                       ("normalizer", "<f4"),
+                       ("respin", "<i4"),
+                       ("srcnum", "<u4"),
+                       ("savedetflag", "<u4"),
+                       ("reserved", "<i4", (2,))])
+MCH_MAGIC = b"MCXH"
+# quantities that MCX saves for every detected photon in the order of the bits of the `savedetflag` and their number
+# of columns, None stands for one column per medium
+MCH_COLUMNS = [("detector_id", 1),
+               ("number_of_scattering_events", None),
+               ("partial_path_length", None),
+               ("momentum_transfer", None),
+               ("exit_position", 3),
+               ("exit_direction", 3),
+               ("initial_weight", 1),
+               ("stokes_vector", 4)]
+MCH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_mch_columns(header: np.void) -> Dict[str, slice]:
+    """
+    determines which columns of the photon records in an `.mch` file hold which quantity
+
+    :param header: header of a block of photons as read by `iterate_mch_file`
+    :return: dictionary mapping the names in `MCH_COLUMNS` of the saved quantities to their columns
+    """
+    save_detector_flag = int(header["savedetflag"])
+    if save_detector_flag == 0:
+        raise ValueError("The .mch file does not specify which quantities were saved for the detected photons.")
+    columns = dict()
+    start = 0
+    for bit, (name, number_of_columns) in enumerate(MCH_COLUMNS):
+        if save_detector_flag & (1 << bit):
+            number_of_columns = int(header["maxmedia"]) if number_of_columns is None else number_of_columns
+            columns[name] = slice(start, start + number_of_columns)
+            start += number_of_columns
+    if start != int(header["colcount"]):
+        raise ValueError(f"The .mch file has {int(header['colcount'])} columns per photon, but its save flag "
+                         f"{save_detector_flag} describes {start}.")
+    return columns
+
+
+def iterate_mch_file(path: str, chunk_size: int = MCH_CHUNK_SIZE) -> Iterator[Tuple[np.void, Iterator[np.ndarray]]]:
+    """
+    reads the binary `.mch` file in which MCX saves the detected photons. The file consists of blocks of a header
+    followed by the photon records and optionally their random seeds. The records are read in chunks of
+    `chunk_size` photons straight into `float32` arrays, such that not all photons have to be held in memory at once.
+
+    :param path: path to the `.mch` file
+    :param chunk_size: maximum number of photons per chunk
+    :return: iterator over tuples of the header of a block and an iterator over the chunks of its photons, which are
+        arrays of shape `(number of photons, colcount)`. The chunks of a block have to be read before the next block.
+    """
+    with open(path, "rb") as mch_file:
+        while True:
+            header_bytes = mch_file.read(MCH_HEADER.itemsize)
+            if len(header_bytes) == 0:
+                return
+            if len(header_bytes) < MCH_HEADER.itemsize:
+                raise ValueError(f"The .mch file {path} ends within a header.")
+            header = np.frombuffer(header_bytes, dtype=MCH_HEADER)[0]
+            if header["magic"] != MCH_MAGIC:
+                raise ValueError(f"{path} is not an .mch file written by MCX.")
+            number_of_photons = int(header["savedphoton"])
+            number_of_columns = int(header["colcount"])
+            block_end = mch_file.tell() + number_of_photons * (number_of_columns * 4 + int(header["seedbyte"]))
+
+            def iterate_chunks():
+                for start in range(0, number_of_photons, chunk_size):
+                    count = min(chunk_size, number_of_photons - start) * number_of_columns
+                    photons = np.fromfile(mch_file, dtype="<f4", count=count)
+                    if photons.size < count:
+                        raise ValueError(f"The .mch file {path} ends within the photon records.")
+                    yield photons.reshape(-1, number_of_columns)
+
+            yield header, iterate_chunks()
+            mch_file.seek(block_end)
+
+
+def bin_photon_exit_positions(image: np.ndarray, positions: np.ndarray) -> None:
+    """
+    adds the number of photons that exit through each voxel of the x-y grid to the image. Photons outside of the grid
+    are ignored.
+
+    :param image: array of shape `(nx, ny)` to which the photons are added
+    :param positions: exit positions of the photons in voxel units as an array of shape `(number of photons, 3)`
+    :return: None
+    """
+    x = np.floor(positions[:, 0]).astype(np.int64)
+    y = np.floor(positions[:, 1]).astype(np.int64)
+    inside = (x >= 0) & (x < image.shape[0]) & (y >= 0) & (y < image.shape[1])
+    image += np.bincount(x[inside] * image.shape[1] + y[inside], minlength=image.size).reshape(image.shape)
+
+
+class PhotonExitData:
+    """
+    Collects the exit positions and directions of detected photons in preallocated arrays that grow geometrically,
+    such that photons can be appended chunk by chunk and illuminator by illuminator without keeping lists of arrays
+    that have to be concatenated in the end.
+    """
+
+    def __init__(self):
+        self.number_of_photons = 0
+        self._positions = np.empty((0, 3), dtype=np.float32)
+        self._directions = np.empty((0, 3), dtype=np.float32)
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self._positions[:self.number_of_photons]
+
+    @property
+    def directions(self) -> np.ndarray:
+        return self._directions[:self.number_of_photons]
+
+    def reserve(self, capacity: int) -> None:
+        """
+        makes sure that at least `capacity` photons fit into the arrays
+
+        :param capacity: number of photons
+        :return: None
+        """
+        if capacity <= len(self._positions):
+            return
+        positions = np.empty((capacity, 3), dtype=np.float32)
+        directions = np.empty((capacity, 3), dtype=np.float32)
+        positions[:self.number_of_photons] = self.positions
+        directions[:self.number_of_photons] = self.directions
+        self._positions, self._directions = positions, directions
+
+    def append(self, positions: np.ndarray, directions: np.ndarray) -> None:
+        """
+        :param positions: exit positions of the photons as an array of shape `(number of photons, 3)`
+        :param directions: exit directions of the photons as an array of shape `(number of photons, 3)`
+        :return: None
+        """
+        number_of_photons = self.number_of_photons + len(positions)
+        if number_of_photons > len(self._positions):
+            self.reserve(max(number_of_photons, 2 * len(self._positions)))
+        self._positions[self.number_of_photons:number_of_photons] = positions
+        self._directions[self.number_of_photons:number_of_photons] = directions
+        self.number_of_photons = number_of_photons
+
 
 class MCXAdapterReflectance(MCXAdapter):
     """
@@ -38,8 +190,8 @@ class MCXAdapterReflectance(MCXAdapter):
         super(MCXAdapterReflectance, self).__init__(global_settings=global_settings)
         self.mcx_photon_data_file = None
         self.padded = None
-        self.mcx_output_suffixes = {'mcx_volumetric_data_file': '.jnii',
-                                    'mcx_photon_data_file': '_detp.jdat'}
+        self.mcx_output_suffixes = {'mcx_volumetric_data_file': '.mc2',
+                                    'mcx_photon_data_file': '.mch'}
 
     def forward_model(self,
                       absorption_cm: np.ndarray,
@@ -61,34 +213,53 @@ class MCXAdapterReflectance(MCXAdapter):
         :return: `Settings` containing the results of optical simulations, the keys in this dictionary-like object
             depend on the Tags defined in `self.component_settings`
         """
-        if Tags.MCX_ASSUMED_ANISOTROPY in self.component_settings:
-            _assumed_anisotropy = self.component_settings[Tags.MCX_ASSUMED_ANISOTROPY]
-        else:
-            _assumed_anisotropy = 0.9
+        _assumed_anisotropy = self.get_assumed_anisotropy()
 
-        self.generate_mcx_bin_input(absorption_cm=absorption_cm,
-                                    scattering_cm=scattering_cm,
-                                    anisotropy=_assumed_anisotropy,
-                                    assumed_anisotropy=_assumed_anisotropy)
+        with self.scratch_directory(self.get_scratch_size_bytes(np.shape(absorption_cm))):
+            self.generate_mcx_bin_input(absorption_cm=absorption_cm,
+                                        scattering_cm=scattering_cm,
+                                        anisotropy=_assumed_anisotropy,
+                                        assumed_anisotropy=_assumed_anisotropy)
 
-        settings_dict = self.get_mcx_settings(illumination_geometry=illumination_geometry,
-                                              assumed_anisotropy=_assumed_anisotropy,
-                                              )
+            settings_dict = self.get_mcx_settings(illumination_geometry=illumination_geometry,
+                                                  assumed_anisotropy=_assumed_anisotropy,
+                                                  )
 
-        print(settings_dict)
-        self.generate_mcx_json_input(settings_dict=settings_dict)
-        # run the simulation
-        cmd = self.get_command()
-        self.run_mcx(cmd)
+            print(settings_dict)
+            self.generate_mcx_json_input(settings_dict=settings_dict)
+            # run the simulation
+            cmd = self.get_command()
+            self.run_mcx(cmd)
 
-        # Read output
-        results = self.read_mcx_output()
-        struct._clearcache()
+            # Read output
+            results = self.read_mcx_output()
+            struct._clearcache()
 
-        # clean temporary files
-        self.remove_mcx_output()
+            # clean temporary files
+            self.remove_mcx_output()
         return results
 
+    def iterate_forward_model(self,
+                              absorption_cm: np.ndarray,
+                              scattering_cm: np.ndarray,
+                              anisotropy: np.ndarray,
+                              illumination_geometries: List[IlluminationGeometryBase]) -> Iterator[Tuple[int, Dict]]:
+        """
+        runs the MCX simulations of the given illumination geometries as in `MCXAdapter.iterate_forward_model`. As in
+        `self.forward_model`, the assumed anisotropy is used for the whole volume.
+
+        :param absorption_cm: array containing the absorption of the tissue in `cm` units
+        :param scattering_cm: array containing the scattering of the tissue in `cm` units
+        :param anisotropy: array containing the anisotropy of the volume defined by `absorption_cm` and `scattering_cm`
+        :param illumination_geometries: list of instances of `IlluminationGeometryBase`
+        :return: iterator over tuples of the index of the illumination geometry and the results of its simulation
+        """
+        return super(MCXAdapterReflectance, self).iterate_forward_model(
+            absorption_cm=absorption_cm,
+            scattering_cm=scattering_cm,
+            anisotropy=self.get_assumed_anisotropy(),
+            illumination_geometries=illumination_geometries)
+
     def get_command(self) -> List:
         """
         generates list of commands to be parse to MCX in a subprocess
@@ -102,20 +273,41 @@ class MCXAdapterReflectance(MCXAdapter):
         cmd.append("-O")
         cmd.append("F")
         cmd.append("-F")
-        cmd.append("jnii")
-        if Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and \
-                self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]:
+        cmd.append("mc2")
+        save_photon_direction = Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and \
+            self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]
+        save_photon_exit_image = Tags.COMPUTE_PHOTON_EXIT_IMAGE in self.component_settings and \
+            self.component_settings[Tags.COMPUTE_PHOTON_EXIT_IMAGE]
+        if save_photon_direction or save_photon_exit_image:
             cmd.append("-H")
             cmd.append(f"{int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS])}")
-            cmd.append("--bc")  # save photon exit position and direction
+            cmd.append("--bc")  # save photon exit position and direction to the binary .mch file
             cmd.append("______000010")
             cmd.append("--savedetflag")
-            cmd.append("XV")
+            cmd.append("XV" if save_photon_direction else "X")
         if Tags.COMPUTE_DIFFUSE_REFLECTANCE in self.component_settings and \
                 self.component_settings[Tags.COMPUTE_DIFFUSE_REFLECTANCE]:
             cmd.append("--saveref")  # save diffuse reflectance at 0 filled voxels outside of domain
         return cmd
 
+    def get_scratch_size_bytes(self, shape: Tuple[int, int, int], number_of_runs: int = 1) -> int:
+        """
+        :param shape: the shape of the simulated volume
+        :param number_of_runs: the number of MCX runs whose output is kept at the same time
+        :return: the size of the medium and fluence files, see `MCXAdapter.get_scratch_size_bytes`, and of the
+            float32 exit positions and directions of at most Tags.OPTICAL_MODEL_NUMBER_PHOTONS detected photons per run
+        """
+        size_bytes = super(MCXAdapterReflectance, self).get_scratch_size_bytes(shape, number_of_runs)
+        save_photon_direction = Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and \
+            self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]
+        save_photon_exit_image = Tags.COMPUTE_PHOTON_EXIT_IMAGE in self.component_settings and \
+            self.component_settings[Tags.COMPUTE_PHOTON_EXIT_IMAGE]
+        if save_photon_direction or save_photon_exit_image:
+            number_of_columns = 6 if save_photon_direction else 3
+            size_bytes += number_of_runs * int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS]) * \
+                number_of_columns * 4
+        return size_bytes
+
     def read_mcx_output(self, **kwargs) -> Dict:
         """
         reads the temporary output generated with MCX
@@ -126,25 +318,64 @@ class MCXAdapterReflectance(MCXAdapter):
         results = dict()
         if os.path.isfile(self.mcx_volumetric_data_file) and self.mcx_volumetric_data_file.endswith(
                 self.mcx_output_suffixes['mcx_volumetric_data_file']):
-            content = jdata.load(self.mcx_volumetric_data_file)
-            fluence = content['NIFTIData']
+            mcx_output = self.map_mcx_output()
+            fluence = np.array(mcx_output)
+            del mcx_output
+            if np.shape(fluence)[3] == 1:
+                fluence = np.squeeze(fluence, 3)
             ref, ref_pos, fluence = self.extract_reflectance_from_fluence(fluence=fluence)
             fluence = self.post_process_volumes(**{'arrays': (fluence,)})[0]
             fluence *= 100  # Convert from J/mm^2 to J/cm^2
             results[Tags.DATA_FIELD_FLUENCE] = fluence
         else:
-            raise FileNotFoundError(f"Could not find .jnii file for {self.mcx_volumetric_data_file}")
+            raise FileNotFoundError(f"Could not find .mc2 file for {self.mcx_volumetric_data_file}")
         if Tags.COMPUTE_DIFFUSE_REFLECTANCE in self.component_settings and \
                 self.component_settings[Tags.COMPUTE_DIFFUSE_REFLECTANCE]:
             results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE] = ref
             results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE_POS] = ref_pos
-        if Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and \
-                self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]:
-            content = jdata.load(self.mcx_photon_data_file)
-            photon_pos = content['MCXData']['PhotonData']['p']
-            photon_dir = content['MCXData']['PhotonData']['v']
-            results[Tags.DATA_FIELD_PHOTON_EXIT_POS] = photon_pos
-            results[Tags.DATA_FIELD_PHOTON_EXIT_DIR] = photon_dir
+        if (Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and
+                self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]) or \
+                (Tags.COMPUTE_PHOTON_EXIT_IMAGE in self.component_settings and
+                 self.component_settings[Tags.COMPUTE_PHOTON_EXIT_IMAGE]):
+            results.update(self.read_photon_exit_data())
+        return results
+
+    def read_photon_exit_data(self) -> Dict:
+        """
+        reads the photons detected by MCX chunk by chunk from its binary `.mch` output. If
+        `Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT` is set, their exit positions and directions are copied into arrays that
+        are allocated once per block of photons. If `Tags.COMPUTE_PHOTON_EXIT_IMAGE` is set, the exit positions are
+        binned into an image on the x-y grid, which is normalized by the number of simulated photons.
+
+        :return: dictionary containing the requested photon exit data
+        """
+        save_photon_direction = Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and \
+            self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]
+        save_photon_exit_image = Tags.COMPUTE_PHOTON_EXIT_IMAGE in self.component_settings and \
+            self.component_settings[Tags.COMPUTE_PHOTON_EXIT_IMAGE]
+        photon_exit_data = PhotonExitData()
+        photon_exit_image = np.zeros((self.nx, self.ny))
+        number_of_simulated_photons = 0
+        for header, photon_chunks in iterate_mch_file(self.mcx_photon_data_file):
+            columns = get_mch_columns(header)
+            if "exit_position" not in columns or (save_photon_direction and "exit_direction" not in columns):
+                raise ValueError(f"The exit positions and directions were not saved in {self.mcx_photon_data_file}")
+            # a positive respin means that the simulation was repeated as often
+            number_of_simulated_photons += int(header["totalphoton"]) * max(int(header["respin"]), 1)
+            if save_photon_direction:
+                photon_exit_data.reserve(photon_exit_data.number_of_photons + int(header["savedphoton"]))
+            for photons in photon_chunks:
+                if save_photon_direction:
+                    photon_exit_data.append(photons[:, columns["exit_position"]],
+                                            photons[:, columns["exit_direction"]])
+                if save_photon_exit_image:
+                    bin_photon_exit_positions(photon_exit_image, photons[:, columns["exit_position"]])
+        results = dict()
+        if save_photon_direction:
+            results[Tags.DATA_FIELD_PHOTON_EXIT_POS] = photon_exit_data.positions
+            results[Tags.DATA_FIELD_PHOTON_EXIT_DIR] = photon_exit_data.directions
+        if save_photon_exit_image:
+            results[Tags.DATA_FIELD_PHOTON_EXIT_IMAGE] = photon_exit_image / max(number_of_simulated_photons, 1)
         return results
 
     @staticmethod
@@ -182,7 +413,9 @@ class MCXAdapterReflectance(MCXAdapter):
         check_padding = (Tags.COMPUTE_DIFFUSE_REFLECTANCE in self.component_settings and
                          self.component_settings[Tags.COMPUTE_DIFFUSE_REFLECTANCE]) or \
                         (Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and
-                         self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT])
+                         self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]) or \
+                        (Tags.COMPUTE_PHOTON_EXIT_IMAGE in self.component_settings and
+                         self.component_settings[Tags.COMPUTE_PHOTON_EXIT_IMAGE])
         # check that all volumes on first layer along z have only 0 values
         if np.any([np.any(a[:, :, 0] != 0)] for a in arrays) and check_padding:
             results = tuple(np.pad(a, ((0, 0), (0, 0), (1, 0)), "constant", constant_values=0) for a in arrays)
@@ -221,7 +454,9 @@ class MCXAdapterReflectance(MCXAdapter):
                           anisotropy: np.ndarray
                           ) -> Dict:
         """
-        runs `self.forward_model` as many times as defined by `device` and aggregates the results.
+        runs `self.forward_model` as many times as defined by `device` and aggregates the results. The diffuse
+        reflectance and the photon exit data are concatenated in the order of the illumination geometries, also if the
+        runs finish in another order.
 
         :param _device: device illumination geometry
         :param device: class defining illumination
@@ -232,65 +467,75 @@ class MCXAdapterReflectance(MCXAdapter):
         """
         reflectance = []
         reflectance_position = []
-        photon_position = []
-        photon_direction = []
+        photon_exit_data = PhotonExitData()
+        photon_exit_images = []
         if isinstance(_device, list):
             # per convention this list has at least two elements
-            results = self.forward_model(absorption_cm=absorption,
-                                         scattering_cm=scattering,
-                                         anisotropy=anisotropy,
-                                         illumination_geometry=_device[0])
-            self._append_results(results=results,
-                                 reflectance=reflectance,
-                                 reflectance_position=reflectance_position,
-                                 photon_position=photon_position,
-                                 photon_direction=photon_direction)
-            fluence = results[Tags.DATA_FIELD_FLUENCE]
-            for idx in range(1, len(_device)):
-                # we already looked at the 0th element, so go from 1 to n-1
-                results = self.forward_model(absorption_cm=absorption,
-                                             scattering_cm=scattering,
-                                             anisotropy=anisotropy,
-                                             illumination_geometry=_device[idx])
-                self._append_results(results=results,
-                                     reflectance=reflectance,
-                                     reflectance_position=reflectance_position,
-                                     photon_position=photon_position,
-                                     photon_direction=photon_direction)
-                fluence += results[Tags.DATA_FIELD_FLUENCE]
-
-            fluence = fluence / len(_device)
+            fluence = None
+            # the results are aggregated as soon as they can be appended in the order of the illumination geometries,
+            # such that the photons of all illumination geometries are copied into one set of arrays and the results
+            # of the single illumination geometries can be freed. Results of runs that finish before those of
+            # preceding illumination geometries are kept until they are next in order.
+            pending_results = dict()
+            next_index = 0
+            for index, results in self.iterate_forward_model(absorption_cm=absorption,
+                                                             scattering_cm=scattering,
+                                                             anisotropy=anisotropy,
+                                                             illumination_geometries=_device):
+                if fluence is None:
+                    # the sum does not depend on the order in which the results arrive
+                    fluence = results.pop(Tags.DATA_FIELD_FLUENCE)
+                    fluence_dtype = fluence.dtype
+                    fluence = fluence.astype(np.float64)
+                else:
+                    fluence += results.pop(Tags.DATA_FIELD_FLUENCE)
+                pending_results[index] = results
+                del results
+                while next_index in pending_results:
+                    self._append_results(results=pending_results.pop(next_index),
+                                         reflectance=reflectance,
+                                         reflectance_position=reflectance_position,
+                                         photon_exit_data=photon_exit_data,
+                                         photon_exit_images=photon_exit_images)
+                    next_index += 1
+
+            fluence = (fluence / len(_device)).astype(fluence_dtype)
 
         else:
-            results = self.forward_model(absorption_cm=absorption,
-                                         scattering_cm=scattering,
-                                         anisotropy=anisotropy,
-                                         illumination_geometry=_device)
+            results = self.cached_forward_model(absorption_cm=absorption,
+                                                scattering_cm=scattering,
+                                                anisotropy=anisotropy,
+                                                illumination_geometry=_device)
             self._append_results(results=results,
                                  reflectance=reflectance,
                                  reflectance_position=reflectance_position,
-                                 photon_position=photon_position,
-                                 photon_direction=photon_direction)
+                                 photon_exit_data=photon_exit_data,
+                                 photon_exit_images=photon_exit_images)
             fluence = results[Tags.DATA_FIELD_FLUENCE]
         aggregated_results = dict()
         aggregated_results[Tags.DATA_FIELD_FLUENCE] = fluence
         if reflectance:
             aggregated_results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE] = np.concatenate(reflectance, axis=0)
             aggregated_results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE_POS] = np.concatenate(reflectance_position, axis=0)
-        if photon_position:
-            aggregated_results[Tags.DATA_FIELD_PHOTON_EXIT_POS] = np.concatenate(photon_position, axis=0)
-            aggregated_results[Tags.DATA_FIELD_PHOTON_EXIT_DIR] = np.concatenate(photon_direction, axis=0)
+        if Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT in self.component_settings and \
+                self.component_settings[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT]:
+            aggregated_results[Tags.DATA_FIELD_PHOTON_EXIT_POS] = photon_exit_data.positions
+            aggregated_results[Tags.DATA_FIELD_PHOTON_EXIT_DIR] = photon_exit_data.directions
+        if photon_exit_images:
+            aggregated_results[Tags.DATA_FIELD_PHOTON_EXIT_IMAGE] = np.mean(photon_exit_images, axis=0)
         return aggregated_results
 
     @staticmethod
     def _append_results(results,
                         reflectance,
                         reflectance_position,
-                        photon_position,
-                        photon_direction):
+                        photon_exit_data,
+                        photon_exit_images):
         if Tags.DATA_FIELD_DIFFUSE_REFLECTANCE in results:
             reflectance.append(results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE])
             reflectance_position.append(results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE_POS])
         if Tags.DATA_FIELD_PHOTON_EXIT_POS in results:
-            photon_position.append(results[Tags.DATA_FIELD_PHOTON_EXIT_POS])
-            photon_direction.append(results[Tags.DATA_FIELD_PHOTON_EXIT_DIR])
+            photon_exit_data.append(results[Tags.DATA_FIELD_PHOTON_EXIT_POS],
+                                    results[Tags.DATA_FIELD_PHOTON_EXIT_DIR])
+        if Tags.DATA_FIELD_PHOTON_EXIT_IMAGE in results:
+            photon_exit_images.append(results[Tags.DATA_FIELD_PHOTON_EXIT_IMAGE])
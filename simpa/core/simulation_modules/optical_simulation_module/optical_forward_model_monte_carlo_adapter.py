@@ -0,0 +1,852 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from simpa.utils import Tags, Settings
+from simpa.core.simulation_modules.optical_simulation_module import OpticalForwardModuleBase
+from simpa.core.device_digital_twins import PhotoacousticDevice
+from simpa.core.device_digital_twins.illumination_geometries.illumination_geometry_base import IlluminationGeometryBase
+
+SPEED_OF_LIGHT_MM_PER_S = 299792458e3
+
+# the standard errors are only estimated once the spread of this many batches is known
+MINIMUM_NUMBER_OF_ADAPTIVE_BATCHES = 4
+
+# approximate extent of the output of a single fibre bundle of the MSOT InVision along the ring and along the y-axis
+MSOT_INVISION_BUNDLE_EXTENT_MM = (25.0, 2.0)
+
+
+class MonteCarloAdapter(OpticalForwardModuleBase):
+    """
+    This class implements a voxel-based Monte Carlo simulation of photon transport that runs on the CPU in the python
+    process and, if Tags.MONTE_CARLO_NUMBER_OF_WORKERS is larger than one, in a pool of worker processes.
+    Batches of photon packets are propagated with vectorised numpy kernels. The packets lose weight continuously
+    according to the absorption of the traversed voxels, their step lengths are sampled from the scattering
+    coefficient and they are scattered according to the Henyey-Greenstein phase function with the anisotropy of the
+    voxel they are in. The refractive index is assumed to be constant and photons that leave the volume are lost.
+
+    The photon sources are created from the same definition as for MCX,
+    i.e. `IlluminationGeometryBase.get_mcx_illuminator_definition`, and the fluence is normalised in the same way as
+    by the `MCXAdapter`, which allows to use both adapters interchangeably.
+
+    Every batch of Tags.MONTE_CARLO_PHOTON_BATCH_SIZE photons draws from its own random stream that is spawned from
+    the seed and the index of the batch. The results are therefore reproducible and do not depend on the number of
+    workers.
+
+    If Tags.MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR is given, the batches are simulated until the relative standard
+    error of the fluence within the convergence region (Tags.MONTE_CARLO_CONVERGENCE_REGION_MM) drops below the target
+    or Tags.OPTICAL_MODEL_NUMBER_PHOTONS photons are simulated. The mean and the variance of the fluence of the batches
+    are updated with Welford's algorithm after every batch, and the relative standard error is the sum of the standard
+    errors of the voxels in the region divided by the sum of their fluence. The number of photons that were simulated
+    for all illumination geometries is stored as Tags.DATA_FIELD_NUMBER_OF_PHOTONS.
+    """
+
+    def __init__(self, global_settings: Settings):
+        """
+        :param global_settings: global settings used during simulations
+        """
+        super(MonteCarloAdapter, self).__init__(global_settings=global_settings)
+        if Tags.MONTE_CARLO_NUMBER_OF_WORKERS in self.component_settings:
+            self.number_of_workers = max(1, int(self.component_settings[Tags.MONTE_CARLO_NUMBER_OF_WORKERS]))
+        else:
+            self.number_of_workers = 1
+        if Tags.MONTE_CARLO_PHOTON_BATCH_SIZE in self.component_settings:
+            self.photon_batch_size = max(1, int(self.component_settings[Tags.MONTE_CARLO_PHOTON_BATCH_SIZE]))
+        else:
+            self.photon_batch_size = 10000
+        if Tags.MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR in self.component_settings:
+            self.target_relative_standard_error = self.component_settings[
+                Tags.MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR]
+        else:
+            self.target_relative_standard_error = None
+        self.convergence_region_mm = None
+        if Tags.MONTE_CARLO_CONVERGENCE_REGION_MM in self.component_settings:
+            self.convergence_region_mm = np.asarray(self.component_settings[Tags.MONTE_CARLO_CONVERGENCE_REGION_MM])
+
+    def get_random_seed(self):
+        """
+        :return: Tags.MCX_SEED of the optical settings or Tags.RANDOM_SEED if the former is not given. If neither is
+            given, the entropy of a new numpy SeedSequence is returned.
+        """
+        if Tags.MCX_SEED in self.component_settings:
+            return int(self.component_settings[Tags.MCX_SEED])
+        if Tags.RANDOM_SEED in self.global_settings:
+            return int(self.global_settings[Tags.RANDOM_SEED])
+        return np.random.SeedSequence().entropy
+
+    def get_maximum_path_length_mm(self) -> float:
+        """
+        :return: the distance light travels within Tags.TOTAL_TIME (5 ns by default), after which photons are
+            terminated like in the time gate of MCX
+        """
+        if Tags.TOTAL_TIME in self.component_settings:
+            total_time = self.component_settings[Tags.TOTAL_TIME]
+        else:
+            total_time = 5e-09
+        return total_time * SPEED_OF_LIGHT_MM_PER_S
+
+    def get_cache_parameters(self, illumination_geometry: IlluminationGeometryBase) -> Dict:
+        """
+        In the adaptive mode, the number of simulated photons depends on the convergence region, which may be the
+        field of view of the device instead of a setting, as well as on the target relative standard error and the
+        photon limits.
+
+        :param illumination_geometry: A device that represents a detection geometry
+        :return: the parameters apart from the optical properties that determine the results of the forward model
+        """
+        parameters = super(MonteCarloAdapter, self).get_cache_parameters(illumination_geometry)
+        if self.target_relative_standard_error is not None:
+            parameters["adaptive_photon_budget"] = {
+                "convergence_region_mm": None if self.convergence_region_mm is None
+                else np.asarray(self.convergence_region_mm, dtype=np.float64).tolist(),
+                "target_relative_standard_error": float(self.target_relative_standard_error),
+                "maximum_number_of_photons": int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS]),
+                "photon_batch_size": self.photon_batch_size
+            }
+        return parameters
+
+    def run_forward_model(self,
+                          _device,
+                          device: Union[IlluminationGeometryBase, PhotoacousticDevice],
+                          absorption: np.ndarray,
+                          scattering: np.ndarray,
+                          anisotropy: np.ndarray) -> Dict:
+        """
+        runs `self.forward_model` for all illumination geometries defined by `device` and averages the fluence like
+        `OpticalForwardModuleBase.run_forward_model`. In addition, the total number of simulated photons is returned.
+        If no convergence region is given in the settings, the field of view of the detection geometry of `device` is
+        used.
+
+        :param _device: device illumination geometry
+        :param device: class defining illumination
+        :param absorption: Absorption volume
+        :param scattering: Scattering volume
+        :param anisotropy: Dimensionless scattering anisotropy
+        :return: `Dict` containing the fluence in units of J/cm^2 and the number of photons
+        """
+        if Tags.MONTE_CARLO_CONVERGENCE_REGION_MM not in self.component_settings:
+            if isinstance(device, PhotoacousticDevice) and device.detection_geometry is not None:
+                self.convergence_region_mm = device.detection_geometry.get_field_of_view_mm()
+            else:
+                self.convergence_region_mm = None
+        illumination_geometries = _device if isinstance(_device, list) else [_device]
+
+        fluence = None
+        number_of_photons = 0
+        for _, results in self.iterate_forward_model(absorption_cm=absorption,
+                                                     scattering_cm=scattering,
+                                                     anisotropy=anisotropy,
+                                                     illumination_geometries=illumination_geometries):
+            if fluence is None:
+                fluence = results[Tags.DATA_FIELD_FLUENCE].astype(np.float64)
+            else:
+                fluence += results[Tags.DATA_FIELD_FLUENCE]
+            number_of_photons += int(results[Tags.DATA_FIELD_NUMBER_OF_PHOTONS])
+        fluence = (fluence / len(illumination_geometries)).astype(np.float32)
+        return {Tags.DATA_FIELD_FLUENCE: fluence,
+                Tags.DATA_FIELD_NUMBER_OF_PHOTONS: number_of_photons}
+
+    def forward_model(self,
+                      absorption_cm: np.ndarray,
+                      scattering_cm: np.ndarray,
+                      anisotropy: np.ndarray,
+                      illumination_geometry: IlluminationGeometryBase) -> Dict:
+        """
+        runs the Monte Carlo simulation of Tags.OPTICAL_MODEL_NUMBER_PHOTONS photons, or in the adaptive mode of at most
+        as many photons as are needed to reach the target relative standard error.
+
+        :param absorption_cm: array containing the absorption of the tissue in `cm` units
+        :param scattering_cm: array containing the scattering of the tissue in `cm` units
+        :param anisotropy: array containing the anisotropy of the volume defined by `absorption_cm` and `scattering_cm`
+        :param illumination_geometry: and instance of `IlluminationGeometryBase` defining the illumination geometry
+        :return: `Dict` containing the fluence in units of J/cm^2 and the number of simulated photons
+        """
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        number_of_photons = int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS])
+        source = illumination_geometry.get_mcx_illuminator_definition(self.global_settings)
+        volumes = (np.asarray(absorption_cm, dtype=np.float64) / 10,
+                   np.asarray(scattering_cm, dtype=np.float64) / 10,
+                   np.asarray(anisotropy, dtype=np.float64))
+        maximum_path_length_mm = self.get_maximum_path_length_mm()
+        random_seed = self.get_random_seed()
+
+        batches = [(source, min(self.photon_batch_size, number_of_photons - first_photon), spacing_mm,
+                    maximum_path_length_mm, random_seed, batch_index)
+                   for batch_index, first_photon in enumerate(range(0, number_of_photons, self.photon_batch_size))]
+        self.logger.debug(f"Simulating up to {number_of_photons} photons in {len(batches)} batches with "
+                          f"{self.number_of_workers} workers")
+
+        deposited_path_length_mm = np.zeros(absorption_cm.size, dtype=np.float64)
+        if self.target_relative_standard_error is None:
+            for batch_result in self.simulate_photon_batches(volumes, batches):
+                deposited_path_length_mm += batch_result
+        else:
+            region = self.get_convergence_region_slices(np.shape(absorption_cm))
+            statistics = FluenceStatistics()
+            number_of_photons = 0
+            for batch, batch_result in zip(batches, self.simulate_photon_batches(volumes, batches)):
+                deposited_path_length_mm += batch_result
+                number_of_photons += batch[1]
+                statistics.update(batch_result.reshape(absorption_cm.shape)[region] / batch[1], batch[1])
+                relative_standard_error = statistics.get_relative_standard_error()
+                if relative_standard_error <= self.target_relative_standard_error:
+                    self.logger.debug(f"The relative standard error of the fluence is {relative_standard_error} "
+                                      f"after {number_of_photons} photons")
+                    break
+            else:
+                self.logger.warning(f"The relative standard error of the fluence is still "
+                                    f"{statistics.get_relative_standard_error()} after the maximum number of "
+                                    f"{number_of_photons} photons")
+
+        # the fluence is normalised to the energy of all photons, i.e. it is given in 1/mm^2 per J
+        fluence = deposited_path_length_mm.reshape(absorption_cm.shape) / (number_of_photons * spacing_mm ** 3)
+        fluence = (fluence * 100).astype(np.float32)  # Convert from J/mm^2 to J/cm^2
+        return {Tags.DATA_FIELD_FLUENCE: fluence,
+                Tags.DATA_FIELD_NUMBER_OF_PHOTONS: np.asarray(number_of_photons)}
+
+    def forward_model_absorption_derivatives(self,
+                                             absorption_cm: np.ndarray,
+                                             scattering_cm: np.ndarray,
+                                             anisotropy: np.ndarray,
+                                             illumination_geometries: List[IlluminationGeometryBase],
+                                             absorption_perturbations_cm: List[np.ndarray] = (),
+                                             adjoint: np.ndarray = None,
+                                             random_seed: int = None
+                                             ) -> Tuple[np.ndarray, List[np.ndarray], np.ndarray]:
+        """
+        runs the Monte Carlo simulation of Tags.OPTICAL_MODEL_NUMBER_PHOTONS photons for every illumination geometry
+        and records the derivatives of the fluence, averaged over the illumination geometries, with respect to the
+        absorption along the same photon paths by perturbation Monte Carlo. The fluence is the same as the one of
+        `run_forward_model` for the same seed. The Jacobian-vector products come at a small extra cost per
+        perturbation, whereas the vector-Jacobian product traces every photon a second time.
+
+        :param absorption_cm: array containing the absorption of the tissue in `cm` units
+        :param scattering_cm: array containing the scattering of the tissue in `cm` units
+        :param anisotropy: array containing the anisotropy of the volume defined by `absorption_cm` and `scattering_cm`
+        :param illumination_geometries: list of instances of `IlluminationGeometryBase`
+        :param absorption_perturbations_cm: perturbations of the absorption in `cm` units
+        :param adjoint: if given, the gradient of the sum of the fluence weighted by this volume is computed
+        :param random_seed: the seed of the photons, by default `self.get_random_seed()`. Iterative methods have to
+            keep it fixed, such that the fluence is a smooth function of the absorption.
+        :return: tuple of the fluence in units of J/cm^2, of its Jacobian-vector products with the perturbations in
+            units of J/cm and of the vector-Jacobian product with the adjoint in units of J/cm or None
+        """
+        spacing_mm = self.global_settings[Tags.SPACING_MM]
+        number_of_photons = int(self.component_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS])
+        volumes = (np.asarray(absorption_cm, dtype=np.float64) / 10,
+                   np.asarray(scattering_cm, dtype=np.float64) / 10,
+                   np.asarray(anisotropy, dtype=np.float64))
+        absorption_perturbations = tuple(np.asarray(perturbation, dtype=np.float64) / 10
+                                         for perturbation in absorption_perturbations_cm)
+        if adjoint is not None:
+            adjoint = np.asarray(adjoint, dtype=np.float64)
+        maximum_path_length_mm = self.get_maximum_path_length_mm()
+        if random_seed is None:
+            random_seed = self.get_random_seed()
+
+        batches = []
+        for illumination_geometry in illumination_geometries:
+            source = illumination_geometry.get_mcx_illuminator_definition(self.global_settings)
+            batches += [(source, min(self.photon_batch_size, number_of_photons - first_photon), spacing_mm,
+                         maximum_path_length_mm, random_seed, batch_index, absorption_perturbations, adjoint)
+                        for batch_index, first_photon in enumerate(range(0, number_of_photons,
+                                                                         self.photon_batch_size))]
+
+        deposited_path_length_mm = np.zeros(np.size(absorption_cm), dtype=np.float64)
+        jacobian_vector_products = [np.zeros_like(deposited_path_length_mm) for _ in absorption_perturbations]
+        vector_jacobian_product = None if adjoint is None else np.zeros_like(deposited_path_length_mm)
+        for batch_deposits, batch_jacobian_vector_products, batch_vector_jacobian_product in \
+                self.simulate_photon_batches(volumes, batches, simulate_photon_batch_derivatives):
+            deposited_path_length_mm += batch_deposits
+            for jacobian_vector_product, batch_jacobian_vector_product in zip(jacobian_vector_products,
+                                                                              batch_jacobian_vector_products):
+                jacobian_vector_product += batch_jacobian_vector_product
+            if adjoint is not None:
+                vector_jacobian_product += batch_vector_jacobian_product
+
+        # normalised like the fluence, the derivatives with respect to the absorption in 1/mm are divided by 10 for
+        # the absorption in 1/cm
+        normalisation = 100 / (len(illumination_geometries) * number_of_photons * spacing_mm ** 3)
+        shape = np.shape(absorption_cm)
+        fluence = (deposited_path_length_mm * normalisation).reshape(shape).astype(np.float32)
+        jacobian_vector_products = [(jacobian_vector_product * normalisation).reshape(shape)
+                                    for jacobian_vector_product in jacobian_vector_products]
+        if adjoint is not None:
+            vector_jacobian_product = (vector_jacobian_product * normalisation / 10).reshape(shape)
+        return fluence, jacobian_vector_products, vector_jacobian_product
+
+    def simulate_photon_batches(self, volumes: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                                batches: List[tuple], simulation_function: Callable = None) -> Iterator:
+        """
+        Simulates the given batches in the calling process or in a pool of workers and yields their results in the
+        order of the batches, such that the result does not depend on the number of workers. Only a few batches per
+        worker are dispatched ahead of the one that is yielded, so that no work is wasted if the iteration is stopped
+        early.
+
+        :param volumes: tuple of the absorption and scattering in units of per millimeter and the anisotropy
+        :param batches: list of the arguments of the simulation function apart from the volumes
+        :param simulation_function: `simulate_photon_batch` (default) or `simulate_photon_batch_derivatives`
+        :return: iterator over the results of the simulation function for the batches, i.e. by default the flat
+            arrays of the deposited path lengths
+        """
+        if simulation_function is None:
+            simulation_function = simulate_photon_batch
+        if self.number_of_workers == 1 or len(batches) == 1:
+            for batch in batches:
+                yield simulation_function(volumes, *batch)
+            return
+        # workers are spawned rather than forked, as forking is not safe once torch or CUDA have been initialised
+        with ProcessPoolExecutor(max_workers=self.number_of_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_initialize_worker, initargs=(volumes, )) as executor:
+            remaining_batches = deque(batches)
+            pending_results = deque()
+            try:
+                while remaining_batches and len(pending_results) < 2 * self.number_of_workers:
+                    pending_results.append(executor.submit(_simulate_photon_batch_in_worker, simulation_function,
+                                                           remaining_batches.popleft()))
+                while pending_results:
+                    batch_result = pending_results.popleft().result()
+                    if remaining_batches:
+                        pending_results.append(executor.submit(_simulate_photon_batch_in_worker,
+                                                               simulation_function, remaining_batches.popleft()))
+                    yield batch_result
+            finally:
+                for pending_result in pending_results:
+                    pending_result.cancel()
+
+    def get_convergence_region_slices(self, shape: Tuple[int, int, int]) -> Tuple[slice, slice, slice]:
+        """
+        :param shape: shape of the simulated volume
+        :return: slices of the voxels of the convergence region within the volume, which contain at least one voxel
+            along each axis
+        """
+        if self.convergence_region_mm is None:
+            return slice(None), slice(None), slice(None)
+        region_voxels = np.round(np.asarray(self.convergence_region_mm, dtype=np.float64) /
+                                 self.global_settings[Tags.SPACING_MM]).astype(int)
+        slices = []
+        for axis in range(3):
+            start = min(max(region_voxels[2 * axis], 0), shape[axis] - 1)
+            end = min(max(region_voxels[2 * axis + 1], start + 1), shape[axis])
+            slices.append(slice(start, end))
+        return tuple(slices)
+
+
+class FluenceStatistics:
+    """
+    Keeps the running mean and variance of the fluence per photon of a sequence of photon batches with Welford's
+    algorithm, where every batch is weighted by its number of photons.
+    """
+
+    def __init__(self):
+        self.number_of_batches = 0
+        self.number_of_photons = 0
+        self.mean = None
+        self.sum_of_squared_deviations = None
+
+    def update(self, batch_fluence: np.ndarray, number_of_photons: int):
+        """
+        :param batch_fluence: the fluence per photon of a batch
+        :param number_of_photons: the number of photons of the batch
+        """
+        self.number_of_batches += 1
+        self.number_of_photons += number_of_photons
+        if self.mean is None:
+            self.mean = np.array(batch_fluence, dtype=np.float64)
+            self.sum_of_squared_deviations = np.zeros_like(self.mean)
+            return
+        deviation = batch_fluence - self.mean
+        self.mean += deviation * (number_of_photons / self.number_of_photons)
+        self.sum_of_squared_deviations += number_of_photons * deviation * (batch_fluence - self.mean)
+
+    def get_relative_standard_error(self) -> float:
+        """
+        :return: the sum of the standard errors of the mean fluence of all voxels divided by their summed mean
+            fluence, or infinity as long as too few batches are known
+        """
+        total_fluence = np.sum(self.mean) if self.mean is not None else 0
+        if self.number_of_batches < MINIMUM_NUMBER_OF_ADAPTIVE_BATCHES or total_fluence <= 0:
+            return np.inf
+        variance_of_the_mean = self.sum_of_squared_deviations / ((self.number_of_batches - 1) * self.number_of_photons)
+        return float(np.sum(np.sqrt(variance_of_the_mean)) / total_fluence)
+
+
+_worker_volumes = None
+
+
+def _initialize_worker(volumes: Tuple[np.ndarray, np.ndarray, np.ndarray]):
+    global _worker_volumes
+    _worker_volumes = volumes
+
+
+def _simulate_photon_batch_in_worker(simulation_function, batch: tuple):
+    return simulation_function(_worker_volumes, *batch)
+
+
+def simulate_photon_batch(volumes: Tuple[np.ndarray, np.ndarray, np.ndarray], source: dict, number_of_photons: int,
+                          spacing_mm: float, maximum_path_length_mm: float, random_seed: int,
+                          batch_index: int) -> np.ndarray:
+    """
+    Launches a batch of photons from the given source and propagates them through the volume.
+
+    :param volumes: tuple of the absorption and scattering in units of per millimeter and the anisotropy
+    :param source: mcx illuminator definition as given by `IlluminationGeometryBase.get_mcx_illuminator_definition`
+    :param number_of_photons: the number of photons in this batch
+    :param spacing_mm: the voxel spacing of the volumes
+    :param maximum_path_length_mm: the path length after which photons are terminated
+    :param random_seed: the seed from which the random streams of all batches are spawned
+    :param batch_index: the index of this batch, which determines its random stream
+    :return: flat array of the path lengths in mm travelled in every voxel, weighted by the photon weights
+    """
+    random_generator = np.random.default_rng(np.random.SeedSequence(random_seed, spawn_key=(batch_index, )))
+    positions, directions = sample_photon_sources(source, number_of_photons, random_generator)
+    return propagate_photons(*volumes, positions=positions, directions=directions,
+                             random_generator=random_generator,
+                             maximum_path_length_voxels=maximum_path_length_mm / spacing_mm,
+                             spacing_mm=spacing_mm) * spacing_mm
+
+
+def simulate_photon_batch_derivatives(volumes: Tuple[np.ndarray, np.ndarray, np.ndarray], source: dict,
+                                      number_of_photons: int, spacing_mm: float, maximum_path_length_mm: float,
+                                      random_seed: int, batch_index: int,
+                                      absorption_perturbations: Tuple[np.ndarray, ...] = (),
+                                      adjoint: np.ndarray = None) -> Tuple[np.ndarray, List[np.ndarray], np.ndarray]:
+    """
+    Simulates the same photons as `simulate_photon_batch` and records the derivatives of their deposited path lengths
+    with respect to the absorption. The vector-Jacobian product needs the total adjoint weight of every photon, so
+    its paths are traced a second time from the same random stream.
+
+    :param volumes: tuple of the absorption and scattering in units of per millimeter and the anisotropy
+    :param source: mcx illuminator definition as given by `IlluminationGeometryBase.get_mcx_illuminator_definition`
+    :param number_of_photons: the number of photons in this batch
+    :param spacing_mm: the voxel spacing of the volumes
+    :param maximum_path_length_mm: the path length after which photons are terminated
+    :param random_seed: the seed from which the random streams of all batches are spawned
+    :param batch_index: the index of this batch, which determines its random stream
+    :param absorption_perturbations: perturbations of the absorption in units of per millimeter, for which the
+        Jacobian-vector products are recorded
+    :param adjoint: if given, the vector-Jacobian product with this volume is recorded
+    :return: tuple of the flat arrays of the path lengths in mm travelled in every voxel, of their Jacobian-vector
+        products with the perturbations in mm^2 and of their vector-Jacobian product with the adjoint in mm^2 or None
+    """
+    absorption_perturbation_tallies = [AbsorptionPerturbationTally(np.ravel(perturbation) * spacing_mm)
+                                       for perturbation in absorption_perturbations]
+    tallies = list(absorption_perturbation_tallies)
+    if adjoint is not None:
+        adjoint_weight_tally = AdjointWeightTally(np.ravel(adjoint))
+        tallies.append(adjoint_weight_tally)
+    random_generator = np.random.default_rng(np.random.SeedSequence(random_seed, spawn_key=(batch_index, )))
+    positions, directions = sample_photon_sources(source, number_of_photons, random_generator)
+    deposited_path_length = propagate_photons(*volumes, positions=positions, directions=directions,
+                                              random_generator=random_generator,
+                                              maximum_path_length_voxels=maximum_path_length_mm / spacing_mm,
+                                              spacing_mm=spacing_mm, tallies=tallies) * spacing_mm
+    jacobian_vector_products = [tally.get_result() * spacing_mm for tally in absorption_perturbation_tallies]
+    if adjoint is None:
+        return deposited_path_length, jacobian_vector_products, None
+
+    absorption_adjoint_tally = AbsorptionAdjointTally(np.ravel(adjoint), adjoint_weight_tally.get_result())
+    random_generator = np.random.default_rng(np.random.SeedSequence(random_seed, spawn_key=(batch_index, )))
+    positions, directions = sample_photon_sources(source, number_of_photons, random_generator)
+    propagate_photons(*volumes, positions=positions, directions=directions, random_generator=random_generator,
+                      maximum_path_length_voxels=maximum_path_length_mm / spacing_mm, spacing_mm=spacing_mm,
+                      tallies=[absorption_adjoint_tally])
+    return deposited_path_length, jacobian_vector_products, absorption_adjoint_tally.get_result() * spacing_mm ** 2
+
+
+def get_orthonormal_basis(direction: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param direction: normalised vector
+    :return: two normalised vectors that are orthogonal to the direction and to each other
+    """
+    helper = np.array([1.0, 0, 0]) if abs(direction[0]) < 0.9 else np.array([0, 1.0, 0])
+    first_axis = np.cross(direction, helper)
+    first_axis /= np.linalg.norm(first_axis)
+    return first_axis, np.cross(direction, first_axis)
+
+
+def sample_photon_sources(source: dict, number_of_photons: int,
+                          random_generator: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Samples the initial positions and directions of photons of the given mcx source. The positions are given in
+    voxel units, where voxel i covers the interval [i, i + 1). Like in MCX with "OriginType" 0, the position of the
+    source is given with respect to an origin of [1, 1, 1].
+
+    :param source: mcx illuminator definition as given by `IlluminationGeometryBase.get_mcx_illuminator_definition`
+    :param number_of_photons: the number of photons
+    :param random_generator: the random generator to draw from
+    :return: tuple of arrays of shape (number_of_photons, 3) with the positions and the normalised directions
+    """
+    source_type = source["Type"]
+    position = np.asarray(source["Pos"][:3], dtype=np.float64) - 1
+    direction = np.asarray(source["Dir"][:3], dtype=np.float64)
+    direction /= np.linalg.norm(direction)
+    param1 = np.asarray(source.get("Param1", [0, 0, 0, 0]), dtype=np.float64)
+    param2 = np.asarray(source.get("Param2", [0, 0, 0, 0]), dtype=np.float64)
+    first_axis, second_axis = get_orthonormal_basis(direction)
+
+    positions = np.tile(position, (number_of_photons, 1))
+    directions = np.tile(direction, (number_of_photons, 1))
+
+    if source_type == Tags.ILLUMINATION_TYPE_PENCIL:
+        pass
+    elif source_type == Tags.ILLUMINATION_TYPE_PENCILARRAY:
+        # the beams are spread over a grid spanned by the first three components of both parameters
+        for param in [param1, param2]:
+            number_of_beams = int(param[3])
+            if number_of_beams > 1:
+                beam_indices = random_generator.integers(0, number_of_beams, number_of_photons)
+                positions += beam_indices[:, None] * param[:3] / (number_of_beams - 1)
+    elif source_type in [Tags.ILLUMINATION_TYPE_DISK, Tags.ILLUMINATION_TYPE_GAUSSIAN]:
+        if source_type == Tags.ILLUMINATION_TYPE_DISK:
+            radii = param1[0] * np.sqrt(random_generator.random(number_of_photons))
+        else:
+            # param1[0] is the radius at which the intensity has dropped to 1/e^2
+            radii = param1[0] * np.sqrt(-0.5 * np.log(1 - random_generator.random(number_of_photons)))
+        angles = 2 * np.pi * random_generator.random(number_of_photons)
+        positions += (radii * np.cos(angles))[:, None] * first_axis + (radii * np.sin(angles))[:, None] * second_axis
+        if len(source["Dir"]) > 3 and source["Dir"][3] != 0:
+            # the beam is focused onto a point at the given focal length
+            directions = position + direction * source["Dir"][3] - positions
+            directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    elif source_type == Tags.ILLUMINATION_TYPE_SLIT:
+        positions += random_generator.random(number_of_photons)[:, None] * param1[:3]
+    elif source_type == Tags.ILLUMINATION_TYPE_MSOT_ACUITY_ECHO:
+        # a slit of the given length along the x-axis that is centred at the position of the source
+        positions[:, 0] += (random_generator.random(number_of_photons) - 0.5) * param1[0]
+    elif source_type == Tags.ILLUMINATION_TYPE_MSOT_INVISION:
+        # a rectangular fibre bundle output that is tangential to the ring of illuminators, param1[0] is the spacing
+        tangent = np.cross([0, 1.0, 0], direction)
+        tangent /= np.linalg.norm(tangent)
+        extent_voxels = np.asarray(MSOT_INVISION_BUNDLE_EXTENT_MM) / param1[0]
+        positions += ((random_generator.random(number_of_photons) - 0.5) * extent_voxels[0])[:, None] * tangent
+        positions[:, 1] += (random_generator.random(number_of_photons) - 0.5) * extent_voxels[1]
+    else:
+        raise ValueError(f"The illumination type {source_type} is not supported by the Monte Carlo adapter.")
+
+    return positions, directions
+
+
+def move_photons_into_volume(positions: np.ndarray, directions: np.ndarray,
+                             shape: Tuple[int, int, int]) -> np.ndarray:
+    """
+    Moves photons that are launched outside of the volume along their direction onto the surface of the volume.
+
+    :param positions: array of shape (n, 3) with positions in voxel units, which is modified in place
+    :param directions: array of shape (n, 3) with the normalised directions
+    :param shape: the shape of the volume
+    :return: boolean array that is False for photons that miss the volume
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lower = (0 - positions) / directions
+        upper = (np.asarray(shape) - positions) / directions
+    inside_interval = (positions >= 0) & (positions < shape)
+    near = np.where(directions == 0, np.where(inside_interval, -np.inf, np.inf), np.minimum(lower, upper))
+    far = np.where(directions == 0, np.where(inside_interval, np.inf, -np.inf), np.maximum(lower, upper))
+    entry = np.max(np.maximum(near, 0), axis=1)
+    exit_distance = np.min(far, axis=1)
+    hits_volume = entry < exit_distance
+    positions[hits_volume] += entry[hits_volume, None] * directions[hits_volume]
+    return hits_volume
+
+
+def scatter_photons(directions: np.ndarray, anisotropy: np.ndarray,
+                    random_generator: np.random.Generator) -> np.ndarray:
+    """
+    Samples new directions according to the Henyey-Greenstein phase function.
+
+    :param directions: array of shape (n, 3) with the normalised directions
+    :param anisotropy: array of shape (n, ) with the anisotropy at the scattering events
+    :param random_generator: the random generator to draw from
+    :return: array of shape (n, 3) with the new normalised directions
+    """
+    random_numbers = random_generator.random(len(anisotropy))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = (1 - anisotropy ** 2) / (1 - anisotropy + 2 * anisotropy * random_numbers)
+        cos_theta = (1 + anisotropy ** 2 - fraction ** 2) / (2 * anisotropy)
+    cos_theta = np.clip(np.where(np.abs(anisotropy) < 1e-6, 2 * random_numbers - 1, cos_theta), -1, 1)
+    sin_theta = np.sqrt(1 - cos_theta ** 2)
+    phi = 2 * np.pi * random_generator.random(len(anisotropy))
+    cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+
+    ux, uy, uz = directions[:, 0], directions[:, 1], directions[:, 2]
+    normal = np.sqrt(np.maximum(1 - uz ** 2, 1e-12))
+    new_directions = np.stack([sin_theta * (ux * uz * cos_phi - uy * sin_phi) / normal + ux * cos_theta,
+                               sin_theta * (uy * uz * cos_phi + ux * sin_phi) / normal + uy * cos_theta,
+                               -sin_theta * cos_phi * normal + uz * cos_theta], axis=1)
+    along_z = np.abs(uz) > 0.99999
+    new_directions[along_z] = np.stack([sin_theta * cos_phi, sin_theta * sin_phi,
+                                        np.sign(uz) * cos_theta], axis=1)[along_z]
+    return new_directions / np.linalg.norm(new_directions, axis=1, keepdims=True)
+
+
+class DepositBuffer:
+    """
+    Bins values into a flat volume. The deposits of several steps are binned at once, as binning into the whole
+    volume dominates the run time for few photons.
+    """
+
+    def __init__(self, size: int):
+        """
+        :param size: number of voxels of the volume
+        """
+        self.volume = np.zeros(size, dtype=np.float64)
+        self.indices, self.values, self.number_of_deposits = [], [], 0
+
+    def add(self, indices: np.ndarray, values: np.ndarray):
+        """
+        :param indices: flat indices of the voxels
+        :param values: the values that are added to the voxels
+        """
+        self.indices.append(indices)
+        self.values.append(values)
+        self.number_of_deposits += len(indices)
+        if self.number_of_deposits >= len(self.volume):
+            self.flush()
+
+    def flush(self) -> np.ndarray:
+        """
+        :return: the volume after all deposits have been binned into it
+        """
+        if self.number_of_deposits > 0:
+            self.volume += np.bincount(np.concatenate(self.indices), np.concatenate(self.values),
+                                       minlength=len(self.volume))
+            self.indices, self.values, self.number_of_deposits = [], [], 0
+        return self.volume
+
+
+class PhotonTally:
+    """
+    Base class of quantities that are recorded along the paths of the photons in addition to the deposited path
+    lengths. A tally is started once the photons that hit the volume are known and is then updated with every step
+    of every photon.
+    """
+
+    def start(self, number_of_photons: int, size: int):
+        """
+        :param number_of_photons: the number of photons that hit the volume, which are identified by their index
+        :param size: the number of voxels of the volume
+        """
+        self.deposits = DepositBuffer(size)
+
+    def record(self, photon_indices: np.ndarray, flat_indices: np.ndarray, weights: np.ndarray, step: np.ndarray,
+               voxel_absorption: np.ndarray, path_length: np.ndarray):
+        """
+        :param photon_indices: the indices of the photons that take the step
+        :param flat_indices: the flat indices of the voxels in which the steps are taken
+        :param weights: the weights of the photons at the beginning of the step
+        :param step: the lengths of the steps in voxel units
+        :param voxel_absorption: the absorption of the voxels in units of per voxel
+        :param path_length: the path lengths weighted by the attenuation within the step
+        """
+        raise NotImplementedError()
+
+    def get_result(self) -> np.ndarray:
+        """
+        :return: flat array of the recorded quantity in voxel units
+        """
+        return self.deposits.flush()
+
+
+def get_attenuation_moments(voxel_absorption: np.ndarray, step: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param voxel_absorption: the absorption of the voxels in units of per voxel
+    :param step: the lengths of the steps in voxel units
+    :return: tuple of the integrals of s exp(-mu_a s) and of (1 - exp(-mu_a s)) / mu_a over the steps, which are
+        evaluated with their series expansions for small optical thicknesses
+    """
+    optical_thickness = voxel_absorption * step
+    small = optical_thickness < 1e-3
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        attenuation = np.exp(-optical_thickness)
+        first_moment = np.where(small, step ** 2 * (1 / 2 - optical_thickness / 3 + optical_thickness ** 2 / 8),
+                                (1 - attenuation * (1 + optical_thickness)) / voxel_absorption ** 2)
+        integrated_path_length = np.where(small, step ** 2 * (1 / 2 - optical_thickness / 6 +
+                                                              optical_thickness ** 2 / 24),
+                                          (optical_thickness - 1 + attenuation) / voxel_absorption ** 2)
+    return first_moment, integrated_path_length
+
+
+class AbsorptionPerturbationTally(PhotonTally):
+    """
+    Records the directional derivative of the deposited path lengths with respect to the absorption by perturbation
+    Monte Carlo. The weight of a photon at path length s is exp(-integral of mu_a along its path), such that the
+    derivative of the deposit of a step in the direction of the perturbation is minus the integral of the weight times
+    the perturbation accumulated along the path so far. The paths themselves do not depend on the absorption.
+    """
+
+    def __init__(self, perturbation: np.ndarray):
+        """
+        :param perturbation: flat perturbation of the absorption in units of per voxel
+        """
+        self.perturbation = perturbation
+
+    def start(self, number_of_photons: int, size: int):
+        super(AbsorptionPerturbationTally, self).start(number_of_photons, size)
+        self.accumulated_perturbation = np.zeros(number_of_photons)
+
+    def record(self, photon_indices, flat_indices, weights, step, voxel_absorption, path_length):
+        accumulated_perturbation = self.accumulated_perturbation[photon_indices]
+        voxel_perturbation = self.perturbation[flat_indices]
+        first_moment, _ = get_attenuation_moments(voxel_absorption, step)
+        self.deposits.add(flat_indices, -weights * (accumulated_perturbation * path_length +
+                                                    voxel_perturbation * first_moment))
+        self.accumulated_perturbation[photon_indices] = accumulated_perturbation + voxel_perturbation * step
+
+
+class AdjointWeightTally(PhotonTally):
+    """
+    Records the total adjoint weight of every photon, i.e. the integral of its weight times the adjoint volume along
+    its whole path, which is needed by the `AbsorptionAdjointTally` in a second pass over the same paths.
+    """
+
+    def __init__(self, adjoint: np.ndarray):
+        """
+        :param adjoint: flat adjoint volume, i.e. the derivative of a scalar function with respect to the deposits
+        """
+        self.adjoint = adjoint
+
+    def start(self, number_of_photons: int, size: int):
+        self.adjoint_weights = np.zeros(number_of_photons)
+
+    def record(self, photon_indices, flat_indices, weights, step, voxel_absorption, path_length):
+        self.adjoint_weights[photon_indices] += weights * self.adjoint[flat_indices] * path_length
+
+    def get_result(self) -> np.ndarray:
+        return self.adjoint_weights
+
+
+class AbsorptionAdjointTally(PhotonTally):
+    """
+    Records the gradient of the sum of the deposited path lengths weighted by the adjoint volume with respect to the
+    absorption, i.e. the vector-Jacobian product of the deposits. A step contributes the adjoint weight that the
+    photon collects after it, which is the total adjoint weight of the `AdjointWeightTally` minus the adjoint weight
+    collected so far, integrated over the step.
+    """
+
+    def __init__(self, adjoint: np.ndarray, adjoint_weights: np.ndarray):
+        """
+        :param adjoint: flat adjoint volume, i.e. the derivative of a scalar function with respect to the deposits
+        :param adjoint_weights: the total adjoint weights of the photons as recorded by the `AdjointWeightTally` for
+            the same paths
+        """
+        self.adjoint = adjoint
+        self.remaining_adjoint_weights = np.array(adjoint_weights, dtype=np.float64)
+
+    def record(self, photon_indices, flat_indices, weights, step, voxel_absorption, path_length):
+        voxel_adjoint = self.adjoint[flat_indices]
+        remaining_adjoint_weights = self.remaining_adjoint_weights[photon_indices]
+        _, integrated_path_length = get_attenuation_moments(voxel_absorption, step)
+        self.deposits.add(flat_indices, -(remaining_adjoint_weights * step -
+                                          voxel_adjoint * weights * integrated_path_length))
+        self.remaining_adjoint_weights[photon_indices] = remaining_adjoint_weights - \
+            voxel_adjoint * weights * path_length
+
+
+def propagate_photons(absorption_per_mm: np.ndarray, scattering_per_mm: np.ndarray, anisotropy: np.ndarray,
+                      positions: np.ndarray, directions: np.ndarray, random_generator: np.random.Generator,
+                      maximum_path_length_voxels: float = np.inf, spacing_mm: float = 1.0,
+                      roulette_threshold: float = 1e-4, roulette_survival: float = 0.1,
+                      tallies: List[PhotonTally] = ()) -> np.ndarray:
+    """
+    Propagates photon packets with an initial weight of 1 voxel by voxel through the volume until they leave it,
+    exceed the maximum path length or are terminated by russian roulette.
+
+    :param absorption_per_mm: absorption volume in units of per millimeter
+    :param scattering_per_mm: scattering volume in units of per millimeter
+    :param anisotropy: dimensionless scattering anisotropy volume
+    :param positions: array of shape (n, 3) with the initial positions in voxel units
+    :param directions: array of shape (n, 3) with the normalised initial directions
+    :param random_generator: the random generator to draw from
+    :param maximum_path_length_voxels: the path length in voxel units after which photons are terminated
+    :param spacing_mm: the voxel spacing, which converts the coefficients to voxel units
+    :param roulette_threshold: photons with a lower weight take part in russian roulette
+    :param roulette_survival: probability of a photon to survive the russian roulette
+    :param tallies: further quantities that are recorded along the paths of the photons
+    :return: flat array of the path lengths in voxel units travelled in every voxel weighted by the photon weights,
+        i.e. the absorbed energy divided by the absorption coefficient
+    """
+    shape = np.shape(absorption_per_mm)
+    absorption = np.ravel(absorption_per_mm) * spacing_mm
+    scattering = np.ravel(scattering_per_mm) * spacing_mm
+    anisotropy = np.ravel(anisotropy)
+    deposited_path_length = DepositBuffer(len(absorption))
+
+    positions = np.array(positions, dtype=np.float64)
+    directions = np.array(directions, dtype=np.float64)
+    hits_volume = move_photons_into_volume(positions, directions, shape)
+    positions, directions = positions[hits_volume], directions[hits_volume]
+    number_of_photons = len(positions)
+    # the voxel indices are tracked explicitly, as positions on a voxel boundary are ambiguous
+    voxel_indices = np.clip(np.floor(positions + 1e-9 * directions).astype(np.int64), 0, np.asarray(shape) - 1)
+    weights = np.ones(number_of_photons)
+    optical_depths = -np.log(1 - random_generator.random(number_of_photons))
+    remaining_path_lengths = np.full(number_of_photons, float(maximum_path_length_voxels))
+    strides = np.asarray([shape[1] * shape[2], shape[2], 1])
+    photon_indices = np.arange(number_of_photons)
+    for tally in tallies:
+        tally.start(number_of_photons, len(absorption))
+
+    while len(weights) > 0:
+        flat_indices = voxel_indices @ strides
+        voxel_absorption = absorption[flat_indices]
+        voxel_scattering = scattering[flat_indices]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            boundary_distances = (voxel_indices + (directions > 0) - positions) / directions
+            boundary_distances[directions == 0] = np.inf
+            crossed_axes = np.argmin(boundary_distances, axis=1)
+            boundary_distance = np.maximum(boundary_distances[np.arange(len(weights)), crossed_axes], 0)
+            scattering_distance = np.where(voxel_scattering > 0, optical_depths / voxel_scattering, np.inf)
+
+        scatters = scattering_distance <= boundary_distance
+        step = np.minimum(np.minimum(scattering_distance, boundary_distance), remaining_path_lengths)
+
+        attenuation = np.exp(-voxel_absorption * step)
+        # expm1 keeps the path length accurate for almost vanishing absorption
+        with np.errstate(divide="ignore", invalid="ignore"):
+            path_length = np.where(voxel_absorption > 0, -np.expm1(-voxel_absorption * step) / voxel_absorption,
+                                   step)
+        deposited_path_length.add(flat_indices, weights * path_length)
+        for tally in tallies:
+            tally.record(photon_indices, flat_indices, weights, step, voxel_absorption, path_length)
+
+        weights *= attenuation
+        positions += step[:, None] * directions
+        optical_depths -= voxel_scattering * step
+        remaining_path_lengths -= step
+        alive = remaining_path_lengths > 0
+
+        scattering_photons = np.flatnonzero(scatters & alive)
+        if len(scattering_photons) > 0:
+            directions[scattering_photons] = scatter_photons(directions[scattering_photons],
+                                                             anisotropy[flat_indices[scattering_photons]],
+                                                             random_generator)
+            optical_depths[scattering_photons] = -np.log(1 - random_generator.random(len(scattering_photons)))
+
+        crossing_photons = np.flatnonzero(~scatters & alive)
+        crossing_axes = crossed_axes[crossing_photons]
+        voxel_indices[crossing_photons, crossing_axes] += np.where(
+            directions[crossing_photons, crossing_axes] > 0, 1, -1)
+        alive &= np.all((voxel_indices >= 0) & (voxel_indices < shape), axis=1)
+
+        roulette = alive & (weights < roulette_threshold)
+        if np.any(roulette):
+            survives = random_generator.random(np.count_nonzero(roulette)) < roulette_survival
+            alive[roulette] = survives
+            weights[roulette] /= roulette_survival
+
+        if not np.all(alive):
+            positions, directions, voxel_indices = positions[alive], directions[alive], voxel_indices[alive]
+            weights, optical_depths = weights[alive], optical_depths[alive]
+            remaining_path_lengths, photon_indices = remaining_path_lengths[alive], photon_indices[alive]
+
+    return deposited_path_length.flush()
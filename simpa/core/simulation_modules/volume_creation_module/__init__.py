@@ -10,9 +10,11 @@ import numpy as np
 import torch
 from simpa.core import SimulationModule
 from simpa.utils.dict_path_manager import generate_dict_path
-from simpa.io_handling import save_data_field
+from simpa.io_handling import save_data_field, load_data_field
 from simpa.utils.quality_assurance.data_sanity_testing import assert_equal_shapes, assert_array_well_defined
 from simpa.utils.processing_device import get_processing_device
+from simpa.utils.compact_volume import COMPACT_VOLUME_FRACTIONS
+from simpa.utils.calculate import downsample_volume
 
 
 class VolumeCreatorModuleBase(SimulationModule):
@@ -26,21 +28,33 @@ class VolumeCreatorModuleBase(SimulationModule):
         self.component_settings = global_settings.get_volume_creation_settings()
         self.torch_device = get_processing_device(self.global_settings)
 
-    def create_empty_volumes(self):
-        volumes = dict()
-        voxel_spacing = self.global_settings[Tags.SPACING_MM]
+    def get_volume_dimensions_voxels(self, spacing_mm: float = None) -> tuple:
+        """
+        :param spacing_mm: the voxel spacing. The global Tags.SPACING_MM by default.
+        :return: the number of voxels of the simulation volume along the x-, y-, and z-axis
+        """
+        voxel_spacing = self.global_settings[Tags.SPACING_MM] if spacing_mm is None else spacing_mm
         volume_x_dim = int(round(self.global_settings[Tags.DIM_VOLUME_X_MM] / voxel_spacing))
         volume_y_dim = int(round(self.global_settings[Tags.DIM_VOLUME_Y_MM] / voxel_spacing))
         volume_z_dim = int(round(self.global_settings[Tags.DIM_VOLUME_Z_MM] / voxel_spacing))
-        sizes = (volume_x_dim, volume_y_dim, volume_z_dim)
+        return volume_x_dim, volume_y_dim, volume_z_dim
 
+    def get_property_tags_for_current_wavelength(self) -> list:
+        """
+        :return: the tissue property tags that need to be created in the current wavelength run. The
+            wavelength-independent properties are only created in the run of the first wavelength.
+        """
         wavelength = self.global_settings[Tags.WAVELENGTH]
         first_wavelength = self.global_settings[Tags.WAVELENGTHS][0]
+        return [key for key in TissueProperties.property_tags
+                if key not in TissueProperties.wavelength_independent_properties or wavelength == first_wavelength]
 
-        for key in TissueProperties.property_tags:
-            # Create wavelength-independent properties only in the first wavelength run
-            if key in TissueProperties.wavelength_independent_properties and wavelength != first_wavelength:
-                continue
+    def create_empty_volumes(self):
+        volumes = dict()
+        sizes = self.get_volume_dimensions_voxels()
+        volume_x_dim, volume_y_dim, volume_z_dim = sizes
+
+        for key in self.get_property_tags_for_current_wavelength():
             volumes[key] = torch.zeros(sizes, dtype=torch.float, device=self.torch_device)
 
         return volumes, volume_x_dim, volume_y_dim, volume_z_dim
@@ -56,9 +70,65 @@ class VolumeCreatorModuleBase(SimulationModule):
         """
         pass
 
+    def create_compact_simulation_volume(self) -> dict:
+        """
+        This method creates the compact representation of the in silico tissue that is used if
+        Tags.COMPACT_VOLUME_REPRESENTATION is set in the volume creation settings.
+
+        :return: A dictionary containing the per-voxel structure labels and volume fractions, the segmentation labels,
+            and the per-structure tables of the properties of the current wavelength
+            (see simpa.utils.compact_volume).
+        :rtype: dict
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support the compact volume representation.")
+
+    def create_optical_grid_volumes(self) -> dict:
+        """
+        This method creates the absorption, scattering, and anisotropy volumes at the spacing of the optical forward
+        model (see Settings.get_optical_spacing_mm). By default, blocks of the stored volumes are averaged, which
+        requires the optical spacing to be an integer multiple of the global spacing. Volume creators that can
+        rasterise the tissue at any spacing should override this method.
+
+        :return: A dictionary containing the wavelength-dependent optical properties as 3d numpy arrays.
+        :rtype: dict
+        """
+        optical_spacing_mm = self.global_settings.get_optical_spacing_mm()
+        factor = int(round(optical_spacing_mm / self.global_settings[Tags.SPACING_MM]))
+        if factor < 1 or not np.isclose(factor * self.global_settings[Tags.SPACING_MM], optical_spacing_mm):
+            raise ValueError(f"{type(self).__name__} requires the optical spacing ({optical_spacing_mm} mm) to be "
+                             f"an integer multiple of the spacing of the volume "
+                             f"({self.global_settings[Tags.SPACING_MM]} mm).")
+        optical_grid_shape = self.get_volume_dimensions_voxels(optical_spacing_mm)
+        return {key: downsample_volume(load_data_field(self.global_settings[Tags.SIMPA_OUTPUT_PATH], key,
+                                                       self.global_settings[Tags.WAVELENGTH]),
+                                       factor, optical_grid_shape)
+                for key in TissueProperties.wavelength_dependent_properties}
+
+    def save_optical_grid_volumes(self):
+        """
+        Stores the volumes of the optical grid if the optical spacing differs from the global spacing.
+        """
+        if self.global_settings.get_optical_spacing_mm() == self.global_settings[Tags.SPACING_MM]:
+            return
+        volumes = self.create_optical_grid_volumes()
+        torch.cuda.empty_cache()
+        if not (Tags.IGNORE_QA_ASSERTIONS in self.global_settings and Tags.IGNORE_QA_ASSERTIONS):
+            assert_equal_shapes(list(volumes.values()))
+            for _volume_name in volumes.keys():
+                assert_array_well_defined(volumes[_volume_name], array_name=_volume_name)
+        save_data_field(volumes, self.global_settings[Tags.SIMPA_OUTPUT_PATH],
+                        data_field=Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES,
+                        wavelength=self.global_settings[Tags.WAVELENGTH])
+
     def run(self, device):
         self.logger.info("VOLUME CREATION")
 
+        if Tags.COMPACT_VOLUME_REPRESENTATION in self.component_settings and \
+                self.component_settings[Tags.COMPACT_VOLUME_REPRESENTATION]:
+            self.save_compact_simulation_volume()
+            self.save_optical_grid_volumes()
+            return
+
         volumes = self.create_simulation_volume()
         # explicitly empty cache to free reserved GPU memory after volume creation
         torch.cuda.empty_cache()
@@ -74,3 +144,31 @@ class VolumeCreatorModuleBase(SimulationModule):
         for key, value in volumes.items():
             save_data_field(value, self.global_settings[Tags.SIMPA_OUTPUT_PATH],
                             data_field=key, wavelength=self.global_settings[Tags.WAVELENGTH])
+
+        self.save_optical_grid_volumes()
+
+    def save_compact_simulation_volume(self):
+        """
+        Stores the compact volume representation. The labels, volume fractions, and wavelength-independent property
+        tables are only stored in the run of the first wavelength, the wavelength-dependent property tables are stored
+        for every wavelength.
+        """
+        compact_volume = self.create_compact_simulation_volume()
+        torch.cuda.empty_cache()
+
+        if not (Tags.IGNORE_QA_ASSERTIONS in self.global_settings and Tags.IGNORE_QA_ASSERTIONS):
+            assert_array_well_defined(compact_volume[COMPACT_VOLUME_FRACTIONS], array_name=COMPACT_VOLUME_FRACTIONS)
+            for property_tag in TissueProperties.property_tags:
+                if property_tag in compact_volume and property_tag != Tags.DATA_FIELD_OXYGENATION:
+                    assert_array_well_defined(compact_volume[property_tag], array_name=property_tag)
+
+        wavelength = self.global_settings[Tags.WAVELENGTH]
+        property_table = dict()
+        for property_tag in TissueProperties.wavelength_dependent_properties:
+            property_table[property_tag] = compact_volume.pop(property_tag)
+
+        save_data_field(property_table, self.global_settings[Tags.SIMPA_OUTPUT_PATH],
+                        data_field=Tags.DATA_FIELD_PROPERTY_TABLE, wavelength=wavelength)
+        if wavelength == self.global_settings[Tags.WAVELENGTHS][0]:
+            save_data_field(compact_volume, self.global_settings[Tags.SIMPA_OUTPUT_PATH],
+                            data_field=Tags.DATA_FIELD_COMPACT_VOLUME)
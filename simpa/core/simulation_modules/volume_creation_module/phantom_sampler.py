@@ -0,0 +1,360 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from simpa.utils import Tags, Settings
+from simpa.utils.tissue_properties import TissueProperties
+from simpa.io_handling import save_hdf5
+from simpa.core.simulation_modules.volume_creation_module.volume_creation_module_model_based_adapter import \
+    ModelBasedVolumeCreationAdapter
+
+
+class ParameterDistribution(ABC):
+    """
+    Base class of the distributions from which the parameters of randomized structures are drawn.
+    """
+
+    @abstractmethod
+    def sample(self, random_state: np.random.Generator):
+        """
+        :param random_state: the random number generator of the phantom
+        :return: a random value drawn from the distribution
+        """
+        pass
+
+
+class UniformDistribution(ParameterDistribution):
+    """
+    Draws values uniformly from [low, high). If low and high are arrays, a value is drawn for each of their entries.
+    """
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, random_state: np.random.Generator):
+        return random_state.uniform(self.low, self.high)
+
+
+class UniformIntegerDistribution(ParameterDistribution):
+    """
+    Draws integers uniformly from [low, high], including both bounds.
+    """
+
+    def __init__(self, low: int, high: int):
+        self.low = low
+        self.high = high
+
+    def sample(self, random_state: np.random.Generator):
+        return random_state.integers(self.low, self.high, endpoint=True)
+
+
+class NormalDistribution(ParameterDistribution):
+    """
+    Draws values from a normal distribution. The values are optionally clipped to [minimum, maximum].
+    """
+
+    def __init__(self, mean, standard_deviation, minimum=None, maximum=None):
+        self.mean = mean
+        self.standard_deviation = standard_deviation
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def sample(self, random_state: np.random.Generator):
+        value = random_state.normal(self.mean, self.standard_deviation)
+        if self.minimum is not None or self.maximum is not None:
+            value = np.clip(value, self.minimum, self.maximum)
+        return value
+
+
+class ChoiceDistribution(ParameterDistribution):
+    """
+    Draws one of the given options, e.g. one of several molecular compositions.
+    """
+
+    def __init__(self, options: list, probabilities: list = None):
+        self.options = list(options)
+        self.probabilities = probabilities
+
+    def sample(self, random_state: np.random.Generator):
+        return self.options[random_state.choice(len(self.options), p=self.probabilities)]
+
+
+def sample_parameters(parameters, random_state: np.random.Generator):
+    """
+    Replaces every ParameterDistribution in the given parameters by a value drawn from it. Plain lists, tuples, and
+    dictionaries are traversed recursively, all other values are returned as they are.
+
+    :param parameters: a value, a ParameterDistribution, or a (nested) list, tuple, or dictionary of those
+    :param random_state: the random number generator of the phantom
+    :return: the parameters with all distributions replaced by random values
+    """
+    if isinstance(parameters, ParameterDistribution):
+        value = parameters.sample(random_state)
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+    # exact type checks, because e.g. a MolecularComposition is a list that must not be traversed
+    if type(parameters) in (list, tuple):
+        return type(parameters)(sample_parameters(value, random_state) for value in parameters)
+    if type(parameters) in (dict, Settings):
+        return {key: sample_parameters(value, random_state) for key, value in parameters.items()}
+    return parameters
+
+
+class StructureDistribution:
+    """
+    Describes a randomized structure. The structure settings are defined as for the ModelBasedVolumeCreationAdapter,
+    but every value may be replaced by a ParameterDistribution::
+
+        StructureDistribution({
+            Tags.PRIORITY: 5,
+            Tags.STRUCTURE_START_MM: [UniformDistribution(0, 20), 0, UniformDistribution(2, 8)],
+            Tags.STRUCTURE_END_MM: [UniformDistribution(0, 20), 20, UniformDistribution(2, 8)],
+            Tags.STRUCTURE_RADIUS_MM: NormalDistribution(1, 0.3, minimum=0.2),
+            Tags.MOLECULE_COMPOSITION: ChoiceDistribution([TISSUE_LIBRARY.blood(0.6), TISSUE_LIBRARY.blood(0.9)]),
+            Tags.CONSIDER_PARTIAL_VOLUME: True,
+            Tags.STRUCTURE_TYPE: Tags.CIRCULAR_TUBULAR_STRUCTURE
+        }, number_of_structures=UniformIntegerDistribution(1, 4))
+
+    """
+
+    def __init__(self, structure_settings: dict, number_of_structures=1):
+        """
+        :param structure_settings: the settings of a single structure, possibly containing ParameterDistributions
+        :param number_of_structures: the number of independently drawn structures of this kind per phantom. Can be
+            an integer or a ParameterDistribution of integers.
+        """
+        self.structure_settings = structure_settings
+        self.number_of_structures = number_of_structures
+
+    def sample(self, name: str, random_state: np.random.Generator) -> dict:
+        """
+        :param name: the identifier of the structure in Tags.STRUCTURES
+        :param random_state: the random number generator of the phantom
+        :return: a dictionary that maps unique identifiers to the settings of the drawn structures
+        """
+        if isinstance(self.number_of_structures, ParameterDistribution):
+            number_of_structures = int(self.number_of_structures.sample(random_state))
+        elif self.number_of_structures == 1:
+            return {name: sample_parameters(self.structure_settings, random_state)}
+        else:
+            number_of_structures = int(self.number_of_structures)
+        return {f"{name}_{structure_index}": sample_parameters(self.structure_settings, random_state)
+                for structure_index in range(number_of_structures)}
+
+
+class PhantomSampler:
+    """
+    Generates batches of randomized phantoms for the production of training data. For every phantom, the structures
+    are drawn from the given StructureDistributions and merged by the ModelBasedVolumeCreationAdapter into the compact
+    volume representation (see simpa.utils.compact_volume)::
+
+        sampler = PhantomSampler(settings, {
+            "background": define_background_structure_settings(TISSUE_LIBRARY.constant(1e-4, 1e-4, 0.9)),
+            "epidermis": StructureDistribution({
+                **define_horizontal_layer_structure_settings(z_start_mm=1, thickness_mm=0.1,
+                                                             molecular_composition=TISSUE_LIBRARY.epidermis()),
+                Tags.STRUCTURE_END_MM: [0, 0, UniformDistribution(1.1, 1.3)]}),
+            "vessel": StructureDistribution({...}, number_of_structures=UniformIntegerDistribution(1, 4))
+        }, random_seed=42, number_of_workers=8)
+
+        for file_path in sampler.generate(1000, output_directory="/path/to/dataset"):
+            ...
+
+    Every phantom draws from its own random stream that is spawned from the random seed and the phantom index with
+    a numpy SeedSequence. The phantoms are thus independent and reproducible regardless of the number of workers.
+    The settings, the molecular compositions, and their spectra are sent to every worker process only once, and the
+    structure settings of the individual phantoms are not validated again.
+
+    Instead of the compact volumes, the settings of each phantom can be passed straight into the simulation pipeline
+    via get_phantom_settings. The ModelBasedVolumeCreationAdapter then creates the identical phantom.
+    """
+
+    def __init__(self, global_settings: Settings, structure_distributions: dict, random_seed: int = None,
+                 number_of_workers: int = 1):
+        """
+        :param global_settings: the settings of the simulation. The volume dimensions, the spacing, the wavelengths,
+            and the volume creation settings are shared by all phantoms.
+        :param structure_distributions: a dictionary that maps structure identifiers to StructureDistributions or
+            to fixed structure settings.
+        :param random_seed: the seed from which the random streams of all phantoms are spawned. If None,
+            Tags.RANDOM_SEED of the global settings is used if present, otherwise fresh entropy.
+        :param number_of_workers: the number of worker processes. If 1, the phantoms are created in the calling
+            process.
+        """
+        self.global_settings = Settings(global_settings, verbose=False)
+        if Tags.VOLUME_CREATION_MODEL_SETTINGS in global_settings:
+            self.volume_creation_settings = Settings(global_settings.get_volume_creation_settings(), verbose=False)
+        else:
+            self.volume_creation_settings = Settings(verbose=False)
+        self.structure_distributions = structure_distributions
+
+        if random_seed is None and Tags.RANDOM_SEED in global_settings:
+            random_seed = global_settings[Tags.RANDOM_SEED]
+        if random_seed is not None:
+            random_seed = int(random_seed)
+        # the entropy is fixed here, such that all workers spawn the same random streams
+        self.random_seed = np.random.SeedSequence(random_seed).entropy
+        self.number_of_workers = max(1, int(number_of_workers))
+
+    def get_random_state(self, phantom_index: int) -> np.random.Generator:
+        """
+        :param phantom_index: the index of the phantom
+        :return: the independent random number generator of the phantom
+        """
+        return np.random.default_rng(np.random.SeedSequence(self.random_seed, spawn_key=(phantom_index, )))
+
+    def get_phantom_settings(self, phantom_index: int) -> Settings:
+        """
+        Draws the structures of a phantom.
+
+        :param phantom_index: the index of the phantom
+        :return: a copy of the global settings that contains the drawn structures and the random seed of the phantom
+        """
+        random_state = self.get_random_state(phantom_index)
+
+        structures = dict()
+        for name, structure_distribution in self.structure_distributions.items():
+            if not isinstance(structure_distribution, StructureDistribution):
+                structure_distribution = StructureDistribution(structure_distribution)
+            structures.update(structure_distribution.sample(name, random_state))
+
+        volume_creation_settings = Settings(self.volume_creation_settings, verbose=False)
+        volume_creation_settings[Tags.STRUCTURES] = structures
+        phantom_settings = Settings(self.global_settings, verbose=False)
+        phantom_settings[Tags.VOLUME_CREATION_MODEL_SETTINGS] = volume_creation_settings
+        # seeds the global numpy random state that is used e.g. by vessel trees and deformed layers
+        phantom_settings[Tags.RANDOM_SEED] = int(random_state.integers(2**31))
+        phantom_settings[Tags.VOLUME_NAME] = self.get_phantom_name(phantom_index)
+        return phantom_settings
+
+    def get_phantom_name(self, phantom_index: int) -> str:
+        """
+        :param phantom_index: the index of the phantom
+        :return: the volume name of the phantom
+        """
+        volume_name = self.global_settings[Tags.VOLUME_NAME] if Tags.VOLUME_NAME in self.global_settings \
+            else "phantom"
+        return f"{volume_name}_{phantom_index:06d}"
+
+    def create_phantom(self, phantom_index: int) -> dict:
+        """
+        Creates the compact volume of a phantom.
+
+        :param phantom_index: the index of the phantom
+        :return: a dictionary in the layout of a SIMPA output file that contains the settings of the phantom, its
+            compact volume, and the property tables of every wavelength.
+        """
+        phantom_settings = self.get_phantom_settings(phantom_index)
+        wavelengths = phantom_settings[Tags.WAVELENGTHS]
+        phantom_settings[Tags.WAVELENGTH] = wavelengths[0]
+
+        np.random.seed(phantom_settings[Tags.RANDOM_SEED])
+        volume_creator = ModelBasedVolumeCreationAdapter(phantom_settings)
+        molecular_compositions = list()
+        merger = volume_creator.merge_structures(molecular_compositions)
+        compact_volume = merger.get_compact_volume(TissueProperties.wavelength_independent_properties)
+
+        # (number of structures, number of wavelengths, number of wavelength-dependent properties)
+        structure_property_tables = np.zeros((len(molecular_compositions), len(wavelengths),
+                                              len(TissueProperties.wavelength_dependent_properties)))
+        for structure_index, molecular_composition in enumerate(molecular_compositions):
+            structure_property_tables[structure_index] = molecular_composition.get_property_table(
+                wavelengths, TissueProperties.wavelength_dependent_properties)
+        property_tables = dict()
+        for wavelength_index, wavelength in enumerate(wavelengths):
+            property_tables[wavelength] = {
+                property_tag: structure_property_tables[:, wavelength_index, property_index]
+                for property_index, property_tag in enumerate(TissueProperties.wavelength_dependent_properties)}
+
+        return {
+            Tags.SETTINGS: phantom_settings,
+            Tags.SIMULATIONS: {
+                Tags.SIMULATION_PROPERTIES: {
+                    Tags.DATA_FIELD_COMPACT_VOLUME: compact_volume,
+                    Tags.DATA_FIELD_PROPERTY_TABLE: property_tables
+                }
+            }
+        }
+
+    def write_phantom(self, phantom_index: int, output_directory: str) -> str:
+        """
+        Creates a phantom and stores it as a SIMPA output file, from which the dense property volumes can be loaded
+        with load_data_field.
+
+        :param phantom_index: the index of the phantom
+        :param output_directory: the directory in which the file is stored
+        :return: the path of the file
+        """
+        phantom = self.create_phantom(phantom_index)
+        file_path = os.path.join(output_directory, self.get_phantom_name(phantom_index) + ".hdf5")
+        phantom[Tags.SETTINGS][Tags.SIMPA_OUTPUT_PATH] = file_path
+        save_hdf5(phantom, file_path)
+        return file_path
+
+    def generate(self, number_of_phantoms: int, output_directory: str = None, first_phantom_index: int = 0):
+        """
+        A generator function that creates the phantoms in the worker processes and yields them in order of their
+        index. At most twice as many phantoms as there are workers are held in memory at the same time.
+
+        :param number_of_phantoms: the number of phantoms
+        :param output_directory: if given, the phantoms are stored in this directory by the workers and their file
+            paths are yielded. Otherwise, the dictionaries returned by create_phantom are yielded.
+        :param first_phantom_index: the index of the first phantom, e.g. to continue a previously generated dataset
+        """
+        if output_directory is not None:
+            os.makedirs(output_directory, exist_ok=True)
+        phantom_indices = range(first_phantom_index, first_phantom_index + number_of_phantoms)
+
+        if self.number_of_workers == 1:
+            for phantom_index in phantom_indices:
+                yield _create_phantom(self, phantom_index, output_directory)
+            return
+
+        # workers are spawned rather than forked, as forking is not safe once torch or CUDA have been initialised
+        with ProcessPoolExecutor(max_workers=self.number_of_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_initialize_worker, initargs=(self, )) as executor:
+            in_flight = deque()
+            remaining_phantom_indices = iter(phantom_indices)
+            while True:
+                while len(in_flight) < 2 * self.number_of_workers:
+                    phantom_index = next(remaining_phantom_indices, None)
+                    if phantom_index is None:
+                        break
+                    in_flight.append(executor.submit(_create_phantom_in_worker, phantom_index, output_directory))
+                if not in_flight:
+                    break
+                yield in_flight.popleft().result()
+
+
+_worker_phantom_sampler = None
+
+
+def _initialize_worker(phantom_sampler: PhantomSampler):
+    global _worker_phantom_sampler
+    _worker_phantom_sampler = phantom_sampler
+    # the phantoms are created in parallel processes, so every process only needs a single thread
+    torch.set_num_threads(1)
+
+
+def _create_phantom_in_worker(phantom_index: int, output_directory: str = None):
+    return _create_phantom(_worker_phantom_sampler, phantom_index, output_directory)
+
+
+def _create_phantom(phantom_sampler: PhantomSampler, phantom_index: int, output_directory: str = None):
+    if output_directory is None:
+        return phantom_sampler.create_phantom(phantom_index)
+    return phantom_sampler.write_phantom(phantom_index, output_directory)
@@ -0,0 +1,200 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import numpy as np
+import torch
+
+from simpa.utils import Tags
+from simpa.utils.tissue_properties import TissueProperties
+from simpa.utils.compact_volume import COMPACT_VOLUME_LABELS, COMPACT_VOLUME_FRACTIONS, \
+    COMPACT_VOLUME_SEGMENTATION_LABELS, COMPACT_VOLUME_LABEL_DTYPE
+
+
+def get_property_tables(structure_properties: list, property_tags: list) -> dict:
+    """
+    :param structure_properties: the tissue properties of each structure
+    :param property_tags: the tissue property tags for which a table should be created
+    :return: a dictionary that maps each property tag to an array with the property value of each structure.
+        Properties that are not defined for a structure are set to zero.
+    """
+    tables = dict()
+    for property_tag in property_tags:
+        tables[property_tag] = np.asarray([0.0 if properties[property_tag] is None else float(properties[property_tag])
+                                           for properties in structure_properties], dtype=np.float64)
+    return tables
+
+
+class StructureMerger:
+    """
+    Merges the geometrical volumes of a sequence of structures into a single simulation volume.
+
+    The structures have to be added in descending order of priority. Every structure may only claim the volume
+    fraction of a voxel that has not already been claimed by a structure of higher priority. For each structure, only
+    the voxels that it actually occupies are visited, and only a compact per-voxel accumulator (the already filled
+    volume fraction and the segmentation bookkeeping) is updated. The per-property volumes are then created at the
+    very end in a single pass as the product of the sparse (voxel -> structure fraction) matrix and the dense
+    (structure -> property) table::
+
+        merger = StructureMerger(volume_dimensions_voxels, torch_device)
+        for structure in priority_sorted_structures(global_settings, volume_creation_settings):
+            merger.add_structure(structure.geometrical_volume, structure.properties_for_wavelength(wavelength))
+        volumes = merger.get_property_volumes(TissueProperties.property_tags)
+
+    """
+
+    def __init__(self, volume_dimensions_voxels, torch_device: torch.device = torch.device("cpu")):
+        """
+        :param volume_dimensions_voxels: the number of voxels along the x-, y-, and z-axis of the simulation volume
+        :param torch_device: the device on which the merge is computed
+        """
+        self.volume_dimensions_voxels = tuple(int(dim) for dim in volume_dimensions_voxels)
+        self.number_of_voxels = int(np.prod(self.volume_dimensions_voxels))
+        self.torch_device = torch_device
+
+        self.global_volume_fractions = torch.zeros(self.number_of_voxels, dtype=torch.float,
+                                                   device=self.torch_device)
+        self.max_added_fractions = torch.zeros(self.number_of_voxels, dtype=torch.float, device=self.torch_device)
+        # index of the structure that determines the segmentation of a voxel, -1 if no structure does
+        self.segmentation_structure_indices = torch.full((self.number_of_voxels, ), -1, dtype=torch.long,
+                                                         device=self.torch_device)
+
+        self.voxel_indices = list()
+        self.added_fractions = list()
+        self.structure_properties = list()
+
+    @property
+    def number_of_structures(self) -> int:
+        return len(self.structure_properties)
+
+    def add_structure(self, geometrical_volume, structure_properties: TissueProperties) -> int:
+        """
+        Adds the next structure (in descending order of priority) to the merged volume.
+
+        :param geometrical_volume: array with the volume fraction that the structure occupies in every voxel
+        :param structure_properties: the tissue properties of the structure
+        :return: the index of the added structure
+        """
+        structure_index = self.number_of_structures
+
+        structure_volume_fractions = torch.as_tensor(geometrical_volume, dtype=torch.float,
+                                                     device=self.torch_device).reshape(-1)
+        voxel_indices = torch.nonzero(structure_volume_fractions > 0, as_tuple=True)[0]
+        remaining_volume_fractions = 1 - self.global_volume_fractions[voxel_indices]
+        free_voxels = remaining_volume_fractions > 0
+        voxel_indices = voxel_indices[free_voxels]
+        added_fractions = torch.minimum(structure_volume_fractions[voxel_indices],
+                                        remaining_volume_fractions[free_voxels])
+
+        self.global_volume_fractions[voxel_indices] += added_fractions
+
+        if structure_properties[Tags.DATA_FIELD_SEGMENTATION] is not None:
+            dominates = added_fractions > self.max_added_fractions[voxel_indices]
+            dominated_voxel_indices = voxel_indices[dominates]
+            self.max_added_fractions[dominated_voxel_indices] = added_fractions[dominates]
+            self.segmentation_structure_indices[dominated_voxel_indices] = structure_index
+
+        self.voxel_indices.append(voxel_indices)
+        self.added_fractions.append(added_fractions)
+        self.structure_properties.append(structure_properties)
+        return structure_index
+
+    def get_property_table(self, property_tags: list) -> torch.Tensor:
+        """
+        :param property_tags: the tissue property tags that define the columns of the table
+        :return: a (number of structures x number of properties) table. Properties that are not defined for a
+            structure are set to zero.
+        """
+        table = torch.zeros((self.number_of_structures, len(property_tags)), dtype=torch.float,
+                            device=self.torch_device)
+        for structure_index, structure_properties in enumerate(self.structure_properties):
+            for property_index, property_tag in enumerate(property_tags):
+                if structure_properties[property_tag] is not None:
+                    table[structure_index, property_index] = float(structure_properties[property_tag])
+        return table
+
+    def get_property_volumes(self, property_tags: list) -> dict:
+        """
+        Computes the merged volume for each of the given tissue properties.
+
+        :param property_tags: the tissue property tags for which a volume should be created
+        :return: a dictionary that maps each property tag to a torch tensor with the dimensions of the simulation volume
+        """
+        volumes = dict()
+        if self.number_of_structures == 0:
+            for property_tag in property_tags:
+                volumes[property_tag] = torch.zeros(self.volume_dimensions_voxels, dtype=torch.float,
+                                                    device=self.torch_device)
+            return volumes
+
+        fractional_tags = [tag for tag in property_tags if tag != Tags.DATA_FIELD_SEGMENTATION]
+        if fractional_tags:
+            structure_indices = torch.cat([torch.full_like(voxel_indices, structure_index)
+                                           for structure_index, voxel_indices in enumerate(self.voxel_indices)])
+            # each non-zero entry of the voxel -> structure fraction matrix scatters its row of the property table
+            merged_properties = torch.zeros((self.number_of_voxels, len(fractional_tags)), dtype=torch.float,
+                                            device=self.torch_device)
+            merged_properties.index_add_(0, torch.cat(self.voxel_indices),
+                                         torch.cat(self.added_fractions)[:, None] *
+                                         self.get_property_table(fractional_tags)[structure_indices])
+            for property_index, property_tag in enumerate(fractional_tags):
+                volumes[property_tag] = merged_properties[:, property_index].reshape(self.volume_dimensions_voxels)
+
+        if Tags.DATA_FIELD_SEGMENTATION in property_tags:
+            # the last entry of the lookup table is used for voxels that are not claimed by any structure
+            segmentation_lookup_table = torch.cat([self.get_property_table([Tags.DATA_FIELD_SEGMENTATION])[:, 0],
+                                                   torch.zeros(1, dtype=torch.float, device=self.torch_device)])
+            volumes[Tags.DATA_FIELD_SEGMENTATION] = segmentation_lookup_table[
+                self.segmentation_structure_indices].reshape(self.volume_dimensions_voxels)
+
+        return volumes
+
+    def get_property_tables(self, property_tags: list) -> dict:
+        """
+        :param property_tags: the tissue property tags for which a table should be created
+        :return: a dictionary that maps each property tag to an array with the property value of each structure.
+            Properties that are not defined for a structure are set to zero.
+        """
+        return get_property_tables(self.structure_properties, property_tags)
+
+    def get_compact_volume(self, property_tags: list) -> dict:
+        """
+        Creates the compact representation of the merged volume. Instead of one dense volume per property, every
+        voxel only stores the labels of the structures that occupy it together with their volume fractions. The
+        property values are stored once per structure.
+
+        :param property_tags: the tissue property tags for which a table should be created
+        :return: a dictionary with the labels, the volume fractions, the segmentation labels, and the property tables
+        """
+        structure_indices = torch.cat([torch.full_like(voxel_indices, structure_index)
+                                       for structure_index, voxel_indices in enumerate(self.voxel_indices)]
+                                      + [torch.zeros(0, dtype=torch.long, device=self.torch_device)])
+        voxel_indices = torch.cat(self.voxel_indices + [torch.zeros(0, dtype=torch.long, device=self.torch_device)])
+        added_fractions = torch.cat(self.added_fractions + [torch.zeros(0, dtype=torch.float,
+                                                                        device=self.torch_device)])
+
+        # sort the entries by voxel and within a voxel by descending volume fraction
+        _, order = torch.sort(added_fractions, descending=True, stable=True)
+        sorted_voxel_indices, voxel_order = torch.sort(voxel_indices[order], stable=True)
+        order = order[voxel_order]
+
+        structures_per_voxel = torch.bincount(voxel_indices, minlength=self.number_of_voxels)
+        number_of_slots = max(int(structures_per_voxel.max()) if len(voxel_indices) > 0 else 0, 1)
+        first_entry_of_voxel = torch.cumsum(structures_per_voxel, dim=0) - structures_per_voxel
+        slots = torch.arange(len(sorted_voxel_indices), device=self.torch_device) - \
+            first_entry_of_voxel[sorted_voxel_indices]
+
+        labels = torch.full((self.number_of_voxels, number_of_slots), -1, dtype=torch.long, device=self.torch_device)
+        fractions = torch.zeros((self.number_of_voxels, number_of_slots), dtype=torch.float,
+                                device=self.torch_device)
+        labels[sorted_voxel_indices, slots] = structure_indices[order]
+        fractions[sorted_voxel_indices, slots] = added_fractions[order]
+
+        compact_volume = self.get_property_tables(property_tags)
+        compact_volume[COMPACT_VOLUME_LABELS] = labels.reshape(self.volume_dimensions_voxels + (number_of_slots, ))\
+            .cpu().numpy().astype(COMPACT_VOLUME_LABEL_DTYPE)
+        compact_volume[COMPACT_VOLUME_FRACTIONS] = fractions.reshape(self.volume_dimensions_voxels +
+                                                                     (number_of_slots, )).cpu().numpy()
+        compact_volume[COMPACT_VOLUME_SEGMENTATION_LABELS] = self.segmentation_structure_indices\
+            .reshape(self.volume_dimensions_voxels).cpu().numpy().astype(COMPACT_VOLUME_LABEL_DTYPE)
+        return compact_volume
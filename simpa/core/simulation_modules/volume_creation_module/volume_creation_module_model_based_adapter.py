@@ -3,11 +3,13 @@
 # SPDX-License-Identifier: MIT
 
 from simpa.core.simulation_modules.volume_creation_module import VolumeCreatorModuleBase
-from simpa.utils.libraries.structure_library import priority_sorted_structures
+from simpa.core.simulation_modules.volume_creation_module.structure_merger import StructureMerger
+from simpa.utils.libraries.structure_library import priority_sorted_structures, get_structure_class
 from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa.utils.tissue_properties import TissueProperties
 import numpy as np
 from simpa.utils import create_deformation_settings
-import torch
 
 
 class ModelBasedVolumeCreationAdapter(VolumeCreatorModuleBase):
@@ -45,8 +47,16 @@ class ModelBasedVolumeCreationAdapter(VolumeCreatorModuleBase):
 
     """
 
-    def create_simulation_volume(self) -> dict:
+    def merge_structures(self, molecular_compositions: list = None, spacing_mm: float = None) -> StructureMerger:
+        """
+        Creates all structures defined in the settings and merges them in descending order of priority.
 
+        :param molecular_compositions: if given, the molecular composition of every merged structure is appended to
+            this list in the order of the structure labels.
+        :param spacing_mm: the voxel spacing at which the structures are rasterised. The global Tags.SPACING_MM by
+            default.
+        :return: the StructureMerger that contains all structures of the volume
+        """
         if Tags.SIMULATE_DEFORMED_LAYERS in self.component_settings \
                 and self.component_settings[Tags.SIMULATE_DEFORMED_LAYERS]:
             self.logger.debug("Tags.SIMULATE_DEFORMED_LAYERS in self.component_settings is TRUE")
@@ -59,48 +69,55 @@ class ModelBasedVolumeCreationAdapter(VolumeCreatorModuleBase):
                     filter_sigma=0,
                     cosine_scaling_factor=1)
 
-        volumes, x_dim_px, y_dim_px, z_dim_px = self.create_empty_volumes()
-        global_volume_fractions = torch.zeros((x_dim_px, y_dim_px, z_dim_px),
-                                              dtype=torch.float, device=self.torch_device)
-        max_added_fractions = torch.zeros((x_dim_px, y_dim_px, z_dim_px), dtype=torch.float, device=self.torch_device)
         wavelength = self.global_settings[Tags.WAVELENGTH]
 
-        for structure in priority_sorted_structures(self.global_settings, self.component_settings):
+        global_settings = self.global_settings
+        if spacing_mm is not None and spacing_mm != global_settings[Tags.SPACING_MM]:
+            global_settings = Settings(global_settings, verbose=False)
+            global_settings[Tags.SPACING_MM] = spacing_mm
+
+        merger = StructureMerger(self.get_volume_dimensions_voxels(spacing_mm), self.torch_device)
+        for structure in priority_sorted_structures(global_settings, self.component_settings):
             self.logger.debug(type(structure))
+            merger.add_structure(structure.geometrical_volume, structure.properties_for_wavelength(wavelength))
+            if molecular_compositions is not None:
+                molecular_compositions.append(structure.molecule_composition)
+        return merger
 
-            structure_properties = structure.properties_for_wavelength(wavelength)
-
-            structure_volume_fractions = torch.as_tensor(
-                structure.geometrical_volume, dtype=torch.float, device=self.torch_device)
-            structure_indexes_mask = structure_volume_fractions > 0
-            global_volume_fractions_mask = global_volume_fractions < 1
-            mask = structure_indexes_mask & global_volume_fractions_mask
-            added_volume_fraction = (global_volume_fractions + structure_volume_fractions)
-
-            added_volume_fraction[added_volume_fraction <= 1 & mask] = structure_volume_fractions[
-                added_volume_fraction <= 1 & mask]
-
-            selector_more_than_1 = added_volume_fraction > 1
-            if torch.any(selector_more_than_1):
-                remaining_volume_fraction_to_fill = 1 - global_volume_fractions[selector_more_than_1]
-                fraction_to_be_filled = structure_volume_fractions[selector_more_than_1]
-                added_volume_fraction[selector_more_than_1] = torch.min(torch.stack((remaining_volume_fraction_to_fill,
-                                                                                     fraction_to_be_filled)), 0).values
-            for key in volumes.keys():
-                if structure_properties[key] is None:
-                    continue
-                if key == Tags.DATA_FIELD_SEGMENTATION:
-                    added_fraction_greater_than_any_added_fraction = added_volume_fraction > max_added_fractions
-                    volumes[key][added_fraction_greater_than_any_added_fraction & mask] = structure_properties[key]
-                    max_added_fractions[added_fraction_greater_than_any_added_fraction & mask] = \
-                        added_volume_fraction[added_fraction_greater_than_any_added_fraction & mask]
-                else:
-                    volumes[key][mask] += added_volume_fraction[mask] * structure_properties[key]
-
-            global_volume_fractions[mask] += added_volume_fraction[mask]
+    def create_simulation_volume(self) -> dict:
+        merger = self.merge_structures()
+        volumes = merger.get_property_volumes(self.get_property_tags_for_current_wavelength())
 
         # convert volumes back to CPU
         for key in volumes.keys():
             volumes[key] = volumes[key].cpu().numpy().astype(np.float64, copy=False)
 
         return volumes
+
+    def create_compact_simulation_volume(self) -> dict:
+        return self.merge_structures().get_compact_volume(self.get_property_tags_for_current_wavelength())
+
+    def create_optical_grid_volumes(self) -> dict:
+        """
+        Rasterises the structures directly at the optical spacing if the geometry of all of them is independent of the
+        spacing (see GeometricalStructure.supports_any_spacing). Otherwise, e.g. for vessel trees, whose random walk
+        proceeds in voxel steps, the structures would differ between the grids and blocks of the volume are averaged
+        instead, which requires the optical spacing to be an integer multiple of the global spacing.
+
+        :return: A dictionary containing the wavelength-dependent optical properties as 3d numpy arrays.
+        :rtype: dict
+        """
+        structure_settings = []
+        if Tags.STRUCTURES in self.component_settings:
+            structure_settings = self.component_settings[Tags.STRUCTURES].values()
+        if not all(get_structure_class(structure_setting).supports_any_spacing
+                   for structure_setting in structure_settings):
+            self.logger.debug("The geometry of a structure depends on the spacing, the optical grid is averaged from "
+                              "the volume.")
+            return super(ModelBasedVolumeCreationAdapter, self).create_optical_grid_volumes()
+
+        merger = self.merge_structures(spacing_mm=self.global_settings.get_optical_spacing_mm())
+        volumes = merger.get_property_volumes(TissueProperties.wavelength_dependent_properties)
+        for key in volumes.keys():
+            volumes[key] = volumes[key].cpu().numpy().astype(np.float64, copy=False)
+        return volumes
@@ -5,10 +5,16 @@
 from simpa.core.simulation_modules.volume_creation_module import VolumeCreatorModuleBase
 from simpa.utils import Tags
 from simpa.utils.tissue_properties import TissueProperties
-from simpa.io_handling import save_hdf5
-import h5py
+from simpa.utils.compact_volume import COMPACT_VOLUME_LABELS, COMPACT_VOLUME_FRACTIONS, \
+    COMPACT_VOLUME_SEGMENTATION_LABELS, COMPACT_VOLUME_LABEL_DTYPE
+from simpa.io_handling import save_hdf5, open_segmentation_volume
 import numpy as np
 
+SEGMENTATION_SLAB_SIZE_VOXELS = 2 ** 24
+"""
+Approximate number of voxels of the segmentation volume that are read at once.
+"""
+
 
 class SegmentationBasedVolumeCreationAdapter(VolumeCreatorModuleBase):
     """
@@ -18,33 +24,143 @@ class SegmentationBasedVolumeCreationAdapter(VolumeCreatorModuleBase):
     the settings under Tags.SEGMENTATION_CLASS_MAPPING.
 
     With this, an even greater utility is warranted.
+
+    Instead of the array itself, the segmentation volume can also be referenced by path under the
+    Tags.INPUT_SEGMENTATION_VOLUME_PATH tag (see simpa.io_handling.open_segmentation_volume).
+
+    The segmentation classes are converted once into a compact integer label volume. For every wavelength, the
+    class mapping is compiled into a (property x label) lookup table and all property volumes are created with a
+    single gather of the lookup table at the labels.
     """
 
-    def create_simulation_volume(self) -> dict:
-        volumes, x_dim_px, y_dim_px, z_dim_px = self.create_empty_volumes()
-        wavelength = self.global_settings[Tags.WAVELENGTH]
+    def __init__(self, global_settings):
+        super(SegmentationBasedVolumeCreationAdapter, self).__init__(global_settings)
+        self.segmentation_labels = None
+        self.label_classes = None
+
+    def get_segmentation_labels(self):
+        """
+        Converts the input segmentation volume into integer labels that index the lookup tables. The conversion is
+        only done once and reused for all wavelengths. A segmentation volume that is referenced by path is read in
+        slabs along the x-axis, such that it is never held in memory as a whole.
+
+        :return: a tuple of the label volume and a list that contains the segmentation class of each label or None if
+            the label does not occur in the segmentation volume.
+        """
+        if self.segmentation_labels is not None:
+            return self.segmentation_labels, self.label_classes
+
+        with open_segmentation_volume(self.component_settings) as segmentation_volume:
+            x_dim_px, y_dim_px, z_dim_px = self.get_volume_dimensions_voxels()
+            x_dim_seg_px, y_dim_seg_px, z_dim_seg_px = segmentation_volume.shape
+
+            if x_dim_px != x_dim_seg_px:
+                raise ValueError("x_dim of volumes and segmentation must perfectly match but was {} and {}"
+                                 .format(x_dim_px, x_dim_seg_px))
+            if y_dim_px != y_dim_seg_px:
+                raise ValueError("y_dim of volumes and segmentation must perfectly match but was {} and {}"
+                                 .format(y_dim_px, y_dim_seg_px))
+            if z_dim_px != z_dim_seg_px:
+                raise ValueError("z_dim of volumes and segmentation must perfectly match but was {} and {}"
+                                 .format(z_dim_px, z_dim_seg_px))
+
+            slab_size = max(1, SEGMENTATION_SLAB_SIZE_VOXELS // max(1, y_dim_seg_px * z_dim_seg_px))
+            slabs = [slice(x_start, min(x_start + slab_size, x_dim_seg_px))
+                     for x_start in range(0, x_dim_seg_px, slab_size)]
+
+            # non-negative integer classes can directly be used as labels, all other classes are enumerated
+            direct_labels = np.issubdtype(segmentation_volume.dtype, np.integer)
+            class_occurrences = np.zeros(0, dtype=np.int64)
+            segmentation_classes = list()
+            for slab in slabs:
+                segmentation_slab = np.asarray(segmentation_volume[slab])
+                if direct_labels and segmentation_slab.size > 0 and segmentation_slab.min() < 0:
+                    direct_labels = False
+                    segmentation_classes.append(np.flatnonzero(class_occurrences))
+                if direct_labels:
+                    slab_occurrences = np.bincount(segmentation_slab.reshape(-1))
+                    if len(slab_occurrences) > len(class_occurrences):
+                        class_occurrences = np.pad(class_occurrences,
+                                                   (0, len(slab_occurrences) - len(class_occurrences)))
+                    class_occurrences[:len(slab_occurrences)] += slab_occurrences
+                else:
+                    segmentation_classes.append(np.unique(segmentation_slab))
 
-        segmentation_volume = self.component_settings[Tags.INPUT_SEGMENTATION_VOLUME]
-        segmentation_classes = np.unique(segmentation_volume, return_counts=False)
-        x_dim_seg_px, y_dim_seg_px, z_dim_seg_px = np.shape(segmentation_volume)
+            if direct_labels:
+                label_classes = [label if occurrences > 0 else None
+                                 for label, occurrences in enumerate(class_occurrences)]
+            else:
+                segmentation_classes = np.unique(np.concatenate(segmentation_classes))
+                label_classes = segmentation_classes.tolist()
 
-        if x_dim_px != x_dim_seg_px:
-            raise ValueError("x_dim of volumes and segmentation must perfectly match but was {} and {}"
-                             .format(x_dim_px, x_dim_seg_px))
-        if y_dim_px != y_dim_seg_px:
-            raise ValueError("y_dim of volumes and segmentation must perfectly match but was {} and {}"
-                             .format(y_dim_px, y_dim_seg_px))
-        if z_dim_px != z_dim_seg_px:
-            raise ValueError("z_dim of volumes and segmentation must perfectly match but was {} and {}"
-                             .format(z_dim_px, z_dim_seg_px))
+            label_dtype = COMPACT_VOLUME_LABEL_DTYPE \
+                if len(label_classes) <= np.iinfo(COMPACT_VOLUME_LABEL_DTYPE).max else np.int64
+            labels = np.empty((x_dim_seg_px, y_dim_seg_px, z_dim_seg_px), dtype=label_dtype)
+            for slab in slabs:
+                segmentation_slab = np.asarray(segmentation_volume[slab])
+                if direct_labels:
+                    labels[slab] = segmentation_slab
+                else:
+                    labels[slab] = np.searchsorted(segmentation_classes, segmentation_slab)
 
+        self.segmentation_labels = labels
+        self.label_classes = label_classes
+        return self.segmentation_labels, self.label_classes
+
+    def create_property_lookup_table(self, property_tags: list) -> np.ndarray:
+        """
+        :param property_tags: the tissue property tags that define the rows of the table
+        :return: a (number of properties x number of labels) table with the properties of each segmentation class.
+            Properties that are not defined for a class are set to zero, an undefined oxygenation is set to NaN.
+        :raises KeyError: if a segmentation class that occurs in the volume is not part of the class mapping
+        """
+        wavelength = self.global_settings[Tags.WAVELENGTH]
         class_mapping = self.component_settings[Tags.SEGMENTATION_CLASS_MAPPING]
+        _, label_classes = self.get_segmentation_labels()
 
-        for seg_class in segmentation_classes:
+        lookup_table = np.zeros((len(property_tags), len(label_classes)), dtype=np.float64)
+        for label, seg_class in enumerate(label_classes):
+            if seg_class is None:
+                continue
+            if seg_class not in class_mapping:
+                raise KeyError(f"The segmentation class {seg_class} is not defined in the "
+                               f"Tags.SEGMENTATION_CLASS_MAPPING.")
             class_properties = class_mapping[seg_class].get_properties_for_wavelength(wavelength)
-            for prop_tag in TissueProperties.property_tags:
-                volumes[prop_tag][segmentation_volume == seg_class] = class_properties[prop_tag]
+            for property_index, property_tag in enumerate(property_tags):
+                if class_properties[property_tag] is not None:
+                    lookup_table[property_index, label] = class_properties[property_tag]
+                elif property_tag == Tags.DATA_FIELD_OXYGENATION:
+                    lookup_table[property_index, label] = np.nan
+        return lookup_table
+
+    def create_simulation_volume(self) -> dict:
+        labels, _ = self.get_segmentation_labels()
+        property_tags = self.get_property_tags_for_current_wavelength()
+        property_volumes = self.create_property_lookup_table(property_tags)[:, labels]
+        volumes = {property_tag: property_volumes[property_index]
+                   for property_index, property_tag in enumerate(property_tags)}
+
+        if Tags.DATA_FIELD_SEGMENTATION in volumes and \
+                np.array_equal(volumes[Tags.DATA_FIELD_SEGMENTATION],
+                               np.round(volumes[Tags.DATA_FIELD_SEGMENTATION])):
+            volumes[Tags.DATA_FIELD_SEGMENTATION] = volumes[Tags.DATA_FIELD_SEGMENTATION].astype(labels.dtype)
 
         save_hdf5(self.global_settings, self.global_settings[Tags.SIMPA_OUTPUT_PATH], "/settings/")
 
         return volumes
+
+    def create_compact_simulation_volume(self) -> dict:
+        labels, _ = self.get_segmentation_labels()
+        property_tags = self.get_property_tags_for_current_wavelength()
+        lookup_table = self.create_property_lookup_table(property_tags)
+
+        # every voxel is occupied by exactly one segmentation class
+        compact_volume = {property_tag: lookup_table[property_index]
+                          for property_index, property_tag in enumerate(property_tags)}
+        compact_volume[COMPACT_VOLUME_LABELS] = labels[..., np.newaxis]
+        compact_volume[COMPACT_VOLUME_FRACTIONS] = np.ones(np.shape(labels) + (1, ), dtype=np.float32)
+        compact_volume[COMPACT_VOLUME_SEGMENTATION_LABELS] = labels
+
+        save_hdf5(self.global_settings, self.global_settings[Tags.SIMPA_OUTPUT_PATH], "/settings/")
+
+        return compact_volume
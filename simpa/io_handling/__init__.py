@@ -6,3 +6,6 @@ from simpa.io_handling.io_hdf5 import load_hdf5
 from simpa.io_handling.io_hdf5 import save_hdf5
 from simpa.io_handling.io_hdf5 import load_data_field
 from simpa.io_handling.io_hdf5 import save_data_field
+from simpa.io_handling.io_hdf5 import delete_data_field
+from simpa.io_handling.io_hdf5 import load_optical_output_in_volume
+from simpa.io_handling.io_segmentation import open_segmentation_volume
@@ -8,6 +8,9 @@ from simpa.utils.dict_path_manager import generate_dict_path
 import numpy as np
 from simpa.log import Logger
 from simpa.utils.serializer import SerializableSIMPAClass
+from simpa.utils.tags import Tags
+from simpa.utils.tissue_properties import TissueProperties
+from simpa.utils.compact_volume import materialize_property_volume
 
 logger = Logger()
 
@@ -168,12 +171,95 @@ def load_hdf5(file_path, file_dictionary_path="/"):
         return data_grabber(h5file, file_dictionary_path)
 
 
+def contains_hdf5_path(file_path, file_dictionary_path) -> bool:
+    """
+    Checks if an hdf5 file contains the given path.
+
+    :param file_path: Path of the hdf5 file.
+    :param file_dictionary_path: Path in dictionary structure of the hdf5 file.
+    :returns: True if the path exists in the file.
+    """
+    with h5py.File(file_path, "r") as h5file:
+        return file_dictionary_path.rstrip("/") in h5file
+
+
 def load_data_field(file_path, data_field, wavelength=None):
     path = generate_dict_path(data_field, wavelength=wavelength)
+    if data_field in TissueProperties.property_tags:
+        # probe the dense and the compact representation within a single opening of the file
+        with h5py.File(file_path, "r") as h5file:
+            is_compact = (path.rstrip("/") not in h5file and
+                          generate_dict_path(Tags.DATA_FIELD_COMPACT_VOLUME).rstrip("/") in h5file)
+        if is_compact:
+            return load_compact_data_field(file_path, data_field, wavelength)
     data = load_hdf5(file_path, path)
     return data
 
 
+def load_compact_data_field(file_path, data_field, wavelength=None):
+    """
+    Materializes the dense volume of a tissue property from the compact volume representation stored in the file.
+
+    :param file_path: Path of the hdf5 file.
+    :param data_field: The tissue property to materialize.
+    :param wavelength: Wavelength of the wavelength-dependent properties. If None, the volumes of all wavelengths are
+        returned as a dictionary.
+    :returns: np.ndarray or dict
+    """
+    compact_volume = load_hdf5(file_path, generate_dict_path(Tags.DATA_FIELD_COMPACT_VOLUME))
+    if data_field not in TissueProperties.wavelength_dependent_properties:
+        return materialize_property_volume(compact_volume, data_field)
+    if wavelength is not None:
+        property_table = load_hdf5(file_path, generate_dict_path(Tags.DATA_FIELD_PROPERTY_TABLE, wavelength))
+        return materialize_property_volume(compact_volume, data_field, property_table)
+    property_tables = load_hdf5(file_path, generate_dict_path(Tags.DATA_FIELD_PROPERTY_TABLE))
+    return {wl: materialize_property_volume(compact_volume, data_field, property_table)
+            for wl, property_table in property_tables.items()}
+
+
+def load_optical_output_in_volume(file_path, data_field, volume_shape, wavelength=None):
+    """
+    Loads an output of the optical forward model, e.g. the fluence or the initial pressure. If it was only stored
+    within the field of view (Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW), it is placed at its offset in a volume of
+    zeros of the given shape.
+
+    :param file_path: Path of the hdf5 file.
+    :param data_field: The data field of the optical output.
+    :param volume_shape: The shape of the simulated volume.
+    :param wavelength: Wavelength of the optical output.
+    :returns: np.ndarray
+    :raises: ValueError: if the stored region does not fit into a volume of the given shape
+    """
+    data = load_data_field(file_path, data_field, wavelength)
+    offset_path = generate_dict_path(Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, wavelength=wavelength)
+    if not contains_hdf5_path(file_path, offset_path):
+        return data
+    offset = np.asarray(load_hdf5(file_path, offset_path))
+    if len(offset) != np.ndim(data) or len(volume_shape) != np.ndim(data):
+        raise ValueError(f"The offset {offset} of the {data_field} of shape {np.shape(data)} does not match a "
+                         f"volume of shape {volume_shape}.")
+    if np.any(offset < 0) or np.any(offset + np.shape(data) > np.asarray(volume_shape)):
+        raise ValueError(f"The {data_field} of shape {np.shape(data)} at the offset {offset} does not fit into a "
+                         f"volume of shape {volume_shape}.")
+    volume = np.zeros(volume_shape, dtype=data.dtype)
+    volume[tuple(slice(start, start + size) for start, size in zip(offset, np.shape(data)))] = data
+    return volume
+
+
 def save_data_field(data, file_path, data_field, wavelength=None):
     dict_path = generate_dict_path(data_field, wavelength=wavelength)
     save_hdf5(data, file_path, dict_path)
+
+
+def delete_data_field(file_path, data_field, wavelength=None):
+    """
+    Removes a data field from an hdf5 file if it is contained in it.
+
+    :param file_path: Path of the hdf5 file.
+    :param data_field: The data field to remove.
+    :param wavelength: Wavelength of the data field.
+    """
+    dict_path = generate_dict_path(data_field, wavelength=wavelength).rstrip("/")
+    with h5py.File(file_path, "a") as h5file:
+        if dict_path in h5file:
+            del h5file[dict_path]
@@ -0,0 +1,51 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+from contextlib import contextmanager
+import os
+import h5py
+import numpy as np
+from simpa.utils import Tags
+
+
+@contextmanager
+def open_segmentation_volume(volume_creation_settings):
+    """
+    Opens the segmentation volume that is defined in the volume creation settings without loading it into memory.
+    The segmentation volume is either given as an array via Tags.INPUT_SEGMENTATION_VOLUME or referenced by path via
+    Tags.INPUT_SEGMENTATION_VOLUME_PATH::
+
+        with open_segmentation_volume(volume_creation_settings) as segmentation_volume:
+            slab = np.asarray(segmentation_volume[x_start:x_end])
+
+    :param volume_creation_settings: the volume creation settings
+    :returns: an array-like object that supports shape, dtype, and slicing along the first axis
+    :raises ValueError: if the segmentation volume is not defined or its file type is not supported
+    """
+    if Tags.INPUT_SEGMENTATION_VOLUME in volume_creation_settings:
+        yield np.asarray(volume_creation_settings[Tags.INPUT_SEGMENTATION_VOLUME])
+        return
+
+    if Tags.INPUT_SEGMENTATION_VOLUME_PATH not in volume_creation_settings:
+        raise ValueError("Either Tags.INPUT_SEGMENTATION_VOLUME or Tags.INPUT_SEGMENTATION_VOLUME_PATH has to be "
+                         "defined in the volume creation settings.")
+
+    file_path = volume_creation_settings[Tags.INPUT_SEGMENTATION_VOLUME_PATH]
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".npy":
+        yield np.load(file_path, mmap_mode="r")
+    elif extension in [".hdf5", ".h5"]:
+        if Tags.INPUT_SEGMENTATION_VOLUME_DATASET not in volume_creation_settings:
+            raise ValueError("Tags.INPUT_SEGMENTATION_VOLUME_DATASET has to be defined for HDF5 segmentation files.")
+        with h5py.File(file_path, "r") as h5file:
+            yield h5file[volume_creation_settings[Tags.INPUT_SEGMENTATION_VOLUME_DATASET]]
+    else:
+        if not (Tags.INPUT_SEGMENTATION_VOLUME_SHAPE in volume_creation_settings and
+                Tags.INPUT_SEGMENTATION_VOLUME_DTYPE in volume_creation_settings):
+            raise ValueError(f"The segmentation file {file_path} is interpreted as raw binary file. Its shape and "
+                             f"dtype have to be defined with Tags.INPUT_SEGMENTATION_VOLUME_SHAPE and "
+                             f"Tags.INPUT_SEGMENTATION_VOLUME_DTYPE.")
+        yield np.memmap(file_path, mode="r",
+                        dtype=np.dtype(volume_creation_settings[Tags.INPUT_SEGMENTATION_VOLUME_DTYPE]),
+                        shape=tuple(int(dim) for dim in volume_creation_settings[Tags.INPUT_SEGMENTATION_VOLUME_SHAPE]))
@@ -13,11 +13,12 @@ from .constants import SegmentationClasses
 # If there are import errors in the tests, it is probably due to an incorrect
 # initialization order
 from .libraries.spectrum_library import AbsorptionSpectrumLibrary
-from .libraries.spectrum_library import Spectrum
+from .libraries.spectrum_library import Spectrum, get_values_for_wavelengths
 from .libraries.spectrum_library import view_saved_spectra
 from .libraries.spectrum_library import AnisotropySpectrumLibrary
 from .libraries.spectrum_library import ScatteringSpectrumLibrary
 from .libraries.spectrum_library import get_simpa_internal_absorption_spectra_by_names
+from .libraries.spectrum_library import SpectrumRegistry, get_spectrum_registry, set_spectrum_registry
 
 from .libraries.molecule_library import Molecule, MolecularCompositionGenerator
 from .libraries.molecule_library import MoleculeLibrary
@@ -29,9 +30,11 @@ from .libraries.tissue_library import TISSUE_LIBRARY
 from .calculate import calculate_oxygenation
 from .calculate import calculate_gruneisen_parameter_from_temperature
 from .calculate import randomize_uniform
+from .calculate import downsample_volume, upsample_volume
 
 from .deformation_manager import create_deformation_settings
 from .deformation_manager import get_functional_from_deformation_settings
+from .deformation_manager import get_deformation_elevation_map_mm
 
 from .settings import Settings
 
@@ -49,6 +52,7 @@ from .libraries.structure_library.EllipticalTubularStructure import EllipticalTu
     define_elliptical_tubular_structure_settings
 from .libraries.structure_library.HorizontalLayerStructure import HorizontalLayerStructure, \
     define_horizontal_layer_structure_settings
+from .libraries.structure_library.MeshStructure import MeshStructure, define_mesh_structure_settings
 from .libraries.structure_library.ParallelepipedStructure import ParallelepipedStructure, \
     define_parallelepiped_structure_settings
 from .libraries.structure_library.RectangularCuboidStructure import RectangularCuboidStructure, \
@@ -223,3 +223,49 @@ def positive_gauss(mean, std) -> float:
         return positive_gauss(mean, std)
     else:
         return random_value
+
+
+def downsample_volume(volume: np.ndarray, factor: int, target_shape: tuple = None) -> np.ndarray:
+    """
+    Averages non-overlapping blocks of factor x factor x factor voxels.
+
+    :param volume: the volume to downsample
+    :param factor: the integer ratio of the target spacing and the spacing of the volume
+    :param target_shape: the shape of the downsampled volume. The volume is cropped or padded with its edge values to
+        the shape times the factor. By default, every partial block at the end of an axis is padded.
+    :return: the downsampled volume
+    """
+    if target_shape is None:
+        target_shape = tuple(int(np.ceil(size / factor)) for size in np.shape(volume))
+    volume = volume[tuple(slice(0, size * factor) for size in target_shape)]
+    padding = [(0, size * factor - current_size) for size, current_size in zip(target_shape, np.shape(volume))]
+    if any(after > 0 for _, after in padding):
+        volume = np.pad(volume, padding, mode="edge")
+    blocks = volume.reshape(sum(((size, factor) for size in target_shape), ()))
+    return blocks.mean(axis=tuple(range(1, 2 * len(target_shape), 2)))
+
+
+def upsample_volume(volume: np.ndarray, target_shape: tuple, source_spacing_mm: float,
+                    target_spacing_mm: float) -> np.ndarray:
+    """
+    Linearly interpolates a volume at the voxel centres of a finer grid that starts at the same origin. The
+    interpolation is separable and is done axis by axis. Voxel centres outside of the centres of the volume are
+    assigned the value of the nearest voxel.
+
+    :param volume: the volume to upsample
+    :param target_shape: the shape of the upsampled volume
+    :param source_spacing_mm: the spacing of the volume
+    :param target_spacing_mm: the spacing of the upsampled volume
+    :return: the upsampled volume
+    """
+    for axis, target_size in enumerate(target_shape):
+        source_size = np.shape(volume)[axis]
+        positions = np.clip((np.arange(target_size) + 0.5) * target_spacing_mm / source_spacing_mm - 0.5,
+                            0, source_size - 1)
+        left = np.minimum(np.floor(positions).astype(np.int64), max(source_size - 2, 0))
+        right = np.minimum(left + 1, source_size - 1)
+        weight_shape = [1] * np.ndim(volume)
+        weight_shape[axis] = target_size
+        weights = (positions - left).reshape(weight_shape).astype(np.result_type(volume.dtype, np.float32))
+        volume = np.take(volume, left, axis=axis) * (1 - weights) + np.take(volume, right, axis=axis) * weights
+    return volume
@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import numpy as np
+from simpa.utils.tags import Tags
+from simpa.utils.tissue_properties import TissueProperties
+
+COMPACT_VOLUME_LABELS = "labels"
+"""
+(x, y, z, K) integer array with the indices of the (at most K) structures that occupy a voxel, sorted by
+descending volume fraction. Unused slots are marked with -1.
+"""
+
+COMPACT_VOLUME_FRACTIONS = "fractions"
+"""
+(x, y, z, K) float32 array with the volume fractions that belong to the labels.
+"""
+
+COMPACT_VOLUME_SEGMENTATION_LABELS = "segmentation_labels"
+"""
+(x, y, z) integer array with the index of the structure that determines the segmentation of a voxel or -1.
+"""
+
+COMPACT_VOLUME_LABEL_DTYPE = np.int16
+
+
+def get_lookup_table(property_values) -> np.ndarray:
+    """
+    :param property_values: the value of a property for each structure
+    :return: the property values with an appended zero, such that a label of -1 is mapped to zero.
+    """
+    return np.append(np.asarray(property_values, dtype=np.float64).reshape(-1), 0.0)
+
+
+def materialize_property_volume(compact_volume: dict, data_field: str, property_table: dict = None) -> np.ndarray:
+    """
+    Creates the dense volume of a tissue property from its compact representation.
+
+    :param compact_volume: dictionary with the labels, the volume fractions, the segmentation labels, and the tables
+        of the wavelength-independent properties as stored in the Tags.DATA_FIELD_COMPACT_VOLUME data field.
+    :param data_field: the tissue property that is supposed to be materialized.
+    :param property_table: dictionary with the tables of the wavelength-dependent properties as stored in the
+        Tags.DATA_FIELD_PROPERTY_TABLE data field. Only required for wavelength-dependent properties.
+    :return: the dense property volume as float64 array.
+    """
+    if data_field in TissueProperties.wavelength_dependent_properties:
+        if property_table is None:
+            raise ValueError(f"The wavelength-dependent property {data_field} requires a property table.")
+        lookup_table = get_lookup_table(property_table[data_field])
+    else:
+        lookup_table = get_lookup_table(compact_volume[data_field])
+
+    if data_field == Tags.DATA_FIELD_SEGMENTATION:
+        return lookup_table[compact_volume[COMPACT_VOLUME_SEGMENTATION_LABELS]]
+
+    labels = compact_volume[COMPACT_VOLUME_LABELS]
+    fractions = compact_volume[COMPACT_VOLUME_FRACTIONS]
+    volume = np.zeros(np.shape(labels)[:3], dtype=np.float64)
+    for slot in range(np.shape(labels)[3]):
+        volume += fractions[..., slot] * lookup_table[labels[..., slot]]
+    return volume
@@ -4,10 +4,21 @@
 
 import matplotlib.pyplot as plt
 from simpa.utils import Tags
-from scipy.interpolate import interp2d
+from scipy.interpolate import RectBivariateSpline
 from scipy.ndimage import gaussian_filter
+from collections import OrderedDict
+from threading import Lock
+import hashlib
 import numpy as np
 
+ELEVATION_MAP_CACHE_SIZE = 8
+"""
+Maximum number of deformation elevation maps that are kept in memory.
+"""
+
+_elevation_map_cache = OrderedDict()
+_elevation_map_cache_lock = Lock()
+
 
 def create_deformation_settings(bounds_mm, maximum_z_elevation_mm=1, filter_sigma=1, cosine_scaling_factor=4):
     """
@@ -49,9 +60,13 @@ def create_deformation_settings(bounds_mm, maximum_z_elevation_mm=1, filter_sigm
     return deformation_settings
 
 
-def get_functional_from_deformation_settings(deformation_settings: dict):
+def get_spline_from_deformation_settings(deformation_settings: dict) -> RectBivariateSpline:
     """
-    FIXME
+    Creates a bicubic spline that interpolates the surface elevations of the deformation settings.
+
+    :param deformation_settings: the deformation settings as created by create_deformation_settings
+    :return: a spline that maps (x, y) positions in mm to the surface elevation in mm
+    :raises KeyError: if the deformation settings are incomplete
     """
 
     if Tags.DEFORMATION_X_COORDINATES_MM not in deformation_settings:
@@ -61,15 +76,71 @@ def get_functional_from_deformation_settings(deformation_settings: dict):
     if Tags.DEFORMATION_Z_ELEVATIONS_MM not in deformation_settings:
         raise KeyError("z elevations not defined in deformation settings")
 
-    x_coordinates_mm = deformation_settings[Tags.DEFORMATION_X_COORDINATES_MM]
-    y_coordinates_mm = deformation_settings[Tags.DEFORMATION_Y_COORDINATES_MM]
-    z_elevations_mm = deformation_settings[Tags.DEFORMATION_Z_ELEVATIONS_MM]
-    order = "cubic"
+    x_coordinates_mm = np.asarray(deformation_settings[Tags.DEFORMATION_X_COORDINATES_MM], dtype=np.float64)
+    y_coordinates_mm = np.asarray(deformation_settings[Tags.DEFORMATION_Y_COORDINATES_MM], dtype=np.float64)
+    z_elevations_mm = np.asarray(deformation_settings[Tags.DEFORMATION_Z_ELEVATIONS_MM], dtype=np.float64)
+
+    # the coordinates are either given as vectors or as a meshgrid in 'ij' indexing
+    if x_coordinates_mm.ndim == 2:
+        x_coordinates_mm = x_coordinates_mm[:, 0]
+    if y_coordinates_mm.ndim == 2:
+        y_coordinates_mm = y_coordinates_mm[0, :]
+
+    return RectBivariateSpline(x_coordinates_mm, y_coordinates_mm, z_elevations_mm,
+                               kx=min(3, len(x_coordinates_mm) - 1), ky=min(3, len(y_coordinates_mm) - 1), s=0)
+
+
+def get_functional_from_deformation_settings(deformation_settings: dict):
+    """
+    Creates a function that evaluates the deformation surface on the grid spanned by a vector of x positions and a
+    vector of y positions (both in mm). As scipy's former interp2d, the function returns the elevations in mm with
+    shape (len(y_positions), len(x_positions)).
+
+    For evaluations on the voxel grid of the simulation volume, use get_deformation_elevation_map_mm instead.
+    """
+    spline = get_spline_from_deformation_settings(deformation_settings)
+
+    def functional_mm(x_positions_mm, y_positions_mm):
+        return spline(np.asarray(x_positions_mm, dtype=np.float64),
+                      np.asarray(y_positions_mm, dtype=np.float64)).T
 
-    functional_mm = interp2d(x_coordinates_mm, y_coordinates_mm, z_elevations_mm, kind=order)
     return functional_mm
 
 
+def get_deformation_elevation_map_mm(deformation_settings: dict, volume_dimensions_voxels, voxel_spacing: float):
+    """
+    Evaluates the deformation surface once on the x-y voxel grid of the simulation volume. The result is cached, such
+    that all structures of a simulation share the same elevation map.
+
+    :param deformation_settings: the deformation settings as created by create_deformation_settings
+    :param volume_dimensions_voxels: the number of voxels along the x-, y- (and z-) axis
+    :param voxel_spacing: the voxel spacing in mm
+    :return: a read-only array with shape (x, y) containing the surface elevation in mm at the positions
+        (x_index * voxel_spacing, y_index * voxel_spacing)
+    """
+    x_dim, y_dim = int(volume_dimensions_voxels[0]), int(volume_dimensions_voxels[1])
+    digest = hashlib.blake2b(digest_size=16)
+    for tag in [Tags.DEFORMATION_X_COORDINATES_MM, Tags.DEFORMATION_Y_COORDINATES_MM, Tags.DEFORMATION_Z_ELEVATIONS_MM]:
+        if tag in deformation_settings:
+            digest.update(np.ascontiguousarray(deformation_settings[tag], dtype=np.float64).tobytes())
+    cache_key = (digest.hexdigest(), x_dim, y_dim, float(voxel_spacing))
+
+    with _elevation_map_cache_lock:
+        if cache_key in _elevation_map_cache:
+            _elevation_map_cache.move_to_end(cache_key)
+            return _elevation_map_cache[cache_key]
+
+    spline = get_spline_from_deformation_settings(deformation_settings)
+    elevation_map_mm = spline(np.arange(x_dim) * voxel_spacing, np.arange(y_dim) * voxel_spacing)
+    elevation_map_mm.setflags(write=False)
+
+    with _elevation_map_cache_lock:
+        _elevation_map_cache[cache_key] = elevation_map_mm
+        while len(_elevation_map_cache) > ELEVATION_MAP_CACHE_SIZE:
+            _elevation_map_cache.popitem(last=False)
+    return elevation_map_mm
+
+
 if __name__ == "__main__":
     x_bounds = [0, 9]
     y_bounds = [0, 9]
@@ -19,7 +19,9 @@ def generate_dict_path(data_field, wavelength: (int, float) = None) -> str:
 
     wavelength_dependent_properties = [Tags.DATA_FIELD_ABSORPTION_PER_CM,
                                        Tags.DATA_FIELD_SCATTERING_PER_CM,
-                                       Tags.DATA_FIELD_ANISOTROPY]
+                                       Tags.DATA_FIELD_ANISOTROPY,
+                                       Tags.DATA_FIELD_PROPERTY_TABLE,
+                                       Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES]
 
     wavelength_independent_properties = [Tags.DATA_FIELD_OXYGENATION,
                                          Tags.DATA_FIELD_SEGMENTATION,
@@ -27,6 +29,7 @@ def generate_dict_path(data_field, wavelength: (int, float) = None) -> str:
                                          Tags.DATA_FIELD_SPEED_OF_SOUND,
                                          Tags.DATA_FIELD_DENSITY,
                                          Tags.DATA_FIELD_ALPHA_COEFF,
+                                         Tags.DATA_FIELD_COMPACT_VOLUME,
                                          Tags.KWAVE_PROPERTY_SENSOR_MASK,
                                          Tags.KWAVE_PROPERTY_DIRECTIVITY_ANGLE]
 
@@ -38,7 +41,10 @@ def generate_dict_path(data_field, wavelength: (int, float) = None) -> str:
                          Tags.DATA_FIELD_DIFFUSE_REFLECTANCE,
                          Tags.DATA_FIELD_DIFFUSE_REFLECTANCE_POS,
                          Tags.DATA_FIELD_PHOTON_EXIT_POS,
-                         Tags.DATA_FIELD_PHOTON_EXIT_DIR]
+                         Tags.DATA_FIELD_PHOTON_EXIT_DIR,
+                         Tags.DATA_FIELD_PHOTON_EXIT_IMAGE,
+                         Tags.DATA_FIELD_NUMBER_OF_PHOTONS,
+                         Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET]
 
     simulation_output_fields = [Tags.OPTICAL_MODEL_OUTPUT_NAME,
                                 Tags.SIMULATION_PROPERTIES]
@@ -58,7 +64,9 @@ def generate_dict_path(data_field, wavelength: (int, float) = None) -> str:
     elif data_field in simulation_output:
         if data_field in [Tags.DATA_FIELD_FLUENCE, Tags.DATA_FIELD_INITIAL_PRESSURE, Tags.OPTICAL_MODEL_UNITS,
                           Tags.DATA_FIELD_DIFFUSE_REFLECTANCE, Tags.DATA_FIELD_DIFFUSE_REFLECTANCE_POS,
-                          Tags.DATA_FIELD_PHOTON_EXIT_POS, Tags.DATA_FIELD_PHOTON_EXIT_DIR]:
+                          Tags.DATA_FIELD_PHOTON_EXIT_POS, Tags.DATA_FIELD_PHOTON_EXIT_DIR,
+                          Tags.DATA_FIELD_PHOTON_EXIT_IMAGE, Tags.DATA_FIELD_NUMBER_OF_PHOTONS,
+                          Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET]:
             if wavelength is not None:
                 dict_path = "/" + Tags.SIMULATIONS + "/" + Tags.OPTICAL_MODEL_OUTPUT_NAME + "/" + data_field + wl
             else:
@@ -98,10 +106,34 @@ def get_data_field_from_simpa_output(simpa_output: dict, data_field: (tuple, str
     :return: Queried data_field.
     """
 
+    from simpa.utils.tissue_properties import TissueProperties
+    from simpa.utils.compact_volume import materialize_property_volume
+
     dict_path = generate_dict_path(data_field, wavelength)
-    keys_to_data_field = dict_path.split("/")
+    try:
+        return get_data_at_dict_path(simpa_output, dict_path)
+    except KeyError:
+        if data_field not in TissueProperties.property_tags:
+            raise
+        # the dense property volume is not stored and has to be created from the compact volume representation
+        compact_volume = get_data_at_dict_path(simpa_output, generate_dict_path(Tags.DATA_FIELD_COMPACT_VOLUME))
+        property_table = None
+        if data_field in TissueProperties.wavelength_dependent_properties:
+            property_table = get_data_at_dict_path(simpa_output,
+                                                   generate_dict_path(Tags.DATA_FIELD_PROPERTY_TABLE, wavelength))
+        return materialize_property_volume(compact_volume, data_field, property_table)
+
+
+def get_data_at_dict_path(simpa_output: dict, dict_path: str):
+    """
+    Navigates through a nested dictionary along the given path.
+
+    :param simpa_output: Dictionary that is in the standard simpa output format.
+    :param dict_path: Path as generated by generate_dict_path.
+    :return: The data stored at dict_path.
+    """
     current_dict = simpa_output
-    for key in keys_to_data_field:
+    for key in dict_path.split("/"):
         if key == "":
             continue
         current_dict = current_dict[key]
@@ -11,7 +11,117 @@ from simpa.utils.libraries.spectrum_library import AnisotropySpectrumLibrary, Sc
 from simpa.utils import Spectrum
 from simpa.utils.calculate import calculate_oxygenation, calculate_gruneisen_parameter_from_temperature
 from simpa.utils.serializer import SerializableSIMPAClass
-from simpa.utils.libraries.spectrum_library import AbsorptionSpectrumLibrary
+from simpa.utils.libraries.spectrum_library import AbsorptionSpectrumLibrary, get_values_for_wavelengths
+
+
+class CompiledMolecularComposition(object):
+    """
+    An immutable snapshot of a MolecularComposition that evaluates its tissue properties for whole arrays of
+    wavelengths. The wavelength-independent properties are computed once on construction, the wavelength-dependent
+    properties are obtained as a single matrix product of the volume fractions of the molecules and their stacked
+    spectra.
+    """
+
+    STACKED_SPECTRA_CACHE_SIZE = 32
+    """
+    Maximum number of wavelength arrays for which the stacked spectra are kept.
+    """
+
+    def __init__(self, molecular_composition, fingerprint: tuple = None,
+                 endmembers: "CompiledMolecularComposition" = None):
+        """
+        :param molecular_composition: the MolecularComposition to compile
+        :param fingerprint: the fingerprint of the composition (see MolecularComposition.get_fingerprint)
+        :param endmembers: a compiled composition of the same spectra in the same order, e.g. of another mixture of
+            the same molecules. If the spectra are identical, its cache of stacked spectra is shared.
+        """
+        self.fingerprint = fingerprint
+        self.volume_fractions = np.asarray([molecule.volume_fraction for molecule in molecular_composition],
+                                           dtype=np.float64)
+        self.spectra = [(molecule.spectrum, molecule.scattering_spectrum, molecule.anisotropy_spectrum)
+                        for molecule in molecular_composition]
+        if endmembers is not None and len(endmembers.spectra) == len(self.spectra) and all(
+                spectrum is endmember_spectrum
+                for molecule_spectra, endmember_spectra in zip(self.spectra, endmembers.spectra)
+                for spectrum, endmember_spectrum in zip(molecule_spectra, endmember_spectra)):
+            self.spectra = endmembers.spectra
+            self.stacked_spectra_cache = endmembers.stacked_spectra_cache
+        else:
+            self.stacked_spectra_cache = dict()
+
+        wavelength_independent_properties = TissueProperties()
+        wavelength_independent_properties[Tags.DATA_FIELD_SEGMENTATION] = molecular_composition.segmentation_type
+        wavelength_independent_properties[Tags.DATA_FIELD_OXYGENATION] = calculate_oxygenation(molecular_composition)
+        for molecule in molecular_composition:
+            wavelength_independent_properties.volume_fraction += molecule.volume_fraction
+            wavelength_independent_properties[Tags.DATA_FIELD_GRUNEISEN_PARAMETER] += \
+                molecule.volume_fraction * molecule.gruneisen_parameter
+            wavelength_independent_properties[Tags.DATA_FIELD_DENSITY] += molecule.volume_fraction * molecule.density
+            wavelength_independent_properties[Tags.DATA_FIELD_SPEED_OF_SOUND] += molecule.volume_fraction * \
+                molecule.speed_of_sound
+            wavelength_independent_properties[Tags.DATA_FIELD_ALPHA_COEFF] += molecule.volume_fraction * \
+                molecule.alpha_coefficient
+
+        if np.abs(wavelength_independent_properties.volume_fraction - 1.0) > 1e-3:
+            raise AssertionError("Invalid Molecular composition! The volume fractions of all molecules must be"
+                                 "exactly 100%!")
+        self.wavelength_independent_properties = wavelength_independent_properties
+
+    def get_stacked_spectra(self, wavelengths: np.ndarray) -> np.ndarray:
+        """
+        :param wavelengths: array of wavelengths in nm
+        :return: (number of molecules, number of wavelength-dependent properties * number of wavelengths) array with
+            the absorption, scattering, and anisotropy spectra of every molecule. The read-only arrays of the
+            recently requested wavelengths are kept.
+        """
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        cache_key = wavelengths.tobytes()
+        stacked_spectra = self.stacked_spectra_cache.get(cache_key)
+        if stacked_spectra is None:
+            stacked_spectra = get_values_for_wavelengths([spectrum for molecule_spectra in self.spectra
+                                                          for spectrum in molecule_spectra], wavelengths)
+            stacked_spectra = stacked_spectra.reshape(len(self.spectra), -1)
+            stacked_spectra.setflags(write=False)
+            if len(self.stacked_spectra_cache) >= self.STACKED_SPECTRA_CACHE_SIZE:
+                self.stacked_spectra_cache.clear()
+            self.stacked_spectra_cache[cache_key] = stacked_spectra
+        return stacked_spectra
+
+    def get_property_table(self, wavelengths, property_tags: list = None) -> np.ndarray:
+        """
+        :param wavelengths: array of wavelengths in nm
+        :param property_tags: the tissue property tags that define the columns of the table. All properties by default.
+        :return: (number of wavelengths, number of properties) float64 array with the tissue properties for every
+            wavelength. Properties that are not defined for the composition are set to zero.
+        """
+        if property_tags is None:
+            property_tags = TissueProperties.property_tags
+        wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=np.float64))
+
+        wavelength_dependent_table = (self.volume_fractions @ self.get_stacked_spectra(wavelengths)).reshape(
+            len(TissueProperties.wavelength_dependent_properties), len(wavelengths))
+
+        table = np.zeros((len(wavelengths), len(property_tags)), dtype=np.float64)
+        for property_index, property_tag in enumerate(property_tags):
+            if property_tag in TissueProperties.wavelength_dependent_properties:
+                table[:, property_index] = wavelength_dependent_table[
+                    TissueProperties.wavelength_dependent_properties.index(property_tag)]
+            elif self.wavelength_independent_properties[property_tag] is not None:
+                table[:, property_index] = self.wavelength_independent_properties[property_tag]
+        return table
+
+    def get_properties_for_wavelength(self, wavelength) -> TissueProperties:
+        """
+        :param wavelength: the wavelength in nm
+        :return: a new TissueProperties instance with all properties of the composition at the given wavelength
+        """
+        properties = TissueProperties()
+        properties.update(self.wavelength_independent_properties)
+        properties.volume_fraction = self.wavelength_independent_properties.volume_fraction
+        values = self.get_property_table([wavelength], TissueProperties.wavelength_dependent_properties)[0]
+        for property_tag, value in zip(TissueProperties.wavelength_dependent_properties, values):
+            properties[property_tag] = value
+        return properties
 
 
 class MolecularComposition(SerializableSIMPAClass, list):
@@ -28,48 +138,54 @@ class MolecularComposition(SerializableSIMPAClass, list):
         for molecule_name in _keys:
             self.append(molecular_composition_settings[molecule_name])
 
-    def update_internal_properties(self):
+    def get_fingerprint(self) -> tuple:
         """
-        FIXME
+        :return: a tuple that changes whenever a molecule, its volume fraction, its spectra, or one of its
+            wavelength-independent properties is changed, added, or removed.
         """
-        self.internal_properties = TissueProperties()
-        self.internal_properties[Tags.DATA_FIELD_SEGMENTATION] = self.segmentation_type
-        self.internal_properties[Tags.DATA_FIELD_OXYGENATION] = calculate_oxygenation(self)
-        for molecule in self:
-            self.internal_properties.volume_fraction += molecule.volume_fraction
-            self.internal_properties[Tags.DATA_FIELD_GRUNEISEN_PARAMETER] += \
-                molecule.volume_fraction * molecule.gruneisen_parameter
-            self.internal_properties[Tags.DATA_FIELD_DENSITY] += molecule.volume_fraction * molecule.density
-            self.internal_properties[Tags.DATA_FIELD_SPEED_OF_SOUND] += molecule.volume_fraction * \
-                molecule.speed_of_sound
-            self.internal_properties[Tags.DATA_FIELD_ALPHA_COEFF] += molecule.volume_fraction * \
-                molecule.alpha_coefficient
-
-        if np.abs(self.internal_properties.volume_fraction - 1.0) > 1e-3:
-            raise AssertionError("Invalid Molecular composition! The volume fractions of all molecules must be"
-                                 "exactly 100%!")
+        return (self.segmentation_type, ) + tuple(
+            (id(molecule), molecule.volume_fraction, id(molecule.spectrum), id(molecule.scattering_spectrum),
+             id(molecule.anisotropy_spectrum), molecule.gruneisen_parameter, molecule.density,
+             molecule.speed_of_sound, molecule.alpha_coefficient) for molecule in self)
 
-    def get_properties_for_wavelength(self, wavelength) -> TissueProperties:
-
-        self.update_internal_properties()
-        self.internal_properties[Tags.DATA_FIELD_ABSORPTION_PER_CM] = 0
-        self.internal_properties[Tags.DATA_FIELD_SCATTERING_PER_CM] = 0
-        self.internal_properties[Tags.DATA_FIELD_ANISOTROPY] = 0
-
-        for molecule in self:
-            self.internal_properties[Tags.DATA_FIELD_ABSORPTION_PER_CM] += \
-                (molecule.volume_fraction * molecule.spectrum.get_value_for_wavelength(wavelength))
+    def compile(self) -> CompiledMolecularComposition:
+        """
+        :return: the CompiledMolecularComposition of the current state of this composition. It is memoised until
+            the composition changes. If the composition has compiled endmembers (see TissuePreset), their stacked
+            spectra are reused.
+        """
+        fingerprint = self.get_fingerprint()
+        compiled_composition = self.__dict__.get("compiled_composition")
+        if compiled_composition is None or compiled_composition.fingerprint != fingerprint:
+            # the compiled composition is created before it is assigned, such that concurrently constructed
+            # structures that share this composition never observe a partially compiled state
+            compiled_composition = CompiledMolecularComposition(self, fingerprint, self.__dict__.get("endmembers"))
+            self.compiled_composition = compiled_composition
+        return compiled_composition
 
-            self.internal_properties[Tags.DATA_FIELD_SCATTERING_PER_CM] += \
-                (molecule.volume_fraction * (molecule.scattering_spectrum.get_value_for_wavelength(wavelength)))
+    def update_internal_properties(self):
+        """
+        Updates the wavelength-independent properties of the composition.
+        """
+        self.internal_properties = self.compile().wavelength_independent_properties
 
-            self.internal_properties[Tags.DATA_FIELD_ANISOTROPY] += \
-                molecule.volume_fraction * molecule.anisotropy_spectrum.get_value_for_wavelength(wavelength)
+    def get_properties_for_wavelength(self, wavelength) -> TissueProperties:
+        compiled_composition = self.compile()
+        self.internal_properties = compiled_composition.wavelength_independent_properties
+        return compiled_composition.get_properties_for_wavelength(wavelength)
 
-        return self.internal_properties
+    def get_property_table(self, wavelengths, property_tags: list = None) -> np.ndarray:
+        """
+        :param wavelengths: array of wavelengths in nm
+        :param property_tags: the tissue property tags that define the columns of the table. All properties by default.
+        :return: (number of wavelengths, number of properties) float64 array with the tissue properties for every
+            wavelength. Properties that are not defined for the composition are set to zero.
+        """
+        return self.compile().get_property_table(wavelengths, property_tags)
 
     def serialize(self) -> dict:
-        dict_items = self.__dict__
+        dict_items = {key: value for key, value in self.__dict__.items()
+                      if key not in ("compiled_composition", "endmembers")}
         list_items = [molecule for molecule in self]
         return {"MolecularComposition": {"dict_items": dict_items, "list_items": list_items}}
 
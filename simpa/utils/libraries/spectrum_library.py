@@ -5,6 +5,7 @@
 import os
 import inspect
 import glob
+import threading
 import numpy as np
 import matplotlib.pylab as plt
 from simpa.utils.libraries.literature_values import OpticalTissueProperties
@@ -22,18 +23,20 @@ class Spectrum(SerializableSIMPAClass, object):
         :param wavelengths:
         :param values:
         """
-        self.spectrum_name = spectrum_name
-        self.wavelengths = wavelengths
-        self.max_wavelength = int(np.max(wavelengths))
-        self.min_wavelength = int(np.min(wavelengths))
-        self.values = values
-
         if np.shape(wavelengths) != np.shape(values):
             raise ValueError("The shape of the wavelengths and the absorption coefficients did not match: " +
                              str(np.shape(wavelengths)) + " vs " + str(np.shape(values)))
 
-        new_wavelengths = np.arange(self.min_wavelength, self.max_wavelength+1, 1)
-        self.new_absorptions = np.interp(new_wavelengths, self.wavelengths, self.values)
+        if np.any(np.diff(wavelengths) < 0):
+            order = np.argsort(wavelengths, kind="stable")
+            wavelengths = np.asarray(wavelengths)[order]
+            values = np.asarray(values)[order]
+
+        self.spectrum_name = spectrum_name
+        self.wavelengths = wavelengths
+        self.max_wavelength = np.max(wavelengths)
+        self.min_wavelength = np.min(wavelengths)
+        self.values = values
 
     def get_value_over_wavelength(self):
         """
@@ -41,13 +44,20 @@ class Spectrum(SerializableSIMPAClass, object):
         """
         return np.asarray([self.wavelengths, self.values])
 
-    def get_value_for_wavelength(self, wavelength: int) -> float:
+    def get_value_for_wavelength(self, wavelength):
         """
-        :param wavelength: the wavelength to retrieve a optical absorption value for [cm^{-1}].
-                           Must be an integer value between the minimum and maximum wavelength.
-        :return: the best matching linearly interpolated absorption value for the given wavelength.
+        :param wavelength: the wavelength or array of wavelengths to retrieve a optical absorption value for [cm^{-1}].
+                           Must be between the minimum and maximum wavelength.
+        :return: the linearly interpolated absorption value for the given wavelength or an array of the same shape as
+                 the given array of wavelengths.
+        :raises ValueError: if a wavelength lies outside of the sampled range of the spectrum.
         """
-        return self.new_absorptions[wavelength-self.min_wavelength]
+        wavelengths = np.asarray(wavelength, dtype=np.float64)
+        check_wavelength_range(self, wavelengths)
+        values = np.interp(wavelengths, self.wavelengths, self.values)
+        if np.ndim(values) == 0:
+            return float(values)
+        return values
 
     def __eq__(self, other):
         if isinstance(other, Spectrum):
@@ -69,22 +79,214 @@ class Spectrum(SerializableSIMPAClass, object):
         return deserialized_spectrum
 
 
+def check_wavelength_range(spectrum: Spectrum, wavelengths: np.ndarray):
+    """
+    :param spectrum: the spectrum to be evaluated
+    :param wavelengths: array of wavelengths in nm
+    :raises ValueError: if a wavelength lies outside of the sampled range of the spectrum.
+    """
+    if np.size(wavelengths) > 0 and (np.min(wavelengths) < spectrum.min_wavelength or
+                                     np.max(wavelengths) > spectrum.max_wavelength):
+        raise ValueError(f"The spectrum '{spectrum.spectrum_name}' is only defined between "
+                         f"{spectrum.min_wavelength} and {spectrum.max_wavelength} nm, but was evaluated between "
+                         f"{np.min(wavelengths)} and {np.max(wavelengths)} nm.")
+
+
+def get_values_for_wavelengths(spectra: list, wavelengths) -> np.ndarray:
+    """
+    Evaluates many spectra at once. The interpolation positions are computed once for every distinct wavelength
+    sampling among the spectra, such that spectra sharing their sampling are interpolated with a single gather.
+
+    :param spectra: list of Spectrum instances
+    :param wavelengths: wavelength or array of wavelengths in nm
+    :return: float64 array of shape (number of spectra, ) + shape of wavelengths with the linearly interpolated
+             values of every spectrum.
+    :raises ValueError: if a wavelength lies outside of the sampled range of one of the spectra.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    values = np.empty((len(spectra), ) + wavelengths.shape, dtype=np.float64)
+
+    spectra_by_sampling = dict()
+    for spectrum_index, spectrum in enumerate(spectra):
+        sampling = np.asarray(spectrum.wavelengths, dtype=np.float64)
+        spectra_by_sampling.setdefault(sampling.tobytes(), (sampling, []))[1].append(spectrum_index)
+
+    for sampling, spectrum_indices in spectra_by_sampling.values():
+        check_wavelength_range(spectra[spectrum_indices[0]], wavelengths)
+        # fractional sample index of every wavelength, which np.interp computes robustly for any sampling
+        positions = np.interp(wavelengths, sampling, np.arange(len(sampling), dtype=np.float64))
+        left = np.minimum(np.floor(positions).astype(np.int64), max(len(sampling) - 2, 0))
+        right = np.minimum(left + 1, len(sampling) - 1)
+        weights = positions - left
+        samples = np.stack([np.asarray(spectra[spectrum_index].values, dtype=np.float64)
+                            for spectrum_index in spectrum_indices])
+        values[spectrum_indices] = samples[:, left] * (1 - weights) + samples[:, right] * weights
+
+    return values
+
+
+PACKED_SPECTRA_FILE_NAME = "packed_spectra.npy"
+"""
+Name of the optional packed spectra file within a spectra folder. If it is at least as recent as all .npz files of
+the folder, the spectrum registry of the folder is memory-mapped from it.
+"""
+
+
+class SpectrumRegistry(object):
+    """
+    An immutable collection of spectra with a name -> index lookup. The samples of all spectra are packed into two
+    contiguous arrays, which can be stored in and memory-mapped from a single .npy file, such that worker processes
+    share the same pages instead of each loading their own copy::
+
+        registry = get_spectrum_registry(folder_path)
+        registry.save(os.path.join(folder_path, PACKED_SPECTRA_FILE_NAME))
+
+    """
+
+    def __init__(self, spectrum_names: list, wavelengths: np.ndarray, values: np.ndarray, offsets: np.ndarray):
+        """
+        :param spectrum_names: the names of the spectra
+        :param wavelengths: the concatenated wavelengths of all spectra
+        :param values: the concatenated values of all spectra
+        :param offsets: the index of the first sample of every spectrum followed by the total number of samples
+        """
+        self.spectrum_names = tuple(str(name) for name in spectrum_names)
+        self.wavelengths = wavelengths
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        for array in (self.wavelengths, self.values, self.offsets):
+            if not isinstance(array, np.memmap):
+                array.setflags(write=False)
+
+        self.spectrum_indices = {name: index for index, name in enumerate(self.spectrum_names)}
+        self.spectra = tuple(Spectrum(spectrum_name=name,
+                                      wavelengths=self.wavelengths[self.offsets[index]:self.offsets[index + 1]],
+                                      values=self.values[self.offsets[index]:self.offsets[index + 1]])
+                             for index, name in enumerate(self.spectrum_names))
+
+    def __len__(self):
+        return len(self.spectra)
+
+    def __iter__(self):
+        return iter(self.spectra)
+
+    def get_index(self, spectrum_name: str) -> int:
+        """
+        :param spectrum_name: the name of a spectrum
+        :return: the index of the spectrum within the registry
+        """
+        if spectrum_name not in self.spectrum_indices:
+            raise LookupError(f"No spectrum for the given name exists ({spectrum_name}). "
+                              f"Try one of: {list(self.spectrum_names)}")
+        return self.spectrum_indices[spectrum_name]
+
+    def get_spectrum_by_name(self, spectrum_name: str) -> Spectrum:
+        return self.spectra[self.get_index(spectrum_name)]
+
+    def save(self, file_path: str):
+        """
+        Stores all spectra of the registry in a single packed .npy file.
+
+        :param file_path: path of the .npy file
+        """
+        number_of_samples = int(self.offsets[-1])
+        packed_spectra = np.zeros((), dtype=np.dtype([
+            ("spectrum_names", "U256", (len(self.spectrum_names), )),
+            ("offsets", "<i8", (len(self.offsets), )),
+            ("wavelengths", "<f8", (number_of_samples, )),
+            ("values", "<f8", (number_of_samples, ))]))
+        packed_spectra["spectrum_names"] = self.spectrum_names
+        packed_spectra["offsets"] = self.offsets
+        packed_spectra["wavelengths"] = self.wavelengths
+        packed_spectra["values"] = self.values
+        np.save(file_path, packed_spectra)
+
+    @staticmethod
+    def load(file_path: str):
+        """
+        :param file_path: path of a packed .npy file created with SpectrumRegistry.save
+        :return: the SpectrumRegistry, whose samples are memory-mapped from the file
+        """
+        packed_spectra = np.load(file_path, mmap_mode="r")
+        return SpectrumRegistry(spectrum_names=list(packed_spectra["spectrum_names"]),
+                                wavelengths=packed_spectra["wavelengths"],
+                                values=packed_spectra["values"],
+                                offsets=np.array(packed_spectra["offsets"]))
+
+    @staticmethod
+    def from_folder(folder_path: str):
+        """
+        :param folder_path: path of a folder with one .npz file per spectrum
+        :return: the SpectrumRegistry with all spectra of the folder
+        """
+        spectrum_names = list()
+        wavelengths = list()
+        values = list()
+        for spectrum_file in sorted(glob.glob(os.path.join(folder_path, "*.npz"))):
+            spectrum_names.append(os.path.basename(spectrum_file)[:-4])
+            with np.load(spectrum_file) as numpy_data:
+                wavelengths.append(np.asarray(numpy_data["wavelengths"], dtype=np.float64))
+                values.append(np.asarray(numpy_data["values"], dtype=np.float64))
+        offsets = np.cumsum([0] + [len(spectrum_values) for spectrum_values in values])
+        return SpectrumRegistry(spectrum_names=spectrum_names,
+                                wavelengths=np.concatenate(wavelengths) if wavelengths else np.zeros(0),
+                                values=np.concatenate(values) if values else np.zeros(0),
+                                offsets=offsets)
+
+
+_spectrum_registries = dict()
+_spectrum_registries_lock = threading.Lock()
+
+
+def get_spectrum_registry(folder_path: str) -> SpectrumRegistry:
+    """
+    Returns the process-wide SpectrumRegistry of a spectra folder. It is created lazily on the first request and
+    memory-mapped from the packed spectra file of the folder if that file is up to date.
+
+    :param folder_path: path of a folder with one .npz file per spectrum
+    :return: the SpectrumRegistry with all spectra of the folder
+    """
+    folder_path = os.path.abspath(folder_path)
+    with _spectrum_registries_lock:
+        if folder_path not in _spectrum_registries:
+            packed_spectra_path = os.path.join(folder_path, PACKED_SPECTRA_FILE_NAME)
+            spectrum_files = glob.glob(os.path.join(folder_path, "*.npz"))
+            if os.path.exists(packed_spectra_path) and \
+                    all(os.path.getmtime(spectrum_file) <= os.path.getmtime(packed_spectra_path)
+                        for spectrum_file in spectrum_files):
+                _spectrum_registries[folder_path] = SpectrumRegistry.load(packed_spectra_path)
+            else:
+                _spectrum_registries[folder_path] = SpectrumRegistry.from_folder(folder_path)
+        return _spectrum_registries[folder_path]
+
+
+def set_spectrum_registry(folder_path: str, spectrum_registry: SpectrumRegistry):
+    """
+    Replaces the process-wide SpectrumRegistry of a spectra folder, e.g. with a registry that a worker process
+    memory-maps from a packed spectra file shared by all workers.
+
+    :param folder_path: path of the spectra folder
+    :param spectrum_registry: the SpectrumRegistry that is used for the folder
+    """
+    with _spectrum_registries_lock:
+        _spectrum_registries[os.path.abspath(folder_path)] = spectrum_registry
+
+
 class SpectraLibrary(object):
 
     def __init__(self, folder_name: str, additional_folder_path: str = None):
         self.spectra = list()
+        self.spectrum_indices = dict()
         self.add_spectra_from_folder(folder_name)
         if additional_folder_path is not None:
             self.add_spectra_from_folder(additional_folder_path)
 
     def add_spectra_from_folder(self, folder_name):
         base_path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-        for absorption_spectrum in glob.glob(os.path.join(base_path, folder_name, "*.npz")):
-            name = absorption_spectrum.split(os.path.sep)[-1][:-4]
-            numpy_data = np.load(absorption_spectrum)
-            values = numpy_data["values"]
-            wavelengths = numpy_data["wavelengths"]
-            self.spectra.append(Spectrum(spectrum_name=name, values=values, wavelengths=wavelengths))
+        for spectrum in get_spectrum_registry(os.path.join(base_path, folder_name)):
+            # spectra that are added later take precedence over spectra of the same name
+            self.spectrum_indices[spectrum.spectrum_name] = len(self.spectra)
+            self.spectra.append(spectrum)
 
     def __next__(self):
         if self.i > 0:
@@ -100,9 +302,8 @@ class SpectraLibrary(object):
         return [spectrum.spectrum_name for spectrum in self]
 
     def get_spectrum_by_name(self, spectrum_name: str) -> Spectrum:
-        for spectrum in self:
-            if spectrum.spectrum_name == spectrum_name:
-                return spectrum
+        if spectrum_name in self.spectrum_indices:
+            return self.spectra[self.spectrum_indices[spectrum_name]]
 
         raise LookupError(
             f"No spectrum for the given name exists ({spectrum_name}). Try one of: {self.get_spectra_names()}")
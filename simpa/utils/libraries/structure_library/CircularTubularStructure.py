@@ -46,6 +46,21 @@ class CircularTubularStructure(GeometricalStructure):
         settings[Tags.STRUCTURE_RADIUS_MM] = self.params[2]
         return settings
 
+    supports_signed_distance = True
+
+    def signed_distance_mm(self, positions_mm):
+        start_mm, end_mm, radius_mm, _ = self.params
+        start_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
+        end_mm = torch.tensor(end_mm, dtype=torch.float, device=self.torch_device)
+        axis = (end_mm - start_mm) / torch.linalg.norm(end_mm - start_mm)
+
+        if self.do_deformation:
+            positions_mm = positions_mm + self.get_deformation_offsets_mm(positions_mm)[..., None]
+        relative_positions_mm = positions_mm - start_mm
+        distances_to_axis_mm = torch.linalg.norm(
+            relative_positions_mm - torch.matmul(relative_positions_mm, axis)[..., None] * axis, dim=-1)
+        return distances_to_axis_mm - radius_mm
+
     def get_enclosed_indices(self):
         start_mm, end_mm, radius_mm, partial_volume = self.params
         start_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
@@ -69,14 +84,10 @@ class CircularTubularStructure(GeometricalStructure):
             radius_margin = 0.7071
 
         if self.do_deformation:
-            # the deformation functional needs mm as inputs and returns the result in reverse indexing order...
-            deformation_values_mm = self.deformation_functional_mm(torch.arange(self.volume_dimensions_voxels[0]) *
-                                                                   self.voxel_spacing,
-                                                                   torch.arange(self.volume_dimensions_voxels[1]) *
-                                                                   self.voxel_spacing).T
+            deformation_values_mm = self.deformation_elevation_map_mm
             deformation_values_mm = deformation_values_mm.reshape(self.volume_dimensions_voxels[0],
                                                                   self.volume_dimensions_voxels[1], 1, 1)
-            deformation_values_mm = torch.tile(torch.as_tensor(
+            deformation_values_mm = torch.tile(torch.tensor(
                 deformation_values_mm, dtype=torch.float, device=self.torch_device), (1, 1, self.volume_dimensions_voxels[2], 3))
             deformation_values_mm /= self.voxel_spacing
             target_vector += deformation_values_mm
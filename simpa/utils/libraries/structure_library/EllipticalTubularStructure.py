@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 
 import torch
+import numpy as np
 
 from simpa.utils import Tags
 from simpa.utils.libraries.molecule_library import MolecularComposition
@@ -51,6 +52,33 @@ class EllipticalTubularStructure(GeometricalStructure):
         settings[Tags.CONSIDER_PARTIAL_VOLUME] = self.params[4]
         return settings
 
+    supports_signed_distance = True
+
+    def signed_distance_mm(self, positions_mm):
+        start_mm, end_mm, radius_mm, eccentricity, _ = self.params
+        start_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
+        end_mm = torch.tensor(end_mm, dtype=torch.float, device=self.torch_device)
+        axis = (end_mm - start_mm) / torch.linalg.norm(end_mm - start_mm)
+        main_axis = torch.stack([axis[1], -axis[0], torch.zeros_like(axis[0])])
+        main_axis = main_axis / torch.linalg.norm(main_axis)
+        minor_axis = torch.cross(axis, main_axis, dim=0)
+        main_axis_length_mm = radius_mm / (1 - eccentricity ** 2) ** 0.25
+        minor_axis_length_mm = main_axis_length_mm * np.sqrt(1 - eccentricity ** 2)
+
+        if self.do_deformation:
+            positions_mm = positions_mm + self.get_deformation_offsets_mm(positions_mm)[..., None]
+        relative_positions_mm = positions_mm - start_mm
+        main_projection_mm = torch.matmul(relative_positions_mm, main_axis)
+        minor_projection_mm = torch.matmul(relative_positions_mm, minor_axis)
+
+        # first-order approximation of the distance to the ellipse in the cross-section of the tube
+        k0 = torch.sqrt((main_projection_mm / main_axis_length_mm) ** 2 +
+                        (minor_projection_mm / minor_axis_length_mm) ** 2)
+        k1 = torch.sqrt((main_projection_mm / main_axis_length_mm ** 2) ** 2 +
+                        (minor_projection_mm / minor_axis_length_mm ** 2) ** 2)
+        return torch.where(k1 > 0, k0 * (k0 - 1) / torch.clamp(k1, min=1e-12),
+                           torch.full_like(k0, -min(main_axis_length_mm, minor_axis_length_mm)))
+
     def get_enclosed_indices(self):
         start_mm, end_mm, radius_mm, eccentricity, partial_volume = self.params
         start_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
@@ -76,14 +104,10 @@ class EllipticalTubularStructure(GeometricalStructure):
             radius_margin = 0.7071
 
         if self.do_deformation:
-            # the deformation functional needs mm as inputs and returns the result in reverse indexing order...
-            deformation_values_mm = self.deformation_functional_mm(torch.arange(self.volume_dimensions_voxels[0]) *
-                                                                   self.voxel_spacing,
-                                                                   torch.arange(self.volume_dimensions_voxels[1]) *
-                                                                   self.voxel_spacing).T
+            deformation_values_mm = self.deformation_elevation_map_mm
             deformation_values_mm = deformation_values_mm.reshape(self.volume_dimensions_voxels[0],
                                                                   self.volume_dimensions_voxels[1], 1, 1)
-            deformation_values_mm = torch.tile(torch.as_tensor(
+            deformation_values_mm = torch.tile(torch.tensor(
                 deformation_values_mm, device=self.torch_device), (1, 1, self.volume_dimensions_voxels[2], 3))
             deformation_values_mm /= self.voxel_spacing
             target_vector += deformation_values_mm
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 
 import torch
+import numpy as np
 
 from simpa.utils import Tags
 from simpa.utils.libraries.molecule_library import MolecularComposition
@@ -40,10 +41,36 @@ class HorizontalLayerStructure(GeometricalStructure):
         settings[Tags.STRUCTURE_END_MM] = self.params[1]
         return settings
 
+    supports_signed_distance = True
+
+    def signed_distance_mm(self, positions_mm):
+        start_z_mm = float(self.params[0][2])
+        end_z_mm = float(self.params[1][2])
+        z_positions_mm = positions_mm[..., 2]
+        if self.do_deformation:
+            z_positions_mm = z_positions_mm + self.get_deformation_offsets_mm(positions_mm)
+        return torch.maximum(start_z_mm - z_positions_mm, z_positions_mm - end_z_mm)
+
+    def get_bounding_box_mm(self):
+        lower_mm, upper_mm = super().get_bounding_box_mm()
+        lower_mm, upper_mm = np.array(lower_mm, dtype=float), np.array(upper_mm, dtype=float)
+        lower_mm[2], upper_mm[2] = self.params[0][2], self.params[1][2]
+        if self.do_deformation:
+            lower_mm[2] -= np.max(self.deformation_elevation_map_mm)
+            upper_mm[2] -= np.min(self.deformation_elevation_map_mm)
+        return lower_mm, upper_mm
+
     def get_enclosed_indices(self):
+        """
+        The fractions only depend on the depth of a voxel below the start of the layer. Without deformation, they are
+        computed as a single profile along the z-axis that is broadcast to the whole xy-plane. With deformation,
+        the depth profile of every (x, y) column is only computed within the range of z that the deformed layer
+        can reach.
+
+        :return: tuple of the slices of the region that encloses the layer and the volume fractions within it
+        """
         start_mm = torch.tensor(self.params[0], dtype=torch.float).to(self.torch_device)
         end_mm = torch.tensor(self.params[1], dtype=torch.float).to(self.torch_device)
-        partial_volume = self.params[2]
         start_voxels = start_mm / self.voxel_spacing
         direction_mm = end_mm - start_mm
         depth_voxels = direction_mm[2] / self.voxel_spacing
@@ -51,34 +78,58 @@ class HorizontalLayerStructure(GeometricalStructure):
         if direction_mm[0] != 0 or direction_mm[1] != 0 or direction_mm[2] == 0:
             raise ValueError("Horizontal Layer structure needs a start and end vector in the form of [0, 0, n].")
 
-        target_vector_voxels = torch.stack(torch.meshgrid(torch.arange(self.volume_dimensions_voxels[0], dtype=torch.float, device=self.torch_device),
-                                                          torch.arange(
-                                                              self.volume_dimensions_voxels[1], dtype=torch.float, device=self.torch_device),
-                                                          torch.arange(
-                                                              self.volume_dimensions_voxels[2], dtype=torch.float, device=self.torch_device),
-                                                          indexing='ij'), dim=-1)
+        z_dim_voxels = int(self.volume_dimensions_voxels[2])
+        if self.do_deformation:
+            # the fractions vanish unless -1 <= depth below the deformed start < depth of the layer
+            elevation_voxels = np.asarray(self.deformation_elevation_map_mm) / self.voxel_spacing
+            z_start = int(np.floor(float(start_voxels[2]) - np.max(elevation_voxels))) - 2
+            z_end = int(np.ceil(float(start_voxels[2]) + max(float(depth_voxels), 0) - np.min(elevation_voxels))) + 2
+            z_start, z_end = min(max(z_start, 0), z_dim_voxels), min(max(z_end, 0), z_dim_voxels)
+            if z_end <= z_start:
+                return (slice(None), slice(None), slice(0, 0)), np.zeros(0, dtype=np.float32)
+        else:
+            z_start, z_end = 0, z_dim_voxels
 
-        target_vector_voxels -= start_voxels
-        target_vector_voxels = target_vector_voxels[:, :, :, 2]
+        # the depths are computed with the same floating point operations as on a full voxel grid
+        depth_profile_voxels = torch.arange(z_start, z_end, dtype=torch.float, device=self.torch_device) - \
+            start_voxels[2]
         if self.do_deformation:
-            # the deformation functional needs mm as inputs and returns the result in reverse indexing order...
-            deformation_values_mm = self.deformation_functional_mm(torch.arange(self.volume_dimensions_voxels[0], dtype=torch.float) *
-                                                                   self.voxel_spacing,
-                                                                   torch.arange(self.volume_dimensions_voxels[1], dtype=torch.float) *
-                                                                   self.voxel_spacing).T
-            target_vector_voxels = (target_vector_voxels + torch.from_numpy(deformation_values_mm.reshape(
+            deformation_values_mm = torch.tensor(self.deformation_elevation_map_mm, device=self.torch_device)
+            depth_profile_voxels = (depth_profile_voxels + deformation_values_mm.reshape(
                 self.volume_dimensions_voxels[0],
-                self.volume_dimensions_voxels[1], 1)).to(self.torch_device) / self.voxel_spacing).float()
-
-        volume_fractions = torch.zeros(tuple(self.volume_dimensions_voxels),
-                                       dtype=torch.float, device=self.torch_device)
-
-        if partial_volume:
+                self.volume_dimensions_voxels[1], 1) / self.voxel_spacing).float()
+        else:
+            depth_profile_voxels = depth_profile_voxels.reshape(1, 1, -1)
+
+        volume_fractions = self.get_depth_profile_fractions(depth_profile_voxels, depth_voxels)
+
+        if not self.do_deformation:
+            # only the range of z in which the profile does not vanish has to be broadcast into the volume
+            filled_z_indices = torch.nonzero(volume_fractions[0, 0]).flatten()
+            if len(filled_z_indices) == 0:
+                z_end = z_start
+            else:
+                z_start, z_end = int(filled_z_indices[0]), int(filled_z_indices[-1]) + 1
+            volume_fractions = volume_fractions[:, :, z_start:z_end]
+
+        return (slice(None), slice(None), slice(z_start, z_end)), volume_fractions.cpu().numpy()
+
+    def get_depth_profile_fractions(self, target_vector_voxels: torch.Tensor,
+                                    depth_voxels: torch.Tensor) -> torch.Tensor:
+        """
+        :param target_vector_voxels: tensor of depths in voxels below the start of the layer, whose last dimension
+            runs along the z-axis
+        :param depth_voxels: the thickness of the layer in voxels
+        :return: tensor of the same shape with the volume fractions of the layer
+        """
+        volume_fractions = torch.zeros(target_vector_voxels.shape, dtype=torch.float, device=self.torch_device)
+
+        if self.params[2]:
             bools_first_layer = ((target_vector_voxels >= -1) & (target_vector_voxels < 0))
 
             volume_fractions[bools_first_layer] = 1 - torch.abs(target_vector_voxels[bools_first_layer])
 
-            initial_fractions = torch.max(volume_fractions, dim=2, keepdims=True)[0]
+            initial_fractions = torch.max(volume_fractions, dim=-1, keepdims=True)[0]
             floored_depth_voxels = torch.floor(depth_voxels - initial_fractions)
 
             bools_fully_filled_layers = ((target_vector_voxels >= 0) & (target_vector_voxels < floored_depth_voxels))
@@ -90,16 +141,12 @@ class HorizontalLayerStructure(GeometricalStructure):
             volume_fractions[volume_fractions > depth_voxels] = depth_voxels
             volume_fractions[volume_fractions < 0] = 0
 
-            bools_all_layers = bools_first_layer | bools_last_layer | bools_fully_filled_layers
-
         else:
             bools_fully_filled_layers = ((target_vector_voxels >= -0.5) & (target_vector_voxels < depth_voxels - 0.5))
 
-            bools_all_layers = bools_fully_filled_layers
-
         volume_fractions[bools_fully_filled_layers] = 1
 
-        return bools_all_layers.cpu().numpy(), volume_fractions[bools_all_layers].cpu().numpy()
+        return volume_fractions
 
 
 def define_horizontal_layer_structure_settings(molecular_composition: MolecularComposition,
@@ -0,0 +1,357 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import re
+
+import numpy as np
+import torch
+
+from simpa.utils import Tags
+from simpa.utils.libraries.molecule_library import MolecularComposition
+from simpa.utils.libraries.structure_library.StructureBase import GeometricalStructure
+
+
+class MeshStructure(GeometricalStructure):
+    """
+    Defines a structure by a closed triangle mesh, e.g. an organ that was segmented from a CT or MRI scan and exported
+    as STL or OBJ file. The vertex coordinates are scaled and translated into the simulation volume, where voxel i
+    covers [i * spacing, (i + 1) * spacing) along each axis.
+
+    The mesh is voxelised with a scanline parity algorithm: k x k rays are cast along the z-axis through every voxel
+    column, where k is Tags.PARTIAL_VOLUME_SUPERSAMPLING (4 by default if partial volume effects are considered, 1
+    otherwise). The ray-triangle intersections are computed for all triangles at once in chunks, and consecutive
+    intersections along each ray enclose the inside of the mesh. The exact length of these intervals within each voxel
+    is accumulated with difference arrays, such that the volume fractions are exact along z and averaged over the
+    rays in x and y. Shared edges and vertices are attributed to exactly one triangle, so rays that hit them are
+    counted correctly. The structure can be set to adhere to a deformation defined by the
+    simpa.utils.deformation_manager, which shifts every voxel column along the z-axis.
+    Example usage:
+
+        # single_structure_settings initialization
+        structure = Settings()
+
+        structure[Tags.PRIORITY] = 9
+        structure[Tags.STRUCTURE_MESH_PATH] = "/path/to/liver.stl"
+        structure[Tags.STRUCTURE_MESH_SCALE] = 1
+        structure[Tags.STRUCTURE_MESH_TRANSLATION_MM] = [10, 10, 5]
+        structure[Tags.MOLECULE_COMPOSITION] = TISSUE_LIBRARY.muscle()
+        structure[Tags.CONSIDER_PARTIAL_VOLUME] = True
+        structure[Tags.STRUCTURE_TYPE] = Tags.MESH_STRUCTURE
+
+    """
+
+    PARTIAL_VOLUME_RAYS_PER_AXIS = 4
+    """
+    Number of rays per voxel along x and y if partial volume effects are considered and
+    Tags.PARTIAL_VOLUME_SUPERSAMPLING is not set.
+    """
+
+    RAY_TRIANGLE_CHUNK_SIZE = 2 ** 22
+    """
+    Maximum number of ray-triangle pairs that are tested at once.
+    """
+
+    def get_params_from_settings(self, single_structure_settings):
+        params = (single_structure_settings[Tags.STRUCTURE_MESH_PATH],
+                  single_structure_settings[Tags.STRUCTURE_MESH_SCALE]
+                  if Tags.STRUCTURE_MESH_SCALE in single_structure_settings else 1,
+                  single_structure_settings[Tags.STRUCTURE_MESH_TRANSLATION_MM]
+                  if Tags.STRUCTURE_MESH_TRANSLATION_MM in single_structure_settings else [0, 0, 0],
+                  single_structure_settings[Tags.CONSIDER_PARTIAL_VOLUME])
+        return params
+
+    def to_settings(self):
+        settings = super().to_settings()
+        settings[Tags.STRUCTURE_MESH_PATH] = self.params[0]
+        settings[Tags.STRUCTURE_MESH_SCALE] = self.params[1]
+        settings[Tags.STRUCTURE_MESH_TRANSLATION_MM] = self.params[2]
+        return settings
+
+    def get_triangles_mm(self) -> np.ndarray:
+        """
+        :return: (number of triangles, 3, 3) array with the vertex coordinates of the triangles in the coordinates of
+            the simulation volume in mm
+        """
+        mesh_path, scale, translation_mm, _ = self.params
+        return load_triangle_mesh(mesh_path) * scale + np.asarray(translation_mm, dtype=np.float64)
+
+    def get_enclosed_indices(self):
+        _, _, _, partial_volume = self.params
+        triangles_mm = self.get_triangles_mm()
+
+        if not partial_volume:
+            rays_per_axis = 1
+        elif self.partial_volume_supersampling is not None:
+            rays_per_axis = self.partial_volume_supersampling
+        else:
+            rays_per_axis = self.PARTIAL_VOLUME_RAYS_PER_AXIS
+
+        # the voxelisation is restricted to the bounding box of the mesh
+        lower_mm = triangles_mm.reshape(-1, 3).min(axis=0) if len(triangles_mm) > 0 else np.zeros(3)
+        upper_mm = triangles_mm.reshape(-1, 3).max(axis=0) if len(triangles_mm) > 0 else np.zeros(3)
+        if self.do_deformation:
+            lower_mm[2] -= np.max(self.deformation_elevation_map_mm)
+            upper_mm[2] -= np.min(self.deformation_elevation_map_mm)
+        lower_voxels = np.clip(np.floor(lower_mm / self.voxel_spacing).astype(int), 0, self.volume_dimensions_voxels)
+        upper_voxels = np.clip(np.ceil(upper_mm / self.voxel_spacing).astype(int), lower_voxels,
+                               self.volume_dimensions_voxels)
+        bounding_box = tuple(slice(int(lower), int(upper)) for lower, upper in zip(lower_voxels, upper_voxels))
+        nx, ny, nz = (int(dim) for dim in upper_voxels - lower_voxels)
+        if nx * ny * nz == 0:
+            return bounding_box, np.zeros((nx, ny, nz), dtype=np.float32)
+
+        ray_indices, z_positions_mm = self.get_ray_intersections(triangles_mm, lower_voxels, (nx, ny), rays_per_axis)
+
+        # consecutive intersections along a ray enter and leave the mesh
+        z_positions_mm, order = torch.sort(z_positions_mm)
+        ray_indices, order = torch.sort(ray_indices[order], stable=True)
+        z_positions_mm = z_positions_mm[order]
+        intersections_per_ray = torch.bincount(ray_indices, minlength=nx * ny * rays_per_axis ** 2)
+        odd_rays = intersections_per_ray % 2 == 1
+        if torch.any(odd_rays):
+            self.logger.warning(f"{int(odd_rays.sum())} rays intersect the mesh {self.params[0]} an odd number of "
+                                f"times. The mesh is probably not closed, these rays are ignored.")
+            valid = ~odd_rays[ray_indices]
+            ray_indices, z_positions_mm = ray_indices[valid], z_positions_mm[valid]
+
+        ray_indices = ray_indices[0::2]
+        column_indices = ((ray_indices // (ny * rays_per_axis)) // rays_per_axis) * ny + \
+            (ray_indices % (ny * rays_per_axis)) // rays_per_axis
+        start_mm, end_mm = z_positions_mm[0::2], z_positions_mm[1::2]
+        if self.do_deformation:
+            elevation_map_mm = torch.as_tensor(np.array(self.deformation_elevation_map_mm[bounding_box[0],
+                                                                                         bounding_box[1]]),
+                                               dtype=torch.float64, device=self.torch_device).reshape(-1)
+            start_mm = start_mm - elevation_map_mm[column_indices]
+            end_mm = end_mm - elevation_map_mm[column_indices]
+
+        volume_fractions = self.accumulate_intervals(column_indices, start_mm, end_mm, lower_voxels[2],
+                                                     (nx, ny, nz), 1 / rays_per_axis ** 2)
+        if not partial_volume:
+            volume_fractions = (volume_fractions >= 0.5).float()
+        return bounding_box, volume_fractions.cpu().numpy()
+
+    def get_ray_intersections(self, triangles_mm: np.ndarray, lower_voxels: np.ndarray, number_of_columns: tuple,
+                              rays_per_axis: int):
+        """
+        Intersects the rays along the z-axis with all triangles.
+
+        :param triangles_mm: (number of triangles, 3, 3) array with the vertex coordinates in mm
+        :param lower_voxels: the lower corner of the bounding box in voxels
+        :param number_of_columns: the number of voxel columns of the bounding box along x and y
+        :param rays_per_axis: the number of rays per voxel along x and y
+        :return: tuple of the indices of the intersected rays and the z positions (in mm) of the intersections
+        """
+        number_of_rays_x = number_of_columns[0] * rays_per_axis
+        number_of_rays_y = number_of_columns[1] * rays_per_axis
+        ray_spacing_mm = self.voxel_spacing / rays_per_axis
+
+        triangles = torch.as_tensor(triangles_mm, dtype=torch.float64, device=self.torch_device)
+        # in ray coordinates, ray (i, j) passes through the integer position (i, j)
+        triangles_xy = (triangles[..., :2] - torch.as_tensor(lower_voxels[:2] * self.voxel_spacing,
+                                                             dtype=torch.float64, device=self.torch_device)) / \
+            ray_spacing_mm - 0.5
+        triangles_z = triangles[..., 2]
+
+        lower_rays = torch.clamp(torch.ceil(triangles_xy.min(dim=1).values), min=0).long()
+        upper_rays = torch.minimum(torch.floor(triangles_xy.max(dim=1).values).long(),
+                                   torch.as_tensor([number_of_rays_x - 1, number_of_rays_y - 1],
+                                                   device=self.torch_device))
+        rays_per_triangle = torch.clamp(upper_rays - lower_rays + 1, min=0)
+        pairs_per_triangle = rays_per_triangle[:, 0] * rays_per_triangle[:, 1]
+
+        ray_indices = list()
+        z_positions_mm = list()
+        pair_offsets = np.cumsum(pairs_per_triangle.cpu().numpy())
+        triangle_start = 0
+        while triangle_start < len(triangles):
+            # the chunk contains at least one triangle and at most RAY_TRIANGLE_CHUNK_SIZE pairs otherwise
+            previous_pairs = pair_offsets[triangle_start - 1] if triangle_start > 0 else 0
+            triangle_end = max(triangle_start + 1, int(np.searchsorted(
+                pair_offsets, previous_pairs + self.RAY_TRIANGLE_CHUNK_SIZE, side="right")))
+            chunk = slice(triangle_start, triangle_end)
+            triangle_start = triangle_end
+
+            pairs = pairs_per_triangle[chunk]
+            if int(pairs.sum()) == 0:
+                continue
+            triangle_indices = torch.repeat_interleave(torch.arange(len(pairs), device=self.torch_device), pairs)
+            pair_indices = torch.arange(len(triangle_indices), device=self.torch_device) - \
+                torch.repeat_interleave(torch.cumsum(pairs, dim=0) - pairs, pairs)
+            rays_along_x = rays_per_triangle[chunk][triangle_indices, 0]
+            ray_x = lower_rays[chunk][triangle_indices, 0] + pair_indices % rays_along_x
+            ray_y = lower_rays[chunk][triangle_indices, 1] + pair_indices // rays_along_x
+
+            hit, z_mm = intersect_rays_with_triangles(triangles_xy[chunk][triangle_indices],
+                                                      triangles_z[chunk][triangle_indices],
+                                                      ray_x.double(), ray_y.double())
+            ray_indices.append((ray_x * number_of_rays_y + ray_y)[hit])
+            z_positions_mm.append(z_mm[hit])
+
+        if len(ray_indices) == 0:
+            return (torch.zeros(0, dtype=torch.long, device=self.torch_device),
+                    torch.zeros(0, dtype=torch.float64, device=self.torch_device))
+        return torch.cat(ray_indices), torch.cat(z_positions_mm)
+
+    def accumulate_intervals(self, column_indices: torch.Tensor, start_mm: torch.Tensor, end_mm: torch.Tensor,
+                             lower_z_voxels: int, dimensions: tuple, weight: float) -> torch.Tensor:
+        """
+        Adds the length of the given intervals within each voxel of their column. The fully covered voxels of an
+        interval are added with a difference array, only the two voxels that contain its ends are added directly.
+
+        :param column_indices: the index of the voxel column of each interval within the bounding box
+        :param start_mm: the z position of the start of each interval in mm
+        :param end_mm: the z position of the end of each interval in mm
+        :param lower_z_voxels: the lower z index of the bounding box
+        :param dimensions: the dimensions of the bounding box in voxels
+        :param weight: the weight of every interval
+        :return: the volume fractions within the bounding box
+        """
+        nx, ny, nz = dimensions
+        start_voxels = torch.clamp(start_mm / self.voxel_spacing - lower_z_voxels, 0, nz)
+        end_voxels = torch.clamp(end_mm / self.voxel_spacing - lower_z_voxels, 0, nz)
+        first_voxels = torch.floor(start_voxels).long()
+        last_voxels = torch.floor(end_voxels).long()
+        within_one_voxel = first_voxels == last_voxels
+        column_offsets = column_indices * (nz + 1)
+
+        differences = torch.zeros(nx * ny * (nz + 1), dtype=torch.float, device=self.torch_device)
+        across = ~within_one_voxel
+        differences.index_add_(0, (column_offsets + first_voxels + 1)[across],
+                               torch.full((int(across.sum()), ), weight, dtype=torch.float, device=self.torch_device))
+        differences.index_add_(0, (column_offsets + last_voxels)[across],
+                               torch.full((int(across.sum()), ), -weight, dtype=torch.float,
+                                          device=self.torch_device))
+        volume_fractions = torch.cumsum(differences.reshape(nx * ny, nz + 1), dim=1).reshape(-1)
+
+        volume_fractions.index_add_(0, (column_offsets + first_voxels)[across],
+                                    (weight * (first_voxels + 1 - start_voxels)[across]).float())
+        volume_fractions.index_add_(0, (column_offsets + last_voxels)[across],
+                                    (weight * (end_voxels - last_voxels)[across]).float())
+        volume_fractions.index_add_(0, (column_offsets + first_voxels)[within_one_voxel],
+                                    (weight * (end_voxels - start_voxels)[within_one_voxel]).float())
+
+        return torch.clamp(volume_fractions.reshape(nx, ny, nz + 1)[..., :nz], 0, 1)
+
+
+def intersect_rays_with_triangles(triangles_xy: torch.Tensor, triangles_z: torch.Tensor, ray_x: torch.Tensor,
+                                  ray_y: torch.Tensor):
+    """
+    Intersects rays along the z-axis with triangles. The edge functions are evaluated with a canonical vertex order,
+    such that they are exactly antisymmetric for triangles that share an edge. Rays that pass exactly through an edge
+    or a vertex are attributed to the triangles that would contain them after an infinitesimal shift of the ray by
+    (epsilon, epsilon^2), so each of them is counted by exactly one triangle of a surface.
+
+    :param triangles_xy: (N, 3, 2) tensor with the x and y coordinates of the vertices of each triangle
+    :param triangles_z: (N, 3) tensor with the z coordinates of the vertices of each triangle
+    :param ray_x: (N, ) tensor with the x coordinate of each ray
+    :param ray_y: (N, ) tensor with the y coordinate of each ray
+    :return: tuple of a boolean tensor whether the ray intersects the triangle and the z positions of the intersections
+    """
+    edge_functions = list()
+    edge_vectors = list()
+    for edge in range(3):
+        start = triangles_xy[:, edge]
+        end = triangles_xy[:, (edge + 1) % 3]
+        swap = (start[:, 0] > end[:, 0]) | ((start[:, 0] == end[:, 0]) & (start[:, 1] > end[:, 1]))
+        first = torch.where(swap[:, None], end, start)
+        second = torch.where(swap[:, None], start, end)
+        edge_function = (second[:, 0] - first[:, 0]) * (ray_y - first[:, 1]) - \
+            (second[:, 1] - first[:, 1]) * (ray_x - first[:, 0])
+        edge_functions.append(torch.where(swap, -edge_function, edge_function))
+        edge_vectors.append(end - start)
+
+    # twice the signed area of the projected triangle, the edge functions are oriented such that the inside is positive
+    orientation = torch.sign(edge_vectors[0][:, 0] * edge_vectors[1][:, 1] -
+                             edge_vectors[0][:, 1] * edge_vectors[1][:, 0])
+    hit = orientation != 0
+    for edge in range(3):
+        edge_functions[edge] = edge_functions[edge] * orientation
+        direction = edge_vectors[edge] * orientation[:, None]
+        includes_edge = (direction[:, 1] < 0) | ((direction[:, 1] == 0) & (direction[:, 0] > 0))
+        hit = hit & ((edge_functions[edge] > 0) | ((edge_functions[edge] == 0) & includes_edge))
+
+    # the edge function of an edge is proportional to the barycentric coordinate of the opposite vertex
+    area = edge_functions[0] + edge_functions[1] + edge_functions[2]
+    z_positions = (edge_functions[0] * triangles_z[:, 2] + edge_functions[1] * triangles_z[:, 0] +
+                   edge_functions[2] * triangles_z[:, 1]) / torch.where(area != 0, area, torch.ones_like(area))
+    return hit, z_positions
+
+
+def load_triangle_mesh(file_path: str) -> np.ndarray:
+    """
+    Loads the triangles of a binary STL, ASCII STL, or OBJ file. Polygonal faces of OBJ files are triangulated as
+    fans.
+
+    :param file_path: path to the mesh file
+    :return: (number of triangles, 3, 3) float64 array with the vertex coordinates of each triangle
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".stl":
+        return load_stl(file_path)
+    elif extension == ".obj":
+        return load_obj(file_path)
+    raise ValueError(f"Unsupported mesh file format {extension}. Only STL and OBJ files are supported.")
+
+
+def load_stl(file_path: str) -> np.ndarray:
+    """
+    :param file_path: path to a binary or ASCII STL file
+    :return: (number of triangles, 3, 3) float64 array with the vertex coordinates of each triangle
+    """
+    with open(file_path, "rb") as stl_file:
+        content = stl_file.read()
+
+    # an ASCII file may not start with "solid", but a binary file may, so the size is the decisive criterion
+    if len(content) >= 84:
+        number_of_triangles = int(np.frombuffer(content, dtype="<u4", count=1, offset=80)[0])
+        if len(content) == 84 + 50 * number_of_triangles:
+            records = np.frombuffer(content, dtype=np.dtype([("normal", "<f4", (3, )),
+                                                             ("vertices", "<f4", (3, 3)),
+                                                             ("attributes", "<u2")]),
+                                    count=number_of_triangles, offset=84)
+            return records["vertices"].astype(np.float64)
+
+    vertices = re.findall(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)", content)
+    return np.asarray(vertices, dtype=np.float64).reshape(-1, 3, 3)
+
+
+def load_obj(file_path: str) -> np.ndarray:
+    """
+    :param file_path: path to an OBJ file
+    :return: (number of triangles, 3, 3) float64 array with the vertex coordinates of each triangle
+    """
+    vertices = list()
+    triangles = list()
+    with open(file_path, "r") as obj_file:
+        for line in obj_file:
+            if line.startswith("v "):
+                vertices.append(line.split()[1:4])
+            elif line.startswith("f "):
+                # faces are given as v, v/vt, v//vn, or v/vt/vn with one-based or negative indices
+                face = [int(vertex.split("/")[0]) for vertex in line.split()[1:]]
+                face = [index - 1 if index > 0 else len(vertices) + index for index in face]
+                for corner in range(1, len(face) - 1):
+                    triangles.append((face[0], face[corner], face[corner + 1]))
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    return vertices[np.asarray(triangles, dtype=np.int64).reshape(-1, 3)]
+
+
+def define_mesh_structure_settings(mesh_path: str, molecular_composition: MolecularComposition,
+                                   scale: float = 1, translation_mm: list = None, priority: int = 10,
+                                   consider_partial_volume: bool = False, adhere_to_deformation: bool = False):
+    """
+    TODO
+    """
+    return {
+        Tags.STRUCTURE_MESH_PATH: mesh_path,
+        Tags.STRUCTURE_MESH_SCALE: scale,
+        Tags.STRUCTURE_MESH_TRANSLATION_MM: [0, 0, 0] if translation_mm is None else translation_mm,
+        Tags.PRIORITY: priority,
+        Tags.MOLECULE_COMPOSITION: molecular_composition,
+        Tags.CONSIDER_PARTIAL_VOLUME: consider_partial_volume,
+        Tags.ADHERE_TO_DEFORMATION: adhere_to_deformation,
+        Tags.STRUCTURE_TYPE: Tags.MESH_STRUCTURE
+    }
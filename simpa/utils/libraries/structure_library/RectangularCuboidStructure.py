@@ -4,6 +4,7 @@
 
 from typing import Union
 import torch
+import numpy as np
 
 from simpa.utils import Tags
 from simpa.utils.libraries.molecule_library import MolecularComposition
@@ -50,7 +51,29 @@ class RectangularCuboidStructure(GeometricalStructure):
         settings[Tags.CONSIDER_PARTIAL_VOLUME] = self.params[4]
         return settings
 
+    supports_signed_distance = True
+
+    def signed_distance_mm(self, positions_mm):
+        lower_mm, upper_mm = self.get_bounding_box_mm()
+        center_mm = torch.tensor((lower_mm + upper_mm) / 2, dtype=torch.float, device=self.torch_device)
+        half_extent_mm = torch.tensor((upper_mm - lower_mm) / 2, dtype=torch.float, device=self.torch_device)
+        q = torch.abs(positions_mm - center_mm) - half_extent_mm
+        return torch.linalg.norm(torch.clamp(q, min=0), dim=-1) + torch.clamp(torch.max(q, dim=-1)[0], max=0)
+
+    def get_bounding_box_mm(self):
+        start_mm, x_edge_mm, y_edge_mm, z_edge_mm, _ = self.params
+        start_mm = np.asarray(start_mm, dtype=float)
+        end_mm = start_mm + np.asarray([x_edge_mm, y_edge_mm, z_edge_mm], dtype=float)
+        return np.minimum(start_mm, end_mm), np.maximum(start_mm, end_mm)
+
     def get_enclosed_indices(self):
+        """
+        The edges of the box are aligned with the axes of the volume, which is why the filled and border voxels as
+        well as the partial volume fractions are computed per axis on 1D profiles. The 3D fractions are only
+        materialised within the bounding region of the box as the outer product of these profiles.
+
+        :return: tuple of the slices of the region that encloses the box and the volume fractions within it
+        """
         start_mm, x_edge_mm, y_edge_mm, z_edge_mm, partial_volume = self.params
         start_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
         x_edge_mm = torch.tensor(x_edge_mm, dtype=torch.float, device=self.torch_device)
@@ -65,61 +88,53 @@ class RectangularCuboidStructure(GeometricalStructure):
         z_edge_voxels = torch.tensor([0, 0, z_edge_mm / self.voxel_spacing],
                                      dtype=torch.float, device=self.torch_device)
 
-        target_vector = torch.stack(torch.meshgrid(torch.arange(self.volume_dimensions_voxels[0], dtype=torch.float, device=self.torch_device),
-                                                   torch.arange(
-                                                       self.volume_dimensions_voxels[1], dtype=torch.float, device=self.torch_device),
-                                                   torch.arange(
-                                                       self.volume_dimensions_voxels[2], dtype=torch.float, device=self.torch_device),
-                                                   indexing='ij'), dim=-1)
-
-        target_vector -= start_voxels
-
         matrix = torch.stack([x_edge_voxels, y_edge_voxels, z_edge_voxels])
 
         inverse_matrix = torch.linalg.inv(matrix)
 
-        result = torch.matmul(target_vector, inverse_matrix)
-        del target_vector
-
         norm_vector = torch.tensor([1/torch.linalg.norm(x_edge_voxels),
                                     1/torch.linalg.norm(y_edge_voxels),
                                     1/torch.linalg.norm(z_edge_voxels)], dtype=torch.float, device=self.torch_device)
 
-        filled_mask_bool = (0 <= result) & (result <= 1 - norm_vector)
-        border_bool = (0 - norm_vector < result) & (result <= 1)
-
-        volume_fractions = torch.zeros(tuple(self.volume_dimensions_voxels),
-                                       dtype=torch.float, device=self.torch_device)
-        filled_mask = torch.all(filled_mask_bool, dim=-1)
-
-        border_mask = torch.all(border_bool, dim=-1)
-
-        border_mask = torch.logical_xor(border_mask, filled_mask)
-
-        edge_values = result[border_mask]
-
-        fraction_values = torch.matmul(edge_values, matrix)
-
-        larger_fraction_values = (x_edge_voxels + y_edge_voxels + z_edge_voxels) - fraction_values
-
-        small_bool = fraction_values > 0
-        large_bool = larger_fraction_values >= 1
-
-        fraction_values[small_bool & large_bool] = 0
-        fraction_values[fraction_values <= 0] = 1 + fraction_values[fraction_values <= 0]
-        fraction_values[larger_fraction_values < 1] = larger_fraction_values[larger_fraction_values < 1]
-
-        fraction_values = torch.abs(torch.prod(fraction_values, dim=-1))
-
-        volume_fractions[filled_mask] = 1
-        volume_fractions[border_mask] = fraction_values
-
-        if partial_volume:
-            mask = filled_mask | border_mask
-        else:
-            mask = filled_mask
-
-        return mask.cpu().numpy(), volume_fractions[mask].cpu().numpy()
+        filled_slices = []
+        border_slices = []
+        fraction_profiles = []
+        for axis in range(3):
+            target_vector = torch.arange(self.volume_dimensions_voxels[axis], dtype=torch.float,
+                                         device=self.torch_device) - start_voxels[axis]
+            result = target_vector * inverse_matrix[axis, axis]
+
+            filled_indices = torch.nonzero((0 <= result) & (result <= 1 - norm_vector[axis])).flatten()
+            border_indices = torch.nonzero((0 - norm_vector[axis] < result) & (result <= 1)).flatten()
+            if len(border_indices) == 0:
+                return (slice(0, 0), slice(0, 0), slice(0, 0)), np.zeros(0, dtype=np.float32)
+            border_slices.append(slice(int(border_indices[0]), int(border_indices[-1]) + 1))
+            if len(filled_indices) == 0:
+                filled_slices.append(slice(0, 0))
+            else:
+                filled_slices.append(slice(int(filled_indices[0]), int(filled_indices[-1]) + 1))
+
+            fraction_values = result[border_slices[axis]] * matrix[axis, axis]
+            larger_fraction_values = matrix[axis, axis] - fraction_values
+
+            small_bool = fraction_values > 0
+            large_bool = larger_fraction_values >= 1
+
+            fraction_values[small_bool & large_bool] = 0
+            fraction_values[fraction_values <= 0] = 1 + fraction_values[fraction_values <= 0]
+            fraction_values[larger_fraction_values < 1] = larger_fraction_values[larger_fraction_values < 1]
+            fraction_profiles.append(fraction_values)
+
+        if not partial_volume:
+            return tuple(filled_slices), np.ones((1, 1, 1), dtype=np.float32)
+
+        volume_fractions = torch.abs(fraction_profiles[0].reshape(-1, 1, 1) * fraction_profiles[1].reshape(1, -1, 1) *
+                                     fraction_profiles[2].reshape(1, 1, -1))
+        if all(filled_slice.stop > filled_slice.start for filled_slice in filled_slices):
+            volume_fractions[tuple(slice(filled.start - border.start, filled.stop - border.start)
+                                   for filled, border in zip(filled_slices, border_slices))] = 1
+
+        return tuple(border_slices), volume_fractions.cpu().numpy()
 
 
 def define_rectangular_cuboid_structure_settings(start_mm: list, extent_mm: Union[int, list],
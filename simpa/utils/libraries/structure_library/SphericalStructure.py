@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 
 import torch
+import numpy as np
 
 from simpa.utils import Tags
 from simpa.utils.libraries.molecule_library import MolecularComposition
@@ -42,6 +43,17 @@ class SphericalStructure(GeometricalStructure):
         settings[Tags.STRUCTURE_RADIUS_MM] = self.params[1]
         return settings
 
+    supports_signed_distance = True
+
+    def signed_distance_mm(self, positions_mm):
+        start_mm, radius_mm, _ = self.params
+        center_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
+        return torch.linalg.norm(positions_mm - center_mm, dim=-1) - radius_mm
+
+    def get_bounding_box_mm(self):
+        start_mm, radius_mm, _ = self.params
+        return np.asarray(start_mm) - radius_mm, np.asarray(start_mm) + radius_mm
+
     def get_enclosed_indices(self):
         start_mm, radius_mm, partial_volume = self.params
         start_mm = torch.tensor(start_mm, dtype=torch.float, device=self.torch_device)
@@ -5,9 +5,10 @@
 from abc import abstractmethod
 
 import numpy as np
+import torch
 
 from simpa.log import Logger
-from simpa.utils import Settings, Tags, get_functional_from_deformation_settings
+from simpa.utils import Settings, Tags, get_deformation_elevation_map_mm
 from simpa.utils.libraries.molecule_library import MolecularComposition
 from simpa.utils.tissue_properties import TissueProperties
 from simpa.utils.processing_device import get_processing_device
@@ -23,6 +24,29 @@ class GeometricalStructure:
     occupied by the GeometricalStructure. If a voxel has the value 0, it is outside of the GeometricalStructure.
     """
 
+    supports_concurrent_construction = True
+    """
+    Whether the structure may be constructed in a worker thread, i.e. its geometry does not depend on shared state
+    such as the global numpy random number generator.
+    """
+
+    supports_any_spacing = True
+    """
+    Whether the geometry of the structure is independent of the voxel spacing, such that rasterising it at another
+    spacing yields the same structure, e.g. on the grid of the optical forward model.
+    """
+
+    supports_signed_distance = False
+    """
+    Whether the structure implements signed_distance_mm and can thus be rasterised with
+    Tags.PARTIAL_VOLUME_SUPERSAMPLING.
+    """
+
+    SUPERSAMPLING_CHUNK_SIZE = 2 ** 20
+    """
+    Maximum number of subvoxel samples whose signed distance is evaluated at once.
+    """
+
     def __init__(self, global_settings: Settings,
                  single_structure_settings: Settings = None):
 
@@ -46,12 +70,12 @@ class GeometricalStructure:
         self.logger.debug(f"This structure will simulate deformations: {self.do_deformation}")
 
         if self.do_deformation and Tags.DEFORMED_LAYERS_SETTINGS in global_settings.get_volume_creation_settings():
-            self.deformation_functional_mm = get_functional_from_deformation_settings(
-                global_settings.get_volume_creation_settings()[Tags.DEFORMED_LAYERS_SETTINGS])
+            # (x, y) map of the surface elevation in mm that is shared by all structures of the simulation
+            self.deformation_elevation_map_mm = get_deformation_elevation_map_mm(
+                global_settings.get_volume_creation_settings()[Tags.DEFORMED_LAYERS_SETTINGS],
+                self.volume_dimensions_voxels, self.voxel_spacing)
         else:
-            self.deformation_functional_mm = None
-
-        self.logger.debug(f"This structure's deformation functional: {self.deformation_functional_mm}")
+            self.deformation_elevation_map_mm = None
 
         if single_structure_settings is None:
             self.molecule_composition = MolecularComposition()
@@ -66,6 +90,14 @@ class GeometricalStructure:
         else:
             self.partial_volume = False
 
+        if Tags.PARTIAL_VOLUME_SUPERSAMPLING in single_structure_settings:
+            self.partial_volume_supersampling = int(single_structure_settings[Tags.PARTIAL_VOLUME_SUPERSAMPLING])
+        elif Tags.PARTIAL_VOLUME_SUPERSAMPLING in global_settings.get_volume_creation_settings():
+            self.partial_volume_supersampling = int(
+                global_settings.get_volume_creation_settings()[Tags.PARTIAL_VOLUME_SUPERSAMPLING])
+        else:
+            self.partial_volume_supersampling = None
+
         self.molecule_composition = single_structure_settings[Tags.MOLECULE_COMPOSITION]
         self.molecule_composition.update_internal_properties()
 
@@ -77,9 +109,93 @@ class GeometricalStructure:
         """
         Fills self.geometrical_volume of the GeometricalStructure.
         """
-        indices, values = self.get_enclosed_indices()
+        if self.supports_signed_distance and self.partial_volume_supersampling is not None:
+            indices, values = self.get_enclosed_indices_from_signed_distance(self.partial_volume_supersampling)
+        else:
+            indices, values = self.get_enclosed_indices()
         self.geometrical_volume[indices] = values
 
+    def signed_distance_mm(self, positions_mm: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the signed distance of the given positions to the surface of the GeometricalStructure. The distance
+        is negative inside of the structure and must not overestimate the true distance by much, such that voxels
+        whose center is further than half a voxel diagonal away from the surface are not intersected by it.
+        Structures that implement this method set supports_signed_distance to True.
+
+        :param positions_mm: tensor of shape (..., 3) with positions in mm
+        :return: tensor of shape (...) with the signed distances in mm
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not implement a signed distance function.")
+
+    def get_bounding_box_mm(self) -> tuple:
+        """
+        :return: tuple of the lower and upper corner (in mm) of a box that encloses the GeometricalStructure.
+            The entire simulation volume by default.
+        """
+        return np.zeros(3), self.volume_dimensions_mm
+
+    def get_enclosed_indices_from_signed_distance(self, supersampling: int):
+        """
+        Rasterises the GeometricalStructure from its signed distance function. The distance is evaluated at the
+        voxel centers within the bounding box. Voxels that lie further inside than half a voxel diagonal are
+        completely filled, only the remaining boundary voxels get a partial volume fraction from
+        supersampling x supersampling x supersampling subvoxel samples or, for supersampling = 1, from the closed-form
+        approximation 0.5 - distance / voxel_spacing.
+
+        :param supersampling: number of subvoxel samples along each axis
+        :return: tuple of the slices of the bounding box and the volume fractions within it
+        """
+        lower_mm, upper_mm = self.get_bounding_box_mm()
+        lower_voxels = np.clip(np.floor(np.asarray(lower_mm) / self.voxel_spacing).astype(int) - 1,
+                               0, self.volume_dimensions_voxels)
+        upper_voxels = np.clip(np.ceil(np.asarray(upper_mm) / self.voxel_spacing).astype(int) + 1,
+                               lower_voxels, self.volume_dimensions_voxels)
+        bounding_box = tuple(slice(int(lower), int(upper)) for lower, upper in zip(lower_voxels, upper_voxels))
+
+        voxel_centers_mm = torch.stack(torch.meshgrid(
+            *[(torch.arange(int(lower), int(upper), dtype=torch.float, device=self.torch_device) + 0.5) *
+              self.voxel_spacing for lower, upper in zip(lower_voxels, upper_voxels)],
+            indexing='ij'), dim=-1)
+        distances_mm = self.signed_distance_mm(voxel_centers_mm)
+
+        volume_fractions = (distances_mm <= 0).float()
+        if self.partial_volume:
+            half_voxel_diagonal_mm = np.sqrt(3) / 2 * self.voxel_spacing
+            boundary_mask = torch.abs(distances_mm) < half_voxel_diagonal_mm
+            if supersampling > 1:
+                subvoxel_offsets = ((torch.arange(supersampling, dtype=torch.float, device=self.torch_device) + 0.5) /
+                                    supersampling - 0.5) * self.voxel_spacing
+                subvoxel_offsets = torch.stack(torch.meshgrid(subvoxel_offsets, subvoxel_offsets, subvoxel_offsets,
+                                                              indexing='ij'), dim=-1).reshape(-1, 3)
+                boundary_centers_mm = voxel_centers_mm[boundary_mask]
+                boundary_fractions = torch.empty(len(boundary_centers_mm), dtype=torch.float,
+                                                 device=self.torch_device)
+                chunk_size = max(1, self.SUPERSAMPLING_CHUNK_SIZE // len(subvoxel_offsets))
+                for chunk_start in range(0, len(boundary_centers_mm), chunk_size):
+                    chunk = slice(chunk_start, chunk_start + chunk_size)
+                    subvoxel_distances_mm = self.signed_distance_mm(boundary_centers_mm[chunk, None, :] +
+                                                                    subvoxel_offsets[None, :, :])
+                    boundary_fractions[chunk] = (subvoxel_distances_mm <= 0).float().mean(dim=-1)
+            else:
+                boundary_fractions = torch.clamp(0.5 - distances_mm[boundary_mask] / self.voxel_spacing, 0, 1)
+            volume_fractions[boundary_mask] = boundary_fractions
+
+        return bounding_box, volume_fractions.cpu().numpy()
+
+    def get_deformation_offsets_mm(self, positions_mm: torch.Tensor) -> torch.Tensor:
+        """
+        :param positions_mm: tensor of shape (..., 3) with positions in mm
+        :return: tensor of shape (...) with the deformation surface elevation (in mm) of the voxel column that
+            contains each position
+        """
+        x_indices = torch.clamp((positions_mm[..., 0] / self.voxel_spacing).long(),
+                                0, int(self.volume_dimensions_voxels[0]) - 1)
+        y_indices = torch.clamp((positions_mm[..., 1] / self.voxel_spacing).long(),
+                                0, int(self.volume_dimensions_voxels[1]) - 1)
+        elevation_map_mm = torch.as_tensor(np.array(self.deformation_elevation_map_mm), dtype=torch.float,
+                                           device=self.torch_device)
+        return elevation_map_mm[x_indices, y_indices]
+
     @abstractmethod
     def get_enclosed_indices(self):
         """
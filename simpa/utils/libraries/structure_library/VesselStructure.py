@@ -37,6 +37,11 @@ class VesselStructure(GeometricalStructure):
 
     """
 
+    # the vessel tree is drawn from the global numpy random state and thus has to be constructed in order
+    supports_concurrent_construction = False
+    # the random walk of the vessel tree proceeds in steps of one voxel
+    supports_any_spacing = False
+
     def get_params_from_settings(self, single_structure_settings):
         params = (single_structure_settings[Tags.STRUCTURE_START_MM],
                   single_structure_settings[Tags.STRUCTURE_RADIUS_MM],
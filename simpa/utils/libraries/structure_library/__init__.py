@@ -3,6 +3,8 @@
 # SPDX-License-Identifier: MIT
 
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 import torch
 from simpa.log import Logger
 from simpa.utils import Settings, Tags
@@ -15,6 +17,8 @@ from simpa.utils.libraries.structure_library.EllipticalTubularStructure import E
     define_elliptical_tubular_structure_settings
 from simpa.utils.libraries.structure_library.HorizontalLayerStructure import HorizontalLayerStructure, \
     define_horizontal_layer_structure_settings
+from simpa.utils.libraries.structure_library.MeshStructure import MeshStructure, \
+    define_mesh_structure_settings
 from simpa.utils.libraries.structure_library.ParallelepipedStructure import ParallelepipedStructure, \
     define_parallelepiped_structure_settings
 from simpa.utils.libraries.structure_library.RectangularCuboidStructure import RectangularCuboidStructure, \
@@ -27,7 +31,12 @@ from simpa.utils.libraries.structure_library.VesselStructure import VesselStruct
 
 def priority_sorted_structures(settings: Settings, volume_creator_settings: dict):
     """
-    A generator function to lazily construct structures in descending order of priority
+    A generator function to lazily construct structures in descending order of priority.
+
+    If Tags.NUMBER_OF_STRUCTURE_WORKERS is larger than one in the volume creator settings, the geometry of the
+    upcoming structures is constructed concurrently in a thread pool while the structures are still yielded in
+    descending order of priority. Structures that do not support concurrent construction (e.g. because they draw
+    from the global numpy random state) are constructed in order in the calling thread.
     """
     logger = Logger()
     if not Tags.STRUCTURES in volume_creator_settings:
@@ -36,16 +45,61 @@ def priority_sorted_structures(settings: Settings, volume_creator_settings: dict
     sorted_structure_settings = sorted(
         [structure_setting for structure_setting in volume_creator_settings[Tags.STRUCTURES].values()],
         key=lambda s: s[Tags.PRIORITY] if Tags.PRIORITY in s else 0, reverse=True)
-    for structure_setting in sorted_structure_settings:
-        try:
-            structure_class = globals()[structure_setting[Tags.STRUCTURE_TYPE]]
-            yield structure_class(settings, structure_setting)
+
+    if Tags.NUMBER_OF_STRUCTURE_WORKERS in volume_creator_settings:
+        number_of_workers = max(1, int(volume_creator_settings[Tags.NUMBER_OF_STRUCTURE_WORKERS]))
+    else:
+        number_of_workers = 1
+
+    if number_of_workers == 1:
+        for structure_setting in sorted_structure_settings:
+            yield construct_structure(settings, structure_setting)
             torch.cuda.empty_cache()
-        except Exception as e:
-            logger.critical("An exception has occurred while trying to parse " +
-                            str(structure_setting[Tags.STRUCTURE_TYPE]) +
-                            " from the dictionary.")
-            logger.critical("The structure type was " + str(structure_setting[Tags.STRUCTURE_TYPE]))
-            logger.critical(traceback.format_exc())
-            logger.critical("trying to continue as normal...")
-            raise e
+        return
+
+    with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+        # each entry is either a future of a structure or the settings of a structure that is constructed in order
+        in_flight = deque()
+        remaining_structure_settings = iter(sorted_structure_settings)
+        while True:
+            while len(in_flight) < number_of_workers:
+                structure_setting = next(remaining_structure_settings, None)
+                if structure_setting is None:
+                    break
+                if get_structure_class(structure_setting).supports_concurrent_construction:
+                    in_flight.append(executor.submit(construct_structure, settings, structure_setting))
+                else:
+                    in_flight.append(structure_setting)
+            if not in_flight:
+                break
+            next_structure = in_flight.popleft()
+            if isinstance(next_structure, Future):
+                yield next_structure.result()
+            else:
+                yield construct_structure(settings, next_structure)
+            torch.cuda.empty_cache()
+
+
+def get_structure_class(structure_setting: dict):
+    """
+    :param structure_setting: the settings of a single structure
+    :return: the GeometricalStructure class defined by Tags.STRUCTURE_TYPE
+    """
+    return globals()[structure_setting[Tags.STRUCTURE_TYPE]]
+
+
+def construct_structure(settings: Settings, structure_setting: dict):
+    """
+    Constructs the structure defined by the given structure settings.
+    """
+    try:
+        return get_structure_class(structure_setting)(settings, structure_setting)
+    except Exception as e:
+        logger = Logger()
+        logger.critical("An exception has occurred while trying to parse " +
+                        str(structure_setting[Tags.STRUCTURE_TYPE]) +
+                        " from the dictionary.")
+        logger.critical("The structure type was " + str(structure_setting[Tags.STRUCTURE_TYPE]))
+        logger.critical(traceback.format_exc())
+        logger.critical("trying to continue as normal...")
+        raise e
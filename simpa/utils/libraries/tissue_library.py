@@ -2,14 +2,72 @@
 # SPDX-FileCopyrightText: 2021 Janek Groehl
 # SPDX-License-Identifier: MIT
 
+import copy
 from simpa.utils import OpticalTissueProperties, SegmentationClasses, StandardProperties, MolecularCompositionGenerator
 from simpa.utils import Molecule
 from simpa.utils import MOLECULE_LIBRARY
+from simpa.utils.libraries.molecule_library import MolecularComposition
 from simpa.utils.libraries.spectrum_library import AnisotropySpectrumLibrary, ScatteringSpectrumLibrary
 from simpa.utils.calculate import randomize_uniform
 from simpa.utils.libraries.spectrum_library import AbsorptionSpectrumLibrary
 
 
+class TissuePreset(object):
+    """
+    The molecules of a tissue of the TissueLibrary, which are created and compiled only once. Variants of the tissue
+    with other volume fractions are mixed from these endmembers: the molecules are shallow copies that share the
+    spectra, and the compositions share the evaluated spectra of the compiled endmembers.
+    """
+
+    def __init__(self, molecular_composition: MolecularComposition):
+        """
+        :param molecular_composition: a valid composition of the molecules of the tissue
+        """
+        self.segmentation_type = molecular_composition.segmentation_type
+        self.molecules = list(molecular_composition)
+        self.endmembers = molecular_composition.compile()
+
+    def get_molecular_composition(self, volume_fractions: list) -> MolecularComposition:
+        """
+        :param volume_fractions: the volume fraction of every molecule of the preset
+        :return: a new MolecularComposition of copies of the molecules with the given volume fractions
+        """
+        if len(volume_fractions) != len(self.molecules):
+            raise ValueError(f"The preset consists of {len(self.molecules)} molecules, but {len(volume_fractions)} "
+                             f"volume fractions were given.")
+        molecular_composition = MolecularComposition(segmentation_type=self.segmentation_type)
+        for molecule, volume_fraction in zip(self.molecules, volume_fractions):
+            molecule = copy.copy(molecule)
+            molecule.volume_fraction = volume_fraction
+            molecular_composition.append(molecule)
+        molecular_composition.endmembers = self.endmembers
+        return molecular_composition
+
+
+MAXIMUM_NUMBER_OF_TISSUE_PRESETS = 256
+"""
+Maximum number of cached tissue presets. Presets of e.g. constant tissues are keyed by their optical properties.
+"""
+
+_tissue_presets = dict()
+
+
+def get_tissue_preset(preset_key: tuple, create_molecular_composition) -> TissuePreset:
+    """
+    :param preset_key: a hashable key that identifies the molecules of the preset
+    :param create_molecular_composition: function without arguments that creates a valid composition of the
+        molecules, which is only called if the preset is not cached yet
+    :return: the cached TissuePreset
+    """
+    tissue_preset = _tissue_presets.get(preset_key)
+    if tissue_preset is None:
+        tissue_preset = TissuePreset(create_molecular_composition())
+        if len(_tissue_presets) >= MAXIMUM_NUMBER_OF_TISSUE_PRESETS:
+            _tissue_presets.clear()
+        _tissue_presets[preset_key] = tissue_preset
+    return tissue_preset
+
+
 class TissueLibrary(object):
     """
     TODO
@@ -25,14 +83,16 @@ class TissueLibrary(object):
         """
         TODO
         """
-        return (MolecularCompositionGenerator().append(Molecule(name="constant_mua_mus_g",
-                                                                absorption_spectrum=AbsorptionSpectrumLibrary().CONSTANT_ABSORBER_ARBITRARY(mua),
-                                                                volume_fraction=1.0,
-                                                                scattering_spectrum=ScatteringSpectrumLibrary.
-                                                                CONSTANT_SCATTERING_ARBITRARY(mus),
-                                                                anisotropy_spectrum=AnisotropySpectrumLibrary.
-                                                                CONSTANT_ANISOTROPY_ARBITRARY(g)))
-                .get_molecular_composition(SegmentationClasses.GENERIC))
+        return get_tissue_preset(("constant", mua, mus, g), lambda: (
+            MolecularCompositionGenerator().append(Molecule(name="constant_mua_mus_g",
+                                                            absorption_spectrum=AbsorptionSpectrumLibrary().
+                                                            CONSTANT_ABSORBER_ARBITRARY(mua),
+                                                            volume_fraction=1.0,
+                                                            scattering_spectrum=ScatteringSpectrumLibrary.
+                                                            CONSTANT_SCATTERING_ARBITRARY(mus),
+                                                            anisotropy_spectrum=AnisotropySpectrumLibrary.
+                                                            CONSTANT_ANISOTROPY_ARBITRARY(g)))
+            .get_molecular_composition(SegmentationClasses.GENERIC))).get_molecular_composition([1.0])
 
     def muscle(self, background_oxy=None, blood_volume_fraction=None):
         """
@@ -57,25 +117,32 @@ class TissueLibrary(object):
         # Get the water volume fraction
         water_volume_fraction = OpticalTissueProperties.WATER_VOLUME_FRACTION_HUMAN_BODY
 
-        custom_water = MOLECULE_LIBRARY.water(water_volume_fraction)
-        custom_water.anisotropy_spectrum = AnisotropySpectrumLibrary.CONSTANT_ANISOTROPY_ARBITRARY(
-            OpticalTissueProperties.STANDARD_ANISOTROPY - 0.005)
-        custom_water.alpha_coefficient = 1.58
-        custom_water.speed_of_sound = StandardProperties.SPEED_OF_SOUND_MUSCLE + 16
-        custom_water.density = StandardProperties.DENSITY_MUSCLE + 41
-        custom_water.mus500 = OpticalTissueProperties.MUS500_MUSCLE_TISSUE
-        custom_water.b_mie = OpticalTissueProperties.BMIE_MUSCLE_TISSUE
-        custom_water.f_ray = OpticalTissueProperties.FRAY_MUSCLE_TISSUE
+        volume_fractions = [fraction_oxy, fraction_deoxy,
+                            1 - fraction_oxy - fraction_deoxy - water_volume_fraction, water_volume_fraction]
+
+        def create_molecular_composition():
+            custom_water = MOLECULE_LIBRARY.water(water_volume_fraction)
+            custom_water.anisotropy_spectrum = AnisotropySpectrumLibrary.CONSTANT_ANISOTROPY_ARBITRARY(
+                OpticalTissueProperties.STANDARD_ANISOTROPY - 0.005)
+            custom_water.alpha_coefficient = 1.58
+            custom_water.speed_of_sound = StandardProperties.SPEED_OF_SOUND_MUSCLE + 16
+            custom_water.density = StandardProperties.DENSITY_MUSCLE + 41
+            custom_water.mus500 = OpticalTissueProperties.MUS500_MUSCLE_TISSUE
+            custom_water.b_mie = OpticalTissueProperties.BMIE_MUSCLE_TISSUE
+            custom_water.f_ray = OpticalTissueProperties.FRAY_MUSCLE_TISSUE
+
+            return (MolecularCompositionGenerator()
+                    .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+                    .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+                    .append(value=MOLECULE_LIBRARY.muscle_scatterer(
+                            volume_fraction=1 - fraction_oxy - fraction_deoxy - water_volume_fraction),
+                            key="muscle_scatterers")
+                    .append(custom_water)
+                    .get_molecular_composition(SegmentationClasses.MUSCLE))
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
-                .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
-                .append(value=MOLECULE_LIBRARY.muscle_scatterer(
-                        volume_fraction=1 - fraction_oxy - fraction_deoxy - water_volume_fraction),
-                        key="muscle_scatterers")
-                .append(custom_water)
-                .get_molecular_composition(SegmentationClasses.MUSCLE))
+        return get_tissue_preset(("muscle", ), create_molecular_composition).get_molecular_composition(
+            volume_fractions)
 
     def soft_tissue(self, background_oxy=None, blood_volume_fraction=None):
         """
@@ -102,25 +169,32 @@ class TissueLibrary(object):
         # Get the water volume fraction
         water_volume_fraction = OpticalTissueProperties.WATER_VOLUME_FRACTION_HUMAN_BODY
 
-        custom_water = MOLECULE_LIBRARY.water(water_volume_fraction)
-        custom_water.anisotropy_spectrum = AnisotropySpectrumLibrary.CONSTANT_ANISOTROPY_ARBITRARY(
-            OpticalTissueProperties.STANDARD_ANISOTROPY - 0.005)
-        custom_water.alpha_coefficient = 0.08
-        custom_water.speed_of_sound = StandardProperties.SPEED_OF_SOUND_WATER
-        custom_water.density = StandardProperties.DENSITY_WATER
-        custom_water.mus500 = OpticalTissueProperties.MUS500_MUSCLE_TISSUE
-        custom_water.b_mie = OpticalTissueProperties.BMIE_MUSCLE_TISSUE
-        custom_water.f_ray = OpticalTissueProperties.FRAY_MUSCLE_TISSUE
+        volume_fractions = [fraction_oxy, fraction_deoxy,
+                            1 - fraction_oxy - fraction_deoxy - water_volume_fraction, water_volume_fraction]
+
+        def create_molecular_composition():
+            custom_water = MOLECULE_LIBRARY.water(water_volume_fraction)
+            custom_water.anisotropy_spectrum = AnisotropySpectrumLibrary.CONSTANT_ANISOTROPY_ARBITRARY(
+                OpticalTissueProperties.STANDARD_ANISOTROPY - 0.005)
+            custom_water.alpha_coefficient = 0.08
+            custom_water.speed_of_sound = StandardProperties.SPEED_OF_SOUND_WATER
+            custom_water.density = StandardProperties.DENSITY_WATER
+            custom_water.mus500 = OpticalTissueProperties.MUS500_MUSCLE_TISSUE
+            custom_water.b_mie = OpticalTissueProperties.BMIE_MUSCLE_TISSUE
+            custom_water.f_ray = OpticalTissueProperties.FRAY_MUSCLE_TISSUE
+
+            return (MolecularCompositionGenerator()
+                    .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+                    .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+                    .append(value=MOLECULE_LIBRARY.muscle_scatterer(
+                            volume_fraction=1 - fraction_oxy - fraction_deoxy - water_volume_fraction),
+                            key="muscle_scatterers")
+                    .append(custom_water)
+                    .get_molecular_composition(SegmentationClasses.SOFT_TISSUE))
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
-                .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
-                .append(value=MOLECULE_LIBRARY.muscle_scatterer(
-                        volume_fraction=1 - fraction_oxy - fraction_deoxy - water_volume_fraction),
-                        key="muscle_scatterers")
-                .append(custom_water)
-                .get_molecular_composition(SegmentationClasses.SOFT_TISSUE))
+        return get_tissue_preset(("soft_tissue", ), create_molecular_composition).get_molecular_composition(
+            volume_fractions)
 
     def epidermis(self, melanosom_volume_fraction=None):
         """
@@ -135,10 +209,12 @@ class TissueLibrary(object):
             melanin_volume_fraction = melanosom_volume_fraction
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.melanin(melanin_volume_fraction))
-                .append(MOLECULE_LIBRARY.epidermal_scatterer(1 - melanin_volume_fraction))
-                .get_molecular_composition(SegmentationClasses.EPIDERMIS))
+        return get_tissue_preset(("epidermis", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.melanin(melanin_volume_fraction))
+            .append(MOLECULE_LIBRARY.epidermal_scatterer(1 - melanin_volume_fraction))
+            .get_molecular_composition(SegmentationClasses.EPIDERMIS))).get_molecular_composition(
+            [melanin_volume_fraction, 1 - melanin_volume_fraction])
 
     def dermis(self, background_oxy=None, blood_volume_fraction=None):
         """
@@ -161,11 +237,13 @@ class TissueLibrary(object):
         [fraction_oxy, fraction_deoxy] = self.get_blood_volume_fractions(bvf, oxy)
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
-                .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
-                .append(MOLECULE_LIBRARY.dermal_scatterer(1.0 - bvf))
-                .get_molecular_composition(SegmentationClasses.DERMIS))
+        return get_tissue_preset(("dermis", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+            .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+            .append(MOLECULE_LIBRARY.dermal_scatterer(1.0 - bvf))
+            .get_molecular_composition(SegmentationClasses.DERMIS))).get_molecular_composition(
+            [fraction_oxy, fraction_deoxy, 1.0 - bvf])
 
     def subcutaneous_fat(self, oxy=OpticalTissueProperties.BACKGROUND_OXYGENATION):
         """
@@ -183,15 +261,18 @@ class TissueLibrary(object):
         # Determine fat volume fraction
         fat_volume_fraction = randomize_uniform(0.2, 1 - (water_volume_fraction + fraction_oxy + fraction_deoxy))
 
+        scatterer_volume_fraction = 1 - (fat_volume_fraction + water_volume_fraction + fraction_oxy + fraction_deoxy)
+
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
-                .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
-                .append(MOLECULE_LIBRARY.fat(fat_volume_fraction))
-                .append(MOLECULE_LIBRARY.soft_tissue_scatterer(
-                        1 - (fat_volume_fraction + water_volume_fraction + fraction_oxy + fraction_deoxy)))
-                .append(MOLECULE_LIBRARY.water(water_volume_fraction))
-                .get_molecular_composition(SegmentationClasses.FAT))
+        return get_tissue_preset(("subcutaneous_fat", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+            .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+            .append(MOLECULE_LIBRARY.fat(fat_volume_fraction))
+            .append(MOLECULE_LIBRARY.soft_tissue_scatterer(scatterer_volume_fraction))
+            .append(MOLECULE_LIBRARY.water(water_volume_fraction))
+            .get_molecular_composition(SegmentationClasses.FAT))).get_molecular_composition(
+            [fraction_oxy, fraction_deoxy, fat_volume_fraction, scatterer_volume_fraction, water_volume_fraction])
 
     def blood(self, oxygenation=None):
         """
@@ -206,10 +287,12 @@ class TissueLibrary(object):
         [fraction_oxy, fraction_deoxy] = self.get_blood_volume_fractions(1.0, oxygenation)
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
-                .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
-                .get_molecular_composition(SegmentationClasses.BLOOD))
+        return get_tissue_preset(("blood", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+            .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+            .get_molecular_composition(SegmentationClasses.BLOOD))).get_molecular_composition(
+            [fraction_oxy, fraction_deoxy])
 
     def bone(self):
         """
@@ -224,25 +307,30 @@ class TissueLibrary(object):
                                                   )
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.bone(1 - water_volume_fraction))
-                .append(MOLECULE_LIBRARY.water(water_volume_fraction))
-                .get_molecular_composition(SegmentationClasses.BONE))
+        return get_tissue_preset(("bone", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.bone(1 - water_volume_fraction))
+            .append(MOLECULE_LIBRARY.water(water_volume_fraction))
+            .get_molecular_composition(SegmentationClasses.BONE))).get_molecular_composition(
+            [1 - water_volume_fraction, water_volume_fraction])
 
     def mediprene(self):
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.mediprene())
-                .get_molecular_composition(SegmentationClasses.MEDIPRENE))
+        return get_tissue_preset(("mediprene", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.mediprene())
+            .get_molecular_composition(SegmentationClasses.MEDIPRENE))).get_molecular_composition([1.0])
 
     def heavy_water(self):
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.heavy_water())
-                .get_molecular_composition(SegmentationClasses.HEAVY_WATER))
+        return get_tissue_preset(("heavy_water", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.heavy_water())
+            .get_molecular_composition(SegmentationClasses.HEAVY_WATER))).get_molecular_composition([1.0])
 
     def ultrasound_gel(self):
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.water())
-                .get_molecular_composition(SegmentationClasses.ULTRASOUND_GEL))
+        return get_tissue_preset(("ultrasound_gel", ), lambda: (
+            MolecularCompositionGenerator()
+            .append(MOLECULE_LIBRARY.water())
+            .get_molecular_composition(SegmentationClasses.ULTRASOUND_GEL))).get_molecular_composition([1.0])
 
     def lymph_node(self, oxy=None, blood_volume_fraction=None):
         """
@@ -264,17 +352,21 @@ class TissueLibrary(object):
         # Get the water volume fraction
         # water_volume_fraction = OpticalTissueProperties.WATER_VOLUME_FRACTION_HUMAN_BODY
 
-        lymphatic_fluid = MOLECULE_LIBRARY.water(1 - fraction_deoxy - fraction_oxy)
-        lymphatic_fluid.speed_of_sound = StandardProperties.SPEED_OF_SOUND_LYMPH_NODE + 1.22
-        lymphatic_fluid.density = StandardProperties.DENSITY_LYMPH_NODE - 2.30
-        lymphatic_fluid.alpha_coefficient = StandardProperties.ALPHA_COEFF_LYMPH_NODE + 0.36
+        def create_molecular_composition():
+            lymphatic_fluid = MOLECULE_LIBRARY.water(1 - fraction_deoxy - fraction_oxy)
+            lymphatic_fluid.speed_of_sound = StandardProperties.SPEED_OF_SOUND_LYMPH_NODE + 1.22
+            lymphatic_fluid.density = StandardProperties.DENSITY_LYMPH_NODE - 2.30
+            lymphatic_fluid.alpha_coefficient = StandardProperties.ALPHA_COEFF_LYMPH_NODE + 0.36
+
+            return (MolecularCompositionGenerator()
+                    .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+                    .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+                    .append(lymphatic_fluid)
+                    .get_molecular_composition(SegmentationClasses.LYMPH_NODE))
 
         # generate the tissue dictionary
-        return (MolecularCompositionGenerator()
-                .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
-                .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
-                .append(lymphatic_fluid)
-                .get_molecular_composition(SegmentationClasses.LYMPH_NODE))
+        return get_tissue_preset(("lymph_node", ), create_molecular_composition).get_molecular_composition(
+            [fraction_oxy, fraction_deoxy, 1 - fraction_deoxy - fraction_oxy])
 
 
 TISSUE_LIBRARY = TissueLibrary()
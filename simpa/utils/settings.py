@@ -87,6 +87,17 @@ class Settings(dict, SerializableSIMPAClass):
         """
         self[Tags.OPTICAL_MODEL_SETTINGS] = Settings(optical_settings)
 
+    def get_optical_spacing_mm(self):
+        """
+        Returns the voxel spacing of the optical forward model, which is Tags.SPACING_MM of the optical settings if
+        it is given and the global Tags.SPACING_MM otherwise
+        """
+        if Tags.OPTICAL_MODEL_SETTINGS in self:
+            optical_settings = self[Tags.OPTICAL_MODEL_SETTINGS]
+            if Tags.SPACING_MM in optical_settings and optical_settings[Tags.SPACING_MM]:
+                return optical_settings[Tags.SPACING_MM]
+        return self[Tags.SPACING_MM]
+
     def get_volume_creation_settings(self):
         """"
         Returns the settings for the optical forward model that are saved in this settings dictionary
@@ -141,6 +152,10 @@ class Settings(dict, SerializableSIMPAClass):
         """
         self[Tags.RECONSTRUCTION_MODEL_SETTINGS] = Settings(reconstruction_settings)
 
+    def __reduce__(self):
+        # the items are restored without the sanity check of the tags, which has already been passed
+        return Settings.deserialize, (dict(self), ), {"verbose": self.verbose}
+
     def serialize(self):
         return {"Settings": dict(self)}
 
@@ -110,12 +110,56 @@ class Tags:
     Usage: module volume_creation_module, naming convention
     """
 
+    COMPACT_VOLUME_REPRESENTATION = ("compact_volume_representation", (bool, np.bool_))
+    """
+    If True, the volume creator does not store the dense property volumes, but a per-voxel map of structure labels
+    and their volume fractions together with per-structure property tables. Dense property volumes are materialized
+    on demand by load_data_field.
+    False by default.\n
+    Usage: module volume_creation_module, module io_handling
+    """
+
+    NUMBER_OF_STRUCTURE_WORKERS = ("number_of_structure_workers", (int, np.integer))
+    """
+    Number of threads that construct the geometry of the structures concurrently. The structures are still merged in
+    descending order of priority. At most this many constructed structures are held in memory at the same time.
+    1 (serial construction) by default.\n
+    Usage: adapter versatile_volume_creator, function priority_sorted_structures
+    """
+
     INPUT_SEGMENTATION_VOLUME = ("input_segmentation_volume", np.ndarray)
     """
     Array that defines a segmented volume.\n
     Usage: adapter segmentation_based_volume_creator
     """
 
+    INPUT_SEGMENTATION_VOLUME_PATH = ("input_segmentation_volume_path", str)
+    """
+    Path to a file that contains the segmented volume. Can be used instead of INPUT_SEGMENTATION_VOLUME to avoid
+    storing the array in the settings. Supported are .npy files (memory-mapped), HDF5 files (.hdf5, .h5) together with
+    INPUT_SEGMENTATION_VOLUME_DATASET, and raw binary files together with INPUT_SEGMENTATION_VOLUME_SHAPE and
+    INPUT_SEGMENTATION_VOLUME_DTYPE.\n
+    Usage: adapter segmentation_based_volume_creator
+    """
+
+    INPUT_SEGMENTATION_VOLUME_DATASET = ("input_segmentation_volume_dataset", str)
+    """
+    Path of the dataset within the HDF5 file given by INPUT_SEGMENTATION_VOLUME_PATH.\n
+    Usage: adapter segmentation_based_volume_creator
+    """
+
+    INPUT_SEGMENTATION_VOLUME_SHAPE = ("input_segmentation_volume_shape", (list, tuple, np.ndarray))
+    """
+    Shape (x, y, z) of the raw segmentation volume given by INPUT_SEGMENTATION_VOLUME_PATH.\n
+    Usage: adapter segmentation_based_volume_creator
+    """
+
+    INPUT_SEGMENTATION_VOLUME_DTYPE = ("input_segmentation_volume_dtype", str)
+    """
+    Data type (e.g. "uint8") of the raw segmentation volume given by INPUT_SEGMENTATION_VOLUME_PATH.\n
+    Usage: adapter segmentation_based_volume_creator
+    """
+
     SEGMENTATION_CLASS_MAPPING = ("segmentation_class_mapping", dict)
     """
     Mapping that assigns every class in the INPUT_SEGMENTATION_VOLUME a MOLECULE_COMPOSITION.\n
@@ -192,6 +236,15 @@ class Tags:
     If True, the structure will be generated with its edges only occupying a partial volume of the voxel.\n
     Usage: adapter versatile_volume_creation
     """
+    PARTIAL_VOLUME_SUPERSAMPLING = ("partial_volume_supersampling", (int, np.integer))
+    """
+    If set, structures that define a signed distance function are rasterised from it. Voxels that are intersected by
+    the surface of the structure get their volume fraction from k x k x k subvoxel samples, where k is the given
+    number. For k = 1, the fraction is approximated in closed form from the distance of the voxel center. Can be set
+    for a single structure or for all structures in the volume creation settings. A MeshStructure casts k x k rays
+    per voxel column instead.\n
+    Usage: adapter versatile_volume_creation
+    """
     CONSIDER_PARTIAL_VOLUME_IN_DEVICE = ("consider_partial_volume_in_device", bool)
     """
     If True, the structures inside the device (i.e. US gel and membrane) will be generated with its edges
@@ -283,6 +336,26 @@ class Tags:
     Usage: adapter versatile_volume_creation, class VesselStructure
     """
 
+    STRUCTURE_MESH_PATH = ("structure_mesh_path", str)
+    """
+    Path to the STL (binary or ASCII) or OBJ file with the closed triangle mesh of a MeshStructure.\n
+    Usage: adapter versatile_volume_creation, class MeshStructure
+    """
+
+    STRUCTURE_MESH_SCALE = ("structure_mesh_scale", Number)
+    """
+    Factor that converts the vertex coordinates of a mesh into mm.
+    1 by default.\n
+    Usage: adapter versatile_volume_creation, class MeshStructure
+    """
+
+    STRUCTURE_MESH_TRANSLATION_MM = ("structure_mesh_translation_mm", (list, tuple, np.ndarray))
+    """
+    [x, y, z] translation in mm that is applied to the vertices of a mesh after scaling.
+    [0, 0, 0] by default.\n
+    Usage: adapter versatile_volume_creation, class MeshStructure
+    """
+
     VESSEL_STRUCTURE = "VesselStructure"
 
     """
@@ -361,6 +434,37 @@ class Tags:
     Usage: module optical_simulation_module
     """
 
+    OPTICAL_MODEL_CACHE_DIRECTORY = ("optical_model_cache_directory", str)
+    """
+    Directory in which the results of the optical forward model are cached on disk. If it is given, the forward model
+    is not run again for the same optical properties, illumination geometry, and optical model settings. Note that
+    this also repeats the results of Monte Carlo models, which are only reproducible if a seed is given.\n
+    Usage: module optical_simulation_module
+    """
+
+    OPTICAL_MODEL_CACHE_MAXIMUM_SIZE_MB = ("optical_model_cache_maximum_size_mb", Number)
+    """
+    Maximum total size of the cached results of the optical forward model in megabytes. The least recently used
+    results are deleted first. 1024 by default.\n
+    Usage: module optical_simulation_module
+    """
+
+    OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW = ("optical_model_crop_to_field_of_view", (bool, np.bool_))
+    """
+    If True, the initial pressure is only computed and the fluence is only stored within the field of view of the
+    detection geometry, enlarged by Tags.OPTICAL_MODEL_FIELD_OF_VIEW_PADDING_MM. The forward model itself still runs
+    on the whole volume. The position of the stored region is saved as Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET.\n
+    Usage: module optical_simulation_module
+    """
+
+    OPTICAL_MODEL_FIELD_OF_VIEW_PADDING_MM = ("optical_model_field_of_view_padding_mm", Number)
+    """
+    Margin in mm by which the field of view is enlarged on every side if Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW is
+    True, e.g. to keep the initial pressure of nearby sources that are picked up by the acoustic simulation.
+    0 by default.\n
+    Usage: module optical_simulation_module
+    """
+
     LASER_PULSE_ENERGY_IN_MILLIJOULE = ("laser_pulse_energy_in_millijoule", (int, np.integer, float, list,
                                                                              range, tuple, np.ndarray))
     """
@@ -400,6 +504,64 @@ class Tags:
     Usage: module optical_modelling, adapter mcx_adapter
     """
 
+    MCX_SCRATCH_DIRECTORY = ("mcx_scratch_directory", str)
+    """
+    Directory in which the input and output files of MCX are temporarily stored. By default, the memory-backed
+    /dev/shm is used if it is available and the simulation path otherwise.\n
+    Usage: module optical_modelling, adapter mcx_adapter
+    """
+
+    MCX_NUMBER_OF_PARALLEL_RUNS = ("mcx_number_of_parallel_runs", (int, np.integer))
+    """
+    Maximum number of MCX processes that simulate the illumination geometries of a device concurrently.
+    1 (one illumination geometry after the other) by default.\n
+    Usage: module optical_modelling, adapter mcx_adapter
+    """
+
+    MONTE_CARLO_NUMBER_OF_WORKERS = ("monte_carlo_number_of_workers", (int, np.integer))
+    """
+    Number of processes that propagate the photon batches of the CPU Monte Carlo simulation concurrently.
+    1 (simulation in the calling process) by default.\n
+    Usage: module optical_modelling, adapter monte_carlo_adapter
+    """
+
+    MONTE_CARLO_PHOTON_BATCH_SIZE = ("monte_carlo_photon_batch_size", (int, np.integer))
+    """
+    Number of photons that are propagated together in one batch of the CPU Monte Carlo simulation. Every batch
+    draws from its own random stream. 10000 by default.\n
+    Usage: module optical_modelling, adapter monte_carlo_adapter
+    """
+
+    MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR = ("monte_carlo_target_relative_standard_error", Number)
+    """
+    If given, the CPU Monte Carlo simulation stops as soon as the relative standard error of the fluence in the
+    convergence region drops below this value, and Tags.OPTICAL_MODEL_NUMBER_PHOTONS is the maximum number of photons
+    per illumination geometry. The standard errors are estimated from the spread of the fluence of the photon
+    batches.\n
+    Usage: module optical_modelling, adapter monte_carlo_adapter
+    """
+
+    MONTE_CARLO_CONVERGENCE_REGION_MM = ("monte_carlo_convergence_region_mm", (list, tuple, np.ndarray))
+    """
+    Region [xs, xe, ys, ye, zs, ze] in mm in which the relative standard error of the fluence is evaluated in the
+    adaptive mode of the CPU Monte Carlo simulation. By default, the field of view of the detection geometry of a
+    photoacoustic device is used and the whole volume if there is none.\n
+    Usage: module optical_modelling, adapter monte_carlo_adapter
+    """
+
+    DIFFUSION_SOLVER_TOLERANCE = ("diffusion_solver_tolerance", Number)
+    """
+    Relative tolerance of the residual at which the conjugate gradient solver of the diffusion equation stops.
+    1e-5 by default.\n
+    Usage: module optical_modelling, adapter diffusion_adapter
+    """
+
+    DIFFUSION_SOLVER_MAXIMUM_ITERATIONS = ("diffusion_solver_maximum_iterations", (int, np.integer))
+    """
+    Maximum number of iterations of the conjugate gradient solver of the diffusion equation. 10000 by default.\n
+    Usage: module optical_modelling, adapter diffusion_adapter
+    """
+
     ILLUMINATION_TYPE = ("optical_model_illumination_type", str)
     """
     Type of the illumination geometry used in mcx.\n
@@ -554,6 +716,12 @@ class Tags:
     Usage: module optical_simulation_module, naming convention
     """
 
+    OPTICAL_MODEL_MONTE_CARLO = "monte_carlo"
+    """
+    Corresponds to the Monte Carlo simulation of the MonteCarloAdapter.\n
+    Usage: module optical_simulation_module, module algorithms (iterative_qPAI_algorithm.py), naming convention
+    """
+
     OPTICAL_MODEL_TEST = "simpa_tests"
     """
     Corresponds to an adapter for testing purposes only.\n
@@ -898,6 +1066,26 @@ class Tags:
     Usage: adapter KwaveAcousticForwardModel, adapter TimeReversalAdapter, naming convention
     """
 
+    DATA_FIELD_COMPACT_VOLUME = "compact_volume"
+    """
+    Compact representation of the generated volume that contains the structure labels per voxel, their volume
+    fractions, and the tables of the wavelength-independent properties per structure.\n
+    Usage: module volume_creation_module, module io_handling, naming convention
+    """
+
+    DATA_FIELD_PROPERTY_TABLE = "property_table"
+    """
+    Tables of the wavelength-dependent properties per structure that belong to the DATA_FIELD_COMPACT_VOLUME.\n
+    Usage: module volume_creation_module, module io_handling, naming convention
+    """
+
+    DATA_FIELD_OPTICAL_GRID_PROPERTIES = "optical_grid_properties"
+    """
+    The absorption, scattering, and anisotropy volumes at the spacing of the optical forward model, which are created
+    if Tags.SPACING_MM in the optical model settings differs from the global Tags.SPACING_MM.\n
+    Usage: module volume_creation_module, module optical_simulation_module, naming convention
+    """
+
     KWAVE_PROPERTY_SENSOR_MASK = "sensor_mask"
     """
     Sensor mask of kwave of the used PA device.\n
@@ -925,8 +1113,11 @@ class Tags:
     # Volume geometry settings
     SPACING_MM = ("voxel_spacing_mm", Number)
     """
-    Isotropic extent of one voxels in mm in the generated volume.\n
-    Usage: SIMPA package
+    Isotropic extent of one voxels in mm in the generated volume.
+    If given in the optical model settings, the optical forward model is simulated on a grid with this spacing and the
+    fluence is linearly upsampled to the volume before the initial pressure is computed. The fluence is smooth, such
+    that a two to four times coarser optical grid usually suffices.\n
+    Usage: SIMPA package, module optical_simulation_module
     """
 
     DIM_VOLUME_X_MM = ("volume_x_dim_mm", Number)
@@ -1202,6 +1393,12 @@ class Tags:
     Usage: module volume_creation_module, naming_convention
     """
 
+    MESH_STRUCTURE = "MeshStructure"
+    """
+    Corresponds to the MeshStructure in the structure_library.\n
+    Usage: module volume_creation_module, naming_convention
+    """
+
     STRUCTURE_TYPE = ("structure_type", str)
     """
     Defines the structure type to one structure in the structure_library.\n
@@ -1440,6 +1637,14 @@ class Tags:
     Usage: simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_reflectance_adapter
     """
 
+    COMPUTE_PHOTON_EXIT_IMAGE = "save_photon_exit_image"
+    """
+    Flag that indicates if the exit positions of the detected photons should be binned into an image on the x-y grid
+    of the volume while the MCX output is read. Only the image is kept, the positions and directions of the single
+    photons are stored only if COMPUTE_PHOTON_DIRECTION_AT_EXIT is set as well.
+    Usage: simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_reflectance_adapter
+    """
+
     DATA_FIELD_DIFFUSE_REFLECTANCE = "diffuse_reflectance"
     """
     Identifier for the diffuse reflectance values at the surface of the volume (interface to 0-values voxels) 
@@ -1466,3 +1671,23 @@ class Tags:
     are detected.
     Usage: simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_reflectance_adapter
     """
+
+    DATA_FIELD_PHOTON_EXIT_IMAGE = "photon_exit_image"
+    """
+    Identifier for the fraction of the simulated photons that exit the volume through each voxel of the x-y grid,
+    averaged over all illumination geometries. Currently only photon exiting along the Z axis are detected.
+    Usage: simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_reflectance_adapter
+    """
+
+    DATA_FIELD_NUMBER_OF_PHOTONS = "number_of_photons"
+    """
+    Identifier for the number of photons that were simulated in total for all illumination geometries.
+    Usage: simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter
+    """
+
+    DATA_FIELD_OPTICAL_OUTPUT_OFFSET = "optical_output_offset"
+    """
+    Identifier for the voxel indices of the first voxel of the region within which the fluence and the initial
+    pressure are stored if Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW is True.
+    Usage: simpa.core.simulation_modules.optical_simulation_module, simpa.io_handling
+    """
@@ -105,3 +105,22 @@ class TestBoxes(unittest.TestCase):
         self.assertAlmostEqual(bs.geometrical_volume[0, 0, 3], 0.25 ** 2)
         self.assertAlmostEqual(bs.geometrical_volume[1, 0, 3], 0.5 ** 2)
         self.assertAlmostEqual(bs.geometrical_volume[2, 0, 3], 0.25 ** 2)
+
+    def test_box_structure_fractions_are_restricted_to_the_bounding_region(self):
+        self.box_settings[Tags.STRUCTURE_START_MM] = [0.75, 1, 0.75]
+        self.box_settings[Tags.STRUCTURE_X_EXTENT_MM] = 1.5
+        self.box_settings[Tags.STRUCTURE_Y_EXTENT_MM] = 2
+        self.box_settings[Tags.STRUCTURE_Z_EXTENT_MM] = 2.5
+        bs = RectangularCuboidStructure(self.global_settings, self.box_settings)
+        indices, values = bs.get_enclosed_indices()
+        self.assertEqual(indices, (slice(0, 3), slice(1, 4), slice(0, 4)))
+        self.assertEqual(values.shape, (3, 3, 4))
+        self.assertAlmostEqual(bs.geometrical_volume.sum(), 1.5 * 2 * 2.5)
+        self.assertEqual(bs.geometrical_volume[:, 0].sum(), 0)
+        self.assertEqual(bs.geometrical_volume[:, 3:].sum(), 0)
+
+        self.box_settings[Tags.CONSIDER_PARTIAL_VOLUME] = False
+        bs = RectangularCuboidStructure(self.global_settings, self.box_settings)
+        self.assertEqual(bs.geometrical_volume.sum(), 1 * 2 * 2)
+        self.assertEqual(bs.geometrical_volume[1, 1, 1], 1)
+        self.assertEqual(bs.geometrical_volume[1, 1, 2], 1)
@@ -85,3 +85,15 @@ class TestLayers(unittest.TestCase):
         self.layer_settings[Tags.STRUCTURE_END_MM] = [0, 0, 1.8]
         ls = HorizontalLayerStructure(self.global_settings, self.layer_settings)
         self.assert_values(ls.geometrical_volume, [0, 0.8, 0, 0, 0, 0])
+
+    def test_layer_structure_fractions_are_a_depth_profile(self):
+        self.layer_settings[Tags.STRUCTURE_START_MM] = [0, 0, 1.2]
+        self.layer_settings[Tags.STRUCTURE_END_MM] = [0, 0, 3.5]
+        ls = HorizontalLayerStructure(self.global_settings, self.layer_settings)
+        indices, values = ls.get_enclosed_indices()
+        self.assertEqual(indices, (slice(None), slice(None), slice(1, 4)))
+        self.assertEqual(values.shape, (1, 1, 3))
+        for x in range(2):
+            for y in range(2):
+                self.assertEqual(list(ls.geometrical_volume[x, y]), list(ls.geometrical_volume[0, 0]))
+        self.assert_values(ls.geometrical_volume, [0, 0.8, 1, 0.5, 0, 0])
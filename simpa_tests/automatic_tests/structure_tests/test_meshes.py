@@ -0,0 +1,146 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils.libraries.tissue_library import TISSUE_LIBRARY
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import MeshStructure, RectangularCuboidStructure, \
+    define_mesh_structure_settings, define_rectangular_cuboid_structure_settings, priority_sorted_structures
+from simpa.utils.libraries.structure_library.MeshStructure import load_triangle_mesh
+
+
+class TestMeshes(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.global_settings = Settings()
+        self.global_settings[Tags.SPACING_MM] = 0.5
+        self.global_settings[Tags.DIM_VOLUME_X_MM] = 10
+        self.global_settings[Tags.DIM_VOLUME_Y_MM] = 10
+        self.global_settings[Tags.DIM_VOLUME_Z_MM] = 10
+        self.global_settings[Tags.GPU] = False
+        self.global_settings.set_volume_creation_settings({})
+
+        corners = np.asarray([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64)
+        quads = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+        self.cube_triangles = np.asarray([[corners[quad[0]], corners[quad[corner]], corners[quad[corner + 1]]]
+                                          for quad in quads for corner in (1, 2)])
+
+        # closed UV sphere with radius 1 around the origin
+        rings, segments = 40, 80
+        vertices = [[0, 0, 1]]
+        for theta in np.linspace(0, np.pi, rings + 1)[1:-1]:
+            for phi in np.linspace(0, 2 * np.pi, segments, endpoint=False):
+                vertices.append([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)])
+        vertices.append([0, 0, -1])
+        faces = [[0, 1 + segment, 1 + (segment + 1) % segments] for segment in range(segments)]
+        for ring in range(rings - 2):
+            for segment in range(segments):
+                first = 1 + ring * segments + segment
+                second = 1 + ring * segments + (segment + 1) % segments
+                faces += [[first, first + segments, second], [second, first + segments, second + segments]]
+        last_ring = 1 + (rings - 2) * segments
+        faces += [[last_ring + segment, len(vertices) - 1, last_ring + (segment + 1) % segments]
+                  for segment in range(segments)]
+        self.sphere_triangles = np.asarray(vertices)[np.asarray(faces)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_binary_stl(self, triangles, file_name="mesh.stl"):
+        file_path = os.path.join(self.directory, file_name)
+        records = np.zeros(len(triangles), dtype=np.dtype([("normal", "<f4", (3, )), ("vertices", "<f4", (3, 3)),
+                                                           ("attributes", "<u2")]))
+        records["vertices"] = triangles
+        with open(file_path, "wb") as stl_file:
+            stl_file.write(b"solid binary".ljust(80))
+            stl_file.write(np.uint32(len(triangles)).tobytes())
+            stl_file.write(records.tobytes())
+        return file_path
+
+    def write_ascii_stl(self, triangles, file_name="mesh_ascii.stl"):
+        file_path = os.path.join(self.directory, file_name)
+        with open(file_path, "w") as stl_file:
+            stl_file.write("solid ascii\n")
+            for triangle in triangles:
+                stl_file.write("facet normal 0 0 0\nouter loop\n")
+                for vertex in triangle:
+                    stl_file.write("vertex {} {} {}\n".format(*vertex))
+                stl_file.write("endloop\nendfacet\n")
+            stl_file.write("endsolid ascii\n")
+        return file_path
+
+    def write_obj(self, file_name="cube.obj"):
+        file_path = os.path.join(self.directory, file_name)
+        with open(file_path, "w") as obj_file:
+            for x in (0, 1):
+                for y in (0, 1):
+                    for z in (0, 1):
+                        obj_file.write(f"v {x} {y} {z}\n")
+            obj_file.write("vn 0 0 1\n")
+            for quad in [(1, 2, 4, 3), (5, 7, 8, 6), (1, 5, 6, 2), (3, 4, 8, 7), (1, 3, 7, 5), (2, 6, 8, 4)]:
+                obj_file.write("f " + " ".join(f"{vertex}//1" for vertex in quad) + "\n")
+        return file_path
+
+    def test_mesh_files_are_loaded(self):
+        binary_triangles = load_triangle_mesh(self.write_binary_stl(self.cube_triangles))
+        ascii_triangles = load_triangle_mesh(self.write_ascii_stl(self.cube_triangles))
+        obj_triangles = load_triangle_mesh(self.write_obj())
+        self.assertEqual(binary_triangles.shape, (12, 3, 3))
+        np.testing.assert_allclose(binary_triangles, self.cube_triangles)
+        np.testing.assert_allclose(ascii_triangles, self.cube_triangles)
+        self.assertEqual(obj_triangles.shape, (12, 3, 3))
+        self.assertAlmostEqual(np.abs(np.linalg.det(obj_triangles)).sum() / 6, 1)
+
+    def test_voxel_aligned_cube_equals_rectangular_cuboid(self):
+        mesh_path = self.write_obj()
+        mesh = MeshStructure(self.global_settings, define_mesh_structure_settings(
+            mesh_path, TISSUE_LIBRARY.muscle(), scale=3, translation_mm=[2, 3.5, 1], consider_partial_volume=True))
+        cuboid = RectangularCuboidStructure(self.global_settings, define_rectangular_cuboid_structure_settings(
+            [2, 3.5, 1], [3, 3, 3], TISSUE_LIBRARY.muscle(), consider_partial_volume=True))
+        np.testing.assert_allclose(mesh.geometrical_volume, cuboid.geometrical_volume, atol=1e-6)
+
+        mesh = MeshStructure(self.global_settings, define_mesh_structure_settings(
+            mesh_path, TISSUE_LIBRARY.muscle(), scale=3, translation_mm=[2, 3.5, 1], consider_partial_volume=False))
+        np.testing.assert_array_equal(mesh.geometrical_volume, cuboid.geometrical_volume)
+
+    def test_partial_volume_fractions_of_shifted_cube(self):
+        # the vertices and the diagonals of the faces pass exactly through rays
+        mesh_settings = define_mesh_structure_settings(self.write_ascii_stl(self.cube_triangles),
+                                                       TISSUE_LIBRARY.muscle(), scale=3.5,
+                                                       translation_mm=[0.125, 0.125, 0.3],
+                                                       consider_partial_volume=True)
+        mesh_settings[Tags.PARTIAL_VOLUME_SUPERSAMPLING] = 2
+        mesh = MeshStructure(self.global_settings, mesh_settings)
+        self.assertAlmostEqual(float(mesh.geometrical_volume.sum()) * 0.5 ** 3, 3.5 ** 3, places=4)
+        np.testing.assert_allclose(mesh.geometrical_volume[3, 3, :9], [0.4, 1, 1, 1, 1, 1, 1, 0.6, 0], atol=1e-5)
+        np.testing.assert_allclose(mesh.geometrical_volume[:9, 3, 3], [1, 1, 1, 1, 1, 1, 1, 0, 0], atol=1e-6)
+
+    def test_sphere_volume(self):
+        triangles = self.sphere_triangles * 3 + 5
+        mesh_volume_mm3 = np.sum(np.linalg.det(triangles - 5)) / 6
+        mesh = MeshStructure(self.global_settings, define_mesh_structure_settings(
+            self.write_binary_stl(triangles), TISSUE_LIBRARY.muscle(), consider_partial_volume=True))
+        self.assertAlmostEqual(float(mesh.geometrical_volume.sum()) * 0.5 ** 3 / mesh_volume_mm3, 1, places=2)
+        self.assertEqual(mesh.geometrical_volume[10, 10, 10], 1)
+        self.assertEqual(mesh.geometrical_volume[0, 0, 0], 0)
+
+    def test_mesh_is_merged_by_priority(self):
+        self.global_settings.set_volume_creation_settings({
+            Tags.STRUCTURES: {
+                "cuboid": define_rectangular_cuboid_structure_settings([0, 0, 0], [10, 10, 5], TISSUE_LIBRARY.muscle(),
+                                                                       priority=1),
+                "mesh": define_mesh_structure_settings(self.write_binary_stl(self.sphere_triangles * 3 + 5),
+                                                       TISSUE_LIBRARY.blood(), priority=5)
+            }
+        })
+        structures = list(priority_sorted_structures(self.global_settings,
+                                                     self.global_settings.get_volume_creation_settings()))
+        self.assertIsInstance(structures[0], MeshStructure)
+        self.assertIsInstance(structures[1], RectangularCuboidStructure)
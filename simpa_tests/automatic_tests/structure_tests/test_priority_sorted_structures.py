@@ -0,0 +1,56 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils.libraries.tissue_library import TISSUE_LIBRARY
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import priority_sorted_structures, \
+    define_background_structure_settings, define_circular_tubular_structure_settings, \
+    define_spherical_structure_settings, define_vessel_structure_settings
+
+
+class TestPrioritySortedStructures(unittest.TestCase):
+
+    def setUp(self):
+        self.global_settings = Settings()
+        self.global_settings[Tags.SPACING_MM] = 0.5
+        self.global_settings[Tags.DIM_VOLUME_X_MM] = 10
+        self.global_settings[Tags.DIM_VOLUME_Y_MM] = 8
+        self.global_settings[Tags.DIM_VOLUME_Z_MM] = 10
+
+        structures = dict()
+        structures["background"] = define_background_structure_settings(TISSUE_LIBRARY.muscle())
+        for index in range(6):
+            structures[f"tube_{index}"] = define_circular_tubular_structure_settings(
+                [1 + index * 1.5, 0, 3 + index], [1 + index * 1.5, 8, 3 + index], TISSUE_LIBRARY.blood(),
+                radius_mm=0.5 + 0.1 * index, priority=10 + index, consider_partial_volume=True)
+            structures[f"vessel_{index}"] = define_vessel_structure_settings(
+                [1 + index * 1.5, 0, 6], [0, 1, 0], TISSUE_LIBRARY.blood(), radius_mm=0.7, priority=20 + index,
+                bifurcation_length_mm=4, consider_partial_volume=True)
+        structures["sphere"] = define_spherical_structure_settings([5, 4, 5], TISSUE_LIBRARY.bone(), radius_mm=2,
+                                                                   priority=15, consider_partial_volume=True)
+        self.volume_creation_settings = Settings({Tags.STRUCTURES: structures})
+
+    def construct_structures(self, number_of_workers):
+        self.volume_creation_settings[Tags.NUMBER_OF_STRUCTURE_WORKERS] = number_of_workers
+        self.global_settings.set_volume_creation_settings(self.volume_creation_settings)
+        np.random.seed(4711)
+        return [(structure.priority, type(structure), structure.geometrical_volume)
+                for structure in priority_sorted_structures(self.global_settings, self.volume_creation_settings)]
+
+    def test_concurrent_construction_matches_serial_construction(self):
+        serial_structures = self.construct_structures(1)
+        concurrent_structures = self.construct_structures(4)
+
+        self.assertEqual(len(serial_structures), 14)
+        self.assertEqual([priority for priority, _, _ in serial_structures],
+                         sorted([priority for priority, _, _ in serial_structures], reverse=True))
+        self.assertEqual(len(serial_structures), len(concurrent_structures))
+        for (serial_priority, serial_type, serial_volume), (priority, structure_type, volume) in \
+                zip(serial_structures, concurrent_structures):
+            self.assertEqual(serial_priority, priority)
+            self.assertEqual(serial_type, structure_type)
+            np.testing.assert_array_equal(serial_volume, volume)
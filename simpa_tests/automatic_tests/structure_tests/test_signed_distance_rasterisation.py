@@ -0,0 +1,82 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils.libraries.tissue_library import TISSUE_LIBRARY
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import SphericalStructure, CircularTubularStructure, \
+    EllipticalTubularStructure, HorizontalLayerStructure, RectangularCuboidStructure
+
+
+class TestSignedDistanceRasterisation(unittest.TestCase):
+
+    def setUp(self):
+        self.global_settings = Settings()
+        self.global_settings[Tags.SPACING_MM] = 0.5
+        self.global_settings[Tags.DIM_VOLUME_X_MM] = 10
+        self.global_settings[Tags.DIM_VOLUME_Y_MM] = 10
+        self.global_settings[Tags.DIM_VOLUME_Z_MM] = 10
+        self.global_settings.set_volume_creation_settings({Tags.STRUCTURES: {}})
+
+        self.structure_settings = Settings()
+        self.structure_settings[Tags.MOLECULE_COMPOSITION] = TISSUE_LIBRARY.muscle()
+        self.structure_settings[Tags.CONSIDER_PARTIAL_VOLUME] = True
+        self.structure_settings[Tags.ADHERE_TO_DEFORMATION] = False
+        self.structure_settings[Tags.PARTIAL_VOLUME_SUPERSAMPLING] = 4
+
+    def occupied_volume_mm3(self, structure):
+        volume = structure.geometrical_volume
+        self.assertTrue(np.all((volume >= 0) & (volume <= 1)))
+        return np.sum(volume) * self.global_settings[Tags.SPACING_MM] ** 3
+
+    def test_sphere(self):
+        self.structure_settings[Tags.STRUCTURE_START_MM] = [5.1, 4.9, 5.2]
+        self.structure_settings[Tags.STRUCTURE_RADIUS_MM] = 3
+        sphere = SphericalStructure(self.global_settings, self.structure_settings)
+        self.assertAlmostEqual(self.occupied_volume_mm3(sphere), 4 / 3 * np.pi * 27, delta=0.01 * 4 / 3 * np.pi * 27)
+        self.assertEqual(sphere.geometrical_volume[10, 10, 10], 1)
+        self.assertEqual(sphere.geometrical_volume[0, 0, 0], 0)
+
+    def test_closed_form_fractions(self):
+        self.structure_settings[Tags.PARTIAL_VOLUME_SUPERSAMPLING] = 1
+        self.structure_settings[Tags.STRUCTURE_START_MM] = [5.1, 4.9, 5.2]
+        self.structure_settings[Tags.STRUCTURE_RADIUS_MM] = 3
+        sphere = SphericalStructure(self.global_settings, self.structure_settings)
+        self.assertAlmostEqual(self.occupied_volume_mm3(sphere), 4 / 3 * np.pi * 27, delta=0.02 * 4 / 3 * np.pi * 27)
+
+    def test_tubes(self):
+        self.structure_settings[Tags.STRUCTURE_START_MM] = [5.1, 0, 4.8]
+        self.structure_settings[Tags.STRUCTURE_END_MM] = [5.1, 10, 4.8]
+        self.structure_settings[Tags.STRUCTURE_RADIUS_MM] = 2
+        tube = CircularTubularStructure(self.global_settings, self.structure_settings)
+        self.assertAlmostEqual(self.occupied_volume_mm3(tube), np.pi * 4 * 10, delta=0.01 * np.pi * 4 * 10)
+
+        self.structure_settings[Tags.STRUCTURE_ECCENTRICITY] = 0.8
+        tube = EllipticalTubularStructure(self.global_settings, self.structure_settings)
+        self.assertAlmostEqual(self.occupied_volume_mm3(tube), np.pi * 4 * 10, delta=0.02 * np.pi * 4 * 10)
+
+    def test_layer_and_cuboid(self):
+        # the closed-form fractions are exact for planes that are aligned with the voxel grid
+        self.structure_settings[Tags.PARTIAL_VOLUME_SUPERSAMPLING] = 1
+        self.structure_settings[Tags.STRUCTURE_START_MM] = [0, 0, 2.1]
+        self.structure_settings[Tags.STRUCTURE_END_MM] = [0, 0, 3.4]
+        layer = HorizontalLayerStructure(self.global_settings, self.structure_settings)
+        np.testing.assert_allclose(np.sum(layer.geometrical_volume, axis=2) * 0.5, 1.3, atol=1e-5)
+
+        self.structure_settings[Tags.PARTIAL_VOLUME_SUPERSAMPLING] = 4
+        self.structure_settings[Tags.STRUCTURE_START_MM] = [1.2, 2.3, 3.1]
+        self.structure_settings[Tags.STRUCTURE_X_EXTENT_MM] = 4
+        self.structure_settings[Tags.STRUCTURE_Y_EXTENT_MM] = -2
+        self.structure_settings[Tags.STRUCTURE_Z_EXTENT_MM] = 3.5
+        cuboid = RectangularCuboidStructure(self.global_settings, self.structure_settings)
+        self.assertAlmostEqual(self.occupied_volume_mm3(cuboid), 28, delta=0.01 * 28)
+
+    def test_without_partial_volume(self):
+        self.structure_settings[Tags.CONSIDER_PARTIAL_VOLUME] = False
+        self.structure_settings[Tags.STRUCTURE_START_MM] = [5, 5, 5]
+        self.structure_settings[Tags.STRUCTURE_RADIUS_MM] = 3
+        sphere = SphericalStructure(self.global_settings, self.structure_settings)
+        self.assertTrue(np.all(np.isin(sphere.geometrical_volume, [0, 1])))
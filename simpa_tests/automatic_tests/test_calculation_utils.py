@@ -9,6 +9,7 @@ from simpa.utils.calculate import calculate_oxygenation
 from simpa.utils.calculate import randomize_uniform
 from simpa.utils.calculate import calculate_gruneisen_parameter_from_temperature
 from simpa.utils.calculate import positive_gauss
+from simpa.utils.calculate import downsample_volume, upsample_volume
 import numpy as np
 
 
@@ -86,3 +87,21 @@ class TestCalculationUtils(unittest.TestCase):
             std = np.random.rand(1)[0]
             random_value = positive_gauss(mean, std)
             assert random_value > float(0), "positive Gauss value outside the desired range and negative"
+
+    def test_volume_resampling(self):
+        volume = np.arange(4 * 6 * 5, dtype=np.float64).reshape(4, 6, 5)
+        downsampled_volume = downsample_volume(volume, 2)
+        self.assertEqual(downsampled_volume.shape, (2, 3, 3))
+        self.assertAlmostEqual(downsampled_volume[0, 0, 0], volume[:2, :2, :2].mean())
+        self.assertAlmostEqual(downsampled_volume[1, 2, 2], volume[2:, 4:, 4].mean())
+        self.assertEqual(downsample_volume(volume, 2, (2, 3, 2)).shape, (2, 3, 2))
+
+        # a linear function is reproduced exactly between the outermost voxel centres of the coarse grid
+        x, y, z = np.meshgrid(np.arange(5) + 0.5, np.arange(3) + 0.5, np.arange(4) + 0.5, indexing="ij")
+        coarse_volume = 2 * x - y + 0.5 * z
+        fine_volume = upsample_volume(coarse_volume, (20, 12, 16), 1.0, 0.25)
+        x, y, z = np.meshgrid(np.arange(20) * 0.25 + 0.125, np.arange(12) * 0.25 + 0.125,
+                              np.arange(16) * 0.25 + 0.125, indexing="ij")
+        expected_volume = 2 * np.clip(x, 0.5, 4.5) - np.clip(y, 0.5, 2.5) + 0.5 * np.clip(z, 0.5, 3.5)
+        np.testing.assert_allclose(fine_volume, expected_volume, atol=1e-12)
+        np.testing.assert_allclose(upsample_volume(coarse_volume, coarse_volume.shape, 1.0, 1.0), coarse_volume)
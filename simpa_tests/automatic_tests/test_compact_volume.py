@@ -0,0 +1,82 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.tissue_properties import TissueProperties
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_horizontal_layer_structure_settings, define_circular_tubular_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field, load_hdf5
+from simpa.utils import get_data_field_from_simpa_output
+from simpa import ModelBasedVolumeCreationAdapter
+from simpa.core.device_digital_twins import RSOMExplorerP50
+
+
+class TestCompactVolume(unittest.TestCase):
+
+    def setUp(self):
+        self.wavelengths = [700, 800]
+        self.output_paths = []
+
+    def tearDown(self):
+        for output_path in self.output_paths:
+            if os.path.exists(output_path) and os.path.isfile(output_path):
+                os.remove(output_path)
+
+    def simulate_volume(self, compact: bool) -> str:
+        settings = Settings({
+            Tags.WAVELENGTHS: self.wavelengths,
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: "CompactVolumeTest_" + str(compact),
+            Tags.SIMULATION_PATH: ".",
+            Tags.SPACING_MM: 0.25,
+            Tags.DIM_VOLUME_Z_MM: 5,
+            Tags.DIM_VOLUME_X_MM: 4,
+            Tags.DIM_VOLUME_Y_MM: 3
+        })
+        structures = dict()
+        structures["background"] = define_background_structure_settings(TISSUE_LIBRARY.constant(0.1, 100, 0.9))
+        structures["layer"] = define_horizontal_layer_structure_settings(TISSUE_LIBRARY.epidermis(),
+                                                                         z_start_mm=1.1, thickness_mm=0.6,
+                                                                         priority=5, consider_partial_volume=True)
+        structures["vessel"] = define_circular_tubular_structure_settings([2.1, 0, 1.9], [2.1, 3, 1.9],
+                                                                          TISSUE_LIBRARY.blood(0.7), radius_mm=0.8,
+                                                                          priority=10,
+                                                                          consider_partial_volume=True)
+        settings.set_volume_creation_settings({
+            Tags.STRUCTURES: structures,
+            Tags.COMPACT_VOLUME_REPRESENTATION: compact
+        })
+        simulate([ModelBasedVolumeCreationAdapter(settings)], settings, RSOMExplorerP50(0.1, 1, 1))
+        self.output_paths.append(settings[Tags.SIMPA_OUTPUT_PATH])
+        return settings[Tags.SIMPA_OUTPUT_PATH]
+
+    def test_compact_volume_materializes_dense_volumes(self):
+        dense_path = self.simulate_volume(compact=False)
+        compact_path = self.simulate_volume(compact=True)
+
+        compact_file = load_hdf5(compact_path)
+        compact_volume = load_data_field(compact_path, Tags.DATA_FIELD_COMPACT_VOLUME)
+        self.assertGreater(np.shape(compact_volume["labels"])[3], 1)
+
+        for wavelength in self.wavelengths:
+            for property_tag in TissueProperties.property_tags:
+                dense = load_data_field(dense_path, property_tag, wavelength)
+                materialized = load_data_field(compact_path, property_tag, wavelength)
+                self.assertEqual(np.shape(dense), np.shape(materialized))
+                np.testing.assert_allclose(materialized, dense, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(get_data_field_from_simpa_output(compact_file, property_tag, wavelength),
+                                           dense, rtol=1e-5, atol=1e-6)
+
+    def test_compact_volume_stores_no_dense_volumes(self):
+        compact_file = load_hdf5(self.simulate_volume(compact=True))
+        simulation_properties = compact_file[Tags.SIMULATIONS][Tags.SIMULATION_PROPERTIES]
+        self.assertEqual(set(simulation_properties.keys()),
+                         {Tags.DATA_FIELD_COMPACT_VOLUME, Tags.DATA_FIELD_PROPERTY_TABLE})
+        self.assertEqual(set(simulation_properties[Tags.DATA_FIELD_PROPERTY_TABLE].keys()),
+                         {str(wavelength) for wavelength in self.wavelengths})
@@ -0,0 +1,65 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.tissue_library import TISSUE_LIBRARY
+from simpa.utils.libraries.structure_library import HorizontalLayerStructure
+from simpa.utils.deformation_manager import create_deformation_settings, get_functional_from_deformation_settings, \
+    get_deformation_elevation_map_mm
+
+
+class TestDeformationManager(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(4711)
+        self.deformation_settings = create_deformation_settings(bounds_mm=[[0, 10], [0, 8]],
+                                                                maximum_z_elevation_mm=3,
+                                                                filter_sigma=0,
+                                                                cosine_scaling_factor=1)
+
+    def test_functional_interpolates_knots(self):
+        functional = get_functional_from_deformation_settings(self.deformation_settings)
+        x_positions = self.deformation_settings[Tags.DEFORMATION_X_COORDINATES_MM][:, 0]
+        y_positions = self.deformation_settings[Tags.DEFORMATION_Y_COORDINATES_MM][0, :]
+        values = functional(x_positions, y_positions)
+        self.assertEqual(values.shape, (len(y_positions), len(x_positions)))
+        np.testing.assert_allclose(values.T, self.deformation_settings[Tags.DEFORMATION_Z_ELEVATIONS_MM], atol=1e-10)
+
+    def test_elevation_map_matches_functional_and_is_cached(self):
+        elevation_map = get_deformation_elevation_map_mm(self.deformation_settings, [20, 16, 5], 0.5)
+        functional = get_functional_from_deformation_settings(self.deformation_settings)
+        np.testing.assert_allclose(elevation_map, functional(np.arange(20) * 0.5, np.arange(16) * 0.5).T)
+        self.assertIs(get_deformation_elevation_map_mm(self.deformation_settings, [20, 16, 5], 0.5), elevation_map)
+        self.assertIsNot(get_deformation_elevation_map_mm(self.deformation_settings, [20, 16, 5], 0.25),
+                         elevation_map)
+        self.assertFalse(elevation_map.flags.writeable)
+
+    def test_deformed_layer_follows_elevation_map(self):
+        global_settings = Settings()
+        global_settings[Tags.SPACING_MM] = 0.5
+        global_settings[Tags.DIM_VOLUME_X_MM] = 10
+        global_settings[Tags.DIM_VOLUME_Y_MM] = 8
+        global_settings[Tags.DIM_VOLUME_Z_MM] = 10
+        global_settings.set_volume_creation_settings({
+            Tags.SIMULATE_DEFORMED_LAYERS: True,
+            Tags.DEFORMED_LAYERS_SETTINGS: self.deformation_settings
+        })
+        layer_settings = Settings()
+        layer_settings[Tags.STRUCTURE_START_MM] = [0, 0, 4]
+        layer_settings[Tags.STRUCTURE_END_MM] = [0, 0, 6]
+        layer_settings[Tags.MOLECULE_COMPOSITION] = TISSUE_LIBRARY.muscle()
+        layer_settings[Tags.ADHERE_TO_DEFORMATION] = True
+        layer_settings[Tags.CONSIDER_PARTIAL_VOLUME] = True
+        layer = HorizontalLayerStructure(global_settings, layer_settings)
+
+        elevation_map = get_deformation_elevation_map_mm(self.deformation_settings, [20, 16, 20], 0.5)
+        filled_thickness_mm = np.sum(layer.geometrical_volume, axis=2) * 0.5
+        np.testing.assert_allclose(filled_thickness_mm, 2, atol=1e-4)
+        # the layer is shifted downwards by the (non-positive) surface elevation
+        x_index, y_index = np.unravel_index(np.argmin(elevation_map), elevation_map.shape)
+        first_filled_voxel = np.argmax(layer.geometrical_volume[x_index, y_index] > 0)
+        self.assertAlmostEqual(first_filled_voxel * 0.5, 4 - elevation_map[x_index, y_index], delta=0.5)
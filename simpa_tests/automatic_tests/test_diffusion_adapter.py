@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_horizontal_layer_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field
+from simpa import ModelBasedVolumeCreationAdapter, DiffusionFluenceAdapter
+from simpa.core.device_digital_twins import DiskIlluminationGeometry
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_diffusion_adapter import \
+    get_diffusion_operator, apply_diffusion_operator, solve_diffusion_equation
+
+
+class TestDiffusionAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_operator_is_symmetric_and_positive_definite(self):
+        random_generator = np.random.default_rng(0)
+        shape = (7, 6, 5)
+        self_coefficients, face_coefficients = get_diffusion_operator(
+            torch.tensor(random_generator.uniform(0.01, 1, shape)),
+            torch.tensor(random_generator.uniform(0.1, 2, shape)), 0.5)
+        first, second = torch.tensor(random_generator.normal(size=shape)), \
+            torch.tensor(random_generator.normal(size=shape))
+        first_product = torch.sum(apply_diffusion_operator(first, self_coefficients, face_coefficients) * second)
+        second_product = torch.sum(first * apply_diffusion_operator(second, self_coefficients, face_coefficients))
+        self.assertAlmostEqual(float(first_product), float(second_product), places=10)
+        self.assertGreater(float(torch.sum(first * apply_diffusion_operator(first, self_coefficients,
+                                                                            face_coefficients))), 0)
+
+    def test_point_source_in_homogeneous_medium(self):
+        shape, spacing_mm, absorption_per_mm, reduced_scattering_per_mm = (61, 61, 61), 0.25, 0.05, 1.0
+        source = np.zeros(shape)
+        source[30, 30, 30] = 1 / spacing_mm ** 3
+        fluence, iterations = solve_diffusion_equation(np.full(shape, absorption_per_mm),
+                                                       np.full(shape, reduced_scattering_per_mm), source,
+                                                       spacing_mm, tolerance=1e-6)
+        self.assertLess(iterations, 50)
+        diffusion_coefficient = 1 / (3 * (absorption_per_mm + reduced_scattering_per_mm))
+        effective_attenuation = np.sqrt(absorption_per_mm / diffusion_coefficient)
+        for distance_voxels in [4, 8, 16]:
+            distance_mm = distance_voxels * spacing_mm
+            expected = np.exp(-effective_attenuation * distance_mm) / (4 * np.pi * diffusion_coefficient * distance_mm)
+            self.assertAlmostEqual(float(fluence[30 + distance_voxels, 30, 30]) / expected, 1, delta=0.05)
+
+        warm_fluence, warm_iterations = solve_diffusion_equation(
+            np.full(shape, absorption_per_mm * 1.1), np.full(shape, reduced_scattering_per_mm), source, spacing_mm,
+            initial_fluence=fluence, tolerance=1e-6)
+        cold_fluence, cold_iterations = solve_diffusion_equation(
+            np.full(shape, absorption_per_mm * 1.1), np.full(shape, reduced_scattering_per_mm), source, spacing_mm,
+            tolerance=1e-6)
+        self.assertLess(warm_iterations, cold_iterations)
+        np.testing.assert_allclose(warm_fluence.numpy(), cold_fluence.numpy(), rtol=1e-3, atol=1e-6)
+
+    def test_simulation_pipeline(self):
+        settings = Settings({
+            Tags.WAVELENGTHS: [700, 800],
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: "DiffusionTest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 0.5,
+            Tags.DIM_VOLUME_X_MM: 10,
+            Tags.DIM_VOLUME_Y_MM: 9.5,
+            Tags.DIM_VOLUME_Z_MM: 8,
+            Tags.GPU: False
+        })
+        settings.set_volume_creation_settings({
+            Tags.STRUCTURES: {
+                "background": define_background_structure_settings(TISSUE_LIBRARY.muscle()),
+                "layer": define_horizontal_layer_structure_settings(TISSUE_LIBRARY.epidermis(),
+                                                                    z_start_mm=0, thickness_mm=1)
+            }
+        })
+        settings.set_optical_settings({Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 50000})
+        adapter = DiffusionFluenceAdapter(settings)
+        simulate([ModelBasedVolumeCreationAdapter(settings), adapter], settings,
+                 DiskIlluminationGeometry(beam_radius_mm=2, device_position_mm=np.array([5, 4.75, 0])))
+        self.assertEqual(len(adapter.previous_diffuse_fluences), 1)
+        # the initial guesses are kept on the CPU instead of the processing device
+        self.assertIsInstance(next(iter(adapter.previous_diffuse_fluences.values())), np.ndarray)
+
+        for wavelength in settings[Tags.WAVELENGTHS]:
+            fluence = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_FLUENCE, wavelength)
+            absorption = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM,
+                                         wavelength)
+            initial_pressure = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_INITIAL_PRESSURE,
+                                               wavelength)
+            self.assertEqual(fluence.shape, (20, 19, 16))
+            self.assertTrue(np.all(fluence > 0))
+            np.testing.assert_allclose(initial_pressure, absorption * fluence, rtol=1e-5)
+            # the beam is centred on voxel 9 along x, the fluence is symmetric around it and decays with depth and
+            # distance from the beam
+            self.assertAlmostEqual(np.sum(fluence[9 - 3]) / np.sum(fluence[9 + 3]), 1, delta=0.05)
+            self.assertGreater(fluence[10, 9, 4], fluence[10, 9, 12])
+            self.assertGreater(fluence[10, 9, 4], fluence[1, 9, 4])
+            # at most the energy of the beam is absorbed in the volume
+            self.assertLess(np.sum(absorption * fluence) * 0.05 ** 3, 1)
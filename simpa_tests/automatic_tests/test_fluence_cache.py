@@ -0,0 +1,112 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa.core.simulation_modules.optical_simulation_module import OpticalForwardModuleBase
+from simpa.core.simulation_modules.optical_simulation_module.fluence_cache import FluenceCache
+from simpa.core.device_digital_twins import PencilBeamIlluminationGeometry
+
+
+class CountingAdapter(OpticalForwardModuleBase):
+
+    def __init__(self, global_settings):
+        super(CountingAdapter, self).__init__(global_settings)
+        self.number_of_calls = 0
+
+    def forward_model(self, absorption_cm, scattering_cm, anisotropy, illumination_geometry):
+        self.number_of_calls += 1
+        source_position = illumination_geometry.get_mcx_illuminator_definition(self.global_settings)["Pos"]
+        return {Tags.DATA_FIELD_FLUENCE: absorption_cm * scattering_cm * (1 - anisotropy) * source_position[0]}
+
+
+class TestFluenceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_directory = tempfile.mkdtemp()
+        self.settings = Settings({
+            Tags.SPACING_MM: 1,
+            Tags.RANDOM_SEED: 4711
+        })
+        self.settings.set_optical_settings({
+            Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 1000,
+            Tags.OPTICAL_MODEL_CACHE_DIRECTORY: self.cache_directory
+        })
+        random_generator = np.random.default_rng(0)
+        self.absorption = random_generator.uniform(0.1, 1, (4, 5, 6))
+        self.scattering = random_generator.uniform(10, 100, (4, 5, 6))
+        self.anisotropy = np.full((4, 5, 6), 0.9)
+        self.illumination_geometries = [PencilBeamIlluminationGeometry(device_position_mm=np.array([x, 2, 0]))
+                                        for x in [0, 1, 2]]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+
+    def run_forward_model(self, absorption=None):
+        adapter = CountingAdapter(self.settings)
+        results = adapter.run_forward_model(_device=self.illumination_geometries,
+                                            device=self.illumination_geometries,
+                                            absorption=self.absorption if absorption is None else absorption,
+                                            scattering=self.scattering,
+                                            anisotropy=self.anisotropy)
+        return results[Tags.DATA_FIELD_FLUENCE], adapter.number_of_calls
+
+    def test_identical_inputs_are_not_simulated_again(self):
+        fluence, number_of_calls = self.run_forward_model()
+        self.assertEqual(number_of_calls, 3)
+        self.assertEqual(len(os.listdir(self.cache_directory)), 3)
+
+        cached_fluence, number_of_calls = self.run_forward_model()
+        self.assertEqual(number_of_calls, 0)
+        np.testing.assert_array_equal(fluence, cached_fluence)
+
+        absorption = self.absorption.copy()
+        absorption[1, 2, 3] *= 1.001
+        _, number_of_calls = self.run_forward_model(absorption)
+        self.assertEqual(number_of_calls, 3)
+
+        self.illumination_geometries[1] = PencilBeamIlluminationGeometry(device_position_mm=np.array([3, 2, 0]))
+        _, number_of_calls = self.run_forward_model()
+        self.assertEqual(number_of_calls, 1)
+
+        self.settings.get_optical_settings()[Tags.OPTICAL_MODEL_NUMBER_PHOTONS] = 2000
+        _, number_of_calls = self.run_forward_model()
+        self.assertEqual(number_of_calls, 3)
+
+        self.settings[Tags.RANDOM_SEED] = 1
+        _, number_of_calls = self.run_forward_model()
+        self.assertEqual(number_of_calls, 3)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        entry = {Tags.DATA_FIELD_FLUENCE: np.zeros(1000, dtype=np.float32)}
+        cache = FluenceCache(self.cache_directory, 1024 * 1024)
+        cache.store("first", entry)
+        entry_size_bytes = os.path.getsize(cache.get_path("first"))
+        os.remove(cache.get_path("first"))
+
+        cache = FluenceCache(self.cache_directory, 3 * entry_size_bytes)
+        for key in ["first", "second", "third"]:
+            cache.store(key, entry)
+            time.sleep(0.01)
+        self.assertIsNotNone(cache.load("first"))
+        time.sleep(0.01)
+        cache.store("fourth", entry)
+        self.assertEqual(sorted(os.listdir(self.cache_directory)), ["first.npz", "fourth.npz", "third.npz"])
+        self.assertIsNone(cache.load("second"))
+        np.testing.assert_array_equal(cache.load("fourth")[Tags.DATA_FIELD_FLUENCE], entry[Tags.DATA_FIELD_FLUENCE])
+
+    def test_key_depends_on_the_volume_contents(self):
+        volume = np.arange(24, dtype=np.float64).reshape(2, 3, 4)
+        key = FluenceCache.get_key({"volume": volume}, {"parameter": np.float64(1)})
+        self.assertEqual(key, FluenceCache.get_key({"volume": volume.copy()}, {"parameter": 1.0}))
+        self.assertEqual(key, FluenceCache.get_key({"volume": np.asfortranarray(volume)}, {"parameter": 1.0}))
+        self.assertNotEqual(key, FluenceCache.get_key({"volume": volume.reshape(4, 3, 2)}, {"parameter": 1.0}))
+        self.assertNotEqual(key, FluenceCache.get_key({"volume": volume.astype(np.float32)}, {"parameter": 1.0}))
+        self.assertNotEqual(key, FluenceCache.get_key({"volume": volume}, {"parameter": 2.0}))
@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_spherical_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field
+from simpa import ModelBasedVolumeCreationAdapter, MonteCarloAdapter, IterativeqPAI, GradientBasedqPAI
+from simpa.core.device_digital_twins import PhotoacousticDevice, DiskIlluminationGeometry
+
+
+class TestGradientBasedqPAI(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.settings = Settings({
+            Tags.WAVELENGTHS: [800],
+            Tags.WAVELENGTH: 800,
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: "GradientBasedqPAITest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 0.5,
+            Tags.DIM_VOLUME_X_MM: 4,
+            Tags.DIM_VOLUME_Y_MM: 4,
+            Tags.DIM_VOLUME_Z_MM: 4,
+            Tags.GPU: False
+        })
+        self.settings.set_volume_creation_settings({
+            Tags.STRUCTURES: {
+                "background": define_background_structure_settings(TISSUE_LIBRARY.constant(0.5, 50, 0.8)),
+                "sphere": define_spherical_structure_settings(
+                    start_mm=[2, 2, 1.5], radius_mm=0.75, molecular_composition=TISSUE_LIBRARY.constant(3, 50, 0.8))
+            }
+        })
+        self.settings.set_optical_settings({
+            Tags.OPTICAL_MODEL: Tags.OPTICAL_MODEL_MONTE_CARLO,
+            Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 10000
+        })
+        self.settings["iterative_qpai_reconstruction"] = {
+            Tags.DOWNSCALE_FACTOR: 1,
+            Tags.ITERATIVE_RECONSTRUCTION_CONSTANT_REGULARIZATION: True,
+            Tags.ITERATIVE_RECONSTRUCTION_REGULARIZATION_SIGMA: 1e-3,
+            Tags.ITERATIVE_RECONSTRUCTION_MAX_ITERATION_NUMBER: 10,
+            Tags.ITERATIVE_RECONSTRUCTION_SAVE_INTERMEDIATE_RESULTS: True,
+            Tags.ITERATIVE_RECONSTRUCTION_STOPPING_LEVEL: 1e-8
+        }
+        self.device = PhotoacousticDevice(device_position_mm=np.array([2, 2, 0]))
+        self.device.add_illumination_geometry(DiskIlluminationGeometry(beam_radius_mm=3))
+        simulate([ModelBasedVolumeCreationAdapter(self.settings), MonteCarloAdapter(self.settings)], self.settings,
+                 self.device)
+        self.absorption = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM,
+                                          800)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def reconstruct(self, reconstruction_component):
+        reconstruction_component(self.settings, "iterative_qpai_reconstruction").run(self.device)
+        reconstructed_absorption = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.ITERATIVE_qPAI_RESULT,
+                                                   800)
+        intermediate_absorptions = np.load(os.path.join(
+            self.output_directory, "List_reconstructed_qpai_absorptions_800_GradientBasedqPAITest.npy"))
+        return np.abs(reconstructed_absorption - self.absorption).max() / self.absorption.max(), \
+            intermediate_absorptions
+
+    def test_reconstruction_is_more_accurate_than_the_fixed_point_iteration(self):
+        # with the photons of the simulation, the absorption is the exact minimum of the squared error
+        error, intermediate_absorptions = self.reconstruct(GradientBasedqPAI)
+        self.assertLess(error, 1e-3)
+        self.assertLessEqual(len(intermediate_absorptions), 11)
+        np.testing.assert_allclose(intermediate_absorptions[-1], self.absorption[:, 4, :],
+                                   rtol=0, atol=1e-3 * self.absorption.max())
+
+        fixed_point_error, _ = self.reconstruct(IterativeqPAI)
+        self.assertLess(error, fixed_point_error / 10)
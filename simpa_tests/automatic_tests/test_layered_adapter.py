@@ -0,0 +1,98 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_horizontal_layer_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field
+from simpa import ModelBasedVolumeCreationAdapter, LayeredDiffusionAdapter
+from simpa.core.device_digital_twins import DiskIlluminationGeometry
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_diffusion_adapter import \
+    BOUNDARY_REFLECTION_PARAMETER, solve_diffusion_equation
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_layered_adapter import \
+    solve_layered_diffusion_equation, get_depth_profile
+
+
+class TestLayeredDiffusionAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.spacing_mm = 0.5
+        self.absorption_per_mm = np.concatenate([np.full(6, 0.3), np.full(14, 0.1)])
+        self.reduced_scattering_per_mm = np.concatenate([np.full(6, 2.0), np.full(14, 1.0)])
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_energy_is_conserved(self):
+        for direction_cosine in [1.0, 0.6]:
+            collimated_fluence, diffuse_fluence = solve_layered_diffusion_equation(
+                self.absorption_per_mm, self.reduced_scattering_per_mm, self.spacing_mm, direction_cosine)
+            absorbed = np.sum(self.absorption_per_mm * (collimated_fluence + diffuse_fluence)) * self.spacing_mm
+            transmitted = np.exp(-np.sum(self.absorption_per_mm + self.reduced_scattering_per_mm) *
+                                 self.spacing_mm / direction_cosine)
+            diffusion_coefficient = 1 / (3 * (self.absorption_per_mm + self.reduced_scattering_per_mm))
+            boundary_coefficients = 1 / (self.spacing_mm / (2 * diffusion_coefficient[[0, -1]]) +
+                                         2 * BOUNDARY_REFLECTION_PARAMETER)
+            escaped = np.sum(boundary_coefficients * diffuse_fluence[[0, -1]])
+            self.assertAlmostEqual(absorbed + transmitted + escaped, 1, places=10)
+
+    def test_agreement_with_three_dimensional_diffusion(self):
+        shape = (81, 81, 20)
+        collimated_fluence, diffuse_fluence = solve_layered_diffusion_equation(
+            self.absorption_per_mm, self.reduced_scattering_per_mm, self.spacing_mm)
+        absorption = np.ones(shape) * self.absorption_per_mm
+        reduced_scattering = np.ones(shape) * self.reduced_scattering_per_mm
+        source = np.ones(shape) * self.reduced_scattering_per_mm * collimated_fluence
+        volume_fluence, _ = solve_diffusion_equation(absorption, reduced_scattering, source, self.spacing_mm,
+                                                     tolerance=1e-7)
+        # far from the lateral boundaries of the volume, the fluence is that of a laterally infinite medium
+        np.testing.assert_allclose(volume_fluence.numpy()[40, 40], diffuse_fluence, rtol=1e-2)
+
+    def test_simulation_pipeline(self):
+        settings = Settings({
+            Tags.WAVELENGTHS: [700, 800],
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: "LayeredDiffusionTest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: self.spacing_mm,
+            Tags.DIM_VOLUME_X_MM: 10,
+            Tags.DIM_VOLUME_Y_MM: 9.5,
+            Tags.DIM_VOLUME_Z_MM: 8
+        })
+        settings.set_volume_creation_settings({
+            Tags.STRUCTURES: {
+                "background": define_background_structure_settings(TISSUE_LIBRARY.muscle()),
+                "layer": define_horizontal_layer_structure_settings(TISSUE_LIBRARY.epidermis(),
+                                                                    z_start_mm=0, thickness_mm=1)
+            }
+        })
+        settings.set_optical_settings({Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 10000})
+        simulate([ModelBasedVolumeCreationAdapter(settings), LayeredDiffusionAdapter(settings)], settings,
+                 DiskIlluminationGeometry(beam_radius_mm=2, device_position_mm=np.array([5, 4.75, 0])))
+
+        for wavelength in settings[Tags.WAVELENGTHS]:
+            fluence = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_FLUENCE, wavelength)
+            absorption = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM,
+                                         wavelength)
+            scattering = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_SCATTERING_PER_CM,
+                                         wavelength)
+            anisotropy = load_data_field(settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ANISOTROPY, wavelength)
+            self.assertEqual(fluence.shape, (20, 19, 16))
+            absorption_profile, is_layered = get_depth_profile(absorption / 10)
+            self.assertTrue(is_layered)
+            reduced_scattering_profile, _ = get_depth_profile(scattering * (1 - anisotropy) / 10)
+            collimated_fluence, diffuse_fluence = solve_layered_diffusion_equation(
+                absorption_profile, reduced_scattering_profile, self.spacing_mm)
+            # the whole beam hits the volume, such that the fluence integrated over each layer is the depth profile
+            np.testing.assert_allclose(np.sum(fluence, axis=(0, 1)) * self.spacing_mm ** 2 / 100,
+                                       collimated_fluence + diffuse_fluence, rtol=1e-5)
+            self.assertEqual(np.count_nonzero(fluence[:, :, 0]), np.count_nonzero(fluence[:, :, -1]))
+            self.assertGreater(fluence[10, 9, 4], fluence[10, 9, 12])
@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+import numpy as np
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa import MCXAdapter
+from simpa.core.device_digital_twins import PencilBeamIlluminationGeometry
+
+# Stands in for MCX: it checks the shared volume file, writes a fluence of the absorption times the x-position of the
+# source and logs when it ran.
+STAND_IN_SOLVER = """#!{executable}
+import json
+import sys
+import time
+import numpy as np
+
+start = time.time()
+with open(sys.argv[sys.argv.index("-f") + 1]) as json_file:
+    config = json.load(json_file)
+shape = config["Domain"]["Dim"]
+medium = np.fromfile(config["Domain"]["VolumeFile"], dtype=np.float32).reshape(shape + [2])
+fluence = medium[..., 0] * config["Optode"]["Source"]["Pos"][0]
+time.sleep(0.5)
+fluence.astype(np.float32).flatten(order="F").tofile(config["Session"]["ID"] + ".mc2")
+with open("{log_file}", "a") as log_file:
+    log_file.write(f"{{start}} {{time.time()}} {{config['Domain']['VolumeFile']}}\\n")
+"""
+
+
+class TestMCXParallelRuns(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.output_directory, "runs.log")
+        solver_path = os.path.join(self.output_directory, "mcx")
+        with open(solver_path, "w") as solver_file:
+            solver_file.write(STAND_IN_SOLVER.format(executable=sys.executable, log_file=self.log_file))
+        os.chmod(solver_path, os.stat(solver_path).st_mode | stat.S_IEXEC)
+
+        self.settings = Settings({
+            Tags.VOLUME_NAME: "ParallelTest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 1,
+        })
+        self.settings.set_optical_settings({
+            Tags.OPTICAL_MODEL_BINARY_PATH: solver_path,
+            Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 1
+        })
+        random_generator = np.random.default_rng(0)
+        self.absorption = random_generator.uniform(0.1, 1, (4, 5, 6))
+        self.scattering = np.full((4, 5, 6), 100.0)
+        self.anisotropy = np.full((4, 5, 6), 0.9)
+        self.illumination_geometries = [PencilBeamIlluminationGeometry(device_position_mm=np.array([x, 2, 0]))
+                                        for x in [0, 1, 2]]
+        mean_source_position = np.mean([geometry.get_mcx_illuminator_definition(self.settings)["Pos"][0]
+                                        for geometry in self.illumination_geometries])
+        self.expected_fluence = self.absorption / 10 * mean_source_position * 100
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def run_forward_model(self):
+        results = MCXAdapter(self.settings).run_forward_model(_device=self.illumination_geometries,
+                                                              device=self.illumination_geometries,
+                                                              absorption=self.absorption,
+                                                              scattering=self.scattering,
+                                                              anisotropy=self.anisotropy)
+        if not os.path.exists(self.log_file):
+            return results[Tags.DATA_FIELD_FLUENCE], []
+        with open(self.log_file) as log_file:
+            runs = [line.split() for line in log_file.readlines()]
+        os.remove(self.log_file)
+        return results[Tags.DATA_FIELD_FLUENCE], runs
+
+    def test_illumination_geometries_are_simulated_concurrently(self):
+        self.settings.get_optical_settings()[Tags.MCX_NUMBER_OF_PARALLEL_RUNS] = 3
+        fluence, runs = self.run_forward_model()
+
+        np.testing.assert_allclose(fluence, self.expected_fluence, rtol=1e-5)
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(len(set(volume_file for _, _, volume_file in runs)), 1)
+        self.assertLess(max(float(start) for start, _, _ in runs), min(float(end) for _, end, _ in runs))
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["mcx"])
+
+    def test_number_of_parallel_runs_is_limited(self):
+        self.settings.get_optical_settings()[Tags.MCX_NUMBER_OF_PARALLEL_RUNS] = 1
+        fluence, runs = self.run_forward_model()
+
+        np.testing.assert_allclose(fluence, self.expected_fluence, rtol=1e-5)
+        runs = sorted((float(start), float(end)) for start, end, _ in runs)
+        for (_, previous_end), (start, _) in zip(runs[:-1], runs[1:]):
+            self.assertLessEqual(previous_end, start)
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["mcx"])
+
+    def test_cached_illumination_geometries_are_not_simulated_again(self):
+        self.settings.get_optical_settings()[Tags.MCX_NUMBER_OF_PARALLEL_RUNS] = 3
+        self.settings.get_optical_settings()[Tags.OPTICAL_MODEL_CACHE_DIRECTORY] = \
+            os.path.join(self.output_directory, "cache")
+        fluence, runs = self.run_forward_model()
+        self.assertEqual(len(runs), 3)
+
+        cached_fluence, runs = self.run_forward_model()
+        self.assertEqual(len(runs), 0)
+        np.testing.assert_array_equal(fluence, cached_fluence)
+
+        self.illumination_geometries.append(PencilBeamIlluminationGeometry(device_position_mm=np.array([3, 2, 0])))
+        _, runs = self.run_forward_model()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["cache", "mcx"])
+
+    def test_temporary_files_are_kept_in_the_scratch_directory(self):
+        scratch_directory = os.path.join(self.output_directory, "scratch")
+        os.mkdir(scratch_directory)
+        self.settings.get_optical_settings()[Tags.MCX_SCRATCH_DIRECTORY] = scratch_directory
+        illumination_geometry = self.illumination_geometries[0]
+        source_position = illumination_geometry.get_mcx_illuminator_definition(self.settings)["Pos"][0]
+
+        results = MCXAdapter(self.settings).forward_model(absorption_cm=self.absorption,
+                                                          scattering_cm=self.scattering,
+                                                          anisotropy=self.anisotropy,
+                                                          illumination_geometry=illumination_geometry)
+        np.testing.assert_allclose(results[Tags.DATA_FIELD_FLUENCE], self.absorption / 10 * source_position * 100,
+                                   rtol=1e-5)
+        _, runs = self.run_forward_model()
+        self.assertTrue(all(volume_file.startswith(scratch_directory + "/") for _, _, volume_file in runs))
+        self.assertEqual(os.listdir(scratch_directory), [])
+
+        del self.settings.get_optical_settings()[Tags.MCX_SCRATCH_DIRECTORY]
+        _, runs = self.run_forward_model()
+        default_scratch_directory = "/dev/shm" if os.access("/dev/shm", os.W_OK) else self.output_directory
+        self.assertTrue(all(volume_file.startswith(default_scratch_directory + "/") for _, _, volume_file in runs))
+
+    def test_files_are_kept_in_the_simulation_path_if_dev_shm_is_too_small(self):
+        self.settings.get_optical_settings()[Tags.MCX_NUMBER_OF_PARALLEL_RUNS] = 3
+        adapter = MCXAdapter(self.settings)
+        # the medium and the fluence of three concurrent runs, including a padded layer
+        self.assertEqual(adapter.get_scratch_size_bytes((4, 5, 6), 3), 4 * 5 * 7 * 4 * (2 + 3))
+        if not os.access("/dev/shm", os.W_OK):
+            self.skipTest("/dev/shm is not available.")
+        self.assertEqual(adapter.get_scratch_directory(0), "/dev/shm")
+
+        free_bytes = adapter.get_scratch_size_bytes((4, 5, 6), 3) - 1
+        with patch("shutil.disk_usage", return_value=Mock(free=free_bytes)):
+            fluence, runs = self.run_forward_model()
+        np.testing.assert_allclose(fluence, self.expected_fluence, rtol=1e-5)
+        self.assertTrue(all(volume_file.startswith(self.output_directory + "/") for _, _, volume_file in runs))
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["mcx"])
@@ -0,0 +1,229 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags
+from simpa.utils.settings import Settings
+from simpa import MCXAdapterReflectance
+from simpa.core.device_digital_twins import PencilBeamIlluminationGeometry
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_mcx_reflectance_adapter import \
+    MCH_HEADER, iterate_mch_file, get_mch_columns, bin_photon_exit_positions, PhotonExitData
+
+
+def write_mch_block(mch_file, photons, save_detector_flag, total_number_of_photons, seed_bytes=0):
+    header = np.zeros(1, dtype=MCH_HEADER)
+    header["magic"] = b"MCXH"
+    header["version"] = 1
+    header["maxmedia"] = 1
+    header["detnum"] = 1
+    header["colcount"] = photons.shape[1]
+    header["totalphoton"] = total_number_of_photons
+    header["detected"] = len(photons)
+    header["savedphoton"] = len(photons)
+    header["unitinmm"] = 1
+    header["seedbyte"] = seed_bytes
+    header["normalizer"] = 1
+    header["respin"] = 1
+    header["srcnum"] = 1
+    header["savedetflag"] = save_detector_flag
+    mch_file.write(header.tobytes())
+    mch_file.write(photons.astype("<f4").tobytes())
+    mch_file.write(b"\xff" * (len(photons) * seed_bytes))
+
+
+# Stands in for MCX: it writes a fluence of the absorption times the x-position of the source with a reflectance of
+# 0.5 in the padded layer, and detected photons whose number depends on the source. The photons are also saved to a
+# .npy file to compare them with what the adapter read. Runs of sources with a smaller x-position take longer.
+STAND_IN_SOLVER = """#!{executable}
+import json
+import struct
+import sys
+import time
+import numpy as np
+
+with open(sys.argv[sys.argv.index("-f") + 1]) as json_file:
+    config = json.load(json_file)
+shape = config["Domain"]["Dim"]
+source_x = config["Optode"]["Source"]["Pos"][0]
+time.sleep({delay_s} * max(4 - source_x, 0))
+medium = np.fromfile(config["Domain"]["VolumeFile"], dtype=np.float32).reshape(shape + [2])
+fluence = np.nan_to_num(medium[..., 0]) * source_x
+fluence[:, :, 0] = -0.5
+fluence.astype(np.float32).flatten(order="F").tofile(config["Session"]["ID"] + ".mc2")
+
+save_exit_direction = sys.argv[sys.argv.index("--savedetflag") + 1] == "XV"
+random_generator = np.random.default_rng(int(source_x * 10))
+number_of_photons = 100 + int(source_x * 10)
+photons = random_generator.uniform(-1, 1, (number_of_photons, 6)).astype(np.float32)
+photons[:, 0] = random_generator.uniform(-0.5, shape[0] + 0.5, number_of_photons)
+photons[:, 1] = random_generator.uniform(0, shape[1], number_of_photons)
+photons[:, 2] = 0
+saved_photons = photons if save_exit_direction else photons[:, :3]
+with open(config["Session"]["ID"] + ".mch", "wb") as mch_file:
+    mch_file.write(b"MCXH" + struct.pack("<7IfIfiII2i", 1, 1, 1, saved_photons.shape[1],
+                                         config["Session"]["Photons"], number_of_photons, number_of_photons, 1.0, 0,
+                                         1.0, 1, 1, 48 if save_exit_direction else 16, 0, 0))
+    mch_file.write(saved_photons.tobytes())
+np.save("{output_directory}/photons_" + str(source_x) + ".npy", photons)
+"""
+
+
+class TestMCXPhotonExitData(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        solver_path = os.path.join(self.output_directory, "mcx")
+        self.write_solver(solver_path)
+
+        self.settings = Settings({
+            Tags.VOLUME_NAME: "PhotonExitTest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 1,
+        })
+        self.settings.set_optical_settings({
+            Tags.OPTICAL_MODEL_BINARY_PATH: solver_path,
+            Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 1000,
+            Tags.MCX_SCRATCH_DIRECTORY: self.output_directory
+        })
+        random_generator = np.random.default_rng(0)
+        self.absorption = random_generator.uniform(0.1, 1, (4, 5, 6))
+        self.scattering = np.full((4, 5, 6), 100.0)
+        self.anisotropy = np.full((4, 5, 6), 0.9)
+        self.illumination_geometries = [PencilBeamIlluminationGeometry(device_position_mm=np.array([x, 2, 0]))
+                                        for x in [0, 1, 2]]
+        self.source_positions = [geometry.get_mcx_illuminator_definition(self.settings)["Pos"][0]
+                                 for geometry in self.illumination_geometries]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def write_solver(self, solver_path, delay_s=0):
+        with open(solver_path, "w") as solver_file:
+            solver_file.write(STAND_IN_SOLVER.format(executable=sys.executable, output_directory=self.output_directory,
+                                                     delay_s=delay_s))
+        os.chmod(solver_path, os.stat(solver_path).st_mode | stat.S_IEXEC)
+
+    def get_photons(self, source_position):
+        return np.load(os.path.join(self.output_directory, f"photons_{source_position}.npy"))
+
+    def test_mch_file_is_read_in_chunks(self):
+        random_generator = np.random.default_rng(1)
+        first_photons = random_generator.normal(size=(10, 8)).astype(np.float32)
+        second_photons = random_generator.normal(size=(3, 8)).astype(np.float32)
+        path = os.path.join(self.output_directory, "test.mch")
+        with open(path, "wb") as mch_file:
+            # detector id, partial path length, exit position and exit direction
+            write_mch_block(mch_file, first_photons, 1 | 4 | 16 | 32, 100, seed_bytes=7)
+            write_mch_block(mch_file, np.zeros((0, 8)), 1 | 4 | 16 | 32, 50)
+            write_mch_block(mch_file, second_photons, 1 | 4 | 16 | 32, 100)
+
+        blocks = []
+        for header, photon_chunks in iterate_mch_file(path, chunk_size=4):
+            blocks.append((header, [photons for photons in photon_chunks]))
+        self.assertEqual([int(header["totalphoton"]) for header, _ in blocks], [100, 50, 100])
+        self.assertEqual([[len(photons) for photons in chunks] for _, chunks in blocks], [[4, 4, 2], [], [3]])
+        np.testing.assert_array_equal(np.concatenate(blocks[0][1]), first_photons)
+        np.testing.assert_array_equal(np.concatenate(blocks[2][1]), second_photons)
+
+        columns = get_mch_columns(blocks[0][0])
+        self.assertEqual(columns, {"detector_id": slice(0, 1), "partial_path_length": slice(1, 2),
+                                   "exit_position": slice(2, 5), "exit_direction": slice(5, 8)})
+
+        # the chunks of a block do not have to be read
+        headers = [header for header, _ in iterate_mch_file(path, chunk_size=4)]
+        self.assertEqual([int(header["savedphoton"]) for header in headers], [10, 0, 3])
+
+    def test_photon_exit_data_are_aggregated(self):
+        random_generator = np.random.default_rng(2)
+        positions = random_generator.uniform(-1, 6, (1000, 3))
+        image = np.zeros((4, 5))
+        photon_exit_data = PhotonExitData()
+        for start in range(0, 1000, 300):
+            bin_photon_exit_positions(image, positions[start:start + 300])
+            photon_exit_data.append(positions[start:start + 300], -positions[start:start + 300])
+        expected_image, _, _ = np.histogram2d(positions[:, 0], positions[:, 1], bins=[np.arange(5), np.arange(6)])
+        np.testing.assert_array_equal(image, expected_image)
+        self.assertEqual(photon_exit_data.number_of_photons, 1000)
+        np.testing.assert_allclose(photon_exit_data.positions, positions, rtol=1e-6)
+        np.testing.assert_allclose(photon_exit_data.directions, -positions, rtol=1e-6)
+
+    def test_photons_of_all_illumination_geometries_are_collected(self):
+        self.settings.get_optical_settings()[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT] = True
+        self.settings.get_optical_settings()[Tags.COMPUTE_DIFFUSE_REFLECTANCE] = True
+        results = MCXAdapterReflectance(self.settings).run_forward_model(_device=self.illumination_geometries,
+                                                                         device=self.illumination_geometries,
+                                                                         absorption=self.absorption,
+                                                                         scattering=self.scattering,
+                                                                         anisotropy=self.anisotropy)
+        np.testing.assert_allclose(results[Tags.DATA_FIELD_FLUENCE],
+                                   self.absorption / 10 * np.mean(self.source_positions) * 100, rtol=1e-5)
+        photons = np.concatenate([self.get_photons(source_position) for source_position in self.source_positions])
+        np.testing.assert_array_equal(results[Tags.DATA_FIELD_PHOTON_EXIT_POS], photons[:, :3])
+        np.testing.assert_array_equal(results[Tags.DATA_FIELD_PHOTON_EXIT_DIR], photons[:, 3:])
+        self.assertEqual(len(results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE]), 3 * 4 * 5)
+        np.testing.assert_allclose(results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE], 0.5)
+        self.assertNotIn(Tags.DATA_FIELD_PHOTON_EXIT_IMAGE, results)
+
+    def test_results_of_parallel_runs_are_in_the_order_of_the_illumination_geometries(self):
+        # the runs finish in the reverse order of the illumination geometries
+        self.write_solver(self.settings.get_optical_settings()[Tags.OPTICAL_MODEL_BINARY_PATH], delay_s=0.5)
+        self.settings.get_optical_settings()[Tags.MCX_NUMBER_OF_PARALLEL_RUNS] = 3
+        self.settings.get_optical_settings()[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT] = True
+        self.settings.get_optical_settings()[Tags.COMPUTE_DIFFUSE_REFLECTANCE] = True
+        adapter = MCXAdapterReflectance(self.settings)
+        completion_order = [index for index, _ in adapter.iterate_forward_model(
+            absorption_cm=self.absorption, scattering_cm=self.scattering, anisotropy=self.anisotropy,
+            illumination_geometries=self.illumination_geometries)]
+        self.assertEqual(completion_order, [2, 1, 0])
+
+        results = adapter.run_forward_model(_device=self.illumination_geometries,
+                                            device=self.illumination_geometries,
+                                            absorption=self.absorption,
+                                            scattering=self.scattering,
+                                            anisotropy=self.anisotropy)
+        photons = np.concatenate([self.get_photons(source_position) for source_position in self.source_positions])
+        np.testing.assert_array_equal(results[Tags.DATA_FIELD_PHOTON_EXIT_POS], photons[:, :3])
+        np.testing.assert_array_equal(results[Tags.DATA_FIELD_PHOTON_EXIT_DIR], photons[:, 3:])
+        self.assertEqual(len(results[Tags.DATA_FIELD_DIFFUSE_REFLECTANCE_POS]), 3 * 4 * 5)
+
+    def test_results_of_a_single_illumination_geometry_are_cached(self):
+        self.settings.get_optical_settings()[Tags.COMPUTE_PHOTON_DIRECTION_AT_EXIT] = True
+        self.settings.get_optical_settings()[Tags.COMPUTE_DIFFUSE_REFLECTANCE] = True
+        self.settings.get_optical_settings()[Tags.OPTICAL_MODEL_CACHE_DIRECTORY] = \
+            os.path.join(self.output_directory, "cache")
+        photon_file = os.path.join(self.output_directory, f"photons_{self.source_positions[0]}.npy")
+        all_results = []
+        for _ in range(2):
+            all_results.append(MCXAdapterReflectance(self.settings).run_forward_model(
+                _device=self.illumination_geometries[0], device=self.illumination_geometries[0],
+                absorption=self.absorption, scattering=self.scattering, anisotropy=self.anisotropy))
+            if len(all_results) == 1:
+                os.remove(photon_file)
+        # the solver only ran once
+        self.assertFalse(os.path.exists(photon_file))
+        self.assertEqual(all_results[0].keys(), all_results[1].keys())
+        for key in all_results[0]:
+            np.testing.assert_array_equal(all_results[0][key], all_results[1][key])
+
+    def test_photon_exit_image_is_binned_without_keeping_the_photons(self):
+        self.settings.get_optical_settings()[Tags.COMPUTE_PHOTON_EXIT_IMAGE] = True
+        results = MCXAdapterReflectance(self.settings).run_forward_model(_device=self.illumination_geometries,
+                                                                         device=self.illumination_geometries,
+                                                                         absorption=self.absorption,
+                                                                         scattering=self.scattering,
+                                                                         anisotropy=self.anisotropy)
+        expected_image = np.zeros((4, 5))
+        for source_position in self.source_positions:
+            photons = self.get_photons(source_position)
+            image, _, _ = np.histogram2d(photons[:, 0], photons[:, 1], bins=[np.arange(5), np.arange(6)])
+            expected_image += image / 1000 / len(self.source_positions)
+        np.testing.assert_allclose(results[Tags.DATA_FIELD_PHOTON_EXIT_IMAGE], expected_image)
+        self.assertNotIn(Tags.DATA_FIELD_PHOTON_EXIT_POS, results)
+        self.assertNotIn(Tags.DATA_FIELD_PHOTON_EXIT_DIR, results)
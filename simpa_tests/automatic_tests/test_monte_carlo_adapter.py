@@ -0,0 +1,249 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_horizontal_layer_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field
+from simpa import ModelBasedVolumeCreationAdapter, MonteCarloAdapter
+from simpa.core.device_digital_twins import PencilBeamIlluminationGeometry, DiskIlluminationGeometry, \
+    SlitIlluminationGeometry, GaussianBeamIlluminationGeometry, PhotoacousticDevice, LinearArrayDetectionGeometry
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_monte_carlo_adapter import \
+    propagate_photons, sample_photon_sources, scatter_photons, FluenceStatistics
+
+
+class TestMonteCarloAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.settings = Settings({
+            Tags.WAVELENGTHS: [800],
+            Tags.WAVELENGTH: 800,
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: "MonteCarloTest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 0.5,
+            Tags.DIM_VOLUME_X_MM: 5,
+            Tags.DIM_VOLUME_Y_MM: 5,
+            Tags.DIM_VOLUME_Z_MM: 5,
+            Tags.GPU: False
+        })
+        self.settings.set_volume_creation_settings({
+            Tags.STRUCTURES: {
+                "background": define_background_structure_settings(TISSUE_LIBRARY.constant(0.5, 50, 0.8)),
+                "layer": define_horizontal_layer_structure_settings(TISSUE_LIBRARY.constant(2, 100, 0.9),
+                                                                    z_start_mm=2, thickness_mm=1)
+            }
+        })
+        self.settings.set_optical_settings({
+            Tags.OPTICAL_MODEL_NUMBER_PHOTONS: 2000,
+            Tags.MONTE_CARLO_PHOTON_BATCH_SIZE: 500
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_pure_absorber_follows_the_beer_lambert_law(self):
+        random_generator = np.random.default_rng(0)
+        shape, spacing_mm, absorption_per_mm = (5, 5, 20), 0.5, 0.3
+        source = PencilBeamIlluminationGeometry(device_position_mm=np.array([1, 1, 0])).get_mcx_illuminator_definition(
+            Settings({Tags.SPACING_MM: spacing_mm}))
+        positions, directions = sample_photon_sources(source, 100, random_generator)
+        path_lengths = propagate_photons(np.full(shape, absorption_per_mm), np.zeros(shape), np.full(shape, 0.9),
+                                         positions, directions, random_generator, spacing_mm=spacing_mm)
+        path_lengths = path_lengths.reshape(shape) * spacing_mm / 100
+        depths_mm = np.arange(20) * spacing_mm
+        expected = np.exp(-absorption_per_mm * depths_mm) * (1 - np.exp(-absorption_per_mm * spacing_mm)) / \
+            absorption_per_mm
+        np.testing.assert_allclose(path_lengths[1, 1], expected, rtol=1e-10)
+        self.assertAlmostEqual(path_lengths.sum(), path_lengths[1, 1].sum())
+
+    def test_henyey_greenstein_scattering_preserves_the_mean_cosine(self):
+        random_generator = np.random.default_rng(0)
+        directions = random_generator.normal(size=(100000, 3))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        for anisotropy in [0, 0.5, 0.9, -0.3]:
+            new_directions = scatter_photons(directions, np.full(len(directions), anisotropy), random_generator)
+            np.testing.assert_allclose(np.linalg.norm(new_directions, axis=1), 1)
+            self.assertAlmostEqual(np.mean(np.sum(new_directions * directions, axis=1)), anisotropy, places=2)
+
+    def test_sources_follow_the_illumination_geometries(self):
+        random_generator = np.random.default_rng(0)
+        global_settings = Settings({Tags.SPACING_MM: 0.5})
+
+        source = DiskIlluminationGeometry(beam_radius_mm=2, device_position_mm=np.array([5, 5, 0])).\
+            get_mcx_illuminator_definition(global_settings)
+        positions, directions = sample_photon_sources(source, 10000, random_generator)
+        radii = np.linalg.norm(positions[:, :2] - 9.5, axis=1)
+        self.assertLessEqual(radii.max(), 4)
+        self.assertAlmostEqual(np.mean(radii < 2), 0.25, places=1)
+        np.testing.assert_array_equal(directions, np.tile([0, 0, 1], (10000, 1)))
+
+        source = GaussianBeamIlluminationGeometry(beam_radius_mm=1, device_position_mm=np.array([5, 5, 0])).\
+            get_mcx_illuminator_definition(global_settings)
+        positions, _ = sample_photon_sources(source, 10000, random_generator)
+        # the beam radius is the full width at half maximum of the intensity
+        self.assertAlmostEqual(np.median(np.linalg.norm(positions[:, :2] - 9.5, axis=1)), 1 / 0.5, places=1)
+
+        source = SlitIlluminationGeometry(slit_vector_mm=[4, 0, 0], device_position_mm=np.array([5, 5, 0])).\
+            get_mcx_illuminator_definition(global_settings)
+        positions, _ = sample_photon_sources(source, 10000, random_generator)
+        self.assertAlmostEqual(positions[:, 0].min(), 5.5, places=2)
+        self.assertAlmostEqual(positions[:, 0].max(), 13.5, places=2)
+        np.testing.assert_array_equal(positions[:, 1:], np.tile([9.5, -0.5], (10000, 1)))
+
+    def test_fluence_does_not_depend_on_the_number_of_workers(self):
+        simulate([ModelBasedVolumeCreationAdapter(self.settings)], self.settings, PencilBeamIlluminationGeometry())
+        absorption = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM, 800)
+        scattering = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_SCATTERING_PER_CM, 800)
+        anisotropy = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ANISOTROPY, 800)
+        illumination_geometry = PencilBeamIlluminationGeometry(device_position_mm=np.array([2.5, 2.5, 0]))
+
+        fluence = MonteCarloAdapter(self.settings).forward_model(absorption, scattering, anisotropy,
+                                                                 illumination_geometry)[Tags.DATA_FIELD_FLUENCE]
+        self.settings.get_optical_settings()[Tags.MONTE_CARLO_NUMBER_OF_WORKERS] = 2
+        parallel_fluence = MonteCarloAdapter(self.settings).forward_model(
+            absorption, scattering, anisotropy, illumination_geometry)[Tags.DATA_FIELD_FLUENCE]
+        np.testing.assert_array_equal(fluence, parallel_fluence)
+
+        self.settings.get_optical_settings()[Tags.MCX_SEED] = 1
+        other_fluence = MonteCarloAdapter(self.settings).forward_model(
+            absorption, scattering, anisotropy, illumination_geometry)[Tags.DATA_FIELD_FLUENCE]
+        self.assertFalse(np.array_equal(fluence, other_fluence))
+
+    def test_adaptive_mode_stops_once_the_target_error_is_reached(self):
+        simulate([ModelBasedVolumeCreationAdapter(self.settings)], self.settings, PencilBeamIlluminationGeometry())
+        absorption = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM, 800)
+        scattering = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_SCATTERING_PER_CM, 800)
+        anisotropy = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ANISOTROPY, 800)
+        illumination_geometry = PencilBeamIlluminationGeometry(device_position_mm=np.array([2.5, 2.5, 0]))
+        optical_settings = self.settings.get_optical_settings()
+        optical_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS] = 100000
+        optical_settings[Tags.MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR] = 0.1
+        optical_settings[Tags.MONTE_CARLO_CONVERGENCE_REGION_MM] = [1, 4, 1, 4, 0, 2]
+
+        results = MonteCarloAdapter(self.settings).forward_model(absorption, scattering, anisotropy,
+                                                                 illumination_geometry)
+        number_of_photons = int(results[Tags.DATA_FIELD_NUMBER_OF_PHOTONS])
+        self.assertLess(number_of_photons, 100000)
+        self.assertEqual(number_of_photons % 500, 0)
+
+        # the batches are the same as without the adaptive mode and do not depend on the number of workers
+        optical_settings[Tags.MONTE_CARLO_NUMBER_OF_WORKERS] = 2
+        parallel_results = MonteCarloAdapter(self.settings).forward_model(absorption, scattering, anisotropy,
+                                                                          illumination_geometry)
+        np.testing.assert_array_equal(results[Tags.DATA_FIELD_FLUENCE], parallel_results[Tags.DATA_FIELD_FLUENCE])
+        del optical_settings[Tags.MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR]
+        optical_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS] = number_of_photons
+        fixed_results = MonteCarloAdapter(self.settings).forward_model(absorption, scattering, anisotropy,
+                                                                       illumination_geometry)
+        np.testing.assert_array_equal(results[Tags.DATA_FIELD_FLUENCE], fixed_results[Tags.DATA_FIELD_FLUENCE])
+
+    def test_adaptive_results_are_cached_per_convergence_region(self):
+        simulate([ModelBasedVolumeCreationAdapter(self.settings)], self.settings, PencilBeamIlluminationGeometry())
+        absorption = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM, 800)
+        scattering = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_SCATTERING_PER_CM, 800)
+        anisotropy = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ANISOTROPY, 800)
+        cache_directory = os.path.join(self.output_directory, "cache")
+        optical_settings = self.settings.get_optical_settings()
+        optical_settings[Tags.OPTICAL_MODEL_NUMBER_PHOTONS] = 100000
+        optical_settings[Tags.MONTE_CARLO_TARGET_RELATIVE_STANDARD_ERROR] = 0.1
+        optical_settings[Tags.OPTICAL_MODEL_CACHE_DIRECTORY] = cache_directory
+
+        numbers_of_photons = []
+        # the convergence region is the field of view of the detection geometry, near the source or in the depth
+        for field_of_view_extent_mm in [[-1, 1, 0, 0, 0, 1], [-2, 2, 0, 0, 3, 5], [-1, 1, 0, 0, 0, 1]]:
+            device = PhotoacousticDevice(device_position_mm=np.array([2.5, 2.5, 0]))
+            device.set_detection_geometry(LinearArrayDetectionGeometry(
+                device_position_mm=np.array([2.5, 2.5, 0]), field_of_view_extent_mm=np.array(field_of_view_extent_mm)))
+            device.add_illumination_geometry(PencilBeamIlluminationGeometry())
+            results = MonteCarloAdapter(self.settings).run_forward_model(device.get_illumination_geometry(), device,
+                                                                         absorption, scattering, anisotropy)
+            numbers_of_photons.append(results[Tags.DATA_FIELD_NUMBER_OF_PHOTONS])
+        self.assertNotEqual(numbers_of_photons[0], numbers_of_photons[1])
+        self.assertEqual(numbers_of_photons[0], numbers_of_photons[2])
+        self.assertEqual(len(os.listdir(cache_directory)), 2)
+
+    def test_fluence_statistics_weigh_the_batches_by_their_number_of_photons(self):
+        random_generator = np.random.default_rng(0)
+        numbers_of_photons = [100, 100, 100, 50]
+        batch_fluences = [random_generator.uniform(1, 2, 10) for _ in numbers_of_photons]
+        statistics = FluenceStatistics()
+        for batch_fluence, number_of_photons in zip(batch_fluences, numbers_of_photons):
+            statistics.update(batch_fluence, number_of_photons)
+        mean = np.average(batch_fluences, axis=0, weights=numbers_of_photons)
+        sum_of_squared_deviations = np.sum(np.asarray(numbers_of_photons)[:, None] *
+                                           (np.asarray(batch_fluences) - mean) ** 2, axis=0)
+        np.testing.assert_allclose(statistics.mean, mean)
+        np.testing.assert_allclose(statistics.sum_of_squared_deviations, sum_of_squared_deviations)
+        expected = np.sum(np.sqrt(sum_of_squared_deviations / (3 * 350))) / np.sum(mean)
+        self.assertAlmostEqual(statistics.get_relative_standard_error(), expected)
+
+    def test_absorption_derivatives_agree_with_finite_differences(self):
+        random_generator = np.random.default_rng(0)
+        shape = (6, 6, 8)
+        absorption = random_generator.uniform(0.5, 3, shape)
+        scattering = random_generator.uniform(20, 60, shape)
+        anisotropy = np.full(shape, 0.8)
+        illumination_geometries = [PencilBeamIlluminationGeometry(device_position_mm=np.array([x, 1.5, 0]))
+                                   for x in [1, 2]]
+        perturbation = random_generator.normal(size=shape)
+        adapter = MonteCarloAdapter(self.settings)
+
+        fluence, (jacobian_vector_product, ), vector_jacobian_product = adapter.forward_model_absorption_derivatives(
+            absorption, scattering, anisotropy, illumination_geometries, [perturbation], adjoint=np.ones(shape))
+        expected_fluence = adapter.run_forward_model(illumination_geometries, illumination_geometries, absorption,
+                                                     scattering, anisotropy)[Tags.DATA_FIELD_FLUENCE]
+        np.testing.assert_allclose(fluence, expected_fluence, rtol=1e-5)
+
+        # with the same random streams, the photon paths do not depend on the absorption
+        epsilon = 1e-4
+        fluences = [adapter.forward_model_absorption_derivatives(absorption + sign * epsilon * perturbation,
+                                                                 scattering, anisotropy, illumination_geometries)[0]
+                    for sign in [1, -1]]
+        finite_difference = (fluences[0].astype(np.float64) - fluences[1]) / (2 * epsilon)
+        np.testing.assert_allclose(jacobian_vector_product, finite_difference, atol=1e-3 * np.abs(fluence).max())
+        self.assertAlmostEqual(np.sum(vector_jacobian_product * perturbation) / np.sum(jacobian_vector_product), 1,
+                               places=8)
+
+    def test_vector_jacobian_product_is_the_adjoint_of_the_jacobian_vector_product(self):
+        random_generator = np.random.default_rng(1)
+        shape = (5, 6, 7)
+        absorption = random_generator.uniform(0.5, 3, shape)
+        scattering = random_generator.uniform(20, 60, shape)
+        anisotropy = np.full(shape, 0.9)
+        illumination_geometries = [DiskIlluminationGeometry(beam_radius_mm=1, device_position_mm=np.array([1, 1.5, 0]))]
+        perturbations = [random_generator.normal(size=shape) for _ in range(2)]
+        adjoint = random_generator.normal(size=shape)
+        self.settings.get_optical_settings()[Tags.OPTICAL_MODEL_NUMBER_PHOTONS] = 1200
+
+        _, jacobian_vector_products, vector_jacobian_product = MonteCarloAdapter(
+            self.settings).forward_model_absorption_derivatives(absorption, scattering, anisotropy,
+                                                                illumination_geometries, perturbations, adjoint)
+        for perturbation, jacobian_vector_product in zip(perturbations, jacobian_vector_products):
+            self.assertAlmostEqual(np.sum(vector_jacobian_product * perturbation) /
+                                   np.sum(adjoint * jacobian_vector_product), 1, places=8)
+
+    def test_simulation_pipeline(self):
+        simulate([ModelBasedVolumeCreationAdapter(self.settings), MonteCarloAdapter(self.settings)], self.settings,
+                 PencilBeamIlluminationGeometry(device_position_mm=np.array([2.5, 2.5, 0])))
+        fluence = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_FLUENCE, 800)
+        initial_pressure = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_INITIAL_PRESSURE,
+                                           800)
+        absorption = load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_ABSORPTION_PER_CM, 800)
+        self.assertEqual(fluence.shape, (10, 10, 10))
+        self.assertTrue(np.all(fluence >= 0))
+        self.assertEqual(load_data_field(self.settings[Tags.SIMPA_OUTPUT_PATH], Tags.DATA_FIELD_NUMBER_OF_PHOTONS,
+                                         800), 2000)
+        np.testing.assert_allclose(initial_pressure, absorption * fluence, rtol=1e-5)
+        # the fluence decays with depth below the beam and the energy absorbed in the volume is below that of the beam
+        self.assertGreater(fluence[4, 4, 0], fluence[4, 4, 9])
+        self.assertLess(np.sum(absorption * fluence) * 0.05 ** 3, 1)
@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.calculate import downsample_volume, upsample_volume
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_horizontal_layer_structure_settings, define_circular_tubular_structure_settings, \
+    define_vessel_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field
+from simpa import ModelBasedVolumeCreationAdapter, SegmentationBasedVolumeCreationAdapter
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_test_adapter import \
+    OpticalForwardModelTestAdapter
+from simpa.core.device_digital_twins import RSOMExplorerP50
+
+
+class TestOpticalGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def get_settings(self, name, spacing_mm, optical_spacing_mm=None, compact=False):
+        settings = Settings({
+            Tags.WAVELENGTHS: [700, 800],
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: name,
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: spacing_mm,
+            Tags.DIM_VOLUME_X_MM: 6,
+            Tags.DIM_VOLUME_Y_MM: 4,
+            Tags.DIM_VOLUME_Z_MM: 5,
+            Tags.GPU: False
+        })
+        settings.set_volume_creation_settings({
+            Tags.COMPACT_VOLUME_REPRESENTATION: compact,
+            Tags.STRUCTURES: {
+                "background": define_background_structure_settings(TISSUE_LIBRARY.muscle()),
+                "layer": define_horizontal_layer_structure_settings(z_start_mm=0.8, thickness_mm=0.7,
+                                                                    molecular_composition=TISSUE_LIBRARY.epidermis(),
+                                                                    consider_partial_volume=True),
+                "vessel": define_circular_tubular_structure_settings([2.2, 0, 2.6], [2.2, 4, 2.6],
+                                                                     TISSUE_LIBRARY.blood(0.7), 0.9,
+                                                                     consider_partial_volume=True)
+            }
+        })
+        optical_settings = {Tags.OPTICAL_MODEL: Tags.OPTICAL_MODEL_TEST,
+                            Tags.ILLUMINATION_TYPE: Tags.ILLUMINATION_TYPE_PENCIL}
+        if optical_spacing_mm is not None:
+            optical_settings[Tags.SPACING_MM] = optical_spacing_mm
+        settings.set_optical_settings(optical_settings)
+        return settings
+
+    def test_structures_are_rasterised_on_the_optical_grid(self):
+        for compact in [False, True]:
+            settings = self.get_settings("OpticalGrid_" + str(compact), 0.25, 0.5, compact)
+            self.assertEqual(settings.get_optical_spacing_mm(), 0.5)
+            simulate([ModelBasedVolumeCreationAdapter(settings), OpticalForwardModelTestAdapter(settings)],
+                     settings, RSOMExplorerP50(0.1, 1, 1))
+            coarse_settings = self.get_settings("OpticalGrid_coarse", 0.5)
+            simulate([ModelBasedVolumeCreationAdapter(coarse_settings)], coarse_settings, RSOMExplorerP50(0.1, 1, 1))
+
+            file_path = settings[Tags.SIMPA_OUTPUT_PATH]
+            for wavelength in settings[Tags.WAVELENGTHS]:
+                optical_grid_volumes = load_data_field(file_path, Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES, wavelength)
+                for key in [Tags.DATA_FIELD_ABSORPTION_PER_CM, Tags.DATA_FIELD_SCATTERING_PER_CM,
+                            Tags.DATA_FIELD_ANISOTROPY]:
+                    self.assertEqual(optical_grid_volumes[key].shape, (12, 8, 10))
+                    np.testing.assert_allclose(optical_grid_volumes[key],
+                                               load_data_field(coarse_settings[Tags.SIMPA_OUTPUT_PATH], key,
+                                                               wavelength), rtol=1e-5)
+
+                absorption = load_data_field(file_path, Tags.DATA_FIELD_ABSORPTION_PER_CM, wavelength)
+                fluence = load_data_field(file_path, Tags.DATA_FIELD_FLUENCE, wavelength)
+                self.assertEqual(fluence.shape, absorption.shape)
+                coarse_fluence = optical_grid_volumes[Tags.DATA_FIELD_ABSORPTION_PER_CM] / (
+                    (1 - optical_grid_volumes[Tags.DATA_FIELD_ANISOTROPY]) *
+                    optical_grid_volumes[Tags.DATA_FIELD_SCATTERING_PER_CM])
+                np.testing.assert_allclose(fluence, upsample_volume(coarse_fluence, absorption.shape, 0.5, 0.25),
+                                           rtol=1e-5)
+                np.testing.assert_allclose(load_data_field(file_path, Tags.DATA_FIELD_INITIAL_PRESSURE, wavelength),
+                                           absorption * fluence, rtol=1e-5)
+
+    def test_vessel_trees_are_averaged_from_the_volume(self):
+        for compact in [False, True]:
+            settings = self.get_settings("OpticalGrid_vessel_" + str(compact), 0.25, 0.5, compact)
+            settings.get_volume_creation_settings()[Tags.STRUCTURES]["vessel_tree"] = define_vessel_structure_settings(
+                vessel_start_mm=[3, 0, 2.5], vessel_direction_mm=[0, 1, 0],
+                molecular_composition=TISSUE_LIBRARY.blood(), radius_mm=0.6, curvature_factor=0.2,
+                bifurcation_length_mm=1.5, priority=9, consider_partial_volume=True)
+            simulate([ModelBasedVolumeCreationAdapter(settings), OpticalForwardModelTestAdapter(settings)],
+                     settings, RSOMExplorerP50(0.1, 1, 1))
+
+            # the random walk of the vessel tree depends on the spacing, such that both grids have to share the tree
+            file_path = settings[Tags.SIMPA_OUTPUT_PATH]
+            for wavelength in settings[Tags.WAVELENGTHS]:
+                optical_grid_volumes = load_data_field(file_path, Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES, wavelength)
+                for key in [Tags.DATA_FIELD_ABSORPTION_PER_CM, Tags.DATA_FIELD_SCATTERING_PER_CM,
+                            Tags.DATA_FIELD_ANISOTROPY]:
+                    self.assertEqual(optical_grid_volumes[key].shape, (12, 8, 10))
+                    np.testing.assert_allclose(optical_grid_volumes[key],
+                                               downsample_volume(load_data_field(file_path, key, wavelength), 2,
+                                                                 (12, 8, 10)), rtol=1e-5)
+
+    def test_other_volume_creators_average_the_volume(self):
+        settings = self.get_settings("OpticalGrid_segmentation", 0.25, 0.75)
+        segmentation_volume = np.zeros((24, 16, 20), dtype=np.int32)
+        segmentation_volume[:, :, 5:9] = 1
+        segmentation_volume[7:12, :, 9:13] = 2
+        settings.set_volume_creation_settings({
+            Tags.INPUT_SEGMENTATION_VOLUME: segmentation_volume,
+            Tags.SEGMENTATION_CLASS_MAPPING: {0: TISSUE_LIBRARY.muscle(), 1: TISSUE_LIBRARY.epidermis(),
+                                              2: TISSUE_LIBRARY.blood(0.7)}
+        })
+        simulate([SegmentationBasedVolumeCreationAdapter(settings), OpticalForwardModelTestAdapter(settings)],
+                 settings, RSOMExplorerP50(0.1, 1, 1))
+
+        file_path = settings[Tags.SIMPA_OUTPUT_PATH]
+        absorption = load_data_field(file_path, Tags.DATA_FIELD_ABSORPTION_PER_CM, 800)
+        optical_grid_volumes = load_data_field(file_path, Tags.DATA_FIELD_OPTICAL_GRID_PROPERTIES, 800)
+        self.assertEqual(optical_grid_volumes[Tags.DATA_FIELD_ABSORPTION_PER_CM].shape, (8, 5, 7))
+        np.testing.assert_allclose(optical_grid_volumes[Tags.DATA_FIELD_ABSORPTION_PER_CM],
+                                   downsample_volume(absorption, 3, (8, 5, 7)))
+        self.assertEqual(load_data_field(file_path, Tags.DATA_FIELD_FLUENCE, 800).shape, absorption.shape)
+
+        settings = self.get_settings("OpticalGrid_invalid", 0.25, 0.6)
+        settings.set_volume_creation_settings({
+            Tags.INPUT_SEGMENTATION_VOLUME: segmentation_volume,
+            Tags.SEGMENTATION_CLASS_MAPPING: {0: TISSUE_LIBRARY.muscle(), 1: TISSUE_LIBRARY.epidermis(),
+                                              2: TISSUE_LIBRARY.blood(0.7)}
+        })
+        with self.assertRaises(ValueError):
+            simulate([SegmentationBasedVolumeCreationAdapter(settings)], settings, RSOMExplorerP50(0.1, 1, 1))
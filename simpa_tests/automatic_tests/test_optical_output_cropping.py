@@ -0,0 +1,144 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.libraries.structure_library import define_background_structure_settings, \
+    define_circular_tubular_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field, save_data_field, load_optical_output_in_volume
+from simpa.io_handling.io_hdf5 import contains_hdf5_path
+from simpa.utils.dict_path_manager import generate_dict_path
+from simpa import ModelBasedVolumeCreationAdapter, FieldOfViewCropping, IterativeqPAI
+from simpa.core.simulation_modules.optical_simulation_module.optical_forward_model_test_adapter import \
+    OpticalForwardModelTestAdapter
+from simpa.core.device_digital_twins import PhotoacousticDevice, LinearArrayDetectionGeometry, \
+    PencilBeamIlluminationGeometry
+
+
+class TestOpticalOutputCropping(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.device = PhotoacousticDevice(device_position_mm=np.array([3, 2, 0]))
+        self.device.set_detection_geometry(LinearArrayDetectionGeometry(
+            device_position_mm=np.array([3, 2, 0]), number_detector_elements=6,
+            field_of_view_extent_mm=np.array([-1.5, 1.5, 0, 0, 0, 3])))
+        self.device.add_illumination_geometry(PencilBeamIlluminationGeometry())
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def simulate(self, name, crop_to_field_of_view, processing_components=(), padding_mm=0.5):
+        settings = Settings({
+            Tags.WAVELENGTHS: [800],
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: name,
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 0.25,
+            Tags.DIM_VOLUME_X_MM: 6,
+            Tags.DIM_VOLUME_Y_MM: 4,
+            Tags.DIM_VOLUME_Z_MM: 5,
+            Tags.GPU: False
+        })
+        settings.set_volume_creation_settings({
+            Tags.STRUCTURES: {
+                "background": define_background_structure_settings(TISSUE_LIBRARY.muscle()),
+                "vessel": define_circular_tubular_structure_settings([2.2, 0, 2.6], [2.2, 4, 2.6],
+                                                                     TISSUE_LIBRARY.blood(0.7), 0.9)
+            }
+        })
+        settings.set_optical_settings({
+            Tags.OPTICAL_MODEL: Tags.OPTICAL_MODEL_TEST,
+            Tags.LASER_PULSE_ENERGY_IN_MILLIJOULE: 20,
+            Tags.OPTICAL_MODEL_CROP_TO_FIELD_OF_VIEW: crop_to_field_of_view,
+            Tags.OPTICAL_MODEL_FIELD_OF_VIEW_PADDING_MM: padding_mm
+        })
+        pipeline = [ModelBasedVolumeCreationAdapter(settings), OpticalForwardModelTestAdapter(settings)]
+        simulate(pipeline + [component(settings) for component in processing_components], settings, self.device)
+        self.settings = settings
+        return settings[Tags.SIMPA_OUTPUT_PATH]
+
+    def test_optical_output_is_stored_within_the_padded_field_of_view(self):
+        full_file_path = self.simulate("Full", False)
+        cropped_file_path = self.simulate("Cropped", True)
+        self.assertFalse(contains_hdf5_path(full_file_path,
+                                            generate_dict_path(Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, 800)))
+        # the field of view from x = 1.5 to 4.5 mm, at y = 2 mm and from z = 0 to 3 mm is padded by 2 voxels
+        np.testing.assert_array_equal(load_data_field(cropped_file_path, Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, 800),
+                                      [4, 6, 0])
+        region = np.s_[4:20, 6:11, 0:14]
+        for data_field in [Tags.DATA_FIELD_FLUENCE, Tags.DATA_FIELD_INITIAL_PRESSURE]:
+            full_output = load_data_field(full_file_path, data_field, 800)
+            cropped_output = load_data_field(cropped_file_path, data_field, 800)
+            self.assertEqual(full_output.shape, (24, 16, 20))
+            np.testing.assert_array_equal(cropped_output, full_output[region])
+
+            placed_output = load_optical_output_in_volume(cropped_file_path, data_field, (24, 16, 20), 800)
+            np.testing.assert_array_equal(placed_output[region], full_output[region])
+            placed_output[region] = 0
+            self.assertFalse(np.any(placed_output))
+            np.testing.assert_array_equal(load_optical_output_in_volume(full_file_path, data_field, (24, 16, 20),
+                                                                        800), full_output)
+
+    def test_field_of_view_cropping_accounts_for_the_offset(self):
+        full_file_path = self.simulate("Full", False, [FieldOfViewCropping])
+        cropped_file_path = self.simulate("Cropped", True, [FieldOfViewCropping])
+        for data_field in [Tags.DATA_FIELD_FLUENCE, Tags.DATA_FIELD_INITIAL_PRESSURE]:
+            full_output = load_data_field(full_file_path, data_field, 800)
+            self.assertEqual(full_output.shape, (12, 12))
+            np.testing.assert_array_equal(load_data_field(cropped_file_path, data_field, 800), full_output)
+        # the cropped data fields share the field of view, such that the offset is obsolete
+        self.assertFalse(contains_hdf5_path(cropped_file_path,
+                                            generate_dict_path(Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, 800)))
+
+    def test_iterative_qpai_inputs_after_field_of_view_cropping(self):
+        initial_data = []
+        for name, crop_to_field_of_view in [("Full", False), ("Cropped", True)]:
+            self.simulate(name, crop_to_field_of_view, [FieldOfViewCropping])
+            self.settings["iterative_qpai_reconstruction"] = {}
+            initial_data.append(IterativeqPAI(self.settings, "iterative_qpai_reconstruction")
+                                .extract_initial_data_from_hdf5())
+        for full_input, cropped_input in zip(*initial_data):
+            self.assertEqual(full_input.shape, (12, 12))
+            np.testing.assert_array_equal(cropped_input, full_input)
+
+    def test_unpadded_three_dimensional_field_of_view(self):
+        self.device = PhotoacousticDevice(device_position_mm=np.array([3, 2, 0]))
+        self.device.set_detection_geometry(LinearArrayDetectionGeometry(
+            device_position_mm=np.array([3, 2, 0]), number_detector_elements=6,
+            field_of_view_extent_mm=np.array([-1.5, 1.5, -1, 1, 0, 3])))
+        self.device.add_illumination_geometry(PencilBeamIlluminationGeometry())
+        initial_data = []
+        for name, crop_to_field_of_view in [("Full", False), ("Cropped", True)]:
+            # the optical output is already stored with the shape of the field of view
+            file_path = self.simulate(name, crop_to_field_of_view, [FieldOfViewCropping], padding_mm=0)
+            self.assertFalse(contains_hdf5_path(file_path,
+                                                generate_dict_path(Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, 800)))
+            self.settings["iterative_qpai_reconstruction"] = {}
+            initial_data.append(IterativeqPAI(self.settings, "iterative_qpai_reconstruction")
+                                .extract_initial_data_from_hdf5())
+        for full_input, cropped_input in zip(*initial_data):
+            self.assertEqual(full_input.shape, (12, 8, 12))
+            np.testing.assert_array_equal(cropped_input, full_input)
+
+    def test_optical_output_must_fit_into_the_volume(self):
+        file_path = self.simulate("Cropped", True)
+        with self.assertRaises(ValueError):
+            load_optical_output_in_volume(file_path, Tags.DATA_FIELD_FLUENCE, (12, 12), 800)
+        with self.assertRaises(ValueError):
+            load_optical_output_in_volume(file_path, Tags.DATA_FIELD_FLUENCE, (18, 16, 20), 800)
+        save_data_field(np.asarray([9, 6, 0]), file_path, Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, 800)
+        with self.assertRaises(ValueError):
+            load_optical_output_in_volume(file_path, Tags.DATA_FIELD_FLUENCE, (24, 16, 20), 800)
+
+    def test_whole_volume_is_stored_without_detection_geometry(self):
+        self.device = PencilBeamIlluminationGeometry(device_position_mm=np.array([3, 2, 0]))
+        file_path = self.simulate("IlluminationOnly", True)
+        self.assertEqual(load_data_field(file_path, Tags.DATA_FIELD_FLUENCE, 800).shape, (24, 16, 20))
+        self.assertFalse(contains_hdf5_path(file_path, generate_dict_path(Tags.DATA_FIELD_OPTICAL_OUTPUT_OFFSET, 800)))
@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.compact_volume import COMPACT_VOLUME_LABELS, COMPACT_VOLUME_FRACTIONS
+from simpa.utils.libraries.structure_library import define_background_structure_settings
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field
+from simpa import ModelBasedVolumeCreationAdapter
+from simpa.core.device_digital_twins import RSOMExplorerP50
+from simpa.core.simulation_modules.volume_creation_module.phantom_sampler import PhantomSampler, \
+    StructureDistribution, UniformDistribution, UniformIntegerDistribution, NormalDistribution, ChoiceDistribution
+
+
+class TestPhantomSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.settings = Settings({
+            Tags.WAVELENGTHS: [700, 800],
+            Tags.VOLUME_NAME: "PhantomSamplerTest",
+            Tags.SIMULATION_PATH: self.output_directory,
+            Tags.SPACING_MM: 0.5,
+            Tags.DIM_VOLUME_X_MM: 8,
+            Tags.DIM_VOLUME_Y_MM: 6,
+            Tags.DIM_VOLUME_Z_MM: 8,
+            Tags.GPU: False
+        })
+        self.settings.set_volume_creation_settings({})
+        self.structure_distributions = {
+            "background": define_background_structure_settings(TISSUE_LIBRARY.constant(0.1, 100, 0.9)),
+            "layer": StructureDistribution({
+                Tags.PRIORITY: 5,
+                Tags.STRUCTURE_START_MM: [0, 0, UniformDistribution(1, 2)],
+                Tags.STRUCTURE_END_MM: [0, 0, UniformDistribution(2.5, 3.5)],
+                Tags.MOLECULE_COMPOSITION: TISSUE_LIBRARY.epidermis(),
+                Tags.CONSIDER_PARTIAL_VOLUME: True,
+                Tags.STRUCTURE_TYPE: Tags.HORIZONTAL_LAYER_STRUCTURE
+            }),
+            "tube": StructureDistribution({
+                Tags.PRIORITY: 10,
+                Tags.STRUCTURE_START_MM: [UniformDistribution(2, 6), 0, UniformDistribution(3, 6)],
+                Tags.STRUCTURE_END_MM: [UniformDistribution(2, 6), 6, UniformDistribution(3, 6)],
+                Tags.STRUCTURE_RADIUS_MM: NormalDistribution(1, 0.3, minimum=0.5, maximum=1.5),
+                Tags.MOLECULE_COMPOSITION: ChoiceDistribution([TISSUE_LIBRARY.blood(0.6),
+                                                               TISSUE_LIBRARY.blood(0.9)]),
+                Tags.CONSIDER_PARTIAL_VOLUME: True,
+                Tags.STRUCTURE_TYPE: Tags.CIRCULAR_TUBULAR_STRUCTURE
+            }, number_of_structures=UniformIntegerDistribution(1, 3)),
+            "vessel": StructureDistribution({
+                Tags.PRIORITY: 9,
+                Tags.STRUCTURE_START_MM: [UniformDistribution(2, 6), 0, UniformDistribution(4, 6)],
+                Tags.STRUCTURE_DIRECTION: [0, 1, 0],
+                Tags.STRUCTURE_RADIUS_MM: 0.5,
+                Tags.STRUCTURE_CURVATURE_FACTOR: 0.1,
+                Tags.STRUCTURE_RADIUS_VARIATION_FACTOR: 0.5,
+                Tags.STRUCTURE_BIFURCATION_LENGTH_MM: 3,
+                Tags.MOLECULE_COMPOSITION: TISSUE_LIBRARY.blood(0.8),
+                Tags.CONSIDER_PARTIAL_VOLUME: True,
+                Tags.STRUCTURE_TYPE: Tags.VESSEL_STRUCTURE
+            })
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def assert_equal_phantoms(self, phantom, other_phantom):
+        compact_volume = phantom[Tags.SIMULATIONS][Tags.SIMULATION_PROPERTIES][Tags.DATA_FIELD_COMPACT_VOLUME]
+        other_compact_volume = other_phantom[Tags.SIMULATIONS][Tags.SIMULATION_PROPERTIES][
+            Tags.DATA_FIELD_COMPACT_VOLUME]
+        np.testing.assert_array_equal(compact_volume[COMPACT_VOLUME_LABELS],
+                                      other_compact_volume[COMPACT_VOLUME_LABELS])
+        np.testing.assert_array_equal(compact_volume[COMPACT_VOLUME_FRACTIONS],
+                                      other_compact_volume[COMPACT_VOLUME_FRACTIONS])
+        property_tables = phantom[Tags.SIMULATIONS][Tags.SIMULATION_PROPERTIES][Tags.DATA_FIELD_PROPERTY_TABLE]
+        other_property_tables = other_phantom[Tags.SIMULATIONS][Tags.SIMULATION_PROPERTIES][
+            Tags.DATA_FIELD_PROPERTY_TABLE]
+        for wavelength in self.settings[Tags.WAVELENGTHS]:
+            np.testing.assert_array_equal(property_tables[wavelength][Tags.DATA_FIELD_ABSORPTION_PER_CM],
+                                          other_property_tables[wavelength][Tags.DATA_FIELD_ABSORPTION_PER_CM])
+
+    def test_phantoms_are_reproducible_and_independent(self):
+        sampler = PhantomSampler(self.settings, self.structure_distributions, random_seed=42)
+        self.assert_equal_phantoms(sampler.create_phantom(3), sampler.create_phantom(3))
+
+        structures = sampler.get_phantom_settings(3).get_volume_creation_settings()[Tags.STRUCTURES]
+        other_structures = sampler.get_phantom_settings(4).get_volume_creation_settings()[Tags.STRUCTURES]
+        self.assertIn("background", structures)
+        self.assertIn("tube_0", structures)
+        self.assertNotEqual(structures["layer"][Tags.STRUCTURE_START_MM],
+                            other_structures["layer"][Tags.STRUCTURE_START_MM])
+
+        other_sampler = PhantomSampler(self.settings, self.structure_distributions, random_seed=43)
+        self.assertNotEqual(structures["layer"][Tags.STRUCTURE_START_MM],
+                            other_sampler.get_phantom_settings(3).get_volume_creation_settings()[Tags.STRUCTURES][
+                                "layer"][Tags.STRUCTURE_START_MM])
+
+    def test_phantoms_do_not_depend_on_the_number_of_workers(self):
+        serial_phantoms = list(PhantomSampler(self.settings, self.structure_distributions,
+                                              random_seed=42).generate(3))
+        parallel_phantoms = list(PhantomSampler(self.settings, self.structure_distributions, random_seed=42,
+                                                number_of_workers=2).generate(3))
+        self.assertEqual(len(parallel_phantoms), 3)
+        for serial_phantom, parallel_phantom in zip(serial_phantoms, parallel_phantoms):
+            self.assert_equal_phantoms(serial_phantom, parallel_phantom)
+
+    def test_written_phantom_matches_the_simulation_pipeline(self):
+        sampler = PhantomSampler(self.settings, self.structure_distributions, random_seed=42)
+        file_paths = list(sampler.generate(2, output_directory=self.output_directory, first_phantom_index=5))
+        self.assertEqual(os.path.basename(file_paths[1]), "PhantomSamplerTest_000006.hdf5")
+
+        phantom_settings = sampler.get_phantom_settings(6)
+        phantom_settings[Tags.VOLUME_NAME] = "PhantomSamplerTest_pipeline"
+        simulate([ModelBasedVolumeCreationAdapter(phantom_settings)], phantom_settings, RSOMExplorerP50(0.1, 1, 1))
+
+        for data_field, wavelength in [(Tags.DATA_FIELD_ABSORPTION_PER_CM, 800),
+                                       (Tags.DATA_FIELD_SCATTERING_PER_CM, 700),
+                                       (Tags.DATA_FIELD_SEGMENTATION, None)]:
+            np.testing.assert_allclose(load_data_field(file_paths[1], data_field, wavelength),
+                                       load_data_field(phantom_settings[Tags.SIMPA_OUTPUT_PATH], data_field,
+                                                       wavelength), rtol=1e-6, atol=1e-6)
@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import unittest
+import h5py
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.settings import Settings
+from simpa.utils.tissue_properties import TissueProperties
+from simpa.core.simulation import simulate
+from simpa.io_handling import load_data_field, load_hdf5
+from simpa import SegmentationBasedVolumeCreationAdapter
+from simpa.core.simulation_modules.volume_creation_module import \
+    volume_creation_module_segmentation_based_adapter as segmentation_based_adapter
+from simpa.core.device_digital_twins import RSOMExplorerP50
+
+
+class TestSegmentationBasedVolumeCreation(unittest.TestCase):
+
+    def setUp(self):
+        self.wavelengths = [700, 800]
+        self.output_paths = []
+        self.segmentation_volume = np.zeros((8, 6, 10), dtype=np.int32)
+        self.segmentation_volume[:, :, 3:] = 1
+        self.segmentation_volume[2:5, :, 5:8] = 3
+        self.class_mapping = {
+            0: TISSUE_LIBRARY.heavy_water(),
+            1: TISSUE_LIBRARY.epidermis(),
+            2: TISSUE_LIBRARY.muscle(),
+            3: TISSUE_LIBRARY.blood(0.8)
+        }
+
+    def tearDown(self):
+        for output_path in self.output_paths:
+            if os.path.exists(output_path) and os.path.isfile(output_path):
+                os.remove(output_path)
+
+    def simulate_volume(self, segmentation_volume, compact: bool = False, segmentation_settings: dict = None) -> str:
+        settings = Settings({
+            Tags.WAVELENGTHS: self.wavelengths,
+            Tags.RANDOM_SEED: 4711,
+            Tags.VOLUME_NAME: "SegmentationBasedVolumeTest_" + str(compact),
+            Tags.SIMULATION_PATH: ".",
+            Tags.SPACING_MM: 0.5,
+            Tags.DIM_VOLUME_X_MM: 4,
+            Tags.DIM_VOLUME_Y_MM: 3,
+            Tags.DIM_VOLUME_Z_MM: 5
+        })
+        if segmentation_settings is None:
+            segmentation_settings = {Tags.INPUT_SEGMENTATION_VOLUME: segmentation_volume}
+        settings.set_volume_creation_settings({
+            Tags.SEGMENTATION_CLASS_MAPPING: self.class_mapping,
+            Tags.COMPACT_VOLUME_REPRESENTATION: compact,
+            **segmentation_settings
+        })
+        self.output_paths.append("./" + settings[Tags.VOLUME_NAME] + ".hdf5")
+        simulate([SegmentationBasedVolumeCreationAdapter(settings)], settings, RSOMExplorerP50(0.1, 1, 1))
+        return settings[Tags.SIMPA_OUTPUT_PATH]
+
+    def reference_volume(self, property_tag, wavelength):
+        volume = np.zeros(np.shape(self.segmentation_volume))
+        for seg_class in np.unique(self.segmentation_volume):
+            value = self.class_mapping[seg_class].get_properties_for_wavelength(wavelength)[property_tag]
+            volume[self.segmentation_volume == seg_class] = value
+        return volume
+
+    def test_volumes_match_class_mapping(self):
+        file_path = self.simulate_volume(self.segmentation_volume)
+        for wavelength in self.wavelengths:
+            for property_tag in TissueProperties.property_tags:
+                np.testing.assert_allclose(load_data_field(file_path, property_tag, wavelength),
+                                           self.reference_volume(property_tag, wavelength))
+        self.assertTrue(np.issubdtype(load_data_field(file_path, Tags.DATA_FIELD_SEGMENTATION).dtype, np.integer))
+
+    def test_compact_volume_matches_dense_volumes(self):
+        file_path = self.simulate_volume(self.segmentation_volume, compact=True)
+        self.assertEqual(np.shape(load_data_field(file_path, Tags.DATA_FIELD_COMPACT_VOLUME)["labels"])[3], 1)
+        for wavelength in self.wavelengths:
+            for property_tag in TissueProperties.property_tags:
+                np.testing.assert_allclose(load_data_field(file_path, property_tag, wavelength),
+                                           self.reference_volume(property_tag, wavelength))
+
+    def test_non_integer_classes(self):
+        self.class_mapping = {float(seg_class): composition for seg_class, composition in self.class_mapping.items()}
+        file_path = self.simulate_volume(self.segmentation_volume.astype(float))
+        np.testing.assert_allclose(load_data_field(file_path, Tags.DATA_FIELD_ABSORPTION_PER_CM, 700),
+                                   self.reference_volume(Tags.DATA_FIELD_ABSORPTION_PER_CM, 700))
+
+    def test_slab_wise_labels_with_negative_classes(self):
+        slab_size = segmentation_based_adapter.SEGMENTATION_SLAB_SIZE_VOXELS
+        segmentation_based_adapter.SEGMENTATION_SLAB_SIZE_VOXELS = 60
+        try:
+            self.segmentation_volume[6:, :, :] = -1
+            self.class_mapping[-1] = TISSUE_LIBRARY.muscle()
+            file_path = self.simulate_volume(self.segmentation_volume)
+        finally:
+            segmentation_based_adapter.SEGMENTATION_SLAB_SIZE_VOXELS = slab_size
+        for property_tag in TissueProperties.property_tags:
+            np.testing.assert_allclose(load_data_field(file_path, property_tag, 700),
+                                       self.reference_volume(property_tag, 700))
+
+    def test_unmapped_class_raises_key_error(self):
+        self.segmentation_volume[0, 0, 0] = 7
+        with self.assertRaises(KeyError):
+            self.simulate_volume(self.segmentation_volume)
+
+    def assert_segmentation_reference_matches(self, segmentation_settings: dict):
+        file_path = self.simulate_volume(None, segmentation_settings=segmentation_settings)
+        self.assertNotIn(Tags.INPUT_SEGMENTATION_VOLUME[0],
+                         load_hdf5(file_path, "/settings/")[Tags.VOLUME_CREATION_MODEL_SETTINGS])
+        for property_tag in TissueProperties.property_tags:
+            np.testing.assert_allclose(load_data_field(file_path, property_tag, 800),
+                                       self.reference_volume(property_tag, 800))
+
+    def test_segmentation_reference_npy(self):
+        self.output_paths.append("./segmentation_reference.npy")
+        np.save(self.output_paths[-1], self.segmentation_volume)
+        self.assert_segmentation_reference_matches({Tags.INPUT_SEGMENTATION_VOLUME_PATH: self.output_paths[-1]})
+
+    def test_segmentation_reference_hdf5(self):
+        self.output_paths.append("./segmentation_reference.hdf5")
+        with h5py.File(self.output_paths[-1], "w") as h5file:
+            h5file.create_dataset("labels/segmentation", data=self.segmentation_volume)
+        self.assert_segmentation_reference_matches({Tags.INPUT_SEGMENTATION_VOLUME_PATH: self.output_paths[-1],
+                                                    Tags.INPUT_SEGMENTATION_VOLUME_DATASET: "labels/segmentation"})
+
+    def test_segmentation_reference_raw(self):
+        self.output_paths.append("./segmentation_reference.raw")
+        self.segmentation_volume.astype(np.uint8).tofile(self.output_paths[-1])
+        self.assert_segmentation_reference_matches({Tags.INPUT_SEGMENTATION_VOLUME_PATH: self.output_paths[-1],
+                                                    Tags.INPUT_SEGMENTATION_VOLUME_SHAPE: [8, 6, 10],
+                                                    Tags.INPUT_SEGMENTATION_VOLUME_DTYPE: "uint8"})
@@ -0,0 +1,75 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils import Tags
+from simpa.utils.tissue_properties import TissueProperties
+from simpa.core.simulation_modules.volume_creation_module.structure_merger import StructureMerger
+
+
+class TestStructureMerger(unittest.TestCase):
+
+    def setUp(self):
+        self.dimensions = (4, 3, 5)
+        self.rng = np.random.default_rng(4711)
+
+    @staticmethod
+    def create_properties(mua, segmentation):
+        properties = TissueProperties()
+        properties[Tags.DATA_FIELD_ABSORPTION_PER_CM] = mua
+        properties[Tags.DATA_FIELD_SEGMENTATION] = segmentation
+        return properties
+
+    def reference_merge(self, structures):
+        global_volume_fractions = np.zeros(self.dimensions)
+        max_added_fractions = np.zeros(self.dimensions)
+        absorption = np.zeros(self.dimensions)
+        segmentation = np.zeros(self.dimensions)
+        for fractions, properties in structures:
+            mask = (fractions > 0) & (global_volume_fractions < 1)
+            added = np.zeros(self.dimensions)
+            added[mask] = np.minimum(fractions[mask], 1 - global_volume_fractions[mask])
+            global_volume_fractions += added
+            if properties[Tags.DATA_FIELD_ABSORPTION_PER_CM] is not None:
+                absorption += added * properties[Tags.DATA_FIELD_ABSORPTION_PER_CM]
+            if properties[Tags.DATA_FIELD_SEGMENTATION] is not None:
+                dominant = added > max_added_fractions
+                max_added_fractions[dominant] = added[dominant]
+                segmentation[dominant] = properties[Tags.DATA_FIELD_SEGMENTATION]
+        return absorption, segmentation
+
+    def test_merge_matches_reference(self):
+        structures = list()
+        for structure_index in range(5):
+            fractions = self.rng.random(self.dimensions)
+            fractions[fractions < 0.4] = 0
+            segmentation = None if structure_index == 2 else structure_index + 1
+            structures.append((fractions, self.create_properties(self.rng.random(), segmentation)))
+        structures[3][1][Tags.DATA_FIELD_ABSORPTION_PER_CM] = None
+
+        merger = StructureMerger(self.dimensions)
+        for fractions, properties in structures:
+            merger.add_structure(fractions, properties)
+        volumes = merger.get_property_volumes([Tags.DATA_FIELD_ABSORPTION_PER_CM, Tags.DATA_FIELD_SEGMENTATION])
+
+        reference_absorption, reference_segmentation = self.reference_merge(structures)
+        self.assertEqual(merger.number_of_structures, 5)
+        np.testing.assert_allclose(volumes[Tags.DATA_FIELD_ABSORPTION_PER_CM].numpy(), reference_absorption,
+                                   rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(volumes[Tags.DATA_FIELD_SEGMENTATION].numpy(), reference_segmentation)
+
+    def test_higher_priority_structure_claims_voxels_first(self):
+        merger = StructureMerger(self.dimensions)
+        merger.add_structure(np.ones(self.dimensions), self.create_properties(2, 1))
+        merger.add_structure(np.ones(self.dimensions), self.create_properties(5, 2))
+        volumes = merger.get_property_volumes([Tags.DATA_FIELD_ABSORPTION_PER_CM, Tags.DATA_FIELD_SEGMENTATION])
+        self.assertTrue(np.all(volumes[Tags.DATA_FIELD_ABSORPTION_PER_CM].numpy() == 2))
+        self.assertTrue(np.all(volumes[Tags.DATA_FIELD_SEGMENTATION].numpy() == 1))
+
+    def test_empty_merger_returns_zero_volumes(self):
+        volumes = StructureMerger(self.dimensions).get_property_volumes(TissueProperties.property_tags)
+        for property_tag in TissueProperties.property_tags:
+            self.assertEqual(tuple(volumes[property_tag].shape), self.dimensions)
+            self.assertEqual(float(volumes[property_tag].abs().sum()), 0)
@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils import Tags, TISSUE_LIBRARY
+from simpa.utils.tissue_properties import TissueProperties
+
+
+class TestCompiledComposition(unittest.TestCase):
+
+    def setUp(self):
+        self.wavelengths = np.asarray([700, 750, 800, 950])
+
+    def test_property_table_matches_molecule_sums(self):
+        for molecular_composition in [TISSUE_LIBRARY.muscle(), TISSUE_LIBRARY.blood(0.7), TISSUE_LIBRARY.epidermis()]:
+            table = molecular_composition.get_property_table(self.wavelengths)
+            self.assertEqual(table.shape, (len(self.wavelengths), len(TissueProperties.property_tags)))
+            for wavelength_index, wavelength in enumerate(self.wavelengths):
+                expected_absorption = sum(molecule.volume_fraction * molecule.spectrum.get_value_for_wavelength(
+                    wavelength) for molecule in molecular_composition)
+                expected_scattering = sum(molecule.volume_fraction *
+                                          molecule.scattering_spectrum.get_value_for_wavelength(wavelength)
+                                          for molecule in molecular_composition)
+                self.assertAlmostEqual(table[wavelength_index, TissueProperties.property_tags.index(
+                    Tags.DATA_FIELD_ABSORPTION_PER_CM)], expected_absorption)
+                self.assertAlmostEqual(table[wavelength_index, TissueProperties.property_tags.index(
+                    Tags.DATA_FIELD_SCATTERING_PER_CM)], expected_scattering)
+
+                properties = molecular_composition.get_properties_for_wavelength(wavelength)
+                for property_index, property_tag in enumerate(TissueProperties.property_tags):
+                    expected_value = 0 if properties[property_tag] is None else properties[property_tag]
+                    self.assertAlmostEqual(table[wavelength_index, property_index], expected_value)
+
+    def test_compiled_composition_is_memoised_until_the_composition_changes(self):
+        molecular_composition = TISSUE_LIBRARY.blood(0.5)
+        compiled_composition = molecular_composition.compile()
+        self.assertIs(molecular_composition.compile(), compiled_composition)
+        self.assertAlmostEqual(molecular_composition.get_properties_for_wavelength(800)[Tags.DATA_FIELD_OXYGENATION],
+                               0.5)
+
+        hemoglobin_fraction = molecular_composition[0].volume_fraction + molecular_composition[1].volume_fraction
+        molecular_composition[0].volume_fraction = hemoglobin_fraction
+        molecular_composition[1].volume_fraction = 0.0
+        self.assertIsNot(molecular_composition.compile(), compiled_composition)
+        self.assertIn(molecular_composition.get_properties_for_wavelength(800)[Tags.DATA_FIELD_OXYGENATION],
+                      [0.0, 1.0])
+
+    def test_properties_for_different_wavelengths_are_independent(self):
+        molecular_composition = TISSUE_LIBRARY.blood(0.7)
+        properties_700 = molecular_composition.get_properties_for_wavelength(700)
+        properties_900 = molecular_composition.get_properties_for_wavelength(900)
+        self.assertNotEqual(properties_700[Tags.DATA_FIELD_ABSORPTION_PER_CM],
+                            properties_900[Tags.DATA_FIELD_ABSORPTION_PER_CM])
+        self.assertEqual(properties_700.volume_fraction, properties_900.volume_fraction)
+
+    def test_invalid_volume_fractions_raise(self):
+        molecular_composition = TISSUE_LIBRARY.muscle()
+        molecular_composition[0].volume_fraction += 0.5
+        with self.assertRaises(AssertionError):
+            molecular_composition.get_property_table(self.wavelengths)
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils import Spectrum, AbsorptionSpectrumLibrary, get_values_for_wavelengths
+
+
+class TestSpectrumInterpolation(unittest.TestCase):
+
+    def setUp(self):
+        self.spectrum = Spectrum("test", np.asarray([500, 700, 600]), np.asarray([1.0, 5.0, 3.0]))
+
+    def test_float_and_array_wavelengths(self):
+        self.assertIsInstance(self.spectrum.get_value_for_wavelength(550), float)
+        self.assertAlmostEqual(self.spectrum.get_value_for_wavelength(550), 2.0)
+        self.assertAlmostEqual(self.spectrum.get_value_for_wavelength(612.5), 3.25)
+        self.assertAlmostEqual(self.spectrum.get_value_for_wavelength(700), 5.0)
+        np.testing.assert_allclose(self.spectrum.get_value_for_wavelength(np.asarray([[500.0, 650.5], [700, 600]])),
+                                   [[1.0, 4.01], [5.0, 3.0]])
+        self.assertFalse(hasattr(self.spectrum, "new_absorptions"))
+
+    def test_wavelengths_outside_of_the_spectrum_raise(self):
+        with self.assertRaises(ValueError):
+            self.spectrum.get_value_for_wavelength(499.5)
+        with self.assertRaises(ValueError):
+            self.spectrum.get_value_for_wavelength([600, 701])
+        with self.assertRaises(ValueError):
+            get_values_for_wavelengths([self.spectrum], [450])
+
+    def test_bulk_evaluation_matches_single_spectra(self):
+        library = AbsorptionSpectrumLibrary()
+        spectra = [library.get_spectrum_by_name(name) for name in ["Water", "Oxyhemoglobin", "Deoxyhemoglobin",
+                                                                   "Fat", "Melanin"]]
+        spectra += [self.spectrum, Spectrum("constant", np.asarray([600, 700]), np.asarray([2.0, 2.0]))]
+        wavelengths = np.linspace(600, 700, 17)
+        values = get_values_for_wavelengths(spectra, wavelengths)
+        self.assertEqual(values.shape, (len(spectra), len(wavelengths)))
+        for spectrum, spectrum_values in zip(spectra, values):
+            np.testing.assert_allclose(spectrum_values, spectrum.get_value_for_wavelength(wavelengths), rtol=1e-12)
+        np.testing.assert_allclose(get_values_for_wavelengths(spectra, 650.25)[:, None],
+                                   get_values_for_wavelengths(spectra, [650.25]))
@@ -0,0 +1,55 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simpa.utils import AbsorptionSpectrumLibrary, ScatteringSpectrumLibrary
+from simpa.utils import SpectrumRegistry, get_spectrum_registry, set_spectrum_registry
+from simpa.utils.libraries.spectrum_library import PACKED_SPECTRA_FILE_NAME
+
+
+class TestSpectrumRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_path = tempfile.mkdtemp()
+        np.savez(os.path.join(self.folder_path, "First.npz"), wavelengths=np.asarray([450, 600, 1000]),
+                 values=np.asarray([1.0, 2.0, 3.0]))
+        np.savez(os.path.join(self.folder_path, "Second.npz"), wavelengths=np.asarray([500, 1000]),
+                 values=np.asarray([4.0, 5.0]))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder_path, ignore_errors=True)
+
+    def test_spectra_are_shared_between_libraries(self):
+        self.assertIs(AbsorptionSpectrumLibrary().get_spectrum_by_name("Water"),
+                      AbsorptionSpectrumLibrary().get_spectrum_by_name("Water"))
+        self.assertIs(ScatteringSpectrumLibrary().get_spectrum_by_name("blood_scattering"),
+                      ScatteringSpectrumLibrary().get_spectrum_by_name("blood_scattering"))
+
+    def test_registry_lookup(self):
+        registry = SpectrumRegistry.from_folder(self.folder_path)
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.get_index("Second"), 1)
+        spectrum = registry.get_spectrum_by_name("First")
+        np.testing.assert_array_equal(spectrum.values, [1.0, 2.0, 3.0])
+        self.assertAlmostEqual(spectrum.get_value_for_wavelength(525), 1.5)
+        with self.assertRaises(ValueError):
+            spectrum.values[0] = 0
+        with self.assertRaises(LookupError):
+            registry.get_spectrum_by_name("Third")
+
+    def test_packed_registry_is_memory_mapped(self):
+        SpectrumRegistry.from_folder(self.folder_path).save(os.path.join(self.folder_path, PACKED_SPECTRA_FILE_NAME))
+        registry = get_spectrum_registry(self.folder_path)
+        self.assertIsInstance(registry.values, np.memmap)
+        self.assertIs(get_spectrum_registry(self.folder_path), registry)
+        np.testing.assert_array_equal(registry.get_spectrum_by_name("Second").wavelengths, [500, 1000])
+        np.testing.assert_array_equal(registry.get_spectrum_by_name("Second").values, [4.0, 5.0])
+
+        in_memory_registry = SpectrumRegistry.from_folder(self.folder_path)
+        set_spectrum_registry(self.folder_path, in_memory_registry)
+        self.assertIs(get_spectrum_registry(self.folder_path), in_memory_registry)
@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2021 Division of Intelligent Medical Systems, DKFZ
+# SPDX-FileCopyrightText: 2021 Janek Groehl
+# SPDX-License-Identifier: MIT
+
+import unittest
+import numpy as np
+from simpa.utils import TISSUE_LIBRARY, MOLECULE_LIBRARY, MolecularCompositionGenerator, SegmentationClasses
+from simpa.utils import AbsorptionSpectrumLibrary, Tags
+from simpa.utils.libraries.tissue_library import TissuePreset
+
+
+class TestTissuePresets(unittest.TestCase):
+
+    def setUp(self):
+        self.wavelengths = np.arange(700, 951, 10)
+
+    def test_mixed_variants_match_newly_created_compositions(self):
+        for blood_volume_fraction, oxygenation in [(0.002, 0.5), (0.05, 0.9), (0.2, 0.0)]:
+            fraction_oxy = blood_volume_fraction * oxygenation
+            fraction_deoxy = blood_volume_fraction * (1 - oxygenation)
+            expected_composition = (MolecularCompositionGenerator()
+                                    .append(MOLECULE_LIBRARY.oxyhemoglobin(fraction_oxy))
+                                    .append(MOLECULE_LIBRARY.deoxyhemoglobin(fraction_deoxy))
+                                    .append(MOLECULE_LIBRARY.dermal_scatterer(1.0 - blood_volume_fraction))
+                                    .get_molecular_composition(SegmentationClasses.DERMIS))
+            composition = TISSUE_LIBRARY.dermis(oxygenation, blood_volume_fraction)
+            self.assertEqual([molecule.volume_fraction for molecule in composition],
+                             [molecule.volume_fraction for molecule in expected_composition])
+            np.testing.assert_allclose(composition.get_property_table(self.wavelengths),
+                                       expected_composition.get_property_table(self.wavelengths), rtol=1e-12)
+            self.assertAlmostEqual(composition.get_properties_for_wavelength(800)[Tags.DATA_FIELD_OXYGENATION],
+                                   oxygenation)
+
+    def test_variants_are_independent_and_share_the_evaluated_spectra(self):
+        composition = TISSUE_LIBRARY.muscle()
+        other_composition = TISSUE_LIBRARY.muscle(0.9, 0.1)
+        self.assertIsNot(composition[0], other_composition[0])
+        self.assertIs(composition[0].spectrum, other_composition[0].spectrum)
+        self.assertEqual(composition[3].speed_of_sound, other_composition[3].speed_of_sound)
+
+        composition.get_property_table(self.wavelengths)
+        self.assertIs(composition.compile().get_stacked_spectra(self.wavelengths),
+                      other_composition.compile().get_stacked_spectra(self.wavelengths))
+
+        TISSUE_LIBRARY.muscle()[0].volume_fraction = 0.5
+        self.assertNotEqual(TISSUE_LIBRARY.muscle()[0].volume_fraction, 0.5)
+
+        other_composition[2].spectrum = AbsorptionSpectrumLibrary.CONSTANT_ABSORBER_ARBITRARY(1.0)
+        absorption = other_composition.get_property_table(self.wavelengths)[:, 0]
+        self.assertIsNot(other_composition.compile().get_stacked_spectra(self.wavelengths),
+                         composition.compile().get_stacked_spectra(self.wavelengths))
+        np.testing.assert_allclose(absorption - TISSUE_LIBRARY.muscle(0.9, 0.1).get_property_table(
+            self.wavelengths)[:, 0], other_composition[2].volume_fraction, rtol=1e-10)
+
+    def test_presets_validate_and_serialize(self):
+        preset = TissuePreset(TISSUE_LIBRARY.blood(0.5))
+        with self.assertRaises(ValueError):
+            preset.get_molecular_composition([1.0])
+        with self.assertRaises(AssertionError):
+            preset.get_molecular_composition([0.3, 0.3]).get_property_table(self.wavelengths)
+
+        self.assertNotIn("endmembers", TISSUE_LIBRARY.blood(0.7).serialize()["MolecularComposition"]["dict_items"])